@@ -0,0 +1,29 @@
+# Command line entry point for offline batch scoring
+import os
+import json
+import argparse
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+from src.config import Settings
+from src.service.batch_runner import BatchRunner, discover_jobs, EXECUTORS
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Score many OSW datasets in parallel, outside the queue.')
+    parser.add_argument('input', help='Directory of dataset zips, or a JSON manifest')
+    parser.add_argument('--output', required=True, help='Folder for results, checkpoints and the summary')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='Datasets scored at a time')
+    parser.add_argument('--executor', choices=EXECUTORS, default='process')
+    args = parser.parse_args(argv)
+
+    jobs = discover_jobs(args.input)
+    runner = BatchRunner(jobs, output_dir=args.output, workers=args.workers, executor=args.executor,
+                         settings=Settings())
+    summary = runner.run()
+    print(json.dumps(summary, indent=2))
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
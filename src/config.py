@@ -15,6 +15,73 @@ class Settings(BaseSettings):
     password: str = os.environ.get('OSM_PASSWORD', '')
     simulate: str = os.environ.get('SIMULATE_METRIC', '')  # For simulation
     max_concurrent_messages: int = os.environ.get('MAX_CONCURRENT_MESSAGES', 1)
+    service_mode: str = os.environ.get('SERVICE_MODE', 'threads')  # threads | async
+    async_io_workers: int = os.environ.get('ASYNC_IO_WORKERS', 64)  # Threads for downloads and publishes
+    async_cpu_workers: int = os.environ.get('ASYNC_CPU_WORKERS', 0)  # Threads for hull and scoring, 0 uses the CPUs
+    osm_backend: str = os.environ.get('OSM_BACKEND', 'api')  # api | extract
+    osm_history_extract: str = os.environ.get('OSM_HISTORY_EXTRACT', '')  # Comma separated .osh/.osc/.pbf paths
+    osm_extract_tile_zoom: int = os.environ.get('OSM_EXTRACT_TILE_ZOOM', 14)
+    osm_api_rate_limit: float = os.environ.get('OSM_API_RATE_LIMIT', 2.0)  # Initial requests per second
+    osm_api_max_rate_limit: float = os.environ.get('OSM_API_MAX_RATE_LIMIT', 20.0)
+    osm_api_max_concurrency: int = os.environ.get('OSM_API_MAX_CONCURRENCY', 8)
+    osm_api_latency_target: float = os.environ.get('OSM_API_LATENCY_TARGET', 2.0)  # Seconds
+    osm_api_max_retries: int = os.environ.get('OSM_API_MAX_RETRIES', 5)
+    osm_api_pool_size: int = os.environ.get('OSM_API_POOL_SIZE', 16)
+    osm_api_limiter_file: str = os.environ.get('OSM_API_LIMITER_FILE', '')  # Empty uses <tmp>/osw-confidence
+    osm_cache_folder: str = os.environ.get('OSM_CACHE_FOLDER', '')  # Empty uses <tmp>/osw-confidence/osm-cache
+    osm_cache_ttl: float = os.environ.get('OSM_CACHE_TTL', 86400)  # Seconds, 0 disables the cache
+    osm_cache_max_mb: float = os.environ.get('OSM_CACHE_MAX_MB', 1024)  # Size of each OSM cache, 0 no limit
+    small_job_cost: float = os.environ.get('SMALL_JOB_COST', 50)  # Jobs up to this cost use the fast lane
+    fast_lane_size: int = os.environ.get('FAST_LANE_SIZE', 0)  # 0 uses MAX_CONCURRENT_MESSAGES
+    slow_lane_size: int = os.environ.get('SLOW_LANE_SIZE', 1)
+    job_cost_budget: float = os.environ.get('JOB_COST_BUDGET', 0)  # 0 disables rejection
+    checkpoint_store: str = os.environ.get('CHECKPOINT_STORE', 'local')  # local | blob | none
+    checkpoint_flush_every: int = os.environ.get('CHECKPOINT_FLUSH_EVERY', 25)
+    checkpoint_flush_interval: float = os.environ.get('CHECKPOINT_FLUSH_INTERVAL', 30)  # Seconds
+    checkpoint_retention: float = os.environ.get('CHECKPOINT_RETENTION', 604800)  # Seconds failed checkpoints are kept
+    idempotency_store: str = os.environ.get('IDEMPOTENCY_STORE', 'local')  # local | blob | none
+    idempotency_ttl: float = os.environ.get('IDEMPOTENCY_TTL', 86400)  # Seconds a completed job is replayed
+    idempotency_stale_after: float = os.environ.get('IDEMPOTENCY_STALE_AFTER', 300)  # Seconds without heartbeat
+    idempotency_poll_interval: float = os.environ.get('IDEMPOTENCY_POLL_INTERVAL', 10)
+    idempotency_retention: float = os.environ.get('IDEMPOTENCY_RETENTION', 0)  # Seconds, 0 uses IDEMPOTENCY_TTL
+    shard_size: int = os.environ.get('SHARD_SIZE', 0)  # Sub-regions per shard, 0 disables sharding
+    shard_store: str = os.environ.get('SHARD_STORE', 'blob')  # blob | local
+    worker_processes: int = os.environ.get('WORKER_PROCESSES', 0)  # 0 scores in the service process
+    worker_max_jobs: int = os.environ.get('WORKER_MAX_JOBS', 20)  # Jobs before a worker is replaced, 0 no limit
+    worker_max_rss_mb: float = os.environ.get('WORKER_MAX_RSS_MB', 2048)  # Worker memory limit, 0 no limit
+    progress_every: int = os.environ.get('PROGRESS_EVERY', 50)  # Sub-regions between interim responses
+    progress_interval: float = os.environ.get('PROGRESS_INTERVAL', 60)  # Seconds between interim responses
+    repair_sub_regions: bool = os.environ.get('REPAIR_SUB_REGIONS', False)  # make_valid invalid sub-regions
+    simplify_tolerance: float = os.environ.get('SIMPLIFY_TOLERANCE', 0)  # Metres, 0 disables simplification
+    footprint_mode: str = os.environ.get('FOOTPRINT_MODE', 'convex')  # convex | clustered
+    footprint_cell_size: float = os.environ.get('FOOTPRINT_CELL_SIZE', 500)  # Metres, clustered footprint grid
+    sub_region_scoring: str = os.environ.get('SUB_REGION_SCORING', 'analyzer')  # analyzer | index
+    sub_region_order: str = os.environ.get('SUB_REGION_ORDER', 'hilbert')  # hilbert | zorder | file
+    anytime_initial_sample: int = os.environ.get('ANYTIME_INITIAL_SAMPLE', 16)  # Tiles in the first estimate
+    anytime_target_error: float = os.environ.get('ANYTIME_TARGET_ERROR', 0)  # 0 refines until the deadline
+    job_timeout: float = os.environ.get('JOB_TIMEOUT', 0)  # Seconds per job, 0 disables
+    download_timeout: float = os.environ.get('DOWNLOAD_TIMEOUT', 0)  # Seconds per stage, 0 disables
+    hull_timeout: float = os.environ.get('HULL_TIMEOUT', 0)
+    sub_region_timeout: float = os.environ.get('SUB_REGION_TIMEOUT', 0)  # Seconds per sub-region
+    grid_timeout: float = os.environ.get('GRID_TIMEOUT', 0)
+    response_format: str = os.environ.get('RESPONSE_FORMAT', 'full')  # full | scores, per request with response_format
+    coordinate_precision: int = os.environ.get('COORDINATE_PRECISION', -1)  # Decimal places returned, -1 keeps all
+    disk_quota_mb: float = os.environ.get('DISK_QUOTA_MB', 0)  # Space all job workspaces may reserve, 0 disables
+    disk_min_free_mb: float = os.environ.get('DISK_MIN_FREE_MB', 0)  # Space kept free on the downloads disk
+    disk_wait_timeout: float = os.environ.get('DISK_WAIT_TIMEOUT', 300)  # Seconds a job waits for disk space
+    workspace_expansion_factor: float = os.environ.get('WORKSPACE_EXPANSION_FACTOR', 4)  # Workspace size per zip byte
+    memory_workspace_folder: str = os.environ.get('MEMORY_WORKSPACE_FOLDER', '')  # e.g. /dev/shm, empty disables
+    memory_workspace_max_job_mb: float = os.environ.get('MEMORY_WORKSPACE_MAX_JOB_MB', 0)
+    dataset_cache_mb: float = os.environ.get('DATASET_CACHE_MB', 0)  # Cached downloaded datasets, 0 disables
+    dataset_cache_folder: str = os.environ.get('DATASET_CACHE_FOLDER', '')  # Empty uses src/dataset_cache
+    profile_jobs: bool = os.environ.get('PROFILE_JOBS', False)  # Profile every job, not only flagged ones
+    profile_store: str = os.environ.get('PROFILE_STORE', 'local')  # local | blob
+    profile_top: int = os.environ.get('PROFILE_TOP', 30)  # Functions and allocation sites in the report
+    profile_retention: float = os.environ.get('PROFILE_RETENTION', 604800)  # Seconds local profiles are kept
+    http_max_concurrent: int = os.environ.get('HTTP_MAX_CONCURRENT', 2)  # Inline scoring requests at a time
+    http_timeout: float = os.environ.get('HTTP_TIMEOUT', 60)  # Seconds per inline scoring request
+    http_max_features: int = os.environ.get('HTTP_MAX_FEATURES', 100)
+    http_stream_threshold: int = os.environ.get('HTTP_STREAM_THRESHOLD', 10)  # Larger inputs stream NDJSON
 
     def get_download_folder(self) -> str:
         root_dir = os.path.dirname(os.path.abspath(__file__))
@@ -0,0 +1,29 @@
+# Command line entry point for the end-to-end load test
+import json
+import argparse
+import warnings
+from dataclasses import asdict
+warnings.simplefilter(action='ignore', category=FutureWarning)
+from src.service.load_harness import LoadHarness, parse_mix
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Load-test the confidence service on in-memory queue, storage and OSM.')
+    parser.add_argument('--messages', type=int, default=50, help='Requests to send')
+    parser.add_argument('--rate', type=float, default=1.0, help='Mean arrivals per second, 0 sends all at once')
+    parser.add_argument('--mix', default='small=0.7,medium=0.25,large=0.05', help='Weights of the job sizes')
+    parser.add_argument('--osm-latency', type=float, default=0.05, help='Mean seconds per simulated OSM call')
+    parser.add_argument('--concurrency', type=int, default=2, help='MAX_CONCURRENT_MESSAGES of the service')
+    parser.add_argument('--timeout', type=float, default=3600, help='Seconds to wait for the last response')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    harness = LoadHarness(messages=args.messages, rate=args.rate, mix=parse_mix(args.mix),
+                          osm_latency=args.osm_latency, concurrency=args.concurrency, seed=args.seed)
+    report = harness.run(timeout=args.timeout)
+    print(json.dumps(asdict(report), indent=2))
+    return 0 if report.completed == report.sent else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
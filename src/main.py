@@ -1,17 +1,23 @@
 import os
+import asyncio
 import psutil
 from src.config import Settings
 from functools import lru_cache
-from fastapi import FastAPI, APIRouter, Depends, status
+from fastapi import FastAPI, APIRouter, Body, Depends, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 from src.service.osw_confidence_service import OSWConfidenceService
+from src.service.inline_scoring import InlineRequestError, ScoringBusyError
+from src.service.job_cancellation import JobTimeoutError
+from src.service.job_workspace import DiskQuotaExceededError
 
 app = FastAPI()
 app.confidence_service = None
 
 prefix_router = APIRouter(prefix='/health')
+admin_router = APIRouter(prefix='/admin')
 
 
 @lru_cache()
@@ -23,7 +29,7 @@ def get_settings():
 async def startup_event(settings: Settings = Depends(get_settings)) -> None:
     print('\n Service has started up')
     try:
-        app.confidence_service = OSWConfidenceService()
+        app.confidence_service = OSWConfidenceService(loop=asyncio.get_running_loop())
     except Exception as e:
         print('Killing the service')
         print(e)
@@ -40,4 +46,55 @@ def health_check():
     return "I'm healthy !!"
 
 
+@prefix_router.get('/disk', status_code=status.HTTP_200_OK)
+def disk_usage():
+    if app.confidence_service is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Service is not running')
+    return app.confidence_service.workspaces.usage()
+
+
+@prefix_router.get('/cache', status_code=status.HTTP_200_OK)
+def dataset_cache_stats():
+    if app.confidence_service is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Service is not running')
+    return app.confidence_service.dataset_cache.stats()
+
+
+@prefix_router.get('/workers', status_code=status.HTTP_200_OK)
+def worker_pool_stats():
+    if app.confidence_service is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Service is not running')
+    if app.confidence_service.workers is None:
+        return {'size': 0}
+    return app.confidence_service.workers.stats()
+
+
+@app.post('/confidence', status_code=status.HTTP_200_OK)
+def score_confidence(request: Request, payload: dict = Body(...)):
+    if app.confidence_service is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='Service is not running')
+    inline = app.confidence_service.inline
+    try:
+        features = inline.parse(payload)
+        if inline.should_stream(features) or 'application/x-ndjson' in request.headers.get('accept', ''):
+            return StreamingResponse(inline.stream(features), media_type='application/x-ndjson')
+        return inline.score(features)
+    except InlineRequestError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except ScoringBusyError as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
+    except DiskQuotaExceededError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    except JobTimeoutError as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=str(e))
+
+
+@admin_router.post('/jobs/{job_id}/cancel', status_code=status.HTTP_202_ACCEPTED)
+def cancel_job(job_id: str):
+    if app.confidence_service is None or not app.confidence_service.cancel_job(job_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Job {job_id} is not running')
+    return {'jobId': job_id, 'status': 'cancelling'}
+
+
 app.include_router(prefix_router)
+app.include_router(admin_router)
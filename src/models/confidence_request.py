@@ -9,6 +9,13 @@ class RequestData:
     meta_file: str
     trigger_type: str
     sub_regions_file: Optional[str] = None
+    progressive: Optional[bool] = False
+    grid_cell_size: Optional[float] = None
+    deadline_seconds: Optional[float] = None
+    profile: Optional[bool] = False
+    response_format: Optional[str] = None
+    coordinate_precision: Optional[int] = None
+    shard: Optional[dict] = None
 
 
 @dataclass
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional
 
 
 @dataclass
@@ -9,6 +10,7 @@ class ResponseData:
     status: str
     message: str
     success: bool
+    progress: Optional[float] = None
 
 @dataclass
 class ConfidenceResponse:
@@ -0,0 +1,138 @@
+# Deadline-aware area scoring: a sampled estimate first, refined until the deadline or convergence
+import math
+import time
+import logging
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+import pandas as pd
+import dask_geopandas
+import geopandas as gpd
+from osw_confidence_metric.area_analyzer import AreaAnalyzer, _get_threshold_values, _initialize_columns
+from osw_confidence_metric.utils import compute_feature_indirect_trust, calculate_overall_trust_score
+
+logging.basicConfig()
+logger = logging.getLogger('AnytimeAreaAnalyzer')
+logger.setLevel(logging.INFO)
+
+# Two-sided 95% normal quantile used for the reported error
+Z_95 = 1.96
+
+
+@dataclass
+class AreaScoreEstimate:
+    """
+    Confidence score of an area estimated from a random sample of its tiles.
+
+    Attributes:
+    - `score` (float): Mean trust score of the sampled tiles.
+    - `error` (float): Half-width of the 95% confidence interval of `score`; 0 once every tile is scored.
+    - `sampled` (int): Tiles scored.
+    - `total` (int): Tiles in the area.
+    """
+    score: float = 0.0
+    error: float = 0.0
+    sampled: int = 0
+    total: int = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.sampled >= self.total
+
+
+def estimate_from_tiles(scored: gpd.GeoDataFrame, total: int) -> AreaScoreEstimate:
+    """
+    Scores the sampled tiles the way `AreaAnalyzer` scores all of them, and derives the sampling error with
+    the finite population correction, so the error reaches 0 when the sample is the whole area.
+    """
+    if scored.empty:
+        return AreaScoreEstimate(total=total)
+    threshold_values = _get_threshold_values(gdf=scored)
+    indirect = scored.apply(lambda x: compute_feature_indirect_trust(feature=x, thresholds=threshold_values), axis=1)
+    trust = scored.assign(indirect_trust_score=indirect) \
+        .apply(lambda x: calculate_overall_trust_score(feature=x), axis=1).to_numpy(dtype=float)
+
+    sampled = len(trust)
+    error = 0.0
+    if 1 < sampled < total:
+        correction = math.sqrt((total - sampled) / (total - 1))
+        error = Z_95 * float(np.std(trust, ddof=1)) / math.sqrt(sampled) * correction
+    return AreaScoreEstimate(score=float(trust.mean()), error=error, sampled=sampled, total=total)
+
+
+class AnytimeAreaAnalyzer(AreaAnalyzer):
+    """
+    `AreaAnalyzer` that scores the tiles of an area in random batches and stops at a deadline.
+
+    The first batch gives a quick estimate with its error; each following batch is twice as large and refines
+    it, until every tile is scored, the deadline passes, or the error drops below `target_error`.
+
+    Parameters:
+    - `osm_data_handler`: Backend providing element histories.
+    - `initial_sample` (int): Tiles in the first batch.
+    - `target_error` (float): Stops once the 95% error is at most this value; 0 refines until the deadline.
+    - `seed` (int): Seed of the tile sampling order.
+
+    Usage:
+    ```python
+    analyzer = AnytimeAreaAnalyzer(osm_data_handler=backend)
+    estimate = analyzer.estimate_area_confidence_score(file_path=hull_file, deadline=time.monotonic() + 60)
+    ```
+    """
+
+    def __init__(self, osm_data_handler, initial_sample: int = 16, target_error: float = 0.0,
+                 seed: Optional[int] = None):
+        super().__init__(osm_data_handler=osm_data_handler)
+        self.initial_sample = max(2, int(initial_sample))
+        self.target_error = float(target_error)
+        self.seed = seed
+
+    def estimate_area_confidence_score(self, file_path: str, deadline: float, cancellation=None) -> AreaScoreEstimate:
+        """
+        Parameters:
+        - `file_path` (str): GeoJSON file of the area.
+        - `deadline` (float): `time.monotonic()` value after which no further batch is started.
+        - `cancellation` (CancellationToken): Optional token checked before every batch.
+
+        Returns:
+        - `estimate` (AreaScoreEstimate): The latest estimate; the first batch is always scored.
+        """
+        self.gdf = gpd.read_file(file_path)
+        self._create_tiling_if_needed()
+        if self.gdf is None:
+            return AreaScoreEstimate(score=0, total=0)
+
+        tiles = _initialize_columns(gdf=self.gdf).sample(frac=1, random_state=self.seed)
+        total = len(tiles)
+        scored = []
+        estimate = AreaScoreEstimate(total=total)
+        batch_size = self.initial_sample
+        while estimate.sampled < total:
+            if cancellation is not None:
+                cancellation.check()
+            batch = tiles.iloc[estimate.sampled:estimate.sampled + batch_size]
+            scored.append(self._score_tiles(batch))
+            estimate = estimate_from_tiles(pd.concat(scored), total)
+            logger.info('Scored %d of %d tiles: %.3f +/- %.3f', estimate.sampled, total, estimate.score,
+                        estimate.error)
+            if time.monotonic() >= deadline or (self.target_error > 0 and estimate.error <= self.target_error):
+                break
+            batch_size *= 2
+        return estimate
+
+    def _score_tiles(self, tiles: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        df_dask = dask_geopandas.from_geopandas(tiles, npartitions=min(16, len(tiles)), name='measures')
+        return df_dask.apply(
+            self._process_feature,
+            axis=1,
+            meta=gpd.GeoDataFrame(
+                {
+                    'geometry': 'geometry',
+                    'direct_confirmations': 'object',
+                    'direct_trust_score': 'object',
+                    'time_trust_score': 'object',
+                    'indirect_values': 'object'
+                },
+                index=[0]
+            )
+        ).compute(scheduler='multiprocessing')
@@ -0,0 +1,140 @@
+# Asyncio service path: queued jobs as coroutines, with blocking work on executors
+import os
+import asyncio
+import logging
+import threading
+from contextlib import ExitStack
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+from src.models.confidence_request import ConfidenceRequest
+from src.service.job_profiler import profiled
+
+logging.basicConfig()
+logger = logging.getLogger('AsyncPipeline')
+logger.setLevel(logging.INFO)
+
+T = TypeVar('T')
+
+
+class AsyncJobPipeline:
+    """
+    Runs queued confidence jobs as coroutines on one event loop, so the number of jobs in flight is not tied to
+    the number of threads doing work.
+
+    The stages of a job are the same as on the threaded path, `OSWConfidenceService.calculate_confidence`. Stages
+    that wait on the network, the blob size lookup, the downloads, the checkpoint load, the cleanup and the response
+    publish, are awaited on a large I/O executor; the storage and queue clients are synchronous, so each in-flight
+    call still holds an I/O thread, but nothing else does. A job waits for its scheduler slot on the event loop
+    itself. Extracting the dataset, computing its hull and scoring run on a small CPU executor, which only takes
+    jobs that hold a slot, so how many jobs score at a time is still decided by the scheduler's lanes.
+
+    The OSM fetches are made by the metric library from inside the scoring, through its synchronous OSM backend,
+    so they hold the scoring job's CPU thread rather than being awaited. The queue client delivers messages to a
+    callback and settles each one when the callback returns, so each received message waits in `process` for its
+    coroutine; those waits are cheap, which lets `MAX_CONCURRENT_MESSAGES` be raised to hundreds.
+
+    Parameters:
+    - `service` (OSWConfidenceService): The service whose job stages are run.
+    - `loop` (AbstractEventLoop): Event loop to run on, such as the FastAPI one; without one the pipeline runs
+            its own loop on a daemon thread.
+    - `io_workers` (int): Threads for the I/O stages.
+    - `cpu_workers` (int): Threads for the hull and scoring stages; 0 uses the number of CPUs.
+
+    Usage:
+    ```python
+    pipeline = AsyncJobPipeline(service, loop=asyncio.get_running_loop())
+    pipeline.submit(request).result()
+    ```
+    """
+
+    def __init__(self, service, loop: Optional[asyncio.AbstractEventLoop] = None, io_workers: int = 64,
+                 cpu_workers: int = 0):
+        self.service = service
+        self.io_executor = ThreadPoolExecutor(max_workers=max(1, int(io_workers)), thread_name_prefix='job-io')
+        self.cpu_executor = ThreadPoolExecutor(max_workers=max(1, int(cpu_workers) or os.cpu_count() or 1),
+                                               thread_name_prefix='job-cpu')
+        self.own_loop = loop is None
+        self.loop = loop or asyncio.new_event_loop()
+        self.loop_thread = None
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        if self.own_loop:
+            self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True, name='job-loop')
+            self.loop_thread.start()
+
+    @classmethod
+    def from_settings(cls, service, settings, loop: Optional[asyncio.AbstractEventLoop] = None) -> 'AsyncJobPipeline':
+        return cls(service, loop=loop, io_workers=int(settings.async_io_workers),
+                   cpu_workers=int(settings.async_cpu_workers))
+
+    def submit(self, request: ConfidenceRequest) -> Future:
+        """
+        Schedules the job on the event loop from any thread and returns a future of the finished `ConfidenceJob`.
+        """
+        return asyncio.run_coroutine_threadsafe(self.calculate_confidence(request), self.loop)
+
+    async def io(self, fn: Callable[[], T]) -> T:
+        return await self.loop.run_in_executor(self.io_executor, fn)
+
+    async def cpu(self, fn: Callable[[], T]) -> T:
+        return await self.loop.run_in_executor(self.cpu_executor, fn)
+
+    async def calculate_confidence(self, request: ConfidenceRequest):
+        """
+        Coroutine counterpart of `OSWConfidenceService.calculate_confidence`.
+        """
+        service = self.service
+        with self.lock:
+            self.in_flight += 1
+        job = service.start_job(request)
+        try:
+            if not service.settings.is_simulated():
+                await self.io(lambda: service.admit_job(job))
+                with job.token.stage('download', timeout=float(service.settings.download_timeout)):
+                    await job.token.run_async(profiled(job.profiler, lambda: service.download_job_inputs(job)),
+                                              executor=self.io_executor)
+                await self.io(lambda: service.prepare_job(job))
+                if service.workers is not None:
+                    # The worker process does the CPU work; this thread only waits for it
+                    await self.io(lambda: service.score_job_in_worker(job))
+                else:
+                    job.metric = await job.token.run_async(
+                        profiled(job.profiler, lambda: service.create_calculator(job)), executor=self.cpu_executor)
+                    await self.score_job(job)
+            else:  # Simulated
+                service.simulate_job(job)
+        except Exception as e:
+            service.fail_job(job, e)
+        finally:
+            await self.io(lambda: service.close_job(job))
+            with self.lock:
+                self.in_flight -= 1
+        await self.io(lambda: service.publish_job_result(job))
+        return job
+
+    async def score_job(self, job) -> None:
+        """
+        Coroutine counterpart of `OSWConfidenceService.score_job`: the job waits for its scheduler slot on the event
+        loop, and only the hull and the scoring hold a CPU thread.
+        """
+        service = self.service
+        estimate = await job.token.run_async(profiled(job.profiler, lambda: service.start_scoring(job)),
+                                             executor=self.cpu_executor)
+        slot = ExitStack()
+        slot.callback(await service.scheduler.acquire_async(estimate, job_id=job.job_id, check=job.token.check))
+        try:
+            job.scores = await job.token.run_async(
+                profiled(job.profiler, lambda: service.calculate_job_scores(job)), executor=self.cpu_executor)
+        finally:
+            # A cancelled calculation runs on until its next check, and keeps its slot until it has stopped
+            job.token.when_stopped(slot.close)
+        await self.io(lambda: service.finish_scoring(job))
+
+    def stop(self) -> None:
+        """
+        Stops the pipeline's own event loop and its executors; jobs still running are not waited for.
+        """
+        if self.own_loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.io_executor.shutdown(wait=False)
+        self.cpu_executor.shutdown(wait=False)
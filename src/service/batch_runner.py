@@ -0,0 +1,248 @@
+# Offline batch scoring of many datasets, for backfills outside the queue
+import os
+import json
+import time
+import logging
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import List, Optional
+from src.service.helper import clean_up
+from src.service.job_checkpoint import JobCheckpoint, LocalCheckpointStore
+from src.service.osm_session import DEFAULT_LIMITER_FILE
+from src.service.osm_data_backend import DEFAULT_CACHE_FOLDER
+from src.service.osw_confidence_metric_calculator import OSWConfidenceMetricCalculator
+
+logging.basicConfig()
+logger = logging.getLogger('BatchRunner')
+logger.setLevel(logging.INFO)
+
+EXECUTORS = ('process', 'thread')
+SUB_REGION_SUFFIXES = ('_subregions.geojson', '_sub_regions.geojson', '.geojson')
+
+
+@dataclass
+class BatchJob:
+    """
+    One dataset of a batch.
+
+    Attributes:
+    - `job_id` (str): Identifier used for the result file and the checkpoint.
+    - `zip_file` (str): The OSW dataset zip.
+    - `sub_regions_file` (str): Optional sub-regions GeoJSON.
+    - `grid_cell_size` (float): Optional grid cell size in metres.
+    """
+    job_id: str
+    zip_file: str
+    sub_regions_file: Optional[str] = None
+    grid_cell_size: Optional[float] = None
+
+
+def discover_jobs(input_path: str) -> List[BatchJob]:
+    """
+    Lists the jobs of a batch.
+
+    A directory yields one job per `.zip`, named after the file, with the sub-regions file next to it called
+    `<name>_subregions.geojson`, `<name>_sub_regions.geojson` or `<name>.geojson`. A `.json` manifest is a list
+    of objects with `zip_file` and optional `job_id`, `sub_regions_file` and `grid_cell_size`; relative paths are
+    resolved against the manifest's folder.
+
+    Parameters:
+    - `input_path` (str): A directory of zips or a JSON manifest.
+    """
+    if os.path.isdir(input_path):
+        jobs = []
+        for name in sorted(os.listdir(input_path)):
+            stem, extension = os.path.splitext(name)
+            if extension.lower() != '.zip':
+                continue
+            candidates = [os.path.join(input_path, stem + suffix) for suffix in SUB_REGION_SUFFIXES]
+            sub_regions_file = next((path for path in candidates if os.path.exists(path)), None)
+            jobs.append(BatchJob(job_id=stem, zip_file=os.path.join(input_path, name),
+                                 sub_regions_file=sub_regions_file))
+        return jobs
+
+    folder = os.path.dirname(os.path.abspath(input_path))
+    with open(input_path, 'r') as file:
+        entries = json.load(file)
+
+    def resolve(path):
+        return os.path.join(folder, path) if path and not os.path.isabs(path) else path
+
+    jobs = []
+    for entry in entries:
+        zip_file = resolve(entry['zip_file'])
+        jobs.append(BatchJob(job_id=str(entry.get('job_id') or os.path.splitext(os.path.basename(zip_file))[0]),
+                             zip_file=zip_file,
+                             sub_regions_file=resolve(entry.get('sub_regions_file')),
+                             grid_cell_size=entry.get('grid_cell_size')))
+    return jobs
+
+
+def result_path(output_dir: str, job_id: str) -> str:
+    return os.path.join(output_dir, 'results', f'{job_id}.geojson')
+
+
+def input_fingerprint(job: BatchJob) -> str:
+    """
+    Identifies a job's input files by path, size and modification time, so a checkpoint is not resumed for a
+    dataset that was replaced at the same path.
+    """
+    parts = []
+    for path in (job.zip_file, job.sub_regions_file):
+        try:
+            stat = os.stat(path)
+            parts.append(f'{path}:{stat.st_size}:{stat.st_mtime_ns}')
+        except (OSError, TypeError):
+            parts.append(str(path))
+    return '|'.join(parts)
+
+
+def run_job(job: BatchJob, output_dir: str) -> dict:
+    """
+    Scores one dataset and writes its FeatureCollection to `<output_dir>/results/<job_id>.geojson`. Progress is
+    checkpointed under `<output_dir>/checkpoints`, so an interrupted job resumes where it stopped.
+
+    Returns:
+    - `record` (dict): `job_id`, `status` (`succeeded` or `failed`), `seconds`, `sub_regions` and `error`.
+    """
+    started = time.monotonic()
+    work_path = os.path.join(output_dir, 'work', job.job_id)
+    os.makedirs(work_path, exist_ok=True)
+    checkpoint = JobCheckpoint(store=LocalCheckpointStore(os.path.join(output_dir, 'checkpoints')),
+                               job_id=job.job_id, fingerprint=input_fingerprint(job))
+    checkpoint.load()
+    record = {'job_id': job.job_id, 'status': 'failed', 'seconds': 0.0, 'sub_regions': 0, 'error': None}
+    try:
+        metric = OSWConfidenceMetricCalculator(output_path=work_path, zip_file=job.zip_file, job_id=job.job_id,
+                                               sub_regions_file=job.sub_regions_file, checkpoint=checkpoint,
+                                               grid_cell_size=job.grid_cell_size)
+        record['sub_regions'] = metric.count_sub_regions()
+        scores = metric.calculate_score()
+
+        path = result_path(output_dir, job.job_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.tmp', 'w') as file:
+            json.dump(scores, file)
+        os.replace(f'{path}.tmp', path)
+        checkpoint.discard()
+        record['status'] = 'succeeded'
+    except Exception as e:
+        logger.error(f'Failed to score {job.job_id}: {e}')
+        checkpoint.close()
+        record['error'] = str(e)
+    finally:
+        clean_up(path=work_path)
+    record['seconds'] = time.monotonic() - started
+    return record
+
+
+def _init_worker(environment: dict) -> None:
+    os.environ.update(environment)
+
+
+class BatchRunner:
+    """
+    Scores a batch of datasets in parallel with `OSWConfidenceMetricCalculator`.
+
+    The worker processes, and the processes the calculator starts for the scoring, all share the OSM API limits
+    through `OSM_API_LIMITER_FILE` and the OSM cache in `OSM_CACHE_FOLDER`, so the batch as a whole stays within the
+    limits and fetches every history once. Each process keeps its own connection pool. The `thread` executor runs
+    every job in this process.
+
+    Jobs that already have a result are skipped, so running the same batch again resumes it. Every finished job
+    is appended to `<output_dir>/jobs.jsonl` and the run ends with `<output_dir>/summary.json`.
+
+    Parameters:
+    - `jobs` (List[BatchJob]): The datasets to score.
+    - `output_dir` (str): Folder for the results, checkpoints and summary.
+    - `workers` (int): Jobs scored at a time.
+    - `executor` (str): `process` or `thread`.
+    - `settings` (Settings): Service settings providing the OSM limiter file, the cache folder and the retention
+            of the checkpoints of failed jobs.
+
+    Usage:
+    ```python
+    runner = BatchRunner(discover_jobs('datasets/'), output_dir='scores/', workers=4)
+    summary = runner.run()
+    ```
+    """
+
+    def __init__(self, jobs: List[BatchJob], output_dir: str, workers: int = 2, executor: str = 'process',
+                 settings=None):
+        executor = str(executor).lower()
+        if executor not in EXECUTORS:
+            raise ValueError(f'Unknown executor: {executor}')
+        self.jobs = jobs
+        self.output_dir = output_dir
+        self.workers = max(1, int(workers))
+        self.executor = executor
+        self.settings = settings
+
+    def pending_jobs(self) -> List[BatchJob]:
+        return [job for job in self.jobs if not os.path.exists(result_path(self.output_dir, job.job_id))]
+
+    def _worker_environment(self) -> dict:
+        if self.settings is None:
+            return {}
+        return {
+            'OSM_API_LIMITER_FILE': self.settings.osm_api_limiter_file or DEFAULT_LIMITER_FILE,
+            'OSM_CACHE_FOLDER': self.settings.osm_cache_folder or DEFAULT_CACHE_FOLDER
+        }
+
+    def _create_executor(self):
+        if self.executor == 'thread':
+            return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch')
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                   initargs=(self._worker_environment(),))
+
+    def run(self) -> dict:
+        """
+        Scores the pending jobs and returns the throughput summary.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.settings is not None:
+            # Checkpoints of failed jobs that were not run again in time
+            LocalCheckpointStore(os.path.join(self.output_dir, 'checkpoints'),
+                                 retention=float(self.settings.checkpoint_retention)).prune()
+        pending = self.pending_jobs()
+        skipped = len(self.jobs) - len(pending)
+        logger.info('Scoring %d datasets, %d already done, with %d %s workers', len(pending), skipped,
+                    self.workers, self.executor)
+        started = time.monotonic()
+        records = []
+        with self._create_executor() as executor, open(os.path.join(self.output_dir, 'jobs.jsonl'), 'a') as log:
+            futures = {executor.submit(run_job, job, self.output_dir): job for job in pending}
+            for future in as_completed(futures):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    # The worker process died
+                    record = {'job_id': futures[future].job_id, 'status': 'failed', 'seconds': 0.0,
+                              'sub_regions': 0, 'error': str(e)}
+                records.append(record)
+                log.write(json.dumps(record) + '\n')
+                log.flush()
+                logger.info('%s %s in %.1f s (%d of %d)', record['job_id'], record['status'], record['seconds'],
+                            len(records), len(pending))
+
+        summary = self.summarize(records, skipped, time.monotonic() - started)
+        with open(os.path.join(self.output_dir, 'summary.json'), 'w') as file:
+            json.dump(summary, file, indent=2)
+        return summary
+
+    def summarize(self, records: List[dict], skipped: int, elapsed: float) -> dict:
+        succeeded = [record for record in records if record['status'] == 'succeeded']
+        sub_regions = sum(record['sub_regions'] for record in succeeded)
+        return {
+            'jobs': len(self.jobs),
+            'succeeded': len(succeeded),
+            'failed': len(records) - len(succeeded),
+            'skipped': skipped,
+            'failed_jobs': [record['job_id'] for record in records if record['status'] != 'succeeded'],
+            'workers': self.workers,
+            'executor': self.executor,
+            'elapsed_seconds': elapsed,
+            'datasets_per_hour': len(succeeded) / elapsed * 3600 if elapsed > 0 else 0.0,
+            'sub_regions_per_second': sub_regions / elapsed if elapsed > 0 else 0.0,
+            'mean_job_seconds': sum(record['seconds'] for record in succeeded) / len(succeeded) if succeeded else 0.0
+        }
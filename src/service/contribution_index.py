@@ -0,0 +1,221 @@
+# Per-element confidence contributions indexed for fast aggregation over arbitrary polygons
+import logging
+from datetime import datetime
+from typing import Optional, Sequence
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+from shapely.geometry.base import BaseGeometry
+from osw_confidence_metric.utils import calculate_direct_confirmations, count_tag_changes, check_for_rollbacks, \
+    calculate_user_interaction_stats, count_tags
+
+logging.basicConfig()
+logger = logging.getLogger('ContributionIndex')
+logger.setLevel(logging.INFO)
+
+SIDEWALK_FILTER = '["highway"~"footway|steps|living_street|path"]'
+EDGE_STATISTICS = ['versions', 'direct_confirmations', 'changes_to_tags', 'rollbacks', 'tags', 'user_count',
+                   'days_since_last_edit']
+FEATURE_CATEGORIES = ['poi', 'bldg', 'road']
+INDIRECT_ITEMS = ['road_users', 'road_time', 'poi_count', 'poi_users', 'poi_time', 'bldg_count', 'bldg_users',
+                  'bldg_time']
+# Fixed thresholds of the confidence library
+CHANGES_TO_TAGS_THRESHOLD = 2
+ROLLBACKS_THRESHOLD = 1
+
+
+def _group_mean(values: np.ndarray, groups: np.ndarray, size: int) -> np.ndarray:
+    """
+    Mean of `values` per group, ignoring NaN; NaN for groups without values.
+    """
+    valid = ~np.isnan(values)
+    sums = np.bincount(groups[valid], weights=values[valid], minlength=size)
+    counts = np.bincount(groups[valid], minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+
+class ContributionIndex:
+    """
+    Statistics of every OSM element in an area, computed once and stored with the element centroid in an
+    STRtree, so the confidence score of any number of polygons is an aggregation over the index instead of
+    a fresh OSM fetch and analysis per polygon.
+
+    Each polygon is scored like a single tile of `AreaAnalyzer`: the direct and time trust of the sidewalk
+    edges inside it, against the polygon's own means, and the indirect trust of its POIs, buildings and roads,
+    against the means of all polygons scored together. Scores are therefore comparable within one call, but
+    not identical to `AreaAnalyzer`, which also splits each polygon into Voronoi tiles.
+
+    Parameters:
+    - `edges` (DataFrame): Sidewalk edges with `x`, `y` centroid columns and the `EDGE_STATISTICS` columns.
+    - `features` (DataFrame): POIs, buildings and roads with `x`, `y`, `category` (`poi`, `bldg` or `road`),
+      `user_count` and `days_since_last_edit` columns.
+
+    Usage:
+    ```python
+    index = ContributionIndex.from_osm(footprint, osm_data_handler)
+    scores = index.score(sub_regions_gdf.geometry)
+    ```
+    """
+
+    def __init__(self, edges: pd.DataFrame, features: pd.DataFrame):
+        self.edges = {column: pd.to_numeric(edges[column], errors='coerce').to_numpy(dtype=float)
+                      for column in EDGE_STATISTICS}
+        self.edge_tree = STRtree(shapely.points(edges['x'].to_numpy(dtype=float), edges['y'].to_numpy(dtype=float)))
+        self.features = {column: pd.to_numeric(features[column], errors='coerce').to_numpy(dtype=float)
+                         for column in ['user_count', 'days_since_last_edit']}
+        self.feature_category = features['category'].to_numpy()
+        self.feature_tree = STRtree(shapely.points(features['x'].to_numpy(dtype=float),
+                                                   features['y'].to_numpy(dtype=float)))
+
+    def __len__(self) -> int:
+        return len(self.edge_tree) + len(self.feature_tree)
+
+    def score(self, polygons: Sequence[BaseGeometry]) -> np.ndarray:
+        """
+        Scores all polygons in one pass over the index.
+
+        Parameters:
+        - `polygons` (Sequence[BaseGeometry]): Polygons or MultiPolygons in the CRS of the index.
+
+        Returns:
+        - `scores` (ndarray): One confidence score per polygon; 0 for polygons without sidewalk edges, as the
+          analyzer scores tiles without sidewalks.
+        """
+        polygons = np.asarray(polygons, dtype=object)
+        size = len(polygons)
+        if size == 0:
+            return np.array([], dtype=float)
+
+        direct, time, has_edges = self._edge_trust(polygons, size)
+        indirect_values = self._indirect_values(polygons, size)
+
+        # Indirect thresholds are the means over the polygons that have sidewalks, as over the analyzer's tiles
+        indirect_items = 0
+        for item in INDIRECT_ITEMS:
+            values = np.where(has_edges, indirect_values[item], np.nan)
+            threshold = np.nanmean(values) if np.any(~np.isnan(values)) else np.nan
+            with np.errstate(invalid='ignore'):
+                indirect_items = indirect_items + (values >= threshold)
+        indirect = (indirect_items > 2).astype(float)
+
+        return np.where(has_edges, direct * 0.5 + indirect * 0.25 + time * 0.25, 0.0)
+
+    def _edge_trust(self, polygons: np.ndarray, size: int):
+        polygon_ids, edge_ids = self.edge_tree.query(polygons, predicate='contains')
+        has_edges = np.bincount(polygon_ids, minlength=size) > 0
+
+        def above_mean(column: str) -> np.ndarray:
+            values = self.edges[column][edge_ids]
+            threshold = _group_mean(values, polygon_ids, size)[polygon_ids]
+            with np.errstate(invalid='ignore'):
+                return values >= threshold
+
+        edge_direct = 0.2 * above_mean('versions') + 0.2 * above_mean('direct_confirmations') + \
+            0.2 * above_mean('user_count') + 0.2 * above_mean('tags')
+        with np.errstate(invalid='ignore'):
+            edge_direct = edge_direct + 0.1 * (self.edges['rollbacks'][edge_ids] >= ROLLBACKS_THRESHOLD) + \
+                0.1 * (self.edges['changes_to_tags'][edge_ids] >= CHANGES_TO_TAGS_THRESHOLD)
+            days = self.edges['days_since_last_edit'][edge_ids]
+            edge_time = (days > _group_mean(days, polygon_ids, size)[polygon_ids]).astype(float)
+
+        direct = np.nan_to_num(_group_mean(edge_direct, polygon_ids, size))
+        time = np.nan_to_num(_group_mean(edge_time, polygon_ids, size))
+        return direct, time, has_edges
+
+    def _indirect_values(self, polygons: np.ndarray, size: int) -> dict:
+        polygon_ids, feature_ids = self.feature_tree.query(polygons, predicate='contains')
+        values = {}
+        for category in FEATURE_CATEGORIES:
+            in_category = self.feature_category[feature_ids] == category
+            ids, members = polygon_ids[in_category], feature_ids[in_category]
+            values[f'{category}_count'] = np.bincount(ids, minlength=size).astype(float)
+            values[f'{category}_users'] = np.nan_to_num(_group_mean(self.features['user_count'][members], ids, size))
+            # The library averages days since last edit over non-zero values only
+            days = self.features['days_since_last_edit'][members]
+            values[f'{category}_time'] = _group_mean(np.where(days > 0, days, np.nan), ids, size)
+        return values
+
+    @classmethod
+    def from_osm(cls, polygon: BaseGeometry, osm_data_handler, date: Optional[datetime] = None,
+                 sidewalk_filter: str = SIDEWALK_FILTER) -> 'ContributionIndex':
+        """
+        Fetches the sidewalks, POIs, buildings and roads inside `polygon` once, with their histories, and
+        indexes their statistics.
+
+        Parameters:
+        - `polygon` (BaseGeometry): Area to index in EPSG:4326, e.g. the union of the hull and the sub-regions.
+        - `osm_data_handler`: Backend providing element histories.
+        - `date` (datetime): Reference date for the time statistics; defaults to now.
+        - `sidewalk_filter` (str): Overpass filter selecting the sidewalk ways.
+        """
+        import osmnx as ox
+        import geonetworkx as gnx
+
+        date = date or datetime.now()
+        try:
+            graph = ox.graph.graph_from_polygon(polygon, custom_filter=sidewalk_filter, truncate_by_edge=True,
+                                                simplify=False, retain_all=True)
+            sidewalks = gnx.graph_edges_to_gdf(graph)
+        except ValueError:
+            sidewalks = None
+
+        edge_rows = []
+        way_statistics = {}
+        if sidewalks is not None:
+            centroids = shapely.centroid(sidewalks.geometry.to_numpy())
+            for osmid, centroid in zip(sidewalks['osmid'], centroids):
+                if osmid not in way_statistics:
+                    way_statistics[osmid] = cls._way_statistics(osm_data_handler.get_way_history(osmid=osmid), date)
+                edge_rows.append({'x': centroid.x, 'y': centroid.y, **way_statistics[osmid]})
+
+        feature_rows = []
+        for category, gdf in cls._fetch_features(polygon).items():
+            centroids = shapely.centroid(gdf.geometry.to_numpy())
+            for row, centroid in zip(gdf.itertuples(index=False), centroids):
+                history = osm_data_handler.get_item_history(item=row)
+                if not history:
+                    continue
+                user_count, days_since_last_edit = calculate_user_interaction_stats(historical_info=history, date=date)
+                feature_rows.append({'x': centroid.x, 'y': centroid.y, 'category': category,
+                                     'user_count': user_count, 'days_since_last_edit': days_since_last_edit})
+
+        logger.info('Indexed %d sidewalk edges and %d features', len(edge_rows), len(feature_rows))
+        return cls(edges=pd.DataFrame(edge_rows, columns=['x', 'y'] + EDGE_STATISTICS),
+                   features=pd.DataFrame(feature_rows, columns=['x', 'y', 'category', 'user_count',
+                                                                'days_since_last_edit']))
+
+    @staticmethod
+    def _way_statistics(history: dict, date: datetime) -> dict:
+        history = {version: value for version, value in history.items() if value['timestamp'] <= date}
+        if not history:
+            return {column: np.nan for column in EDGE_STATISTICS}
+        user_count, days_since_last_edit = calculate_user_interaction_stats(historical_info=history, date=date)
+        return {
+            'versions': len(history),
+            'direct_confirmations': calculate_direct_confirmations(historical_info=history),
+            'changes_to_tags': count_tag_changes(historical_info=history),
+            'rollbacks': int(check_for_rollbacks(historical_info=history)),
+            'tags': count_tags(history),
+            'user_count': user_count,
+            'days_since_last_edit': days_since_last_edit
+        }
+
+    @staticmethod
+    def _fetch_features(polygon: BaseGeometry) -> dict:
+        import osmnx as ox
+        import geonetworkx as gnx
+
+        features = {}
+        for category, tags in [('poi', {'amenity': True}), ('bldg', {'building': True})]:
+            try:
+                features[category] = ox.features.features_from_polygon(polygon, tags=tags)
+            except ValueError:
+                pass
+        try:
+            roads = ox.graph.graph_from_polygon(polygon, network_type='drive', simplify=False, retain_all=True)
+            features['road'] = gnx.graph_edges_to_gdf(roads)
+        except ValueError:
+            pass
+        return features
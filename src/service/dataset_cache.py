@@ -0,0 +1,268 @@
+# Local cache of downloaded datasets, shared by the jobs on a pod
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from typing import Callable, Dict, Optional
+from src.service.helper import clean_up
+
+logging.basicConfig()
+logger = logging.getLogger('DatasetCache')
+logger.setLevel(logging.INFO)
+
+MB = 1024 * 1024
+BLOB_FILE_NAME = 'dataset.zip'
+META_FILE_NAME = 'meta.json'
+ARTIFACTS_FOLDER = 'artifacts'
+
+
+def link_or_copy(source: str, target: str) -> None:
+    """
+    Hard links `source` to `target`, or copies it when they are on different filesystems. A hard link keeps the
+    data readable by the job even when the cache evicts its own entry.
+    """
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class CachedDataset:
+    """
+    One cached blob and the artifacts derived from it, such as the extracted nodes file and the hull.
+
+    Attributes:
+    - `url` (str): The blob URL.
+    - `folder` (str): The cache entry folder.
+    - `hit` (bool): True when the blob was served from the cache.
+    """
+
+    def __init__(self, cache: 'DatasetCache', key: str, url: str, folder: str, hit: bool):
+        self.cache = cache
+        self.key = key
+        self.url = url
+        self.folder = folder
+        self.hit = hit
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.folder, BLOB_FILE_NAME)
+
+    def copy_to(self, target: str) -> None:
+        link_or_copy(self.path, target)
+
+    def restore_artifact(self, name: str, target: str) -> bool:
+        """
+        Places the artifact `name` at `target` and returns True, or returns False when it is not cached.
+        """
+        source = os.path.join(self.folder, ARTIFACTS_FOLDER, name)
+        try:
+            link_or_copy(source, target)
+        except OSError:
+            self.cache.record_artifact(hit=False)
+            return False
+        self.cache.record_artifact(hit=True)
+        return True
+
+    def store_artifact(self, name: str, source: str) -> None:
+        """
+        Adds the file `source` to the entry as the artifact `name`. A failure only costs the reuse.
+        """
+        folder = os.path.join(self.folder, ARTIFACTS_FOLDER)
+        try:
+            os.makedirs(folder, exist_ok=True)
+            temp_path = os.path.join(folder, f'.{name}.tmp')
+            shutil.copyfile(source, temp_path)
+            os.replace(temp_path, os.path.join(folder, name))
+            self.cache.grow(self.key, os.path.getsize(source))
+        except OSError as e:
+            logger.info(f'Could not cache {name} of {self.url}: {e}')
+
+
+class DatasetCache:
+    """
+    Size-bounded cache of downloaded blobs, keyed by blob URL and checked against the blob's ETag or last
+    modified time, so a retried or re-triggered job skips the download and the extraction of its dataset.
+
+    Each entry is a folder named after the hash of the URL, holding the blob, a `meta.json` with its version
+    and last use, and the artifacts jobs derived from it. Entries are evicted least recently used first once
+    the cache grows beyond `max_bytes`. The cache folder is read back on start, so entries survive restarts.
+
+    Parameters:
+    - `root` (str): Folder holding the cache entries.
+    - `max_bytes` (int): Size of the cache; 0 disables it.
+
+    Usage:
+    ```python
+    cache = DatasetCache(root='cache/', max_bytes=2 * 1024 ** 3)
+    cached = cache.fetch(url, version=etag, download=lambda path: download(url, path))
+    if cached is not None:
+        cached.copy_to(local_path)
+    ```
+    """
+
+    def __init__(self, root: str, max_bytes: int = 0):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self.lock = threading.Lock()
+        self.key_locks: Dict[str, threading.Lock] = {}
+        self.entries: Dict[str, dict] = {}
+        self.hits = 0
+        self.misses = 0
+        self.artifact_hits = 0
+        self.artifact_misses = 0
+        self.evictions = 0
+        if self.enabled:
+            self._load()
+
+    @classmethod
+    def from_settings(cls, settings) -> 'DatasetCache':
+        root = settings.dataset_cache_folder or os.path.join(
+            os.path.dirname(settings.get_download_folder()), 'dataset_cache')
+        return cls(root=root, max_bytes=int(float(settings.dataset_cache_mb) * MB))
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _load(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        for key in os.listdir(self.root):
+            try:
+                with open(os.path.join(self.root, key, META_FILE_NAME), 'r') as file:
+                    self.entries[key] = json.load(file)
+            except (OSError, ValueError):
+                # A download that never finished
+                clean_up(path=os.path.join(self.root, key))
+        self._evict()
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def _write_meta(self, key: str, meta: dict) -> None:
+        temp_path = os.path.join(self.root, key, f'.{META_FILE_NAME}.tmp')
+        with open(temp_path, 'w') as file:
+            json.dump(meta, file)
+        os.replace(temp_path, os.path.join(self.root, key, META_FILE_NAME))
+
+    def fetch(self, url: str, version: Optional[str], download: Callable[[str], None]) -> Optional[CachedDataset]:
+        """
+        Returns the cache entry of `url`, downloading the blob first unless the cached copy has `version`.
+        Jobs fetching the same URL at the same time download it once.
+
+        Parameters:
+        - `url` (str): The blob URL.
+        - `version` (str): The blob's ETag or last modified time; without one the cache is bypassed.
+        - `download` (Callable[[str], None]): Writes the blob to the given path.
+
+        Returns:
+        - `cached` (CachedDataset): The entry, or None when the cache is disabled or the download failed.
+        """
+        if not self.enabled or not version:
+            return None
+        key = self.key(url)
+        folder = os.path.join(self.root, key)
+        with self._key_lock(key):
+            with self.lock:
+                meta = self.entries.get(key)
+            if meta is not None and meta.get('version') == version and \
+                    os.path.exists(os.path.join(folder, BLOB_FILE_NAME)):
+                with self.lock:
+                    self.hits += 1
+                    meta['last_used'] = time.time()
+                self._write_meta(key, meta)
+                logger.info('Dataset cache hit for %s', url)
+                return CachedDataset(self, key, url, folder, hit=True)
+
+            with self.lock:
+                self.misses += 1
+                self.entries.pop(key, None)
+            clean_up(path=folder)
+            os.makedirs(folder, exist_ok=True)
+            temp_path = os.path.join(folder, f'.{BLOB_FILE_NAME}.tmp')
+            try:
+                download(temp_path)
+                if not os.path.exists(temp_path):
+                    raise OSError('nothing was downloaded')
+                os.replace(temp_path, os.path.join(folder, BLOB_FILE_NAME))
+                meta = {'url': url, 'version': version, 'bytes': os.path.getsize(os.path.join(folder, BLOB_FILE_NAME)),
+                        'last_used': time.time()}
+                self._write_meta(key, meta)
+            except Exception as e:
+                logger.info(f'Could not cache {url}: {e}')
+                clean_up(path=folder)
+                return None
+            with self.lock:
+                self.entries[key] = meta
+            self._evict(keep=key)
+            return CachedDataset(self, key, url, folder, hit=False)
+
+    def grow(self, key: str, size: int) -> None:
+        with self.lock:
+            meta = self.entries.get(key)
+            if meta is None:
+                return
+            meta['bytes'] = meta.get('bytes', 0) + int(size)
+        try:
+            self._write_meta(key, meta)
+        except OSError:
+            pass
+        self._evict(keep=key)
+
+    def record_artifact(self, hit: bool) -> None:
+        with self.lock:
+            if hit:
+                self.artifact_hits += 1
+            else:
+                self.artifact_misses += 1
+
+    def size_bytes(self) -> int:
+        with self.lock:
+            return sum(meta.get('bytes', 0) for meta in self.entries.values())
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        while True:
+            with self.lock:
+                if sum(meta.get('bytes', 0) for meta in self.entries.values()) <= self.max_bytes:
+                    return
+                candidates = [key for key in self.entries if key != keep]
+                if not candidates:
+                    return
+                key = min(candidates, key=lambda candidate: self.entries[candidate].get('last_used', 0))
+                meta = self.entries.pop(key)
+                self.evictions += 1
+            logger.info('Evicting %s from the dataset cache', meta.get('url'))
+            clean_up(path=os.path.join(self.root, key))
+
+    def stats(self) -> dict:
+        """
+        Hit rates and size of the cache, for the metrics endpoint.
+        """
+        with self.lock:
+            hits, misses = self.hits, self.misses
+            artifact_hits, artifact_misses = self.artifact_hits, self.artifact_misses
+            entries, evictions = len(self.entries), self.evictions
+        return {
+            'enabled': self.enabled,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'artifact_hits': artifact_hits,
+            'artifact_misses': artifact_misses,
+            'artifact_hit_rate': artifact_hits / (artifact_hits + artifact_misses)
+            if artifact_hits + artifact_misses else 0.0,
+            'entries': entries,
+            'evictions': evictions,
+            'size_bytes': self.size_bytes(),
+            'max_bytes': self.max_bytes
+        }
@@ -0,0 +1,111 @@
+# Query footprint of a dataset: the area whose OSM data is fetched and scored
+import logging
+import numpy as np
+import shapely
+import geopandas as gpd
+from shapely.geometry.base import BaseGeometry
+
+logging.basicConfig()
+logger = logging.getLogger('Footprint')
+logger.setLevel(logging.INFO)
+
+FOOTPRINT_MODES = ('convex', 'clustered')
+
+
+def _occupied_cells(x: np.ndarray, y: np.ndarray, cell_size: float) -> np.ndarray:
+    """
+    Column and row of every `cell_size` grid cell holding at least one of the points, one row per cell.
+    """
+    return np.unique(np.c_[np.floor(x / cell_size), np.floor(y / cell_size)].astype(np.int64), axis=0)
+
+
+def _cell_boxes(cells: np.ndarray, cell_size: float) -> np.ndarray:
+    return shapely.box(cells[:, 0] * cell_size, cells[:, 1] * cell_size,
+                       (cells[:, 0] + 1) * cell_size, (cells[:, 1] + 1) * cell_size)
+
+
+def _cluster_hulls(points: gpd.GeoSeries, cell_size: float) -> BaseGeometry:
+    """
+    Grid occupancy clustering: points are snapped to `cell_size` cells and touching occupied cells form a
+    cluster. Each cluster contributes its convex hull, padded by half a cell so clusters of one or two points
+    still form a polygon, and clipped to its occupied cells so a bending corridor does not fill in its bend.
+    """
+    x, y = points.x.to_numpy(), points.y.to_numpy()
+    clusters = shapely.get_parts(shapely.union_all(_cell_boxes(_occupied_cells(x, y, cell_size), cell_size)))
+
+    coordinates = shapely.points(x, y)
+    cluster_index = gpd.GeoSeries(clusters).sindex
+    point_index, cluster_ids = cluster_index.query(coordinates, predicate='intersects')
+    hulls = []
+    for cluster_id in np.unique(cluster_ids):
+        members = coordinates[point_index[cluster_ids == cluster_id]]
+        hull = shapely.buffer(shapely.convex_hull(shapely.multipoints(members)), cell_size / 2, quad_segs=2)
+        # The metre of padding keeps points lying on a cell edge inside the footprint
+        hulls.append(shapely.intersection(hull, shapely.buffer(clusters[cluster_id], 1.0, join_style='mitre')))
+    return shapely.union_all(hulls)
+
+
+def _projected_vertices(geometries: gpd.GeoSeries):
+    source = geometries if geometries.crs is not None else geometries.set_crs(epsg=4326)
+    crs = source.estimate_utm_crs()
+    return source, gpd.GeoSeries(shapely.points(shapely.get_coordinates(source.to_crs(crs).to_numpy())), crs=crs)
+
+
+def compute_footprint(geometries: gpd.GeoSeries, mode: str = 'convex', cell_size: float = 500.0) -> BaseGeometry:
+    """
+    Computes the footprint of a dataset's geometries.
+
+    Modes:
+    - `convex`: one convex hull around everything.
+    - `clustered`: one convex hull per cluster of nearby vertices, so disjoint towns or a long corridor are not
+      joined by empty area. Vertices closer than about `cell_size` metres end up in the same cluster.
+
+    Parameters:
+    - `geometries` (GeoSeries): Dataset geometries; a missing CRS is taken as EPSG:4326.
+    - `mode` (str): `convex` or `clustered`.
+    - `cell_size` (float): Cluster grid cell size in metres, also the longest footprint edge.
+
+    Returns:
+    - `footprint` (BaseGeometry): Polygon or MultiPolygon in the CRS of `geometries`.
+    """
+    mode = str(mode or 'convex').lower()
+    if mode not in FOOTPRINT_MODES:
+        raise ValueError(f'Unknown footprint mode: {mode}')
+    if mode == 'convex' or geometries.empty:
+        return geometries.unary_union.convex_hull
+
+    source, vertices = _projected_vertices(geometries)
+    crs = vertices.crs
+    footprint = _cluster_hulls(vertices, float(cell_size))
+
+    # Long straight edges in UTM bend in geographic coordinates, densify them before reprojecting back
+    footprint = shapely.segmentize(footprint, max_segment_length=float(cell_size))
+    footprint = gpd.GeoSeries([footprint], crs=crs).to_crs(source.crs).iloc[0]
+    convex_area = geometries.unary_union.convex_hull.area
+    if convex_area:
+        logger.info('%s footprint covers %.0f%% of the convex hull', mode, footprint.area / convex_area * 100)
+    return footprint
+
+
+def occupied_grid_cells(geometries: gpd.GeoSeries, cell_size: float) -> gpd.GeoDataFrame:
+    """
+    Square grid cells of `cell_size` metres, aligned in the local UTM zone, that hold at least one vertex of
+    the dataset's geometries.
+
+    Parameters:
+    - `geometries` (GeoSeries): Dataset geometries; a missing CRS is taken as EPSG:4326.
+    - `cell_size` (float): Cell size in metres.
+
+    Returns:
+    - `cells` (GeoDataFrame): `col` and `row` grid indices with the cell polygons, in the CRS of `geometries`. The
+            projected CRS the grid is aligned in is kept in `cells.attrs['grid_crs']`.
+    """
+    if geometries.empty:
+        return gpd.GeoDataFrame({'col': [], 'row': []}, geometry=[], crs=geometries.crs)
+    source, vertices = _projected_vertices(geometries)
+    cells = _occupied_cells(vertices.x.to_numpy(), vertices.y.to_numpy(), float(cell_size))
+    grid = gpd.GeoDataFrame({'col': cells[:, 0], 'row': cells[:, 1]},
+                            geometry=_cell_boxes(cells, float(cell_size)), crs=vertices.crs)
+    grid = grid.to_crs(source.crs)
+    grid.attrs['grid_crs'] = vertices.crs.to_string()
+    return grid
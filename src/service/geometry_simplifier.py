@@ -0,0 +1,64 @@
+# Topology-preserving simplification of the polygons sent to the OSM fetch and scoring
+import logging
+from dataclasses import dataclass
+import shapely
+import geopandas as gpd
+
+logging.basicConfig()
+logger = logging.getLogger('GeometrySimplifier')
+logger.setLevel(logging.INFO)
+
+
+@dataclass
+class SimplificationStats:
+    """
+    Vertex counts before and after simplification.
+
+    Attributes:
+    - `vertices_before` (int): Vertices of the input geometries.
+    - `vertices_after` (int): Vertices of the simplified geometries.
+    """
+    vertices_before: int = 0
+    vertices_after: int = 0
+
+    @property
+    def reduction(self) -> float:
+        if not self.vertices_before:
+            return 0.0
+        return 1 - self.vertices_after / self.vertices_before
+
+
+def simplify_geometries(geometries: gpd.GeoSeries, tolerance: float):
+    """
+    Simplifies polygons with `preserve_topology=True`, then buffers each result by the tolerance so it still
+    contains its input; no OSM data inside the original polygon is dropped from the query.
+
+    The work is done in the local UTM zone so `tolerance` is in metres. Geometries that would gain vertices
+    are kept as they are.
+
+    Parameters:
+    - `geometries` (GeoSeries): Polygons to simplify; a missing CRS is taken as EPSG:4326.
+    - `tolerance` (float): Maximum distance in metres between a simplified and an original boundary; 0 disables.
+
+    Returns:
+    - `geometries` (GeoSeries): The simplified geometries in the input CRS.
+    - `stats` (SimplificationStats): Vertex counts before and after.
+    """
+    vertices_before = shapely.get_num_coordinates(geometries.to_numpy())
+    stats = SimplificationStats(int(vertices_before.sum()), int(vertices_before.sum()))
+    if tolerance <= 0 or geometries.empty:
+        return geometries, stats
+
+    source = geometries if geometries.crs is not None else geometries.set_crs(epsg=4326)
+    projected = source.to_crs(source.estimate_utm_crs())
+    simplified = projected.simplify(tolerance, preserve_topology=True) \
+        .buffer(tolerance, join_style='mitre') \
+        .to_crs(source.crs)
+
+    vertices_after = shapely.get_num_coordinates(simplified.to_numpy())
+    keep_original = (vertices_after >= vertices_before) | ~simplified.is_valid.to_numpy()
+    simplified = simplified.where(~keep_original, source)
+    stats.vertices_after = int(shapely.get_num_coordinates(simplified.to_numpy()).sum())
+    logger.info('Simplified %d geometries from %d to %d vertices (%.0f%% fewer)', len(geometries),
+                stats.vertices_before, stats.vertices_after, stats.reduction * 100)
+    return simplified, stats
@@ -3,6 +3,7 @@ import shutil
 import json
 from jsonschema import validate, ValidationError
 import requests
+from azure.core.exceptions import ResourceExistsError
 
 def clean_up(path):
     """
@@ -64,4 +65,67 @@ def is_valid_geojson(file_path):
         return True
     except ValidationError as e:
         print("Validation Error:", e)
-        return False
\ No newline at end of file
+        return False
+
+def write_blob(storage_client, container_name, file_name, content):
+    """
+    Writes `content` to the file `file_name` of a storage container, replacing the file if it already exists.
+
+    Parameters:
+    - `storage_client` (StorageClient): Client for the storage service.
+    - `container_name` (str): The container holding the file.
+    - `file_name` (str): Path of the file inside the container.
+    - `content` (bytes): The new content of the file.
+
+    Behavior:
+    - `create_file(name).upload(...)` of the Azure provider uploads without overwriting, so every write after the
+      first raises `ResourceExistsError`. On Azure the file is written through its blob client with `overwrite=True`.
+    - Other providers replace the file on upload and are written through `create_file` as before.
+
+    Usage:
+    ```python
+    write_blob(storage_client, 'osw', 'checkpoints/1234.json', b'{}')
+    ```
+    """
+    container = storage_client.get_container(container_name=container_name)
+    container_client = getattr(container, 'container_client', None)
+    if container_client is None:
+        container.create_file(file_name).upload(content)
+        return
+    container_client.get_blob_client(file_name).upload_blob(content, overwrite=True)
+
+
+def create_blob(storage_client, container_name, file_name, content) -> bool:
+    """
+    Writes `content` to the file `file_name` of a storage container unless the file already exists.
+
+    Parameters:
+    - `storage_client` (StorageClient): Client for the storage service.
+    - `container_name` (str): The container holding the file.
+    - `file_name` (str): Path of the file inside the container.
+    - `content` (bytes): The content of the new file.
+
+    Returns:
+    - `created` (bool): False when the file already existed.
+
+    Behavior:
+    - On Azure the upload fails atomically when the blob exists, so of several replicas creating the same file
+      exactly one succeeds.
+    - Other providers replace the file on upload, so every caller succeeds.
+
+    Usage:
+    ```python
+    if create_blob(storage_client, 'osw', 'shards/1234/merge.json', b'{}'):
+        merge()
+    ```
+    """
+    container = storage_client.get_container(container_name=container_name)
+    container_client = getattr(container, 'container_client', None)
+    if container_client is None:
+        container.create_file(file_name).upload(content)
+        return True
+    try:
+        container_client.get_blob_client(file_name).upload_blob(content, overwrite=False)
+    except ResourceExistsError:
+        return False
+    return True
@@ -0,0 +1,163 @@
+# Synchronous scoring of small inline GeoJSON inputs for the HTTP API
+import os
+import json
+import uuid
+import logging
+import threading
+from typing import Iterator, List
+from src.service.job_cancellation import CancellationToken
+from src.service.job_workspace import WorkspaceManager
+from src.service.osw_confidence_metric_calculator import OSWConfidenceMetricCalculator
+
+logging.basicConfig()
+logger = logging.getLogger('InlineScoring')
+logger.setLevel(logging.INFO)
+
+GEOMETRY_TYPES = ('Polygon', 'MultiPolygon')
+
+
+class InlineRequestError(ValueError):
+    """
+    Raised for an inline input that is not a polygon, a Feature or a small FeatureCollection.
+    """
+    pass
+
+
+class ScoringBusyError(Exception):
+    """
+    Raised when every inline scoring slot is taken.
+    """
+    pass
+
+
+def parse_features(payload: dict, max_features: int) -> List[dict]:
+    """
+    Normalizes an inline GeoJSON input, a Polygon or MultiPolygon geometry, a Feature or a FeatureCollection,
+    to a list of features.
+
+    Raises:
+    - `InlineRequestError`: The input is not GeoJSON, is empty, or has more than `max_features` features.
+    """
+    if not isinstance(payload, dict):
+        raise InlineRequestError('Expected a GeoJSON object')
+    kind = payload.get('type')
+    if kind in GEOMETRY_TYPES:
+        features = [{'type': 'Feature', 'properties': {}, 'geometry': payload}]
+    elif kind == 'Feature':
+        features = [payload]
+    elif kind == 'FeatureCollection':
+        features = payload.get('features')
+        if not isinstance(features, list):
+            raise InlineRequestError('FeatureCollection without a features list')
+    else:
+        raise InlineRequestError(f'Unsupported GeoJSON type: {kind}')
+
+    if not features:
+        raise InlineRequestError('No features to score')
+    if len(features) > max_features:
+        raise InlineRequestError(f'{len(features)} features exceed the limit of {max_features}; '
+                                 f'submit larger inputs through the queue')
+    for feature in features:
+        if not isinstance(feature, dict) or not isinstance(feature.get('geometry'), dict):
+            raise InlineRequestError('Every feature needs a geometry')
+        feature.setdefault('properties', {})
+    return features
+
+
+class InlineScoringService:
+    """
+    Scores inline GeoJSON polygons on the request thread, with the same calculator as queued jobs, so
+    interactive tools skip the queue and blob round trip.
+
+    Each polygon is scored like a sub-region of a queued job; no dataset hull is scored. At most
+    `max_concurrent` requests are scored at a time and each one is bounded by `timeout` seconds. Inputs
+    take a workspace like queued jobs do, so they count against the same disk quota.
+
+    Parameters:
+    - `settings` (Settings): Service settings.
+    - `workspaces` (WorkspaceManager): Job working folders and the disk quota.
+
+    Usage:
+    ```python
+    inline = InlineScoringService(settings, workspaces)
+    features = inline.parse(geojson)
+    results = inline.stream(features) if inline.should_stream(features) else inline.score(features)
+    ```
+    """
+
+    def __init__(self, settings, workspaces: WorkspaceManager):
+        self.settings = settings
+        self.workspaces = workspaces
+        self.max_features = int(settings.http_max_features)
+        self.stream_threshold = int(settings.http_stream_threshold)
+        self.timeout = float(settings.http_timeout)
+        self.slots = threading.BoundedSemaphore(max(1, int(settings.http_max_concurrent)))
+
+    def parse(self, payload: dict) -> List[dict]:
+        return parse_features(payload, self.max_features)
+
+    def should_stream(self, features: List[dict]) -> bool:
+        return len(features) > self.stream_threshold
+
+    def score(self, features: List[dict]) -> dict:
+        """
+        Scores all features and returns them as a FeatureCollection, each with its `confidence_score`.
+
+        Raises:
+        - `ScoringBusyError`: Every scoring slot is taken.
+        - `JobTimeoutError`: Scoring took longer than `timeout`.
+        """
+        return {'type': 'FeatureCollection', 'features': list(self.iter_scores(features))}
+
+    def stream(self, features: List[dict]) -> Iterator[str]:
+        """
+        Scores the features one by one, yielding each as a line of NDJSON as soon as it is scored.
+
+        The first feature is scored before returning, so a busy service or a timeout still raises here and can be
+        answered with a status code. A later failure is sent as a final `{"error": ...}` line.
+        """
+        scores = self.iter_scores(features)
+        first = next(scores, None)
+        return self._lines(first, scores)
+
+    @staticmethod
+    def _lines(first: dict, scores: Iterator[dict]) -> Iterator[str]:
+        try:
+            if first is not None:
+                yield json.dumps(first) + '\n'
+            for feature in scores:
+                yield json.dumps(feature) + '\n'
+        except Exception as e:
+            logger.error(f'Inline scoring stopped: {e}')
+            yield json.dumps({'error': str(e)}) + '\n'
+        finally:
+            scores.close()
+
+    def iter_scores(self, features: List[dict]) -> Iterator[dict]:
+        if not self.slots.acquire(blocking=False):
+            raise ScoringBusyError('All scoring slots are busy, retry later')
+        job_id = f'http-{uuid.uuid4().hex}'
+        token = CancellationToken(job_id, timeout=self.timeout)
+        workspace = None
+        try:
+            content = json.dumps({'type': 'FeatureCollection', 'features': features})
+            # The size lets a small request use the in-memory workspace folder
+            workspace = self.workspaces.acquire(
+                job_id, expected_bytes=len(content) * float(self.settings.workspace_expansion_factor))
+            features_file = os.path.join(workspace.path, f'{job_id}_features.geojson')
+            with open(features_file, 'w') as file:
+                file.write(content)
+
+            calculator = token.run(lambda: OSWConfidenceMetricCalculator(
+                output_path=workspace.path, zip_file=None, job_id=job_id, sub_regions_file=features_file,
+                cancellation=token))
+            scored = calculator.score_features()
+            while True:
+                feature = token.run(lambda: next(scored, None))
+                if feature is None:
+                    break
+                yield feature
+        finally:
+            if workspace is not None:
+                workspace.release()
+            self.slots.release()
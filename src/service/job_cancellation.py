@@ -0,0 +1,225 @@
+# Job timeouts and cooperative cancellation
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Executor, Future, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, List, Optional, TypeVar
+
+logging.basicConfig()
+logger = logging.getLogger('JobCancellation')
+logger.setLevel(logging.INFO)
+
+T = TypeVar('T')
+
+
+class JobCancelledError(Exception):
+    """
+    Raised inside a job once it has been cancelled.
+    """
+    pass
+
+
+class JobTimeoutError(JobCancelledError):
+    """
+    Raised inside a job once the job or its current stage ran out of time.
+    """
+    pass
+
+
+class CancellationToken:
+    """
+    Cancellation state and deadlines of one job.
+
+    Work checks the token between sub-regions, tiles and stages with `check()`. Blocking calls run through
+    `run()`, which returns to the caller as soon as the token is cancelled or expires, leaving the abandoned call
+    to stop at its next `check()`.
+
+    Cancellation only takes effect at those checks: a thread cannot be killed, so an abandoned call that has no
+    check ahead, such as the hull score inside the analyzer, runs to its end. `when_stopped()` tells when the
+    abandoned calls have really returned, so the resources they use can be held until then. Work that must stop
+    at once runs in a `WorkerPool` process, which is killed on cancellation.
+
+    Parameters:
+    - `job_id` (str): The job identifier.
+    - `timeout` (float): Seconds the whole job may take; 0 or None for no limit.
+
+    Usage:
+    ```python
+    token = CancellationToken(job_id, timeout=3600)
+    with token.stage('hull', timeout=600):
+        score = token.run(lambda: analyzer.calculate_area_confidence_score(file_path=hull_file))
+    ```
+    """
+
+    def __init__(self, job_id: str, timeout: Optional[float] = None):
+        self.job_id = job_id
+        self.timeout = float(timeout or 0)
+        self.deadline = time.monotonic() + self.timeout if self.timeout else None
+        self.stage_name = None
+        self.stage_deadline = None
+        self.reason = None
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.calls: List[threading.Event] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def cancel(self, reason: str = 'cancelled') -> None:
+        if not self.cancelled:
+            self.reason = reason
+            self.event.set()
+            logger.info('Job %s %s', self.job_id, reason)
+
+    def remaining(self) -> Optional[float]:
+        """
+        Seconds until the nearest of the job and stage deadlines, or None without deadlines.
+        """
+        deadlines = [deadline for deadline in (self.deadline, self.stage_deadline) if deadline is not None]
+        return min(deadlines) - time.monotonic() if deadlines else None
+
+    def check(self) -> None:
+        """
+        Raises `JobCancelledError` if the job was cancelled, or `JobTimeoutError` if a deadline has passed.
+        """
+        if self.cancelled:
+            raise JobCancelledError(f'Job {self.job_id} {self.reason}')
+        now = time.monotonic()
+        if self.stage_deadline is not None and now >= self.stage_deadline:
+            raise JobTimeoutError(f'Job {self.job_id} timed out in stage {self.stage_name}')
+        if self.deadline is not None and now >= self.deadline:
+            raise JobTimeoutError(f'Job {self.job_id} timed out after {self.timeout:g} seconds')
+
+    @contextmanager
+    def stage(self, name: str, timeout: Optional[float] = None):
+        """
+        Marks a stage of the job, with its own optional timeout, and checks the token on entry and exit.
+        """
+        self.check()
+        previous = self.stage_name, self.stage_deadline
+        self.stage_name = name
+        self.stage_deadline = time.monotonic() + float(timeout) if timeout else None
+        try:
+            yield self
+            self.check()
+        finally:
+            self.stage_name, self.stage_deadline = previous
+
+    def _track(self, fn: Callable[[], T]) -> Callable[[], T]:
+        """
+        `fn` wrapped to record when it returns, for `when_stopped()`.
+        """
+        returned = threading.Event()
+        with self.lock:
+            self.calls = [call for call in self.calls if not call.is_set()] + [returned]
+
+        def tracked():
+            try:
+                return fn()
+            finally:
+                returned.set()
+        return tracked
+
+    def when_stopped(self, callback: Callable[[], None]) -> None:
+        """
+        Calls `callback` once every call started through `run()` or `run_async()` has returned: right away when
+        they all have, otherwise from a thread that waits for the abandoned ones.
+        """
+        with self.lock:
+            pending = [call for call in self.calls if not call.is_set()]
+        if not pending:
+            callback()
+            return
+        logger.info('Job %s waits for %d abandoned calls to stop', self.job_id, len(pending))
+
+        def wait():
+            for call in pending:
+                call.wait()
+            logger.info('Abandoned calls of job %s stopped', self.job_id)
+            callback()
+
+        threading.Thread(target=wait, daemon=True, name=f'job-{self.job_id}-stopping').start()
+
+    def run(self, fn: Callable[[], T], poll_interval: float = 0.5) -> T:
+        """
+        Runs `fn` on a daemon thread and waits for it while the token is live. Returns its result, re-raises its
+        exception, or raises `JobCancelledError`/`JobTimeoutError` without waiting for `fn` to return.
+        """
+        self.check()
+        future = Future()
+        fn = self._track(fn)
+
+        def target():
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=target, daemon=True, name=f'job-{self.job_id}').start()
+        while True:
+            self.check()
+            remaining = self.remaining()
+            wait = poll_interval if remaining is None else max(0.0, min(poll_interval, remaining))
+            try:
+                return future.result(timeout=wait)
+            except FutureTimeoutError:
+                continue
+
+    async def run_async(self, fn: Callable[[], T], executor: Optional[Executor] = None,
+                        poll_interval: float = 0.5) -> T:
+        """
+        Coroutine counterpart of `run`: runs `fn` on `executor`, the event loop's default executor when None, and
+        awaits it while the token is live, so waiting costs no thread.
+        """
+        self.check()
+        future = asyncio.get_running_loop().run_in_executor(executor, self._track(fn))
+        try:
+            while True:
+                self.check()
+                remaining = self.remaining()
+                wait = poll_interval if remaining is None else max(0.0, min(poll_interval, remaining))
+                done, _ = await asyncio.wait({future}, timeout=wait)
+                if done:
+                    return future.result()
+        except BaseException:
+            # The abandoned call keeps running; its outcome is no longer awaited
+            future.add_done_callback(lambda finished: finished.cancelled() or finished.exception())
+            raise
+
+
+class JobRegistry:
+    """
+    Tokens of the jobs running in this process, so they can be cancelled by job id.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens: Dict[str, CancellationToken] = {}
+
+    def register(self, token: CancellationToken) -> CancellationToken:
+        with self.lock:
+            self.tokens[token.job_id] = token
+        return token
+
+    def unregister(self, token: CancellationToken) -> None:
+        with self.lock:
+            if self.tokens.get(token.job_id) is token:
+                del self.tokens[token.job_id]
+
+    def cancel(self, job_id: str, reason: str = 'cancelled') -> bool:
+        """
+        Cancels a running job; returns False when no job with that id is running.
+        """
+        with self.lock:
+            token = self.tokens.get(job_id)
+        if token is None:
+            return False
+        token.cancel(reason)
+        return True
+
+    def __contains__(self, job_id: str) -> bool:
+        with self.lock:
+            return job_id in self.tokens
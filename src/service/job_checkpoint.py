@@ -0,0 +1,280 @@
+# Durable per-job checkpoints so redelivered jobs resume instead of starting over
+import os
+import json
+import time
+import logging
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+from src.service.helper import write_blob
+
+logging.basicConfig()
+logger = logging.getLogger('JobCheckpoint')
+logger.setLevel(logging.INFO)
+
+CHECKPOINT_FILE_NAME = 'checkpoint.json'
+
+
+class CheckpointStore(ABC):
+    """
+    Durable storage for job checkpoint documents.
+    """
+
+    @abstractmethod
+    def load(self, job_id: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def save(self, job_id: str, state: dict) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, job_id: str) -> None:
+        pass
+
+    def prune(self) -> int:
+        """
+        Removes the checkpoints of failed jobs that were not retried in time; returns how many were removed.
+        """
+        return 0
+
+
+class LocalCheckpointStore(CheckpointStore):
+    """
+    Stores checkpoints as `<folder>/<job_id>/checkpoint.json`, i.e. inside the job's download folder. A failed
+    job's checkpoint is kept for its retry; `prune` removes the checkpoints not written for `retention` seconds, at
+    most once every `prune_interval` seconds.
+
+    Parameters:
+    - `folder` (str): Folder holding the per-job folders.
+    - `retention` (float): Seconds a checkpoint is kept after its last write; 0 keeps checkpoints.
+    - `prune_interval` (float): Minimum seconds between two prunes.
+    """
+
+    def __init__(self, folder: str, retention: float = 0, prune_interval: float = 600):
+        self.folder = folder
+        self.retention = float(retention or 0)
+        self.prune_interval = float(prune_interval)
+        self.pruned_at = 0.0
+
+    def path(self, job_id: str) -> str:
+        return os.path.join(self.folder, job_id, CHECKPOINT_FILE_NAME)
+
+    def load(self, job_id: str) -> Optional[dict]:
+        path = self.path(job_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as file:
+            return json.load(file)
+
+    def save(self, job_id: str, state: dict) -> None:
+        path = self.path(job_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(state, file)
+        os.replace(temp_path, path)
+
+    def delete(self, job_id: str) -> None:
+        path = self.path(job_id)
+        if os.path.exists(path):
+            os.remove(path)
+        # The job's folder only held the checkpoint when its workspace was in memory
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+    def prune(self) -> int:
+        now = time.time()
+        if not self.retention or now - self.pruned_at < self.prune_interval:
+            return 0
+        self.pruned_at = now
+        try:
+            job_ids = os.listdir(self.folder)
+        except OSError:
+            return 0
+        removed = 0
+        for job_id in job_ids:
+            try:
+                if now - os.path.getmtime(self.path(job_id)) <= self.retention:
+                    continue
+                self.delete(job_id)
+            except OSError:
+                continue
+            removed += 1
+        if removed:
+            logger.info('Removed %d checkpoints older than %g seconds', removed, self.retention)
+        return removed
+
+
+class BlobCheckpointStore(CheckpointStore):
+    """
+    Stores checkpoints as `<prefix>/<job_id>.json` in the storage container.
+
+    Parameters:
+    - `storage_client` (StorageClient): Client for the storage service.
+    - `container_name` (str): Container holding the checkpoints.
+    - `prefix` (str): Folder inside the container.
+    """
+
+    def __init__(self, storage_client, container_name: str, prefix: str = 'checkpoints'):
+        self.storage_client = storage_client
+        self.container_name = container_name
+        self.prefix = prefix
+
+    def name(self, job_id: str) -> str:
+        return f'{self.prefix}/{job_id}.json'
+
+    def load(self, job_id: str) -> Optional[dict]:
+        try:
+            file = self.storage_client.get_file(self.container_name, self.name(job_id))
+            content = file.get_stream()
+        except Exception as e:
+            logger.info(f'No checkpoint found for {job_id}: {e}')
+            return None
+        return json.loads(content) if content else None
+
+    def save(self, job_id: str, state: dict) -> None:
+        # Every flush replaces the previous checkpoint
+        write_blob(self.storage_client, self.container_name, self.name(job_id), json.dumps(state).encode('utf-8'))
+
+    def delete(self, job_id: str) -> None:
+        try:
+            self.storage_client.get_file(self.container_name, self.name(job_id)).delete_file()
+        except Exception as e:
+            logger.info(f'Could not delete checkpoint for {job_id}: {e}')
+
+
+class JobCheckpoint:
+    """
+    Progress of one job: the hull score and the finished sub-region scores.
+
+    Sub-region results are buffered and written in batches, every `flush_every` results or `flush_interval`
+    seconds, on a background thread so the scoring loop does not wait on storage. A checkpoint whose
+    `fingerprint` differs from the current inputs is ignored.
+
+    Parameters:
+    - `store` (CheckpointStore): Where the checkpoint is persisted.
+    - `job_id` (str): The job identifier.
+    - `fingerprint` (str): Identifies the job inputs, e.g. the data and sub-region file URLs.
+    - `flush_every` (int): Number of new results that triggers a write.
+    - `flush_interval` (float): Seconds after which pending results are written.
+
+    Usage:
+    ```python
+    checkpoint = JobCheckpoint(store, job_id, fingerprint=data_file)
+    checkpoint.load()
+    found, score = checkpoint.get_sub_region_score(index)
+    checkpoint.record_sub_region(index, score)
+    checkpoint.close()
+    ```
+    """
+
+    def __init__(self, store: CheckpointStore, job_id: str, fingerprint: str = '', flush_every: int = 25,
+                 flush_interval: float = 30.0):
+        self.store = store
+        self.job_id = job_id
+        self.fingerprint = fingerprint
+        self.flush_every = max(1, int(flush_every))
+        self.flush_interval = float(flush_interval)
+        self.hull_score = None
+        self.sub_region_scores = {}
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'checkpoint-{job_id}')
+        self.last_write = None
+
+    def load(self) -> bool:
+        """
+        Restores a previous checkpoint for the job.
+
+        Returns:
+        - `resumed` (bool): True when a matching checkpoint was found.
+        """
+        try:
+            state = self.store.load(self.job_id)
+        except Exception as e:
+            logger.error(f'Failed to load checkpoint for {self.job_id}: {e}')
+            return False
+        if not state or state.get('fingerprint') != self.fingerprint:
+            return False
+        self.hull_score = state.get('hull_score')
+        self.sub_region_scores = {int(index): score for index, score in state.get('sub_region_scores', {}).items()}
+        logger.info('Resuming job %s from checkpoint with %d finished sub-regions', self.job_id,
+                    len(self.sub_region_scores))
+        return True
+
+    def get_sub_region_score(self, index: int) -> Tuple[bool, Optional[float]]:
+        with self.lock:
+            if index in self.sub_region_scores:
+                return True, self.sub_region_scores[index]
+            return False, None
+
+    def set_hull_score(self, score) -> None:
+        with self.lock:
+            self.hull_score = score
+        self.flush()
+
+    def record_sub_region(self, index: int, score) -> None:
+        with self.lock:
+            self.sub_region_scores[index] = score
+            self.pending += 1
+            due = self.pending >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def _snapshot(self) -> dict:
+        with self.lock:
+            self.pending = 0
+            self.last_flush = time.monotonic()
+            return {
+                'job_id': self.job_id,
+                'fingerprint': self.fingerprint,
+                'hull_score': self.hull_score,
+                'sub_region_scores': {str(index): score for index, score in self.sub_region_scores.items()}
+            }
+
+    def _write(self, state: dict) -> None:
+        try:
+            self.store.save(self.job_id, state)
+        except Exception as e:
+            logger.error(f'Failed to write checkpoint for {self.job_id}: {e}')
+
+    def flush(self) -> None:
+        """
+        Queues a write of the current state on the background thread.
+        """
+        self.last_write = self.executor.submit(self._write, self._snapshot())
+
+    def close(self) -> None:
+        """
+        Writes any pending results and waits for the writes to finish.
+        """
+        if self.pending:
+            self.flush()
+        self.executor.shutdown(wait=True)
+
+    def discard(self) -> None:
+        """
+        Stops writing and removes the checkpoint, once the job's response has been published.
+        """
+        self.executor.shutdown(wait=True)
+        try:
+            self.store.delete(self.job_id)
+        except Exception as e:
+            logger.error(f'Failed to delete checkpoint for {self.job_id}: {e}')
+
+
+def get_checkpoint_store(settings, storage_client=None) -> Optional[CheckpointStore]:
+    """
+    Builds the checkpoint store selected by `settings.checkpoint_store`: `local` (default), `blob` or `none`.
+    """
+    store = str(settings.checkpoint_store or 'none').lower()
+    if store == 'local':
+        return LocalCheckpointStore(settings.get_download_folder(), retention=float(settings.checkpoint_retention))
+    if store == 'blob':
+        return BlobCheckpointStore(storage_client, settings.storage_container_name)
+    return None
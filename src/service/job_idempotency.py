@@ -0,0 +1,446 @@
+# Idempotent processing of redelivered and duplicate job messages
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, asdict
+from typing import Dict, Optional
+from src.models.confidence_request import ConfidenceRequest
+from src.service.helper import write_blob, create_blob
+
+logging.basicConfig()
+logger = logging.getLogger('JobIdempotency')
+logger.setLevel(logging.INFO)
+
+RUNNING = 'running'
+COMPLETED = 'completed'
+# Finished on this pod, answered by another replica, e.g. a split job whose shards are merged elsewhere
+DEFERRED = 'deferred'
+# Request fields that do not change the result
+IGNORED_FIELDS = ('jobId', 'trigger_type', 'progressive', 'profile')
+
+
+class IdempotencyStore(ABC):
+    """
+    Storage for the records of running and completed jobs.
+
+    `shared` is True when several pods use the same records, so a running record may belong to a live job
+    elsewhere; a record in an unshared store belongs to this pod only.
+    """
+    shared = False
+
+    @abstractmethod
+    def load(self, key: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def save(self, key: str, record: dict) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    def create(self, key: str, record: dict) -> bool:
+        """
+        Saves the record of a job that has none; returns False when another claim created one first.
+        """
+        pass
+
+    @abstractmethod
+    def replace(self, key: str, current: dict, record: dict) -> bool:
+        """
+        Replaces the record `current`; returns False when another claim replaced it first.
+        """
+        pass
+
+    def release(self, key: str, record: dict) -> None:
+        """
+        Drops what `replace` kept to tell the claims of `record` apart, once the record is final.
+        """
+        pass
+
+    def prune(self) -> int:
+        """
+        Removes the expired records; returns how many were removed.
+        """
+        return 0
+
+
+class LocalIdempotencyStore(IdempotencyStore):
+    """
+    Stores records as `<folder>/<key>.json`, for the jobs of one pod. Records not written for `retention` seconds
+    are removed by `prune`, at most once every `prune_interval` seconds.
+
+    Parameters:
+    - `folder` (str): Folder holding the records.
+    - `retention` (float): Seconds a record is kept after its last write; 0 keeps records.
+    - `prune_interval` (float): Minimum seconds between two prunes.
+    """
+
+    def __init__(self, folder: str, retention: float = 0, prune_interval: float = 600):
+        self.folder = folder
+        self.retention = float(retention or 0)
+        self.prune_interval = float(prune_interval)
+        self.pruned_at = 0.0
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.folder, f'{key}.json')
+
+    def load(self, key: str) -> Optional[dict]:
+        try:
+            with open(self.path(key), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key: str, record: dict) -> None:
+        os.makedirs(self.folder, exist_ok=True)
+        temp_path = f'{self.path(key)}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(record, file)
+        os.replace(temp_path, self.path(key))
+
+    def delete(self, key: str) -> None:
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def create(self, key: str, record: dict) -> bool:
+        os.makedirs(self.folder, exist_ok=True)
+        try:
+            descriptor = os.open(self.path(key), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return False
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump(record, file)
+        return True
+
+    def replace(self, key: str, current: dict, record: dict) -> bool:
+        # The records belong to this pod, whose guard already serializes the claims of a key
+        self.save(key, record)
+        return True
+
+    def prune(self) -> int:
+        now = time.time()
+        if not self.retention or now - self.pruned_at < self.prune_interval:
+            return 0
+        self.pruned_at = now
+        removed = 0
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return 0
+        for name in names:
+            path = os.path.join(self.folder, name)
+            try:
+                if now - os.path.getmtime(path) > self.retention:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            logger.info('Removed %d idempotency records older than %g seconds', removed, self.retention)
+        return removed
+
+
+class BlobIdempotencyStore(IdempotencyStore):
+    """
+    Stores records as `<prefix>/<key>.json` in the storage container, shared by all pods.
+
+    A record is created only if the job has none, and an existing record is replaced only by the claim that
+    first creates the marker `<prefix>/<key>.<attempt>.claim` for the attempt it replaces, so of several pods
+    claiming the same job exactly one owns it.
+
+    Parameters:
+    - `storage_client` (StorageClient): Client for the storage service.
+    - `container_name` (str): Container holding the records.
+    - `prefix` (str): Folder inside the container.
+    """
+    shared = True
+
+    def __init__(self, storage_client, container_name: str, prefix: str = 'idempotency'):
+        self.storage_client = storage_client
+        self.container_name = container_name
+        self.prefix = prefix
+
+    def name(self, key: str) -> str:
+        return f'{self.prefix}/{key}.json'
+
+    def load(self, key: str) -> Optional[dict]:
+        try:
+            content = self.storage_client.get_file(self.container_name, self.name(key)).get_stream()
+        except Exception as e:
+            logger.info(f'No idempotency record for {key}: {e}')
+            return None
+        return json.loads(content) if content else None
+
+    def save(self, key: str, record: dict) -> None:
+        # Heartbeats and the completed record replace the running record
+        write_blob(self.storage_client, self.container_name, self.name(key), json.dumps(record).encode('utf-8'))
+
+    def delete(self, key: str) -> None:
+        self._delete(key, self.name(key))
+
+    def _delete(self, key: str, name: str) -> None:
+        try:
+            self.storage_client.get_file(self.container_name, name).delete_file()
+        except Exception as e:
+            logger.info(f'Could not delete {name} of job {key}: {e}')
+
+    def claim_name(self, key: str, attempt: str) -> str:
+        return f'{self.prefix}/{key}.{attempt}.claim'
+
+    def create(self, key: str, record: dict) -> bool:
+        return create_blob(self.storage_client, self.container_name, self.name(key),
+                           json.dumps(record).encode('utf-8'))
+
+    def replace(self, key: str, current: dict, record: dict) -> bool:
+        attempt = current.get('attempt') or f'{current.get("owner")}-{current.get("started")}'
+        if not create_blob(self.storage_client, self.container_name, self.claim_name(key, attempt), b''):
+            return False
+        record['replaces'] = attempt
+        self.save(key, record)
+        return True
+
+    def release(self, key: str, record: dict) -> None:
+        if record.get('replaces'):
+            self._delete(key, self.claim_name(key, record['replaces']))
+
+
+def get_idempotency_store(settings, storage_client=None) -> Optional[IdempotencyStore]:
+    """
+    Builds the store selected by `settings.idempotency_store`: `local` (default), `blob` or `none`.
+    """
+    store = str(settings.idempotency_store or 'none').lower()
+    if store == 'local':
+        return LocalIdempotencyStore(os.path.join(settings.get_download_folder(), 'idempotency'),
+                                     retention=float(settings.idempotency_retention or settings.idempotency_ttl))
+    if store == 'blob':
+        return BlobIdempotencyStore(storage_client, settings.storage_container_name)
+    return None
+
+
+@dataclass
+class JobClaim:
+    """
+    Outcome of claiming a job.
+
+    Attributes:
+    - `key` (str): The job's record key.
+    - `fingerprint` (str): Identifies the job inputs.
+    - `owned` (bool): True when this message must compute the job.
+    - `response` (dict): The stored response data to replay when the job was already computed, or None when it is
+            deferred and not answered yet.
+    """
+    key: str
+    fingerprint: str
+    owned: bool
+    response: Optional[dict] = None
+
+
+class IdempotencyGuard:
+    """
+    Makes sure a job is computed once however often its message is delivered.
+
+    Jobs are keyed by `jobId` and compared by the fingerprint of their inputs, so a re-triggered job with other
+    inputs is computed again. A duplicate of a job running on this pod waits for it, one of a job running on
+    another pod polls the shared record until it completes, and either then gets the stored response replayed.
+    Completed records are replayed for `ttl` seconds. A running job refreshes its record every third of
+    `stale_after` seconds; a record not refreshed for longer belongs to a crashed attempt and is taken over.
+    Failed jobs leave no record, so their redelivery computes them again and resumes from their checkpoint.
+    A job whose response is published elsewhere, such as a split job answered by the merge of its shards, is
+    recorded as deferred: its duplicates are dropped until `complete` records the response for replay.
+
+    The record is claimed with the store's atomic `create` or `replace`, so of two pods receiving the same job
+    at the same moment only one computes it; the other waits for its record like any duplicate.
+
+    Parameters:
+    - `store` (IdempotencyStore): Where the records are kept.
+    - `ttl` (float): Seconds a completed job is replayed.
+    - `stale_after` (float): Seconds without a heartbeat after which a running job is taken over.
+    - `poll_interval` (float): Seconds between checks of a job running on another pod.
+
+    Usage:
+    ```python
+    guard = IdempotencyGuard(store)
+    claim = guard.claim(request)
+    if claim.owned:
+        try:
+            response = run(request)
+        finally:
+            guard.finish(claim, response)
+    else:
+        replay(claim.response)
+    ```
+    """
+
+    def __init__(self, store: IdempotencyStore, ttl: float = 86400, stale_after: float = 300,
+                 poll_interval: float = 10):
+        self.store = store
+        self.ttl = float(ttl)
+        self.stale_after = float(stale_after)
+        self.poll_interval = float(poll_interval)
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.lock = threading.Lock()
+        # Serializes writes, so a heartbeat never overwrites the completed record
+        self.save_lock = threading.Lock()
+        self.running: Dict[str, threading.Event] = {}
+        self.records: Dict[str, dict] = {}
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+
+    @classmethod
+    def from_settings(cls, settings, storage_client=None) -> Optional['IdempotencyGuard']:
+        store = get_idempotency_store(settings, storage_client)
+        if store is None:
+            return None
+        return cls(store, ttl=float(settings.idempotency_ttl), stale_after=float(settings.idempotency_stale_after),
+                   poll_interval=float(settings.idempotency_poll_interval))
+
+    @staticmethod
+    def key(request: ConfidenceRequest) -> str:
+        return str(request.data.jobId)
+
+    @staticmethod
+    def fingerprint(request: ConfidenceRequest) -> str:
+        inputs = {name: value for name, value in asdict(request.data).items() if name not in IGNORED_FIELDS}
+        return json.dumps(inputs, sort_keys=True, default=str)
+
+    def claim(self, request: ConfidenceRequest) -> JobClaim:
+        """
+        Claims the job for this message, or waits for the attempt already running and returns its response.
+        """
+        key, fingerprint = self.key(request), self.fingerprint(request)
+        while True:
+            with self.lock:
+                local = self.running.get(key)
+            if local is not None:
+                logger.info('Job %s is already running on this pod, waiting for it', key)
+                local.wait()
+                continue
+
+            record = self.store.load(key)
+            if record is not None and record.get('fingerprint') == fingerprint:
+                now = time.time()
+                if record.get('state') == COMPLETED and now - record.get('completed', 0) < self.ttl:
+                    logger.info('Job %s was already computed, replaying its response', key)
+                    return JobClaim(key, fingerprint, owned=False, response=record.get('response'))
+                if record.get('state') == DEFERRED and now - record.get('completed', 0) < self.ttl:
+                    logger.info('Job %s was already computed and waits to be answered elsewhere', key)
+                    return JobClaim(key, fingerprint, owned=False)
+                if record.get('state') == RUNNING and self.store.shared and \
+                        now - record.get('heartbeat', 0) < self.stale_after:
+                    logger.info('Job %s is running on %s, waiting for it', key, record.get('owner'))
+                    time.sleep(self.poll_interval)
+                    continue
+
+            with self.lock:
+                if key in self.running:
+                    continue
+                self.running[key] = threading.Event()
+                self.records[key] = {'state': RUNNING, 'fingerprint': fingerprint, 'owner': self.owner,
+                                     'attempt': uuid.uuid4().hex, 'started': time.time(), 'heartbeat': time.time()}
+            if not self._claim(key, record):
+                logger.info('Job %s was claimed by another pod first', key)
+                with self.lock:
+                    self.records.pop(key, None)
+                    self.running.pop(key).set()
+                continue
+            self._start_heartbeat()
+            return JobClaim(key, fingerprint, owned=True)
+
+    def finish(self, claim: JobClaim, response: Optional[dict], deferred: bool = False) -> None:
+        """
+        Records the response of a computed job for replay, or that a `deferred` job is answered elsewhere, or drops
+        the record of a failed one, and releases the duplicates waiting on this pod.
+        """
+        try:
+            with self.save_lock:
+                with self.lock:
+                    record = self.records.pop(claim.key, None)
+                if deferred and record is not None:
+                    record.update({'state': DEFERRED, 'completed': time.time()})
+                    self.store.save(claim.key, record)
+                elif response is not None and record is not None:
+                    record.update({'state': COMPLETED, 'completed': time.time(), 'response': response})
+                    self.store.save(claim.key, record)
+                else:
+                    self.store.delete(claim.key)
+                if record is not None:
+                    self.store.release(claim.key, record)
+            self.store.prune()
+        except Exception as e:
+            logger.error(f'Failed to record the outcome of job {claim.key}: {e}')
+        finally:
+            with self.lock:
+                event = self.running.pop(claim.key, None)
+            if event is not None:
+                event.set()
+
+    def complete(self, key: str, response: Optional[dict]) -> None:
+        """
+        Records the response of a deferred job once it was published, on whichever pod answered it, or drops the
+        record when the job failed so that its redelivery computes it again.
+        """
+        try:
+            with self.save_lock:
+                record = self.store.load(key)
+                if record is None or record.get('state') != DEFERRED:
+                    return
+                if response is None:
+                    self.store.delete(key)
+                    return
+                record.update({'state': COMPLETED, 'completed': time.time(), 'response': response})
+                self.store.save(key, record)
+        except Exception as e:
+            logger.error(f'Failed to record the outcome of deferred job {key}: {e}')
+
+    def _claim(self, key: str, current: Optional[dict]) -> bool:
+        """
+        Writes the running record of a claim, in place of `current`; a claim whose record cannot be written is
+        owned anyway, as before the guard could tell.
+        """
+        try:
+            with self.save_lock:
+                with self.lock:
+                    record = self.records[key]
+                if current is None:
+                    return self.store.create(key, record)
+                return self.store.replace(key, current, record)
+        except Exception as e:
+            logger.error(f'Failed to claim the idempotency record of job {key}: {e}')
+            return True
+
+    def _save(self, key: str) -> None:
+        try:
+            with self.save_lock:
+                with self.lock:
+                    record = dict(self.records[key]) if key in self.records else None
+                if record is not None:
+                    self.store.save(key, record)
+        except Exception as e:
+            logger.error(f'Failed to save the idempotency record of job {key}: {e}')
+
+    def _start_heartbeat(self) -> None:
+        with self.lock:
+            if self.heartbeat_thread is not None:
+                return
+            self.heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True, name='idempotency')
+            self.heartbeat_thread.start()
+
+    def _heartbeat(self) -> None:
+        while not self.stopped.wait(self.stale_after / 3):
+            with self.lock:
+                keys = list(self.records)
+                for key in keys:
+                    self.records[key]['heartbeat'] = time.time()
+            for key in keys:
+                self._save(key)
+
+    def stop(self) -> None:
+        self.stopped.set()
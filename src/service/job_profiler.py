@@ -0,0 +1,269 @@
+# Opt-in per-job CPU and memory profiling
+import io
+import os
+import time
+import shutil
+import marshal
+import pstats
+import logging
+import cProfile
+import threading
+import tracemalloc
+from typing import Callable, List, Optional, Set, TypeVar
+from src.service.helper import write_blob
+
+logging.basicConfig()
+logger = logging.getLogger('JobProfiler')
+logger.setLevel(logging.INFO)
+
+T = TypeVar('T')
+
+# tracemalloc is process wide; it runs while at least one profiled job is running, and its peak is reset only
+# when no other profiled job is running, so it is a job's own peak only if the job ran alone
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_profilers: Set['JobProfiler'] = set()
+
+
+def _start_tracemalloc(profiler: 'JobProfiler') -> None:
+    with _tracemalloc_lock:
+        if not _tracemalloc_profilers:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        else:
+            for other in _tracemalloc_profilers:
+                other.peak_shared = True
+            profiler.peak_shared = True
+        _tracemalloc_profilers.add(profiler)
+
+
+def _stop_tracemalloc(profiler: 'JobProfiler') -> int:
+    """
+    Stops tracing for `profiler` and returns the peak traced memory since it started.
+    """
+    with _tracemalloc_lock:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        _tracemalloc_profilers.discard(profiler)
+        if not _tracemalloc_profilers:
+            tracemalloc.stop()
+    return peak_bytes
+
+
+def profiled(profiler: Optional['JobProfiler'], fn: Callable[[], T]) -> Callable[[], T]:
+    """
+    `fn` run under `profiler` when the job is profiled, `fn` itself otherwise.
+    """
+    return fn if profiler is None else lambda: profiler.call(fn)
+
+
+class _ReceivedProfile:
+    """
+    Profile data exported by another process, in the form `pstats.Stats` loads a profile from.
+    """
+
+    def __init__(self, stats: dict):
+        self.received = stats
+        self.stats = {}
+
+    def create_stats(self) -> None:
+        # pstats takes the stats over and clears them, so every load gets its own copy
+        self.stats = dict(self.received)
+
+
+class JobProfiler:
+    """
+    Deterministic profile and allocation snapshot of one job.
+
+    `cProfile` follows one thread, so each piece of the job that runs on a worker thread is passed through `call()`.
+    Work in dask worker processes is not profiled; it shows up as time waiting on the scheduler. `tracemalloc`
+    traces the whole process, so the allocation sites of jobs running at the same time are mixed, and the peak
+    memory of a job that overlapped another profiled job is the peak of the process, reported as such.
+
+    A job scored in a worker process of the `WorkerPool` is profiled there by a profiler of its own, whose
+    `export()` is sent back and added to the service's profiler with `merge()`: the report then holds the functions
+    of both processes, and the peak memory and allocation sites of the worker separately.
+
+    Parameters:
+    - `job_id` (str): The job identifier.
+    - `top` (int): Functions and allocation sites listed in the report.
+
+    Usage:
+    ```python
+    profiler = JobProfiler(job_id)
+    profiler.start()
+    scores = profiler.call(metric.calculate_score)
+    profiler.stop()
+    profiler.save(folder)
+    ```
+    """
+
+    def __init__(self, job_id: str, top: int = 30):
+        self.job_id = job_id
+        self.top = max(1, int(top))
+        self.profiles: List[cProfile.Profile] = []
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.peak_bytes = 0
+        self.peak_shared = False
+        self.started = None
+        self.elapsed = 0.0
+        self.running = False
+        self.worker_peak_bytes = 0
+        self.worker_allocations: List[str] = []
+
+    def start(self) -> None:
+        _start_tracemalloc(self)
+        self.started = time.monotonic()
+        self.running = True
+
+    def stop(self) -> None:
+        if not self.running:
+            return
+        self.running = False
+        self.elapsed = time.monotonic() - self.started
+        self.snapshot = tracemalloc.take_snapshot()
+        self.peak_bytes = _stop_tracemalloc(self)
+
+    def call(self, fn: Callable[[], T]) -> T:
+        """
+        Runs `fn` on the current thread under the profiler and returns its result.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Another profiler is active on this thread
+            logger.info(f'Could not profile job {self.job_id}: {e}')
+            return fn()
+        try:
+            return fn()
+        finally:
+            profile.disable()
+            with self.lock:
+                self.profiles.append(profile)
+
+    def stats(self) -> Optional[pstats.Stats]:
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0], stream=io.StringIO())
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def export(self) -> dict:
+        """
+        The profile of a stopped profiler in picklable form, for `merge()` in another process.
+        """
+        stats = self.stats()
+        return {
+            'stats': stats.stats if stats is not None else {},
+            'peak_bytes': self.peak_bytes,
+            'allocations': [str(statistic) for statistic in self.snapshot.statistics('lineno')[:self.top]]
+            if self.snapshot is not None else []
+        }
+
+    def merge(self, exported: dict) -> None:
+        """
+        Adds the `export()` of the profiler of a worker process that ran part of the job.
+        """
+        with self.lock:
+            if exported.get('stats'):
+                self.profiles.append(_ReceivedProfile(exported['stats']))
+            self.worker_peak_bytes = max(self.worker_peak_bytes, int(exported.get('peak_bytes') or 0))
+            self.worker_allocations = list(exported.get('allocations') or [])
+
+    def report(self) -> str:
+        """
+        Text report: the slowest functions by cumulative time, then the top allocation sites.
+        """
+        out = io.StringIO()
+        peak = f'peak traced memory {self.peak_bytes / 1024 / 1024:.1f} MB'
+        if self.peak_shared:
+            peak = f'{peak} in the process, shared with other profiled jobs running at the same time'
+        out.write(f'Job {self.job_id}: {self.elapsed:.1f} s, {peak}\n')
+        if self.worker_peak_bytes:
+            out.write(f'Peak traced memory in the worker process {self.worker_peak_bytes / 1024 / 1024:.1f} MB\n')
+        out.write('\n')
+        stats = self.stats()
+        if stats is not None:
+            stats.stream = out
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+        if self.snapshot is not None:
+            out.write(f'Top {self.top} allocation sites\n')
+            for statistic in self.snapshot.statistics('lineno')[:self.top]:
+                out.write(f'{statistic}\n')
+        if self.worker_allocations:
+            out.write(f'\nTop {self.top} allocation sites in the worker process\n')
+            for statistic in self.worker_allocations:
+                out.write(f'{statistic}\n')
+        return out.getvalue()
+
+    def artifacts(self) -> dict:
+        """
+        File name and content of each output: `<job_id>.pstats` for pstats, snakeviz or flameprof, and
+        `<job_id>_profile.txt` with the report.
+        """
+        files = {f'{self.job_id}_profile.txt': self.report().encode('utf-8')}
+        stats = self.stats()
+        if stats is not None:
+            # Same format as `Stats.dump_stats`, which only writes to a path
+            files[f'{self.job_id}.pstats'] = marshal.dumps(stats.stats)
+        return files
+
+    def save(self, folder: str) -> List[str]:
+        """
+        Writes the outputs to `folder` and returns their paths.
+        """
+        os.makedirs(folder, exist_ok=True)
+        paths = []
+        for name, content in self.artifacts().items():
+            path = os.path.join(folder, name)
+            with open(path, 'wb') as file:
+                file.write(content)
+            paths.append(path)
+        logger.info('Saved the profile of job %s to %s', self.job_id, folder)
+        return paths
+
+    def upload(self, storage_client, container_name: str, prefix: str = 'profiles') -> List[str]:
+        """
+        Uploads the outputs to `<prefix>/<job_id>/` in the storage container, replacing those of an earlier run of
+        the job, and returns their names.
+        """
+        names = []
+        for name, content in self.artifacts().items():
+            remote_name = f'{prefix}/{self.job_id}/{name}'
+            write_blob(storage_client, container_name, remote_name, content)
+            names.append(remote_name)
+        logger.info('Uploaded the profile of job %s to %s/%s', self.job_id, container_name, prefix)
+        return names
+
+
+def prune_profiles(folder: str, retention: float) -> int:
+    """
+    Removes the profiles saved under `folder`, one folder per job, that are older than `retention` seconds.
+
+    Returns:
+    - `removed` (int): Number of job profiles removed.
+    """
+    if not retention:
+        return 0
+    now = time.time()
+    try:
+        job_ids = os.listdir(folder)
+    except OSError:
+        return 0
+    removed = 0
+    for job_id in job_ids:
+        path = os.path.join(folder, job_id)
+        try:
+            if now - os.path.getmtime(path) <= retention:
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+    if removed:
+        logger.info('Removed %d profiles older than %g seconds', removed, retention)
+    return removed
@@ -0,0 +1,221 @@
+# Cost-based admission control and size-aware scheduling of confidence jobs
+import heapq
+import asyncio
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+logging.basicConfig()
+logger = logging.getLogger('JobScheduler')
+logger.setLevel(logging.INFO)
+
+# Cost units contributed by each input; one unit is roughly one OSM-bound scoring step.
+COST_PER_ZIP_MB = 1.0
+COST_PER_HULL_KM2 = 0.5
+COST_PER_SUB_REGION = 2.0
+
+
+class JobRejectedError(Exception):
+    """
+    Raised when a job's estimated cost exceeds the configured budget.
+    """
+    pass
+
+
+@dataclass
+class JobCostEstimate:
+    """
+    Cheap estimate of the work a job will take, computed before scoring starts.
+
+    Attributes:
+    - `zip_size_bytes` (int): Size of the dataset zip from the blob metadata.
+    - `hull_area_km2` (float): Area of the dataset hull in square kilometres.
+    - `sub_region_count` (int): Number of features in the sub-regions file.
+    """
+    zip_size_bytes: int = 0
+    hull_area_km2: float = 0.0
+    sub_region_count: int = 0
+
+    @property
+    def cost(self) -> float:
+        return (self.zip_size_bytes / (1024 * 1024)) * COST_PER_ZIP_MB + \
+            self.hull_area_km2 * COST_PER_HULL_KM2 + \
+            self.sub_region_count * COST_PER_SUB_REGION
+
+
+class PriorityLane:
+    """
+    Bounded pool of execution slots; when slots are busy, waiting jobs are admitted cheapest first.
+
+    A job waits for its slot either on a thread, with `slot()`, or on an event loop, with `acquire_async()`,
+    which holds no thread while it waits. Both give up their place in the queue when `check` raises, so a job
+    that is cancelled or times out while queued does not wait on.
+
+    Parameters:
+    - `name` (str): Lane name used in logs.
+    - `size` (int): Number of jobs that can run in the lane at once.
+    """
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = max(1, int(size))
+        self.active = 0
+        self.waiting = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def _enqueue(self, cost: float) -> tuple:
+        with self.condition:
+            entry = (cost, next(self.counter))
+            heapq.heappush(self.waiting, entry)
+            return entry
+
+    def _take(self, entry: tuple) -> bool:
+        """
+        Takes a slot for `entry` if one is free and no cheaper job waits; the caller holds the condition.
+        """
+        if self.active >= self.size or self.waiting[0] != entry:
+            return False
+        heapq.heappop(self.waiting)
+        self.active += 1
+        self.condition.notify_all()
+        return True
+
+    def _dequeue(self, entry: tuple) -> None:
+        with self.condition:
+            self.waiting.remove(entry)
+            heapq.heapify(self.waiting)
+            self.condition.notify_all()
+
+    def release(self) -> None:
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, cost: float, check: Optional[Callable[[], None]] = None, poll_interval: float = 0.5):
+        entry = self._enqueue(cost)
+        try:
+            with self.condition:
+                while not self._take(entry):
+                    if check is not None:
+                        check()
+                    self.condition.wait(poll_interval if check is not None else None)
+        except BaseException:
+            self._dequeue(entry)
+            raise
+        try:
+            yield self
+        finally:
+            self.release()
+
+    async def acquire_async(self, cost: float, check: Optional[Callable[[], None]] = None,
+                            poll_interval: float = 0.05) -> None:
+        """
+        Waits for a slot on the running event loop; the caller gives it back with `release()`.
+        """
+        entry = self._enqueue(cost)
+        try:
+            while True:
+                with self.condition:
+                    if self._take(entry):
+                        return
+                if check is not None:
+                    check()
+                await asyncio.sleep(poll_interval)
+        except BaseException:
+            self._dequeue(entry)
+            raise
+
+
+class JobScheduler:
+    """
+    Routes jobs to a fast lane or a capped slow lane by estimated cost, and rejects jobs over budget.
+
+    Parameters:
+    - `small_job_cost` (float): Jobs with a cost up to this value run in the fast lane.
+    - `fast_lane_size` (int): Concurrent small jobs.
+    - `slow_lane_size` (int): Concurrent large jobs.
+    - `cost_budget` (float): Jobs above this cost are rejected; 0 disables the check.
+
+    Usage:
+    ```python
+    scheduler = JobScheduler(small_job_cost=50, fast_lane_size=2, slow_lane_size=1, cost_budget=5000)
+    with scheduler.slot(estimate):
+        scores = metric.calculate_score()
+    ```
+    """
+
+    def __init__(self, small_job_cost: float, fast_lane_size: int, slow_lane_size: int, cost_budget: float = 0):
+        self.small_job_cost = float(small_job_cost)
+        self.cost_budget = float(cost_budget)
+        self.fast_lane = PriorityLane('fast', fast_lane_size)
+        self.slow_lane = PriorityLane('slow', slow_lane_size)
+
+    @classmethod
+    def from_settings(cls, settings) -> 'JobScheduler':
+        """
+        Builds the scheduler from the settings, with the lane sizes fitted to `max_concurrent_messages`.
+
+        The lanes only order the messages already pulled from the queue, so a small job can only overtake large
+        ones when the slow lane cannot take every pulled message. The slow lane is therefore capped at one less
+        than `max_concurrent_messages`; with a single message in flight the lanes cannot reorder anything.
+        """
+        concurrency = max(1, int(settings.max_concurrent_messages))
+        fast_lane_size = int(settings.fast_lane_size) or concurrency
+        slow_lane_size = max(1, int(settings.slow_lane_size))
+        if concurrency == 1:
+            logger.warning('MAX_CONCURRENT_MESSAGES is 1, so a small job waits for the large job ahead of it; '
+                           'raise it above SLOW_LANE_SIZE for the fast lane to take effect')
+        elif slow_lane_size >= concurrency:
+            logger.warning('SLOW_LANE_SIZE %d would let large jobs hold all %d messages in flight, capping it at %d',
+                           slow_lane_size, concurrency, concurrency - 1)
+            slow_lane_size = concurrency - 1
+        return cls(small_job_cost=settings.small_job_cost, fast_lane_size=fast_lane_size,
+                   slow_lane_size=slow_lane_size, cost_budget=settings.job_cost_budget)
+
+    def check_budget(self, estimate: JobCostEstimate, job_id: Optional[str] = None) -> None:
+        """
+        Raises `JobRejectedError` if the estimate exceeds the budget.
+        """
+        if self.cost_budget > 0 and estimate.cost > self.cost_budget:
+            raise JobRejectedError(
+                f'Job {job_id} rejected: estimated cost {estimate.cost:.1f} exceeds the budget of '
+                f'{self.cost_budget:.1f} (zip {estimate.zip_size_bytes} bytes, hull {estimate.hull_area_km2:.2f} km2, '
+                f'{estimate.sub_region_count} sub-regions)')
+
+    def lane_for(self, estimate: JobCostEstimate) -> PriorityLane:
+        return self.fast_lane if estimate.cost <= self.small_job_cost else self.slow_lane
+
+    @contextmanager
+    def slot(self, estimate: JobCostEstimate, job_id: Optional[str] = None,
+             check: Optional[Callable[[], None]] = None):
+        """
+        Checks the budget, then waits for a slot in the job's lane and holds it for the `with` block. While the job
+        waits, `check`, such as the job's `CancellationToken.check`, is called every so often and may raise to give
+        up the wait.
+        """
+        lane = self.queue(estimate, job_id=job_id)
+        with lane.slot(estimate.cost, check=check):
+            logger.info('Job %s started in the %s lane', job_id, lane.name)
+            yield lane
+
+    async def acquire_async(self, estimate: JobCostEstimate, job_id: Optional[str] = None,
+                            check: Optional[Callable[[], None]] = None) -> Callable[[], None]:
+        """
+        Coroutine counterpart of `slot`: waits for the slot on the event loop without holding a thread, and
+        returns the function that gives the slot back.
+        """
+        lane = self.queue(estimate, job_id=job_id)
+        await lane.acquire_async(estimate.cost, check=check)
+        logger.info('Job %s started in the %s lane', job_id, lane.name)
+        return lane.release
+
+    def queue(self, estimate: JobCostEstimate, job_id: Optional[str] = None) -> PriorityLane:
+        self.check_budget(estimate, job_id=job_id)
+        lane = self.lane_for(estimate)
+        logger.info('Job %s with estimated cost %.1f queued in the %s lane', job_id, estimate.cost, lane.name)
+        return lane
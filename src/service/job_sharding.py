@@ -0,0 +1,449 @@
+# Fan-out/fan-in of the sub-regions of a large job across service replicas
+import os
+import json
+import time
+import uuid
+import logging
+from abc import ABC, abstractmethod
+from dataclasses import asdict
+from typing import Callable, List, Optional, Tuple
+from src.models.confidence_request import ConfidenceRequest
+from src.service.helper import write_blob, create_blob
+
+logging.basicConfig()
+logger = logging.getLogger('JobSharding')
+logger.setLevel(logging.INFO)
+
+# Names of the documents kept next to the shard results of a job
+JOB_DOCUMENT = 'job'
+MERGE_CLAIM = 'merge'
+
+
+class ShardResultStore(ABC):
+    """
+    Storage shared by every replica for the shards of a job: the sub-regions of every shard, the results they
+    report, and the job's partial results waiting for them.
+
+    Documents are JSON objects named by the shard index, `job` or `merge`; shard inputs are GeoJSON files.
+    """
+
+    @abstractmethod
+    def load(self, parent_job_id: str, name: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def save(self, parent_job_id: str, name: str, document: dict) -> None:
+        pass
+
+    @abstractmethod
+    def create(self, parent_job_id: str, name: str, document: dict) -> bool:
+        """
+        Saves the document unless it already exists, atomically across replicas.
+
+        Returns:
+        - `created` (bool): False when the document already existed.
+        """
+
+    @abstractmethod
+    def delete(self, parent_job_id: str, name: str) -> None:
+        pass
+
+    @abstractmethod
+    def load_input(self, parent_job_id: str, index: int) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    def save_input(self, parent_job_id: str, index: int, content: bytes) -> None:
+        pass
+
+    @abstractmethod
+    def delete_input(self, parent_job_id: str, index: int) -> None:
+        pass
+
+
+class LocalShardResultStore(ShardResultStore):
+    """
+    Stores documents as `<folder>/<parentJobId>/<name>.json` and shard inputs as
+    `<folder>/<parentJobId>/<index>.geojson`, for replicas sharing a file system.
+
+    Parameters:
+    - `folder` (str): Folder holding the shards.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+
+    def path(self, parent_job_id: str, name: str) -> str:
+        return os.path.join(self.folder, parent_job_id, f'{name}.json')
+
+    def input_path(self, parent_job_id: str, index: int) -> str:
+        return os.path.join(self.folder, parent_job_id, f'{index}.geojson')
+
+    def load(self, parent_job_id: str, name: str) -> Optional[dict]:
+        try:
+            with open(self.path(parent_job_id, name), 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, parent_job_id: str, name: str, document: dict) -> None:
+        self._write(self.path(parent_job_id, name), json.dumps(document).encode('utf-8'))
+
+    def create(self, parent_job_id: str, name: str, document: dict) -> bool:
+        path = self.path(parent_job_id, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump(document, file)
+        return True
+
+    def delete(self, parent_job_id: str, name: str) -> None:
+        self._remove(self.path(parent_job_id, name))
+
+    def load_input(self, parent_job_id: str, index: int) -> Optional[bytes]:
+        try:
+            with open(self.input_path(parent_job_id, index), 'rb') as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def save_input(self, parent_job_id: str, index: int, content: bytes) -> None:
+        self._write(self.input_path(parent_job_id, index), content)
+
+    def delete_input(self, parent_job_id: str, index: int) -> None:
+        self._remove(self.input_path(parent_job_id, index))
+
+    @staticmethod
+    def _write(path: str, content: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(content)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        if os.path.exists(path):
+            os.remove(path)
+        # The job's folder goes with its last file
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+
+class BlobShardResultStore(ShardResultStore):
+    """
+    Stores documents as `<prefix>/<parentJobId>/<name>.json` and shard inputs as
+    `<prefix>/<parentJobId>/<index>.geojson` in the storage container.
+
+    Parameters:
+    - `storage_client` (StorageClient): Client for the storage service.
+    - `container_name` (str): Container holding the shards.
+    - `prefix` (str): Folder inside the container.
+    """
+
+    def __init__(self, storage_client, container_name: str, prefix: str = 'shards'):
+        self.storage_client = storage_client
+        self.container_name = container_name
+        self.prefix = prefix
+
+    def name(self, parent_job_id: str, name: str) -> str:
+        return f'{self.prefix}/{parent_job_id}/{name}.json'
+
+    def input_name(self, parent_job_id: str, index: int) -> str:
+        return f'{self.prefix}/{parent_job_id}/{index}.geojson'
+
+    def load(self, parent_job_id: str, name: str) -> Optional[dict]:
+        content = self._read(self.name(parent_job_id, name))
+        return json.loads(content) if content else None
+
+    def save(self, parent_job_id: str, name: str, document: dict) -> None:
+        # A retried shard replaces the result of its earlier attempt
+        write_blob(self.storage_client, self.container_name, self.name(parent_job_id, name),
+                   json.dumps(document).encode('utf-8'))
+
+    def create(self, parent_job_id: str, name: str, document: dict) -> bool:
+        return create_blob(self.storage_client, self.container_name, self.name(parent_job_id, name),
+                           json.dumps(document).encode('utf-8'))
+
+    def delete(self, parent_job_id: str, name: str) -> None:
+        self._delete(self.name(parent_job_id, name))
+
+    def load_input(self, parent_job_id: str, index: int) -> Optional[bytes]:
+        return self._read(self.input_name(parent_job_id, index))
+
+    def save_input(self, parent_job_id: str, index: int, content: bytes) -> None:
+        write_blob(self.storage_client, self.container_name, self.input_name(parent_job_id, index), content)
+
+    def delete_input(self, parent_job_id: str, index: int) -> None:
+        self._delete(self.input_name(parent_job_id, index))
+
+    def _read(self, file_name: str) -> Optional[bytes]:
+        try:
+            return self.storage_client.get_file(self.container_name, file_name).get_stream()
+        except Exception:
+            return None
+
+    def _delete(self, file_name: str) -> None:
+        try:
+            self.storage_client.get_file(self.container_name, file_name).delete_file()
+        except Exception as e:
+            logger.info(f'Could not delete {file_name}: {e}')
+
+
+def get_shard_store(settings, storage_client=None) -> ShardResultStore:
+    """
+    Builds the store selected by `settings.shard_store`: `blob` (default) or `local`.
+    """
+    if str(settings.shard_store or 'blob').lower() == 'local':
+        return LocalShardResultStore(os.path.join(settings.get_download_folder(), 'shards'))
+    return BlobShardResultStore(storage_client, settings.storage_container_name)
+
+
+def plan_shards(sub_region_count: int, shard_size: int) -> List[Tuple[int, int]]:
+    """
+    Splits the sub-region positions `[0, sub_region_count)` into consecutive `(start, end)` ranges of at most
+    `shard_size` sub-regions.
+    """
+    return [(start, min(start + shard_size, sub_region_count)) for start in range(0, sub_region_count, shard_size)]
+
+
+def merge_scores(results: dict, order: List[int], scores: List) -> dict:
+    """
+    Fills sub-region scores into results built without them: the `scores` entries of the `scores` response format,
+    or the sub-region features following the hull otherwise.
+
+    Parameters:
+    - `results` (dict): The job's results, listing the sub-regions in file order.
+    - `order` (list): The file position of every sub-region in scoring order.
+    - `scores` (list): The sub-region scores in scoring order.
+    """
+    if 'scores' in results:
+        entries = results['scores']
+    else:
+        entries = [feature['properties'] for feature in results['features'][1:1 + len(order)]]
+    for position, score in zip(order, scores):
+        entries[int(position)]['confidence_score'] = score
+    return results
+
+
+class JobSharder:
+    """
+    Splits the sub-regions of a large job into shard messages that any replica can score, and merges their scores.
+
+    The replica that receives the job coordinates it: it saves the sub-regions of every range of `shard_size`
+    consecutive sub-regions of the scoring order to the shard store and publishes one shard message per range to
+    the incoming topic. It then scores the dataset hull and grid itself, saves the results as the job document and
+    settles its message without waiting. A shard is a request with its own `jobId` and a `shard` field naming its
+    parent job and range; the replica that picks it up reads only the shard's sub-regions from the store, scores
+    them and saves their scores instead of publishing a response.
+
+    Whichever replica finds the job document and every shard result in the store, the coordinator or the last
+    shard to report, claims the merge with a document that only one replica can create, fills in the scores and
+    publishes the job's response. A job with a failed shard gets a failure response, and keeps the results of its
+    other shards: a retry of the job only publishes the shards that did not report successfully.
+
+    Parameters:
+    - `store` (ShardResultStore): Where the shards and the job's partial results are kept.
+    - `publish` (Callable): Publishes a shard message, given as a dict with `messageId`, `messageType` and `data`.
+    - `respond` (Callable): Publishes the response of a merged job, given its job document, its success, its
+            results and the failure message.
+    - `shard_size` (int): Sub-regions per shard; jobs with no more sub-regions than this are not split.
+
+    Usage:
+    ```python
+    sharder = JobSharder(store, publish, respond, shard_size=500)
+    ranges = sharder.plan(request, sub_region_count)
+    if ranges is not None:
+        sharder.fan_out(request, ranges, input_paths)
+        sharder.defer(request, results, ranges, order)
+    ```
+    """
+
+    def __init__(self, store: ShardResultStore, publish: Callable[[dict], None],
+                 respond: Callable[[dict, bool, Optional[dict], str], None], shard_size: int):
+        self.store = store
+        self.publish = publish
+        self.respond = respond
+        self.shard_size = int(shard_size)
+
+    @classmethod
+    def from_settings(cls, settings, storage_client, publish: Callable[[dict], None],
+                      respond: Callable[[dict, bool, Optional[dict], str], None]) -> Optional['JobSharder']:
+        if int(settings.shard_size or 0) <= 0:
+            return None
+        return cls(get_shard_store(settings, storage_client), publish, respond, shard_size=int(settings.shard_size))
+
+    @staticmethod
+    def is_shard(request: ConfidenceRequest) -> bool:
+        return bool(request.data.shard)
+
+    def should_split(self, request: ConfidenceRequest, sub_region_count: int) -> bool:
+        return not self.is_shard(request) and sub_region_count > self.shard_size
+
+    def plan(self, request: ConfidenceRequest, sub_region_count: int) -> Optional[List[Tuple[int, int]]]:
+        """
+        Returns the `(start, end)` range of the scoring order of every shard, or None when the job is not split.
+        """
+        if not self.should_split(request, sub_region_count):
+            return None
+        return plan_shards(sub_region_count, self.shard_size)
+
+    @staticmethod
+    def shard_message(request: ConfidenceRequest, index: int, start: int, end: int) -> dict:
+        """
+        Returns the message of one shard: the parent's request for the range `[start, end)`, without the options
+        that only apply to the merged response.
+        """
+        data = asdict(request.data)
+        data.update({'jobId': f'{request.data.jobId}-shard-{index}', 'progressive': False, 'grid_cell_size': None,
+                     'deadline_seconds': None,
+                     'shard': {'parent': request.data.jobId, 'index': index, 'start': start, 'end': end}})
+        return {'messageId': f'{request.messageId}-shard-{index}', 'messageType': request.messageType, 'data': data}
+
+    def fan_out(self, request: ConfidenceRequest, ranges: List[Tuple[int, int]], input_paths: List[str]) -> None:
+        """
+        Saves the sub-regions of the shards that have not reported successfully yet and publishes them.
+
+        Parameters:
+        - `request` (ConfidenceRequest): The job's request.
+        - `ranges` (list): The range of every shard, from `plan`.
+        - `input_paths` (list): The GeoJSON file holding the sub-regions of every shard, in scoring order.
+        """
+        parent = request.data.jobId
+        # A merge claimed by an attempt that crashed would keep this attempt from merging
+        self.store.delete(parent, MERGE_CLAIM)
+        published = 0
+        for index, ((start, end), input_path) in enumerate(zip(ranges, input_paths)):
+            result = self.store.load(parent, str(index))
+            if result is not None and result.get('success'):
+                continue
+            if result is not None:
+                self.store.delete(parent, str(index))
+            with open(input_path, 'rb') as file:
+                self.store.save_input(parent, index, file.read())
+            self.publish(self.shard_message(request, index, start, end))
+            published += 1
+        logger.info('Split job %s into %d shards, published %d', parent, len(ranges), published)
+
+    def fetch_input(self, request: ConfidenceRequest, local_path: str) -> None:
+        """
+        Writes the sub-regions of a shard to `local_path`.
+
+        Raises:
+        - `FileNotFoundError`: When the shard's sub-regions are not in the store.
+        """
+        shard = request.data.shard
+        content = self.store.load_input(shard['parent'], int(shard['index']))
+        if content is None:
+            raise FileNotFoundError(f'The sub-regions of shard {shard["index"]} of job {shard["parent"]} '
+                                    f'are not in the shard store')
+        with open(local_path, 'wb') as file:
+            file.write(content)
+
+    def defer(self, request: ConfidenceRequest, results: dict, ranges: List[Tuple[int, int]],
+              order: List[int]) -> bool:
+        """
+        Saves the results of a split job, scored without its sub-regions, for the merge, and merges them right
+        away when the shards have all reported already.
+
+        Parameters:
+        - `request` (ConfidenceRequest): The job's request.
+        - `results` (dict): The job's results with empty sub-region scores.
+        - `ranges` (list): The range of every shard.
+        - `order` (list): The file position of every sub-region in scoring order.
+
+        Returns:
+        - `merged` (bool): True when this call published the job's response.
+        """
+        self.store.save(request.data.jobId, JOB_DOCUMENT, {
+            'attempt': uuid.uuid4().hex,
+            'messageId': request.messageId,
+            'messageType': request.messageType,
+            'jobId': request.data.jobId,
+            'progressive': bool(request.data.progressive),
+            'ranges': [list(shard_range) for shard_range in ranges],
+            'order': [int(position) for position in order],
+            'results': results
+        })
+        logger.info('Job %s waits for %d shards', request.data.jobId, len(ranges))
+        return self.try_merge(request.data.jobId)
+
+    def report(self, request: ConfidenceRequest, success: bool, scores: Optional[List] = None,
+               message: str = '') -> bool:
+        """
+        Saves the outcome of a shard, and merges the job when this was the last shard to report.
+
+        Returns:
+        - `merged` (bool): True when this call published the job's response.
+        """
+        shard = request.data.shard
+        self.store.save(shard['parent'], str(int(shard['index'])),
+                        {'success': bool(success), 'scores': scores, 'message': message})
+        return self.try_merge(shard['parent'])
+
+    def try_merge(self, parent_job_id: str) -> bool:
+        """
+        Merges the shard scores into the job's results and publishes its response, once the job document and
+        every shard result are in the store and this replica claimed the merge. The job document is read again
+        after claiming, so a replica that saw the job complete just before another one merged and discarded it
+        does not publish a second response.
+
+        Returns:
+        - `merged` (bool): True when this call published the job's response.
+        """
+        job = self.store.load(parent_job_id, JOB_DOCUMENT)
+        if job is None or not self.all_reported(parent_job_id, len(job['ranges'])):
+            return False
+        if not self.store.create(parent_job_id, MERGE_CLAIM, {'claimed': time.time(), 'attempt': job.get('attempt')}):
+            return False
+        # A replica that merged the job in between has removed its job document before its claim
+        current = self.store.load(parent_job_id, JOB_DOCUMENT)
+        results = [self.store.load(parent_job_id, str(index)) for index in range(len(job['ranges']))]
+        if current is None or current.get('attempt') != job.get('attempt') or \
+                any(result is None for result in results):
+            self.store.delete(parent_job_id, MERGE_CLAIM)
+            return False
+        failure = self.find_failure(job, results)
+        if failure:
+            logger.error(failure)
+            self.respond(job, False, None, failure)
+        else:
+            scores = [score for result in results for score in result['scores']]
+            self.respond(job, True, merge_scores(job['results'], job['order'], scores), '')
+            logger.info('Merged the %d shards of job %s', len(results), parent_job_id)
+        # A failed job keeps the reported shards for its retry
+        self.discard(parent_job_id, len(results), keep_results=bool(failure))
+        return True
+
+    def all_reported(self, parent_job_id: str, shard_count: int) -> bool:
+        return all(self.store.load(parent_job_id, str(index)) is not None for index in range(shard_count))
+
+    @staticmethod
+    def find_failure(job: dict, results: List[dict]) -> str:
+        """
+        Returns why the shards of a job failed, or an empty string when they all succeeded.
+        """
+        for index, ((start, end), result) in enumerate(zip(job['ranges'], results)):
+            if not result.get('success'):
+                return f'Shard {index} of job {job["jobId"]} failed: {result.get("message")}'
+            if len(result.get('scores') or []) != end - start:
+                return f'Shard {index} of job {job["jobId"]} reported {len(result.get("scores") or [])} scores ' \
+                       f'for {end - start} sub-regions'
+        return ''
+
+    def discard(self, parent_job_id: str, shard_count: int, keep_results: bool = False) -> None:
+        """
+        Removes the shards and the partial results of a merged job. The job document goes before the merge claim,
+        so a replica that claims the merge afterwards finds the job gone.
+        """
+        for index in range(shard_count):
+            self.store.delete_input(parent_job_id, index)
+            if not keep_results:
+                self.store.delete(parent_job_id, str(index))
+        self.store.delete(parent_job_id, JOB_DOCUMENT)
+        self.store.delete(parent_job_id, MERGE_CLAIM)
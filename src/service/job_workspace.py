@@ -0,0 +1,224 @@
+# Per-job working folders with guaranteed cleanup and a per-pod disk quota
+import os
+import time
+import shutil
+import logging
+import threading
+from typing import Dict, Optional, Sequence
+from src.service.helper import clean_up
+
+logging.basicConfig()
+logger = logging.getLogger('JobWorkspace')
+logger.setLevel(logging.INFO)
+
+MB = 1024 * 1024
+
+
+class DiskQuotaExceededError(Exception):
+    """
+    Raised when a job's workspace does not fit in the disk quota.
+    """
+    pass
+
+
+def folder_size(path: str) -> int:
+    """
+    Bytes used by the files under `path`.
+    """
+    total = 0
+    for folder, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(folder, name))
+            except OSError:
+                pass
+    return total
+
+
+class JobWorkspace:
+    """
+    Working folder of one job. `release()` removes it and frees its reservation; it is safe to call twice.
+
+    Attributes:
+    - `job_id` (str): The job identifier.
+    - `path` (str): The folder holding the job's downloads and extracted files.
+    - `reserved_bytes` (int): Space reserved for the job against the quota.
+    - `in_memory` (bool): True when the folder is on the RAM-backed filesystem.
+    - `written_bytes` (int): Size of the folder when it was last measured.
+    """
+
+    def __init__(self, manager: 'WorkspaceManager', job_id: str, path: str, reserved_bytes: int, in_memory: bool):
+        self.manager = manager
+        self.job_id = job_id
+        self.path = path
+        self.reserved_bytes = reserved_bytes
+        self.in_memory = in_memory
+        self.released = False
+        self.written_bytes = 0
+        self.measured_at = None
+
+    def unwritten_bytes(self, max_age: float) -> int:
+        """
+        Reserved bytes not written yet, from the size of the folder measured at most `max_age` seconds ago.
+        """
+        now = time.monotonic()
+        if self.measured_at is None or now - self.measured_at >= max_age:
+            self.written_bytes = folder_size(self.path)
+            self.measured_at = now
+        return max(0, self.reserved_bytes - self.written_bytes)
+
+    def release(self, keep: Sequence[str] = ()) -> None:
+        """
+        Removes the folder, except the entries named in `keep`, such as a checkpoint a retry resumes from.
+        """
+        if not self.released:
+            self.released = True
+            self.manager.release(self, keep=keep)
+
+
+class WorkspaceManager:
+    """
+    Hands out job workspaces and admits a job only when its expected size fits in the quota and leaves
+    `min_free_bytes` free on the disk. Jobs that do not fit wait for running jobs to release space, up to
+    `wait_timeout` seconds.
+
+    Small jobs can be placed on a RAM-backed filesystem such as `/dev/shm`; a job of unknown size never is.
+    Admission counts the reserved space that the running jobs have not written yet, from the size of their own
+    folders measured at most every `measure_interval` seconds.
+
+    Parameters:
+    - `root` (str): Folder holding the job workspaces, e.g. the downloads folder.
+    - `quota_bytes` (int): Space all workspaces together may reserve; 0 for no quota.
+    - `min_free_bytes` (int): Space to keep free on the disk of `root`.
+    - `wait_timeout` (float): Seconds a job waits for space before it is rejected.
+    - `memory_root` (str): Optional folder on a tmpfs for small jobs.
+    - `memory_max_job_bytes` (int): Largest expected size placed in `memory_root`.
+    - `measure_interval` (float): Seconds a measured workspace size is reused by admission checks.
+
+    Usage:
+    ```python
+    workspaces = WorkspaceManager(root=settings.get_download_folder(), quota_bytes=10 * 1024 ** 3)
+    workspace = workspaces.acquire(job_id, expected_bytes=4 * zip_size)
+    try:
+        ...
+    finally:
+        workspace.release()
+    ```
+    """
+
+    def __init__(self, root: str, quota_bytes: int = 0, min_free_bytes: int = 0, wait_timeout: float = 0,
+                 memory_root: Optional[str] = None, memory_max_job_bytes: int = 0, measure_interval: float = 5.0):
+        self.root = root
+        self.quota_bytes = int(quota_bytes)
+        self.min_free_bytes = int(min_free_bytes)
+        self.wait_timeout = float(wait_timeout)
+        self.memory_root = memory_root or None
+        self.memory_max_job_bytes = int(memory_max_job_bytes)
+        self.measure_interval = float(measure_interval)
+        self.workspaces: Dict[str, JobWorkspace] = {}
+        self.reserved_bytes = 0
+        self.condition = threading.Condition()
+
+    @classmethod
+    def from_settings(cls, settings) -> 'WorkspaceManager':
+        return cls(root=settings.get_download_folder(),
+                   quota_bytes=int(float(settings.disk_quota_mb) * MB),
+                   min_free_bytes=int(float(settings.disk_min_free_mb) * MB),
+                   wait_timeout=float(settings.disk_wait_timeout),
+                   memory_root=settings.memory_workspace_folder,
+                   memory_max_job_bytes=int(float(settings.memory_workspace_max_job_mb) * MB))
+
+    def free_bytes(self, path: Optional[str] = None) -> int:
+        path = path or self.root
+        os.makedirs(path, exist_ok=True)
+        return shutil.disk_usage(path).free
+
+    def _fits(self, expected_bytes: int) -> bool:
+        if self.quota_bytes and self.reserved_bytes + expected_bytes > self.quota_bytes:
+            return False
+        # Reserved space is partly written already, so only the unwritten part still has to be free
+        unwritten = sum(workspace.unwritten_bytes(self.measure_interval) for workspace in self.workspaces.values()
+                        if not workspace.in_memory)
+        return self.free_bytes() - unwritten - expected_bytes >= self.min_free_bytes
+
+    def _fits_in_memory(self, expected_bytes: int) -> bool:
+        # A job of unknown size may be too large for memory
+        if self.memory_root is None or expected_bytes <= 0 or expected_bytes > self.memory_max_job_bytes:
+            return False
+        try:
+            return self.free_bytes(self.memory_root) >= expected_bytes
+        except OSError as e:
+            logger.info(f'In-memory workspace folder is not usable: {e}')
+            return False
+
+    def acquire(self, job_id: str, expected_bytes: int = 0) -> JobWorkspace:
+        """
+        Creates the job's workspace once its expected size fits.
+
+        Parameters:
+        - `job_id` (str): The job identifier.
+        - `expected_bytes` (int): Expected size of the downloads and extracted files.
+
+        Raises:
+        - `DiskQuotaExceededError`: The job can never fit, or no space was released within `wait_timeout`.
+        """
+        expected_bytes = max(0, int(expected_bytes))
+        if self._fits_in_memory(expected_bytes):
+            return self._create(job_id, os.path.join(self.memory_root, job_id), 0, in_memory=True)
+        if self.quota_bytes and expected_bytes > self.quota_bytes:
+            raise DiskQuotaExceededError(
+                f'Job {job_id} needs {expected_bytes / MB:.0f} MB, more than the disk quota of {self.quota_bytes / MB:.0f} MB')
+
+        deadline = time.monotonic() + self.wait_timeout
+        with self.condition:
+            while not self._fits(expected_bytes):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DiskQuotaExceededError(
+                        f'Job {job_id} needs {expected_bytes / MB:.0f} MB of disk, which did not free up in time')
+                logger.info('Job %s waiting for %.0f MB of disk', job_id, expected_bytes / MB)
+                self.condition.wait(timeout=min(remaining, 5.0))
+            self.reserved_bytes += expected_bytes
+        return self._create(job_id, os.path.join(self.root, job_id), expected_bytes, in_memory=False)
+
+    def _create(self, job_id: str, path: str, reserved_bytes: int, in_memory: bool) -> JobWorkspace:
+        os.makedirs(path, exist_ok=True)
+        workspace = JobWorkspace(self, job_id, path, reserved_bytes, in_memory)
+        with self.condition:
+            self.workspaces[job_id] = workspace
+        return workspace
+
+    def release(self, workspace: JobWorkspace, keep: Sequence[str] = ()) -> None:
+        try:
+            kept = [name for name in keep if os.path.exists(os.path.join(workspace.path, name))]
+            if not kept:
+                clean_up(path=workspace.path)
+            else:
+                for name in os.listdir(workspace.path):
+                    if name not in kept:
+                        clean_up(path=os.path.join(workspace.path, name))
+        except OSError as e:
+            # An abandoned calculation may still be writing; what is left stays counted in `used_bytes`
+            logger.error(f'Could not remove the workspace of job {workspace.job_id}: {e}')
+        with self.condition:
+            self.reserved_bytes -= workspace.reserved_bytes
+            if self.workspaces.get(workspace.job_id) is workspace:
+                del self.workspaces[workspace.job_id]
+            self.condition.notify_all()
+
+    def usage(self) -> dict:
+        """
+        Disk usage of the job workspaces, for the metrics endpoint.
+        """
+        with self.condition:
+            active_jobs = len(self.workspaces)
+            in_memory_jobs = sum(workspace.in_memory for workspace in self.workspaces.values())
+            reserved_bytes = self.reserved_bytes
+        return {
+            'used_bytes': folder_size(self.root),
+            'reserved_bytes': reserved_bytes,
+            'free_bytes': self.free_bytes(),
+            'quota_bytes': self.quota_bytes,
+            'active_jobs': active_jobs,
+            'in_memory_jobs': in_memory_jobs
+        }
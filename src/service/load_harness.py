@@ -0,0 +1,465 @@
+# Load-test harness: drives OSWConfidenceService end to end on in-memory stand-ins for the queue, storage and OSM
+import io
+import json
+import time
+import queue
+import random
+import zipfile
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+import geopandas as gpd
+from python_ms_core.core.queue.models.queue_message import QueueMessage
+from src.service.osm_data_backend import OSMDataBackend
+
+logging.basicConfig()
+logger = logging.getLogger('LoadHarness')
+logger.setLevel(logging.INFO)
+
+INCOMING_TOPIC = 'load-test-request'
+OUTGOING_TOPIC = 'load-test-response'
+CONTAINER_NAME = 'load-test'
+# Metres per degree of latitude, for sizing the synthetic datasets
+METRES_PER_DEGREE = 111320.0
+
+
+@dataclass
+class JobProfile:
+    """
+    Size of a synthetic dataset.
+
+    Attributes:
+    - `name` (str): Profile name used in the report.
+    - `size_km` (float): Side of the square area covered by the dataset nodes.
+    - `nodes` (int): Nodes in the dataset.
+    - `sub_regions` (int): Sub-regions, splitting the area into vertical strips; 0 for none.
+    """
+    name: str
+    size_km: float
+    nodes: int = 200
+    sub_regions: int = 0
+
+
+DEFAULT_PROFILES = {
+    'small': JobProfile('small', size_km=0.5, nodes=100),
+    'medium': JobProfile('medium', size_km=2.0, nodes=500, sub_regions=5),
+    'large': JobProfile('large', size_km=5.0, nodes=2000, sub_regions=20),
+}
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """
+    Parses a job mix such as `small=0.7,medium=0.25,large=0.05` into normalized weights.
+    """
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_PROFILES:
+            raise ValueError(f'Unknown job profile: {name}')
+        weights[name] = float(weight or 1)
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError('The job mix needs a positive weight')
+    return {name: weight / total for name, weight in weights.items()}
+
+
+def make_dataset(profile: JobProfile, seed: int, origin: Tuple[float, float] = (-122.33, 47.60)) -> Tuple[bytes, Optional[bytes]]:
+    """
+    Builds a synthetic OSW zip with a `nodes.geojson` of random points, and the sub-regions GeoJSON.
+
+    Returns:
+    - `zip_bytes` (bytes): The dataset zip.
+    - `sub_regions` (bytes): The sub-regions FeatureCollection, or None when the profile has none.
+    """
+    rng = np.random.default_rng(seed)
+    lon, lat = origin
+    height = profile.size_km * 1000 / METRES_PER_DEGREE
+    width = height / np.cos(np.radians(lat))
+    points = gpd.GeoSeries(gpd.points_from_xy(lon + rng.random(profile.nodes) * width,
+                                              lat + rng.random(profile.nodes) * height), crs='EPSG:4326')
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('nodes.geojson', gpd.GeoDataFrame(geometry=points).to_json())
+
+    sub_regions = None
+    if profile.sub_regions:
+        strip = width / profile.sub_regions
+        strips = [{'type': 'Feature', 'properties': {'strip': index}, 'geometry': {'type': 'Polygon', 'coordinates': [[
+            [lon + index * strip, lat], [lon + (index + 1) * strip, lat], [lon + (index + 1) * strip, lat + height],
+            [lon + index * strip, lat + height], [lon + index * strip, lat]]]}}
+            for index in range(profile.sub_regions)]
+        sub_regions = json.dumps({'type': 'FeatureCollection', 'features': strips}).encode('utf-8')
+    return buffer.getvalue(), sub_regions
+
+
+class InMemoryTopic:
+    """
+    Stand-in for a `python_ms_core` topic. `subscribe` blocks, handing messages to `max_concurrent_messages`
+    worker threads until `stop()`. `publish` records the message with its time and passes it to the listeners.
+    """
+
+    def __init__(self, name: str, max_concurrent_messages: int = 1):
+        self.name = name
+        self.max_concurrent_messages = max(1, int(max_concurrent_messages))
+        self.messages = queue.Queue()
+        self.published: List[Tuple[float, QueueMessage]] = []
+        self.lock = threading.Lock()
+        self.listeners: List[Callable[[float, QueueMessage], None]] = []
+        self.on_receive: Optional[Callable[[QueueMessage], None]] = None
+        self.stopped = threading.Event()
+
+    def put(self, message: QueueMessage) -> None:
+        self.messages.put(message)
+
+    def publish(self, data: QueueMessage) -> None:
+        published_at = time.monotonic()
+        with self.lock:
+            self.published.append((published_at, data))
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(published_at, data)
+
+    def subscribe(self, subscription: str, callback: Callable[[QueueMessage], None]) -> None:
+        def worker():
+            while not self.stopped.is_set():
+                try:
+                    message = self.messages.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if self.on_receive is not None:
+                    self.on_receive(message)
+                callback(message)
+
+        workers = [threading.Thread(target=worker, daemon=True, name=f'{self.name}-{index}')
+                   for index in range(self.max_concurrent_messages)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+class InMemoryFile:
+    def __init__(self, name: str, content: Optional[bytes]):
+        self.name = name
+        self.file_path = name if content is not None else None
+        self.content = content
+        self.blob_client = self
+
+    def get_stream(self) -> bytes:
+        return self.content
+
+    def get_blob_properties(self):
+        # The etag changes with the content, as in blob storage, so the dataset cache can key on it
+        etag = hashlib.sha1(self.content).hexdigest() if self.content is not None else None
+        return type('BlobProperties', (), {'size': len(self.content or b''), 'etag': etag, 'last_modified': None})()
+
+    def upload(self, content) -> None:
+        self.content = content.encode('utf-8') if isinstance(content, str) else content
+        self.file_path = self.name
+
+    def delete_file(self) -> None:
+        self.content = None
+        self.file_path = None
+
+
+class InMemoryStorageClient:
+    """
+    Stand-in for the `python_ms_core` storage client, keeping files in a dict keyed by URL or name.
+    """
+
+    def __init__(self):
+        self.files: Dict[str, InMemoryFile] = {}
+        self.lock = threading.Lock()
+
+    def put(self, name: str, content: bytes) -> str:
+        with self.lock:
+            self.files[name] = InMemoryFile(name, content)
+        return name
+
+    def get_file_from_url(self, container_name: str, file_url: str) -> InMemoryFile:
+        with self.lock:
+            return self.files.get(file_url) or InMemoryFile(file_url, None)
+
+    def get_file(self, container_name: str, file_name: str) -> InMemoryFile:
+        return self.get_file_from_url(container_name, file_name)
+
+    def get_container(self, container_name: str):
+        return self
+
+    def create_file(self, file_name: str, mimetype: str = '') -> InMemoryFile:
+        with self.lock:
+            return self.files.setdefault(file_name, InMemoryFile(file_name, None))
+
+
+class InMemoryCore:
+    """
+    Stand-in for `python_ms_core.Core` returning in-memory topics and storage.
+    """
+
+    def __init__(self, storage_client: InMemoryStorageClient, topics: Dict[str, InMemoryTopic]):
+        self.storage_client = storage_client
+        self.topics = topics
+
+    def get_topic(self, topic_name: str, max_concurrent_messages: int = 1) -> InMemoryTopic:
+        if topic_name not in self.topics:
+            self.topics[topic_name] = InMemoryTopic(topic_name, max_concurrent_messages)
+        topic = self.topics[topic_name]
+        topic.max_concurrent_messages = max(topic.max_concurrent_messages, int(max_concurrent_messages))
+        return topic
+
+    def get_storage_client(self) -> InMemoryStorageClient:
+        return self.storage_client
+
+
+class SimulatedOSMDataBackend(OSMDataBackend):
+    """
+    OSM backend that returns empty histories after a random delay of `latency` seconds, give or take `jitter`.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.5, seed: Optional[int] = None):
+        self.latency = float(latency)
+        self.jitter = float(jitter)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def _wait(self) -> None:
+        with self.lock:
+            self.calls += 1
+            delay = self.latency * (1 + self.jitter * (2 * self.random.random() - 1))
+        time.sleep(max(0.0, delay))
+
+    def get_node_history(self, osmid):
+        self._wait()
+        return {}
+
+    def get_way_history(self, osmid):
+        self._wait()
+        return {}
+
+    def get_relation_history(self, osmid):
+        self._wait()
+        return {}
+
+    def get_map_data(self, bounding_params):
+        self._wait()
+        return []
+
+
+class SimulatedAreaAnalyzer:
+    """
+    Stand-in for `AreaAnalyzer` with the same cost shape: the area is split into tiles of `tile_km2`, and every
+    tile makes `calls_per_tile` backend calls, with up to `parallelism` tiles in flight as with the dask workers.
+    The score is derived from a hash of the geometry, so it is stable across runs.
+    """
+
+    tile_km2 = 0.25
+    calls_per_tile = 4
+    parallelism = 4
+
+    def __init__(self, osm_data_handler):
+        self.osm_data_handler = osm_data_handler
+
+    def calculate_area_confidence_score(self, file_path: str) -> float:
+        gdf = gpd.read_file(file_path)
+        if gdf.crs is None:
+            gdf = gdf.set_crs(epsg=4326)
+        area_km2 = float(gdf.to_crs(gdf.estimate_utm_crs()).area.sum() / 1e6)
+        tiles = max(1, int(np.ceil(area_km2 / self.tile_km2)))
+
+        def score_tile(tile):
+            for call in range(self.calls_per_tile):
+                self.osm_data_handler.get_way_history(osmid=tile * self.calls_per_tile + call)
+
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            list(executor.map(score_tile, range(tiles)))
+        digest = hashlib.sha1(gdf.geometry.to_wkb().sum()).digest()
+        return digest[0] / 255
+
+
+@dataclass
+class JobTiming:
+    job_id: str
+    profile: str
+    enqueued_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    success: Optional[bool] = None
+
+
+@dataclass
+class LoadTestReport:
+    """
+    Results of a load test; times are in seconds.
+    """
+    sent: int = 0
+    completed: int = 0
+    failed: int = 0
+    duration: float = 0.0
+    throughput_per_minute: float = 0.0
+    queueing_delay: Dict[str, float] = field(default_factory=dict)
+    latency: Dict[str, float] = field(default_factory=dict)
+    latency_by_profile: Dict[str, Dict[str, float]] = field(default_factory=dict)
+    osm_calls: int = 0
+    dataset_cache: Dict[str, float] = field(default_factory=dict)
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(max(values))}
+
+
+class LoadHarness:
+    """
+    Sends synthetic confidence requests at a Poisson arrival rate through the real `OSWConfidenceService`
+    path `process` → `calculate_confidence` → `send_response_message`. The queue and storage are in memory,
+    and the OSM API and tile scoring are simulated; the stand-ins are handed to the service and its calculators
+    through their constructors. Dataset unzipping, hull computation, sub-region handling, scheduling,
+    checkpointing, workspaces and the dataset cache run for real. Jobs run in the service process.
+
+    Parameters:
+    - `messages` (int): Requests to send.
+    - `rate` (float): Mean arrivals per second.
+    - `mix` (Dict[str, float]): Weight of each `DEFAULT_PROFILES` entry.
+    - `osm_latency` (float): Mean seconds per simulated OSM call.
+    - `concurrency` (int): `MAX_CONCURRENT_MESSAGES` of the service.
+    - `settings` (dict): Overrides of the `Settings` fields of the service and its calculators, e.g.
+      `{'slow_lane_size': 2}` or `{'dataset_cache_mb': 512}`.
+    - `seed` (int): Seed of the arrivals, the job sizes and the synthetic datasets.
+
+    Usage:
+    ```python
+    report = LoadHarness(messages=200, rate=2.0, mix=parse_mix('small=0.8,large=0.2')).run()
+    ```
+    """
+
+    def __init__(self, messages: int = 50, rate: float = 1.0, mix: Optional[Dict[str, float]] = None,
+                 osm_latency: float = 0.05, concurrency: int = 2, settings: Optional[dict] = None,
+                 seed: int = 0):
+        self.messages = int(messages)
+        self.rate = float(rate)
+        self.mix = mix or {'small': 1.0}
+        self.osm_latency = float(osm_latency)
+        self.concurrency = int(concurrency)
+        self.settings = settings or {}
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.storage_client = InMemoryStorageClient()
+        self.topics: Dict[str, InMemoryTopic] = {}
+        self.backend = SimulatedOSMDataBackend(latency=osm_latency, seed=seed)
+        self.timings: Dict[str, JobTiming] = {}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.dataset_cache = None
+
+    def _upload_datasets(self) -> Dict[str, Tuple[str, Optional[str]]]:
+        urls = {}
+        for name in self.mix:
+            zip_bytes, sub_regions = make_dataset(DEFAULT_PROFILES[name], seed=self.seed)
+            zip_url = self.storage_client.put(f'memory://{CONTAINER_NAME}/{name}.zip', zip_bytes)
+            sub_regions_url = None
+            if sub_regions is not None:
+                sub_regions_url = self.storage_client.put(f'memory://{CONTAINER_NAME}/{name}_subregions.geojson',
+                                                          sub_regions)
+            urls[name] = (zip_url, sub_regions_url)
+        return urls
+
+    def _on_received(self, message: QueueMessage) -> None:
+        with self.lock:
+            timing = self.timings.get(message.data['jobId'])
+            if timing is not None and timing.started_at is None:
+                timing.started_at = time.monotonic()
+
+    def _on_response(self, published_at: float, message: QueueMessage) -> None:
+        data = message.data
+        if data.get('status') != 'finished':
+            return
+        with self.lock:
+            timing = self.timings.get(data['jobId'])
+            if timing is None or timing.finished_at is not None:
+                return
+            timing.finished_at = published_at
+            timing.success = bool(data.get('success'))
+            if all(item.finished_at is not None for item in self.timings.values()) and \
+                    len(self.timings) == self.messages:
+                self.done.set()
+
+    def _send(self, incoming: InMemoryTopic, urls: Dict[str, Tuple[str, Optional[str]]]) -> None:
+        names, weights = list(self.mix), list(self.mix.values())
+        for index in range(self.messages):
+            name = self.random.choices(names, weights)[0]
+            job_id = f'load-{index:06d}'
+            zip_url, sub_regions_url = urls[name]
+            message = QueueMessage.data_from({
+                'messageId': job_id,
+                'messageType': 'confidence-calculation',
+                'data': {'jobId': job_id, 'data_file': zip_url, 'meta_file': zip_url, 'trigger_type': 'load-test',
+                         'sub_regions_file': sub_regions_url}
+            })
+            with self.lock:
+                self.timings[job_id] = JobTiming(job_id=job_id, profile=name, enqueued_at=time.monotonic())
+            incoming.put(message)
+            if self.rate > 0 and index < self.messages - 1:
+                time.sleep(self.random.expovariate(self.rate))
+
+    def run(self, timeout: float = 3600) -> LoadTestReport:
+        """
+        Sends all requests, waits for their final responses or `timeout`, and reports.
+        """
+        from src.config import Settings
+        from src.service.osw_confidence_service import OSWConfidenceService
+
+        settings = Settings(**{
+            'simulate': 'NO', 'checkpoint_store': 'none', 'idempotency_store': 'none', 'worker_processes': 0,
+            'max_concurrent_messages': self.concurrency,
+            'incoming_topic_name': INCOMING_TOPIC, 'incoming_topic_subscription': 'load-test',
+            'outgoing_topic_name': OUTGOING_TOPIC, 'storage_container_name': CONTAINER_NAME, **self.settings})
+        core = InMemoryCore(self.storage_client, self.topics)
+        incoming = core.get_topic(INCOMING_TOPIC, self.concurrency)
+        incoming.on_receive = self._on_received
+        core.get_topic(OUTGOING_TOPIC).listeners.append(self._on_response)
+        urls = self._upload_datasets()
+
+        service = OSWConfidenceService(core=core, settings=settings, calculator_options={
+            'settings': settings, 'osm_data_handler': self.backend, 'area_analyzer_class': SimulatedAreaAnalyzer,
+            # The synthetic sub-regions are valid; the real check downloads the GeoJSON schema
+            'validate_geojson': lambda file_path: True})
+        started = time.monotonic()
+        self._send(incoming, urls)
+        self.done.wait(timeout=timeout)
+        incoming.stop()
+        service.listening_thread.join(timeout=5)
+        self.dataset_cache = service.dataset_cache
+        return self.report(time.monotonic() - started)
+
+    def report(self, duration: float) -> LoadTestReport:
+        with self.lock:
+            timings = list(self.timings.values())
+        finished = [timing for timing in timings if timing.finished_at is not None]
+        by_profile = {}
+        for name in self.mix:
+            by_profile[name] = percentiles([timing.finished_at - timing.enqueued_at for timing in finished
+                                            if timing.profile == name])
+        return LoadTestReport(
+            sent=len(timings),
+            completed=sum(1 for timing in finished if timing.success),
+            failed=sum(1 for timing in finished if not timing.success),
+            duration=duration,
+            throughput_per_minute=len(finished) / duration * 60 if duration > 0 else 0.0,
+            queueing_delay=percentiles([timing.started_at - timing.enqueued_at for timing in timings
+                                        if timing.started_at is not None]),
+            latency=percentiles([timing.finished_at - timing.enqueued_at for timing in finished]),
+            latency_by_profile={name: values for name, values in by_profile.items() if values},
+            osm_calls=self.backend.calls,
+            dataset_cache=self.dataset_cache.stats() if self.dataset_cache is not None and self.dataset_cache.enabled
+            else {})
@@ -0,0 +1,498 @@
+# Backends that answer the OSM element queries made by the confidence library
+import os
+import bz2
+import gzip
+import math
+import logging
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import xml.etree.ElementTree as ET
+
+from osmapi import OsmApi
+from osmapi.errors import ElementNotFoundApiError
+from osw_confidence_metric.osm_data_handler import OSMDataHandler
+from src.service.osm_session import get_shared_session
+from src.service.single_flight import SingleFlight, DiskCache
+
+logging.basicConfig()
+logger = logging.getLogger('OSMDataBackend')
+logger.setLevel(logging.INFO)
+
+ELEMENT_TYPES = ('node', 'way', 'relation')
+_TIMESTAMP_FORMATS = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d %H:%M:%S UTC']
+_INT_ATTRIBUTES = {'id', 'version', 'uid', 'changeset', 'ref'}
+_FLOAT_ATTRIBUTES = {'lat', 'lon'}
+DEFAULT_CACHE_FOLDER = os.path.join(tempfile.gettempdir(), 'osw-confidence', 'osm-cache')
+
+
+class OSMDataBackend(ABC):
+    """
+    Interface for the object handed to `AreaAnalyzer` as its `osm_data_handler`.
+
+    The confidence library only calls `get_way_history`, `get_item_history` and `get_map_data`,
+    so any backend implementing the methods below can replace the live `OSMDataHandler`.
+    History results use the same shape as `osmapi`: a dict keyed by version whose values carry
+    `id`, `version`, `timestamp`, `user`, `uid`, `changeset`, `visible`, `tag` and `nd`/`member`.
+
+    Methods:
+    - `get_node_history(self, osmid)`: Returns the version history of a node.
+    - `get_way_history(self, osmid)`: Returns the version history of a way.
+    - `get_relation_history(self, osmid)`: Returns the version history of a relation.
+    - `get_item_history(self, item)`: Returns the history of a GeoDataFrame row with `element_type` and `osmid`.
+    - `get_map_data(self, bounding_params)`: Returns the elements inside `(min_lon, min_lat, max_lon, max_lat)`.
+    """
+
+    @abstractmethod
+    def get_node_history(self, osmid) -> Dict[int, dict]:
+        pass
+
+    @abstractmethod
+    def get_way_history(self, osmid) -> Dict[int, dict]:
+        pass
+
+    @abstractmethod
+    def get_relation_history(self, osmid) -> Dict[int, dict]:
+        pass
+
+    @abstractmethod
+    def get_map_data(self, bounding_params) -> List[dict]:
+        pass
+
+    def get_item_history(self, item) -> Optional[Dict[int, dict]]:
+        item_type = getattr(item, 'element_type', None)
+        if item_type is None and isinstance(item, dict):
+            item_type = item.get('element_type')
+        if item_type is None:
+            return None
+        osmid = item.get('osmid') if isinstance(item, dict) else getattr(item, 'osmid', None)
+
+        if item_type == 'node':
+            return self.get_node_history(osmid)
+        elif item_type == 'way':
+            return self.get_way_history(osmid)
+        elif item_type == 'relation':
+            return self.get_relation_history(osmid)
+        return None
+
+
+class SessionOSMDataHandler(OSMDataHandler):
+    """
+    `OSMDataHandler` whose `OsmApi` sends its requests through the given `requests.Session`.
+    """
+
+    def __init__(self, username: str = '', password: str = '', session=None):
+        self.api = OsmApi(username=username, password=password, session=session)
+
+
+class OSMApiDataBackend(OSMDataBackend):
+    """
+    Backend that fetches element histories live from the OSM API through `OSMDataHandler`.
+
+    Parameters:
+    - `username` (str): OSM username.
+    - `password` (str): OSM password.
+    - `session` (requests.Session): Optional session shared by all API calls, e.g. `get_shared_session()`.
+    """
+
+    def __init__(self, username: str = '', password: str = '', session=None):
+        if session is None:
+            self.handler = OSMDataHandler(username=username, password=password)
+        else:
+            self.handler = SessionOSMDataHandler(username=username, password=password, session=session)
+
+    def get_node_history(self, osmid):
+        return self.handler.api.NodeHistory(osmid)
+
+    def get_way_history(self, osmid):
+        return self.handler.get_way_history(osmid=osmid)
+
+    def get_relation_history(self, osmid):
+        return self.handler.api.RelationHistory(osmid)
+
+    def get_map_data(self, bounding_params):
+        return self.handler.get_map_data(bounding_params=bounding_params)
+
+
+def tile_for(lon: float, lat: float, zoom: int) -> Tuple[int, int]:
+    """
+    Returns the slippy-map `(x, y)` tile containing a WGS84 coordinate at the given zoom.
+    """
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_for_bbox(bounding_params, zoom: int) -> Iterable[Tuple[int, int]]:
+    """
+    Yields every tile at `zoom` intersecting `(min_lon, min_lat, max_lon, max_lat)`.
+    """
+    min_lon, min_lat, max_lon, max_lat = bounding_params
+    min_x, max_y = tile_for(min_lon, min_lat, zoom)
+    max_x, min_y = tile_for(max_lon, max_lat, zoom)
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            yield x, y
+
+
+def filter_map_data(elements: Iterable[dict], bounding_params) -> List[dict]:
+    """
+    Reduces `{'type', 'data'}` elements to what a `/map` call for the bounding box returns: visible nodes
+    inside it, visible ways using one of those nodes, and visible relations with one of those as member.
+    """
+    min_lon, min_lat, max_lon, max_lat = bounding_params
+    by_type = {element_type: [] for element_type in ELEMENT_TYPES}
+    for element in elements:
+        if element['data'] is not None and element['data'].get('visible', True):
+            by_type[element['type']].append(element['data'])
+
+    result = {element_type: {} for element_type in ELEMENT_TYPES}
+    for node in by_type['node']:
+        if 'lat' in node and min_lon <= node['lon'] <= max_lon and min_lat <= node['lat'] <= max_lat:
+            result['node'][node['id']] = node
+    for way in by_type['way']:
+        if any(ref in result['node'] for ref in way.get('nd', [])):
+            result['way'][way['id']] = way
+    for relation in by_type['relation']:
+        if any(member.get('ref') in result.get(member.get('type'), {}) for member in relation.get('member', [])):
+            result['relation'][relation['id']] = relation
+
+    return [{'type': element_type, 'data': data}
+            for element_type in ELEMENT_TYPES
+            for _, data in sorted(result[element_type].items())]
+
+
+def _parse_timestamp(value: str):
+    for date_format in _TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except (ValueError, TypeError):
+            continue
+    return value
+
+
+def _parse_attributes(element: ET.Element) -> dict:
+    result = {}
+    for key, value in element.attrib.items():
+        if key in _INT_ATTRIBUTES:
+            result[key] = int(value)
+        elif key in _FLOAT_ATTRIBUTES:
+            result[key] = float(value)
+        elif key == 'visible':
+            result[key] = value == 'true'
+        elif key == 'timestamp':
+            result[key] = _parse_timestamp(value)
+        else:
+            result[key] = value
+    return result
+
+
+def _parse_element(element: ET.Element, deleted: bool = False) -> dict:
+    data = _parse_attributes(element)
+    data['tag'] = {tag.attrib['k']: tag.attrib['v'] for tag in element.findall('tag')}
+    if element.tag == 'way':
+        data['nd'] = [int(nd.attrib['ref']) for nd in element.findall('nd')]
+    elif element.tag == 'relation':
+        data['member'] = [_parse_attributes(member) for member in element.findall('member')]
+    if deleted:
+        data['visible'] = False
+    data.setdefault('visible', True)
+    return data
+
+
+def _open_extract(path: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _iter_xml_extract(path: str):
+    """
+    Streams `(element_type, data)` pairs from an OSM XML full-history (.osh/.osm) or change (.osc) file.
+    """
+    with _open_extract(path) as source:
+        action = None
+        for event, element in ET.iterparse(source, events=('start', 'end')):
+            if element.tag in ('create', 'modify', 'delete'):
+                action = element.tag if event == 'start' else None
+                continue
+            if event == 'end' and element.tag in ELEMENT_TYPES:
+                yield element.tag, _parse_element(element, deleted=action == 'delete')
+                element.clear()
+
+
+def _iter_pbf_extract(path: str):
+    """
+    Streams `(element_type, data)` pairs from an OSM PBF full-history file using the optional `osmium` package.
+    """
+    try:
+        import osmium
+    except ImportError:
+        raise RuntimeError('Reading PBF history extracts requires the `osmium` package')
+
+    def common(obj) -> dict:
+        return {
+            'id': obj.id,
+            'version': obj.version,
+            'timestamp': obj.timestamp.replace(tzinfo=None),
+            'user': obj.user,
+            'uid': obj.uid,
+            'changeset': obj.changeset,
+            'visible': obj.visible,
+            'tag': {tag.k: tag.v for tag in obj.tags},
+        }
+
+    for obj in osmium.FileProcessor(path):
+        if obj.is_node():
+            data = common(obj)
+            if obj.location.valid():
+                data['lat'], data['lon'] = obj.location.lat, obj.location.lon
+            yield 'node', data
+        elif obj.is_way():
+            data = common(obj)
+            data['nd'] = [node.ref for node in obj.nodes]
+            yield 'way', data
+        elif obj.is_relation():
+            data = common(obj)
+            data['member'] = [{'type': m.type_str(), 'ref': m.ref, 'role': m.role} for m in obj.members]
+            yield 'relation', data
+
+
+class OSMHistoryExtractBackend(OSMDataBackend):
+    """
+    Backend that answers the same queries as `OSMApiDataBackend` from a local OSM full-history extract. It only
+    replaces the OSM API: the street graphs the confidence library builds with `osmnx` still come from Overpass.
+
+    Supports OSM XML history (`.osh`, `.osm`) and change (`.osc`) files, optionally gzip/bz2 compressed,
+    and PBF files when `osmium` is installed. Several files can be given; their versions are merged.
+    Elements are indexed by slippy-map tile at `tile_zoom` so bounding-box lookups only visit the
+    tiles that intersect the query.
+
+    Parameters:
+    - `paths` (list): Paths to the extract files.
+    - `tile_zoom` (int): Zoom level of the tile index.
+    """
+
+    def __init__(self, paths: List[str], tile_zoom: int = 14):
+        self.paths = list(paths)
+        self.tile_zoom = int(tile_zoom)
+        self.overpass_cache: Optional[DiskCache] = None
+        self.history: Dict[str, Dict[int, Dict[int, dict]]] = {element_type: {} for element_type in ELEMENT_TYPES}
+        self.tile_index: Dict[Tuple[int, int], Set[Tuple[str, int]]] = {}
+        for path in self.paths:
+            self._load(path)
+        self._build_tile_index()
+        logger.info('Loaded OSM history extract %s: %d nodes, %d ways, %d relations, %d tiles',
+                    self.paths, len(self.history['node']), len(self.history['way']),
+                    len(self.history['relation']), len(self.tile_index))
+
+    def __reduce__(self):
+        # Dask ships the analyzer (and this backend) to worker processes; rebuild from the
+        # per-process cache there instead of pickling the whole history.
+        return _restore_history_extract, (tuple(self.paths), self.tile_zoom, self.overpass_cache)
+
+    def _load(self, path: str) -> None:
+        reader = _iter_pbf_extract if path.endswith('.pbf') else _iter_xml_extract
+        for element_type, data in reader(path):
+            self.history[element_type].setdefault(data['id'], {})[data['version']] = data
+
+    def _latest(self, element_type: str, osmid: int) -> Optional[dict]:
+        versions = self.history[element_type].get(osmid)
+        if not versions:
+            return None
+        return versions[max(versions)]
+
+    def _node_tiles(self, osmid: int) -> Set[Tuple[int, int]]:
+        tiles = set()
+        for data in self.history['node'].get(osmid, {}).values():
+            if 'lat' in data and 'lon' in data:
+                tiles.add(tile_for(data['lon'], data['lat'], self.tile_zoom))
+        return tiles
+
+    def _build_tile_index(self) -> None:
+        way_tiles: Dict[int, Set[Tuple[int, int]]] = {}
+        for osmid in self.history['node']:
+            for tile in self._node_tiles(osmid):
+                self.tile_index.setdefault(tile, set()).add(('node', osmid))
+        for osmid, versions in self.history['way'].items():
+            tiles = set()
+            for data in versions.values():
+                for ref in data.get('nd', []):
+                    tiles |= self._node_tiles(ref)
+            way_tiles[osmid] = tiles
+            for tile in tiles:
+                self.tile_index.setdefault(tile, set()).add(('way', osmid))
+        for osmid, versions in self.history['relation'].items():
+            tiles = set()
+            for data in versions.values():
+                for member in data.get('member', []):
+                    if member.get('type') == 'node':
+                        tiles |= self._node_tiles(member['ref'])
+                    elif member.get('type') == 'way':
+                        tiles |= way_tiles.get(member['ref'], set())
+            for tile in tiles:
+                self.tile_index.setdefault(tile, set()).add(('relation', osmid))
+
+    def _get_history(self, element_type: str, osmid) -> Dict[int, dict]:
+        versions = self.history[element_type].get(int(osmid))
+        if not versions:
+            raise ElementNotFoundApiError(404, 'Not Found', f'{element_type} {osmid} not in extract')
+        return dict(versions)
+
+    def get_node_history(self, osmid):
+        return self._get_history('node', osmid)
+
+    def get_way_history(self, osmid):
+        return self._get_history('way', osmid)
+
+    def get_relation_history(self, osmid):
+        return self._get_history('relation', osmid)
+
+    def get_map_data(self, bounding_params):
+        candidates = set()
+        for tile in tiles_for_bbox(bounding_params, self.tile_zoom):
+            candidates |= self.tile_index.get(tile, set())
+        elements = [{'type': element_type, 'data': self._latest(element_type, osmid)}
+                    for element_type, osmid in candidates]
+        return filter_map_data(elements, bounding_params)
+
+
+def configure_overpass_cache(cache: DiskCache) -> None:
+    """
+    Points the `osmnx` cache of Overpass responses, which the confidence library uses for the street graphs, at
+    `cache.folder` so every process of the pod reuses the responses of the others, and removes the responses older
+    than `cache.ttl`; `osmnx` itself never expires them.
+    """
+    import osmnx as ox
+    ox.settings.use_cache = True
+    ox.settings.cache_folder = cache.folder
+    cache.prune()
+
+
+class CoalescingOSMDataBackend(OSMDataBackend):
+    """
+    Single-flight layer and shared cache in front of another backend.
+
+    The confidence library fetches the element histories in processes it starts for every computation, so the
+    histories are cached in a `DiskCache` that all the processes of the pod and the later computations read;
+    entries expire after the cache's TTL. Concurrent requests for the same history make one fetch: threads of a
+    process wait on the same call, and other processes wait on the cache's file lock and then read the result.
+
+    The library never calls `get_map_data`, so it is passed to the backend as is.
+
+    Parameters:
+    - `backend` (OSMDataBackend): Backend that performs the actual fetches.
+    - `cache` (DiskCache): Cache of the histories; without it, only concurrent calls are shared.
+    - `overpass_cache` (DiskCache): Optional cache for the Overpass responses of `osmnx`, set up in every process
+      the backend is unpickled in; see `configure_overpass_cache`.
+    """
+
+    flight = SingleFlight()
+
+    def __init__(self, backend: OSMDataBackend, cache: Optional[DiskCache] = None,
+                 overpass_cache: Optional[DiskCache] = None):
+        self.backend = backend
+        self.cache = cache
+        self.overpass_cache = overpass_cache
+        if overpass_cache is not None:
+            configure_overpass_cache(overpass_cache)
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        if self.overpass_cache is not None:
+            configure_overpass_cache(self.overpass_cache)
+
+    def _cached(self, key: tuple, fetch):
+        if self.cache is None:
+            return self.flight.do(key, fetch)
+        return self.flight.do(key, lambda: self.cache.get_or_fetch(key, fetch))
+
+    def _history(self, element_type: str, osmid, fetch) -> Dict[int, dict]:
+        return self._cached((element_type, int(osmid)), lambda: fetch(osmid))
+
+    def get_node_history(self, osmid):
+        return self._history('node', osmid, self.backend.get_node_history)
+
+    def get_way_history(self, osmid):
+        return self._history('way', osmid, self.backend.get_way_history)
+
+    def get_relation_history(self, osmid):
+        return self._history('relation', osmid, self.backend.get_relation_history)
+
+    def get_map_data(self, bounding_params):
+        return self.backend.get_map_data(bounding_params)
+
+
+_extract_lock = threading.Lock()
+
+
+@lru_cache(maxsize=4)
+def _load_history_extract(paths: Tuple[str, ...], tile_zoom: int) -> OSMHistoryExtractBackend:
+    return OSMHistoryExtractBackend(paths=list(paths), tile_zoom=tile_zoom)
+
+
+def load_history_extract(paths: Tuple[str, ...], tile_zoom: int = 14) -> OSMHistoryExtractBackend:
+    """
+    Returns the process-wide `OSMHistoryExtractBackend` for the given files, loading it on first use.
+    """
+    with _extract_lock:
+        return _load_history_extract(tuple(paths), int(tile_zoom))
+
+
+def _restore_history_extract(paths: Tuple[str, ...], tile_zoom: int,
+                             overpass_cache: Optional[DiskCache]) -> OSMHistoryExtractBackend:
+    backend = load_history_extract(paths, tile_zoom)
+    if overpass_cache is not None:
+        backend.overpass_cache = overpass_cache
+        configure_overpass_cache(overpass_cache)
+    return backend
+
+
+def get_osm_caches(settings) -> Tuple[Optional[DiskCache], Optional[DiskCache]]:
+    """
+    Returns the caches of the OSM API responses and of the `osmnx` Overpass responses, in `OSM_CACHE_FOLDER` with
+    a TTL of `OSM_CACHE_TTL` seconds and at most `OSM_CACHE_MAX_MB` each, or None for both when the TTL is 0.
+    """
+    ttl = float(settings.osm_cache_ttl or 0)
+    if ttl <= 0:
+        return None, None
+    folder = settings.osm_cache_folder or DEFAULT_CACHE_FOLDER
+    max_bytes = int(float(settings.osm_cache_max_mb or 0) * 1024 * 1024)
+    return DiskCache(os.path.join(folder, 'osm-api'), ttl=ttl, max_bytes=max_bytes), \
+        DiskCache(os.path.join(folder, 'overpass'), ttl=ttl, max_bytes=max_bytes)
+
+
+def get_osm_data_backend(settings) -> OSMDataBackend:
+    """
+    Builds the OSM data backend selected by `settings.osm_backend`.
+
+    Parameters:
+    - `settings` (Settings): Service settings.
+
+    Returns:
+    - `backend` (OSMDataBackend): For `api` (default), an `OSMApiDataBackend` on the process-wide rate-limited
+      session behind a `CoalescingOSMDataBackend` with the shared cache; for `extract`, the cached
+      `OSMHistoryExtractBackend`. Both set up the shared cache of the `osmnx` Overpass responses.
+    """
+    backend = (settings.osm_backend or 'api').lower()
+    if backend not in ('api', 'extract'):
+        raise ValueError(f'Unknown OSM backend: {settings.osm_backend}')
+    cache, overpass_cache = get_osm_caches(settings)
+    if backend == 'api':
+        api_backend = OSMApiDataBackend(username=settings.username, password=settings.password,
+                                        session=get_shared_session(settings))
+        return CoalescingOSMDataBackend(backend=api_backend, cache=cache, overpass_cache=overpass_cache)
+    paths = [path.strip() for path in settings.osm_history_extract.split(',') if path.strip()]
+    if not paths:
+        raise ValueError('OSM_HISTORY_EXTRACT must be set when OSM_BACKEND is "extract"')
+    for path in paths:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'OSM history extract not found: {path}')
+    return _restore_history_extract(tuple(paths), settings.osm_extract_tile_zoom, overpass_cache)
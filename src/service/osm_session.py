@@ -0,0 +1,415 @@
+# Process-wide HTTP session for OSM API calls with a pod-wide rate limit and adaptive concurrency
+import os
+import json
+import time
+import fcntl
+import random
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logging.basicConfig()
+logger = logging.getLogger('OSMSession')
+logger.setLevel(logging.INFO)
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+DEFAULT_LIMITER_FILE = os.path.join(tempfile.gettempdir(), 'osw-confidence', 'osm-api-limiter.json')
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket whose refill rate can be adjusted while in use.
+
+    Parameters:
+    - `rate` (float): Tokens added per second.
+    - `capacity` (float): Maximum number of tokens, i.e. the allowed burst.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self) -> float:
+        """
+        Takes a token if one is available.
+
+        Returns:
+        - `wait` (float): 0 when a token was taken, otherwise the seconds until one will be available.
+        """
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> None:
+        """
+        Blocks until a token is available and takes it.
+        """
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def set_rate(self, rate: float) -> None:
+        with self.lock:
+            self._refill()
+            self.rate = float(rate)
+
+    def update_rate(self, update: Callable[[float], float]) -> None:
+        """
+        Replaces the rate with `update(rate)` in one step.
+        """
+        with self.lock:
+            self._refill()
+            self.rate = float(update(self.rate))
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD concurrency limiter: the limit grows by one after a window of healthy responses and is
+    halved when the API throttles (429/5xx) or latency exceeds the target.
+
+    Parameters:
+    - `initial` (int): Starting number of concurrent requests.
+    - `minimum` (int): Lower bound for the limit.
+    - `maximum` (int): Upper bound for the limit.
+    - `latency_target` (float): Response time in seconds above which the limit is reduced.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, latency_target: float):
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.limit = min(max(int(initial), self.minimum), self.maximum)
+        self.latency_target = float(latency_target)
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float, throttled: bool = False) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            if throttled or latency > self.latency_target:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self.successes = 0
+            self.condition.notify_all()
+
+
+class SharedLimiterState:
+    """
+    Limiter state kept in a small JSON file and changed under an exclusive `fcntl` lock, so that every process
+    of the pod using the same file shares one limit: the service, the dask processes the confidence library starts
+    for each computation, the worker pool and the batch runner's processes.
+
+    Parameters:
+    - `path` (str): The state file; its folder is created when missing.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = f'{path}.lock'
+
+    @contextmanager
+    def update(self):
+        """
+        Yields the state as a dict, holding the lock, and writes it back when the block succeeds.
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, 'r') as file:
+                        state = json.load(file)
+                except (OSError, ValueError):
+                    state = {}
+                yield state
+                temp_path = f'{self.path}.{os.getpid()}.tmp'
+                with open(temp_path, 'w') as file:
+                    json.dump(state, file)
+                os.replace(temp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedTokenBucket:
+    """
+    `TokenBucket` whose tokens and rate live in a `SharedLimiterState`, so all processes draw from one bucket.
+    The file is initialized with `rate` and `capacity` by the first process to use it.
+    """
+
+    def __init__(self, state: SharedLimiterState, rate: float, capacity: float):
+        self.state = state
+        self.initial_rate = float(rate)
+        self.capacity = float(capacity)
+
+    def _bucket(self, state: dict) -> dict:
+        bucket = state.setdefault('bucket', {'rate': self.initial_rate, 'tokens': self.capacity,
+                                             'updated_at': time.time()})
+        now = time.time()
+        bucket['tokens'] = min(self.capacity, bucket['tokens'] + max(0.0, now - bucket['updated_at']) * bucket['rate'])
+        bucket['updated_at'] = now
+        return bucket
+
+    @property
+    def rate(self) -> float:
+        with self.state.update() as state:
+            return self._bucket(state)['rate']
+
+    def try_acquire(self) -> float:
+        with self.state.update() as state:
+            bucket = self._bucket(state)
+            if bucket['tokens'] >= 1:
+                bucket['tokens'] -= 1
+                return 0.0
+            return (1 - bucket['tokens']) / bucket['rate']
+
+    def acquire(self) -> None:
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def set_rate(self, rate: float) -> None:
+        self.update_rate(lambda _: rate)
+
+    def update_rate(self, update: Callable[[float], float]) -> None:
+        with self.state.update() as state:
+            bucket = self._bucket(state)
+            bucket['rate'] = float(update(bucket['rate']))
+
+
+class SharedConcurrencyLimiter:
+    """
+    `AdaptiveConcurrencyLimiter` whose limit and in-flight requests live in a `SharedLimiterState`. In-flight
+    requests are counted per process id, and those of processes that have exited, e.g. a killed worker, are dropped.
+
+    Parameters:
+    - `state` (SharedLimiterState): The shared state.
+    - `poll_interval` (float): Seconds between attempts while the limit is reached.
+    Others as for `AdaptiveConcurrencyLimiter`.
+    """
+
+    def __init__(self, state: SharedLimiterState, initial: int, minimum: int, maximum: int, latency_target: float,
+                 poll_interval: float = 0.05):
+        self.state = state
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.initial = min(max(int(initial), self.minimum), self.maximum)
+        self.latency_target = float(latency_target)
+        self.poll_interval = float(poll_interval)
+
+    def _limiter(self, state: dict) -> dict:
+        limiter = state.setdefault('limiter', {'limit': self.initial, 'successes': 0, 'in_flight': {}})
+        limiter['in_flight'] = {pid: count for pid, count in limiter['in_flight'].items()
+                                if count > 0 and _process_alive(int(pid))}
+        return limiter
+
+    @property
+    def limit(self) -> int:
+        with self.state.update() as state:
+            return self._limiter(state)['limit']
+
+    @property
+    def in_flight(self) -> int:
+        with self.state.update() as state:
+            return sum(self._limiter(state)['in_flight'].values())
+
+    def acquire(self) -> None:
+        pid = str(os.getpid())
+        while True:
+            with self.state.update() as state:
+                limiter = self._limiter(state)
+                if sum(limiter['in_flight'].values()) < limiter['limit']:
+                    limiter['in_flight'][pid] = limiter['in_flight'].get(pid, 0) + 1
+                    return
+            time.sleep(self.poll_interval)
+
+    def release(self, latency: float, throttled: bool = False) -> None:
+        pid = str(os.getpid())
+        with self.state.update() as state:
+            limiter = self._limiter(state)
+            limiter['in_flight'][pid] = max(0, limiter['in_flight'].get(pid, 0) - 1)
+            if throttled or latency > self.latency_target:
+                limiter['limit'] = max(self.minimum, limiter['limit'] // 2)
+                limiter['successes'] = 0
+            else:
+                limiter['successes'] += 1
+                if limiter['successes'] >= limiter['limit']:
+                    limiter['limit'] = min(self.maximum, limiter['limit'] + 1)
+                    limiter['successes'] = 0
+
+
+class RateLimitedSession(requests.Session):
+    """
+    Connection-pooled, keep-alive `requests.Session` shared by every OSM API call in the process.
+
+    Every request waits for a token from the rate limiter and a slot from the concurrency limiter. With
+    `limiter_file`, both limiters keep their state in that file and are shared by every process using it, which
+    covers the dask processes that the confidence library starts for each computation; the connection pool stays
+    per process. Without it, they only cover the threads of this process.
+
+    The limiters cover the OSM API calls made through this session, i.e. the element histories. The Overpass
+    queries that `osmnx` makes for the street graphs do not go through it; `osmnx` paces those itself.
+    429 and 5xx responses and connection errors are retried with exponential backoff and full jitter,
+    honouring `Retry-After`. Throttled responses halve the request rate; healthy responses raise it
+    step by step up to `max_rate`, so throughput settles at the API's actual limit.
+
+    Parameters:
+    - `rate` (float): Initial requests per second.
+    - `max_rate` (float): Upper bound for the request rate.
+    - `max_concurrency` (int): Upper bound for concurrent requests.
+    - `latency_target` (float): Response time in seconds above which concurrency is reduced.
+    - `max_retries` (int): Retries per request before the last response or error is returned.
+    - `pool_size` (int): Connections kept alive per host.
+    - `backoff_base` (float): Base delay in seconds for the exponential backoff.
+    - `backoff_cap` (float): Maximum backoff delay in seconds.
+    - `limiter_file` (str): Optional file holding the limiter state shared between processes.
+    """
+
+    def __init__(self, rate: float = 2.0, max_rate: float = 20.0, max_concurrency: int = 8,
+                 latency_target: float = 2.0, max_retries: int = 5, pool_size: int = 16,
+                 backoff_base: float = 0.5, backoff_cap: float = 30.0, limiter_file: Optional[str] = None):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.min_rate = min(0.1, float(rate))
+        self.max_rate = max(float(rate), float(max_rate))
+        if limiter_file:
+            state = SharedLimiterState(limiter_file)
+            self.bucket = SharedTokenBucket(state, rate=rate, capacity=max(1.0, float(rate)))
+            self.limiter = SharedConcurrencyLimiter(state, initial=max(1, max_concurrency // 2), minimum=1,
+                                                    maximum=max_concurrency, latency_target=latency_target)
+        else:
+            self.bucket = TokenBucket(rate=rate, capacity=max(1.0, float(rate)))
+            self.limiter = AdaptiveConcurrencyLimiter(initial=max(1, max_concurrency // 2), minimum=1,
+                                                      maximum=max_concurrency, latency_target=latency_target)
+        self.max_retries = int(max_retries)
+        self.backoff_base = float(backoff_base)
+        self.backoff_cap = float(backoff_cap)
+        self.rate_lock = threading.Lock()
+
+    def __reduce__(self):
+        # Other processes use their own process-wide session, which shares the limiter file
+        return get_shared_session, ()
+
+    def backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """
+        Returns the delay before retry `attempt` (starting at 0): `Retry-After` when the server sent
+        one, otherwise a uniformly random delay up to `backoff_base * 2 ** attempt`, capped.
+        """
+        if retry_after:
+            try:
+                return min(self.backoff_cap, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def _adjust_rate(self, throttled: bool) -> None:
+        def update(rate: float) -> float:
+            if throttled:
+                return max(self.min_rate, rate / 2)
+            return min(self.max_rate, rate + 0.1)
+
+        with self.rate_lock:
+            self.bucket.update_rate(update)
+
+    def request(self, method, url, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            self.limiter.acquire()
+            started_at = time.monotonic()
+            response, error = None, None
+            # Any other error is released as throttled and raised as is, so the slot is never leaked
+            throttled = True
+            try:
+                response = super().request(method, url, *args, **kwargs)
+                throttled = response.status_code in RETRY_STATUS_CODES
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                self.limiter.release(latency=time.monotonic() - started_at, throttled=throttled)
+                self._adjust_rate(throttled=throttled)
+
+            if not throttled:
+                return response
+            if attempt >= self.max_retries:
+                if error is not None:
+                    raise error
+                return response
+            retry_after = response.headers.get('Retry-After') if response is not None else None
+            delay = self.backoff(attempt, retry_after)
+            logger.info('OSM request %s %s throttled (%s), retrying in %.2fs', method, url,
+                        error if error is not None else response.status_code, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+_session_lock = threading.Lock()
+_shared_session: Optional[RateLimitedSession] = None
+
+
+def get_shared_session(settings=None) -> RateLimitedSession:
+    """
+    Returns the process-wide `RateLimitedSession`, creating it from `settings` on first use. Its limiters share
+    `OSM_API_LIMITER_FILE` with the other processes of the pod.
+
+    Parameters:
+    - `settings` (Settings): Optional service settings; defaults to a new `Settings()` instance.
+    """
+    global _shared_session
+    with _session_lock:
+        if _shared_session is None:
+            if settings is None:
+                from src.config import Settings
+                settings = Settings()
+            _shared_session = RateLimitedSession(
+                rate=float(settings.osm_api_rate_limit),
+                max_rate=float(settings.osm_api_max_rate_limit),
+                max_concurrency=int(settings.osm_api_max_concurrency),
+                latency_target=float(settings.osm_api_latency_target),
+                max_retries=int(settings.osm_api_max_retries),
+                pool_size=int(settings.osm_api_pool_size),
+                limiter_file=settings.osm_api_limiter_file or DEFAULT_LIMITER_FILE
+            )
+            logger.info('Created shared OSM session')
+        return _shared_session
@@ -5,13 +5,25 @@ import time
 import zipfile
 import logging
 import warnings
-from typing import Tuple, List
+from contextlib import nullcontext
+from typing import Callable, Iterator, Tuple, List, Optional
+import numpy as np
+import shapely
 import geopandas as gpd
 from src.config import Settings
 from src.service.helper import clean_up, is_valid_geojson
+from src.service.osm_data_backend import get_osm_data_backend
+from src.service.job_checkpoint import JobCheckpoint
+from src.service.progress_reporter import ProgressReporter
+from src.service.geometry_simplifier import simplify_geometries
+from src.service.footprint import compute_footprint, occupied_grid_cells
+from src.service.contribution_index import ContributionIndex
+from src.service.anytime_analyzer import AnytimeAreaAnalyzer, AreaScoreEstimate
+from src.service.job_cancellation import CancellationToken
+from src.service.dataset_cache import CachedDataset
+from src.service.spatial_order import locality_order
 from osw_confidence_metric.area_analyzer import AreaAnalyzer
-from osw_confidence_metric.osm_data_handler import OSMDataHandler
-import geojson
+from shapely.geometry import mapping
 
 
 logging.basicConfig()
@@ -20,6 +32,14 @@ logger.setLevel(logging.INFO)
 # warnings.filterwarnings('ignore', category=DeprecationWarning)
 # warnings.simplefilter(action='ignore', category=FutureWarning)
 
+POLYGON_TYPES = ['Polygon', 'MultiPolygon']
+RESPONSE_FORMATS = ('full', 'scores')
+NODES_ARTIFACT = 'nodes.geojson'
+
+
+
+def _json_score(score) -> Optional[float]:
+    return None if score is None or pd.isna(score) else float(score)
 
 
 class OSWConfidenceMetricCalculator:
@@ -36,11 +56,36 @@ class OSWConfidenceMetricCalculator:
     - `extracted_files` (list): List of all files extracted from the input zip.
     - `convex_file` (str): File path to the GeoJSON file representing the convex hull of the extracted OSM nodes.
     - `job_id` (str): A unique identifier.
+    - `checkpoint` (JobCheckpoint): Optional checkpoint used to skip work finished by an earlier attempt.
+    - `progress_reporter` (ProgressReporter): Optional reporter that receives partial results while sub-regions are scored.
+    - `grid_cell_size` (float): Optional grid cell size in metres for scoring a confidence surface over the dataset.
+    - `deadline_seconds` (float): Optional time budget after which the hull score is returned as an estimate.
+    - `cancellation` (CancellationToken): Optional token that stops the calculation when the job is cancelled or times out.
+    - `response_format` (str): `full` echoes every scored geometry, `scores` returns only the hull geometry.
+    - `coordinate_precision` (int): Decimal places of the returned coordinates, or None to keep them as they are.
+    - `cached_dataset` (CachedDataset): Optional dataset cache entry whose nodes file and hull are reused.
+    - `settings` (Settings): Optional settings; a new `Settings()` by default.
+    - `osm_data_handler` (OSMDataBackend): Optional backend used instead of `get_osm_data_backend(settings)`.
+    - `area_analyzer_class` (type): Optional class used instead of `AreaAnalyzer`.
+    - `validate_geojson` (Callable): Optional check of the sub-regions file used instead of `is_valid_geojson`.
 
     Methods:
+    - `get_nodes_file(self) -> Tuple[str, List[str]]`: Returns the nodes file, from the dataset cache when possible.
     - `unzip_nodes_file(self) -> Tuple[str, List[str]]`: Extracts the nodes file from the input zip, excluding unnecessary files and directories.
     - `get_convex_hull(self) -> str`: Reads the nodes file and calculates the convex hull of the node points, saving it as a GeoJSON file.
-    - `calculate_score(self) -> float`: Initiates the process of calculating the confidence score for the area represented by the convex hull.
+    - `get_osm_data_handler(self) -> OSMDataBackend`: Returns the given OSM backend or the one from the settings.
+    - `estimate_hull_score(self, osm_data_handler) -> AreaScoreEstimate`: Estimates the hull score within the deadline.
+    - `get_query_hull(self) -> str`: Returns the hull file to score, simplified when a tolerance is configured.
+    - `score_grid(self, osm_data_handler) -> GeoDataFrame`: Scores every occupied grid cell of the dataset.
+    - `order_sub_regions(self, sub_regions_gdf) -> ndarray`: Returns the positions of the sub-regions in scoring order.
+    - `iter_sub_region_scores(self, osm_data_handler, area_analyzer, sub_regions_gdf, order=None)`: Yields each sub-region score as it completes.
+    - `score_features(self) -> Iterator[dict]`: Yields the scored sub-regions as GeoJSON features, without the hull.
+    - `score_with_index(self, osm_data_handler, query_geometries, scorable) -> dict`: Scores all sub-regions from one contribution index.
+    - `classify_sub_regions(self, sub_regions_gdf) -> GeoDataFrame`: Flags the valid (Multi)Polygon sub-regions that can be scored.
+    - `calculate_score(self, sub_region_scores=None) -> float`: Initiates the process of calculating the confidence score for the area represented by the convex hull.
+    - `score_sub_region_range(self, start, end) -> List[Optional[float]]`: Scores one range of the scoring order.
+    - `score_shard(self) -> List[Optional[float]]`: Scores the sub-regions of a shard, in file order.
+    - `write_shard_inputs(self, ranges) -> Tuple[List[int], List[str]]`: Writes the sub-regions of every shard to its own file.
 
     Usage:
     ```python
@@ -52,24 +97,82 @@ class OSWConfidenceMetricCalculator:
     ```
     """
 
-    def __init__(self, output_path: str, zip_file: str, job_id: str, sub_regions_file: str = None ):
+    def __init__(self, output_path: str, zip_file: str, job_id: str, sub_regions_file: str = None,
+                 checkpoint: JobCheckpoint = None, progress_reporter: ProgressReporter = None,
+                 grid_cell_size: float = None, deadline_seconds: float = None,
+                 cancellation: CancellationToken = None, response_format: str = None,
+                 coordinate_precision: int = None, cached_dataset: CachedDataset = None, settings: Settings = None,
+                 osm_data_handler=None, area_analyzer_class: type = None,
+                 validate_geojson: Callable[[str], bool] = None):
         """
         Initializes an instance of the OSWConfidenceMetricCalculator class.
 
         Parameters:
-        - `zip_file` (str): The path to the input zip file containing OSM node data.
+        - `zip_file` (str): The path to the input zip file containing OSM node data, or None when the sub-regions
+                file is the whole dataset.
         - `job_id` (str): The unique identifier.
+        - `checkpoint` (JobCheckpoint): Optional checkpoint holding scores from an earlier attempt of the job.
+        - `progress_reporter` (ProgressReporter): Optional reporter for interim results.
+        - `grid_cell_size` (float): Optional cell size in metres; when set, every occupied grid cell is scored too.
+        - `deadline_seconds` (float): Optional time budget for the hull score; when set, the hull score is
+                estimated from a sample of its tiles and refined until the deadline.
+        - `cancellation` (CancellationToken): Optional token checked between stages and sub-regions, which also
+                applies the per-stage timeouts.
+        - `response_format` (str): `full` or `scores`; defaults to `settings.response_format`.
+        - `coordinate_precision` (int): Decimal places of the returned coordinates; defaults to
+                `settings.coordinate_precision`, where a negative value keeps full precision.
+        - `cached_dataset` (CachedDataset): Optional cache entry of the zip; the nodes file and hull extracted by
+                an earlier job are reused from it, and the ones extracted here are added to it.
+        - `settings` (Settings): Optional settings, e.g. with overridden fields; defaults to `Settings()`.
+        - `osm_data_handler` (OSMDataBackend): Optional backend for the element histories, e.g. a stand-in;
+                defaults to `get_osm_data_backend(settings)`.
+        - `area_analyzer_class` (type): Optional analyzer class taking `osm_data_handler`; defaults to `AreaAnalyzer`.
+        - `validate_geojson` (Callable): Optional check of the sub-regions file; defaults to `is_valid_geojson`,
+                which fetches the GeoJSON schema.
         """
         self.zip_file_path = zip_file
         self.sub_regions_file = sub_regions_file
         self.job_id = job_id
-        self.settings = Settings()
+        self.checkpoint = checkpoint
+        self.progress_reporter = progress_reporter
+        self.grid_cell_size = grid_cell_size
+        self.deadline_seconds = deadline_seconds
+        self.cancellation = cancellation
+        self.cached_dataset = cached_dataset
+        self.settings = settings or Settings()
+        self.osm_data_handler = osm_data_handler
+        self.area_analyzer_class = area_analyzer_class
+        self.validate_geojson = validate_geojson
+        self.response_format = str(response_format or self.settings.response_format).lower()
+        if self.response_format not in RESPONSE_FORMATS:
+            raise ValueError(f'Unknown response format: {self.response_format}')
+        if coordinate_precision is None:
+            coordinate_precision = int(self.settings.coordinate_precision)
+        self.coordinate_precision = coordinate_precision if coordinate_precision >= 0 else None
         self.username = self.settings.username
         self.password = self.settings.password
         self.output = output_path
-        self.nodes_file, self.extracted_files = self.unzip_nodes_file()
+        if zip_file is not None:
+            self.nodes_file, self.extracted_files = self.get_nodes_file()
+        else:
+            # Inline requests: the sub-regions are the whole dataset
+            self.nodes_file, self.extracted_files = sub_regions_file, []
         self.convex_file = self.get_convex_hull()
 
+    def get_nodes_file(self) -> Tuple[str, List[str]]:
+        """
+        Returns the nodes file, from the dataset cache when an earlier job extracted it, otherwise unzipped.
+        """
+        if self.cached_dataset is not None:
+            nodes_file = os.path.join(self.output, NODES_ARTIFACT)
+            if self.cached_dataset.restore_artifact(NODES_ARTIFACT, nodes_file):
+                logger.info(" using the cached nodes file for job_id: %s", self.job_id)
+                return nodes_file, [NODES_ARTIFACT]
+        nodes_file, extracted_files = self.unzip_nodes_file()
+        if self.cached_dataset is not None and nodes_file is not None:
+            self.cached_dataset.store_artifact(NODES_ARTIFACT, nodes_file)
+        return nodes_file, extracted_files
+
     def unzip_nodes_file(self) -> Tuple[str, List[str]]:
         """
         Extracts the nodes file from the input zip, excluding unnecessary files and directories.
@@ -96,91 +199,433 @@ class OSWConfidenceMetricCalculator:
     def get_convex_hull(self) -> str:
         """
         Reads the nodes file and calculates the convex hull of the node points, saving it as a GeoJSON file.
+        With `settings.footprint_mode` set to `clustered`, the hull is one convex hull per cluster of nodes.
+
+        The hull is reused from the dataset cache when an earlier job computed it with the same footprint settings.
 
         Returns:
         - `output_file` (str): File path to the GeoJSON file representing the convex hull.
         """
+        output_file = os.path.join(self.output, f'{self.job_id}.geojson')
+        artifact = f'hull_{self.settings.footprint_mode}_{float(self.settings.footprint_cell_size):g}.geojson'
+        if self.cached_dataset is not None and self.cached_dataset.restore_artifact(artifact, output_file):
+            return output_file
+
         gdf = gpd.read_file(self.nodes_file)
-        merged_geometry = gdf.unary_union
-        convex_hull = merged_geometry.convex_hull
+        convex_hull = compute_footprint(gdf.geometry, mode=self.settings.footprint_mode,
+                                        cell_size=float(self.settings.footprint_cell_size))
         convex_hull_gdf = gpd.GeoDataFrame(geometry=[convex_hull])
-
-        output_file = os.path.join(self.output, f'{self.job_id}.geojson')
         convex_hull_gdf.to_file(output_file, driver='GeoJSON')
+        if self.cached_dataset is not None:
+            self.cached_dataset.store_artifact(artifact, output_file)
+        return output_file
+
+    def get_hull_area_km2(self) -> float:
+        """
+        Returns the area of the convex hull in square kilometres, measured in the hull's local UTM zone.
+        """
+        hull_gdf = gpd.read_file(self.convex_file)
+        if hull_gdf.crs is None:
+            hull_gdf = hull_gdf.set_crs(epsg=4326)
+        return float(hull_gdf.to_crs(hull_gdf.estimate_utm_crs()).area.sum() / 1e6)
+
+    def get_osm_data_handler(self):
+        """
+        Returns the OSM backend given to the calculator, or the one selected by the settings.
+        """
+        if self.osm_data_handler is not None:
+            return self.osm_data_handler
+        return get_osm_data_backend(self.settings)
+
+    def create_area_analyzer(self, osm_data_handler) -> AreaAnalyzer:
+        return (self.area_analyzer_class or AreaAnalyzer)(osm_data_handler=osm_data_handler)
+
+    def estimate_hull_score(self, osm_data_handler) -> AreaScoreEstimate:
+        """
+        Estimates the hull score from random batches of its tiles until `deadline_seconds` have passed or the
+        error reaches `settings.anytime_target_error`.
+        """
+        deadline = time.monotonic() + float(self.deadline_seconds)
+        analyzer = AnytimeAreaAnalyzer(osm_data_handler=osm_data_handler,
+                                       initial_sample=int(self.settings.anytime_initial_sample),
+                                       target_error=float(self.settings.anytime_target_error))
+        estimate = analyzer.estimate_area_confidence_score(file_path=self.get_query_hull(), deadline=deadline,
+                                                           cancellation=self.cancellation)
+        logger.info(" estimated hull score for job_id: %s from %d of %d tiles: %s +/- %s", self.job_id,
+                    estimate.sampled, estimate.total, estimate.score, estimate.error)
+        return estimate
+
+    def get_query_hull(self) -> str:
+        """
+        Returns the hull file to score: the convex hull itself, or a simplified copy containing it when
+        `settings.simplify_tolerance` is set.
+        """
+        tolerance = float(self.settings.simplify_tolerance)
+        if tolerance <= 0:
+            return self.convex_file
+        hull_gdf = gpd.read_file(self.convex_file)
+        simplified, _ = simplify_geometries(hull_gdf.geometry, tolerance)
+        output_file = os.path.join(self.output, f'{self.job_id}_simplified.geojson')
+        gpd.GeoDataFrame(geometry=simplified).to_file(output_file, driver='GeoJSON')
         return output_file
 
+    def count_sub_regions(self) -> int:
+        """
+        Returns the number of features in the sub-regions file, or 0 when there is none.
+        """
+        if not self.sub_regions_file or not os.path.exists(self.sub_regions_file):
+            return 0
+        with open(self.sub_regions_file, 'r') as file:
+            return len(json.load(file).get('features', []))
+
     # def calculate_score(self) -> JSON:
-    def calculate_score(self):
+    def calculate_score(self, sub_region_scores: Callable[[], List[Optional[float]]] = None):
         """
         Initiates the process of calculating the confidence score for the area represented by the convex hull.
 
+        Parameters:
+        - `sub_region_scores` (Callable): Optional function returning the score of every sub-region in scoring
+                order, called once the hull is scored, for jobs whose sub-regions are scored by shards on other
+                replicas.
+
         Returns:
         - `results` (dict): geojson object with the first element being dataset convex hull, and the subsequent 
                 ones are the given input areas in the subregions file, with confidence_score added to each of
                 element's properties
         """
         
-        osm_data_handler = OSMDataHandler(username=self.settings.username, password=self.settings.password)
-        area_analyzer = AreaAnalyzer(osm_data_handler=osm_data_handler)
+        osm_data_handler = self.get_osm_data_handler()
+        area_analyzer = self.create_area_analyzer(osm_data_handler)
         start_time = time.time()
-        score = area_analyzer.calculate_area_confidence_score(file_path=self.convex_file)
+        hull_error = None
+        with self._stage('hull', self.settings.hull_timeout):
+            if self.checkpoint is not None and self.checkpoint.hull_score is not None:
+                score = self.checkpoint.hull_score
+                logger.info(" using checkpointed hull score for job_id: %s", self.job_id)
+            elif self.deadline_seconds:
+                estimate = self.estimate_hull_score(osm_data_handler)
+                score, hull_error = estimate.score, estimate.error
+                if self.checkpoint is not None and estimate.complete:
+                    self.checkpoint.set_hull_score(score)
+            else:
+                score = area_analyzer.calculate_area_confidence_score(file_path=self.get_query_hull())
+                if self.checkpoint is not None:
+                    self.checkpoint.set_hull_score(score)
         # score = 0.75
         logger.info("--- %s seconds ---" % (time.time() - start_time))
         
         sub_regions_gdf = None
         if self.sub_regions_file:
-            is_sub_region_file_valid = is_valid_geojson(self.sub_regions_file)
+            is_sub_region_file_valid = (self.validate_geojson or is_valid_geojson)(self.sub_regions_file)
             if is_sub_region_file_valid:
-                with open(self.sub_regions_file, "r") as file:
-                    sub_regions = geojson.load(file)
-                    # print(type(sub_regions))
-                    # print((sub_regions))
-                # print(sub_regions_gdf)
-                sub_regions_gdf = gpd.read_file(self.sub_regions_file)
-                conf_scores:List = []
-                for index, feature in enumerate(sub_regions.features):
-                    # print(index, feature)
-                    start_time = time.time()
-                    logger.info(" calculating confidence metric for sub_region: %d of job_id: %s", index, self.job_id)
-                    if isinstance(feature, geojson.Feature) and isinstance(feature.geometry, geojson.Polygon):
-                    # # if isinstance(feature, geojson.Feature):
-                    # if isinstance(feature.geometry, geojson.Polygon):
-                        split_ext = os.path.splitext(self.sub_regions_file)
-                        temp_geojson_file_name = split_ext[0]+"_"+str(index)+split_ext[1]
-                        
-                        with open(temp_geojson_file_name, 'w') as outfile:
-                            geojson.dump(feature, outfile)
-                        sub_score = area_analyzer.calculate_area_confidence_score(file_path=temp_geojson_file_name)
-                    else:
-                        logger.info(" row: ", index, " of subregion is not a polygon. skipping cals..")
-                        # print("skipping for ... ", index)
-                        sub_score = None 
-                        
-                    logger.info("--- %s seconds ---" % (time.time() - start_time))
-                    conf_scores.append(sub_score)
-                
-                # print("len of sub_regoions = ", len(sub_regions_gdf), " len of conf_socres =", len(conf_scores))
-                sub_regions_gdf['confidence_score'] = conf_scores    
-                
+                sub_regions_gdf = self.classify_sub_regions(gpd.read_file(self.sub_regions_file))
+                conf_scores:List = [None] * len(sub_regions_gdf)
+                if sub_region_scores is not None:
+                    order = self.order_sub_regions(sub_regions_gdf)
+                    scores = list(sub_region_scores())
+                    if len(scores) != len(order):
+                        raise ValueError(f'Got {len(scores)} sub-region scores for {len(order)} sub-regions')
+                    for index, sub_score in zip(order, scores):
+                        conf_scores[index] = sub_score
+                else:
+                    completed = {}
+                    for index, sub_score in self.iter_sub_region_scores(osm_data_handler, area_analyzer,
+                                                                        sub_regions_gdf):
+                        conf_scores[index] = completed[index] = sub_score
+                        self._report_progress(score, sub_regions_gdf, completed)
+
+                sub_regions_gdf = sub_regions_gdf.drop(columns='scorable')
+                sub_regions_gdf['confidence_score'] = conf_scores
+
             else:
                 logger.info("Error occurred in reading input subregions file: ")
                 sub_regions_gdf = None
-                        
 
+
+        grid_gdf = None
+        if self.grid_cell_size:
+            with self._stage('grid', self.settings.grid_timeout):
+                grid_gdf = self.score_grid(osm_data_handler)
+
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+
+        return self._build_results(score, sub_regions_gdf, grid_gdf, hull_error=hull_error)
+
+    def score_sub_region_range(self, start: int, end: int) -> List[Optional[float]]:
+        """
+        Scores the sub-regions at positions `[start, end)` of the scoring order alone, without the hull, so each
+        range holds neighbouring sub-regions.
+
+        Returns:
+        - `scores` (list): The scores in scoring order.
+        """
+        sub_regions_gdf = self.classify_sub_regions(gpd.read_file(self.sub_regions_file))
+        positions = self.order_sub_regions(sub_regions_gdf)[start:end]
+        return self._score_in_file_order(sub_regions_gdf.iloc[positions].reset_index(drop=True))
+
+    def score_shard(self) -> List[Optional[float]]:
+        """
+        Scores every sub-region of the file in file order, without the hull, for a shard whose file holds its
+        range of the scoring order of the job that split it, as written by `write_shard_inputs`.
+
+        Returns:
+        - `scores` (list): The scores in file order.
+        """
+        return self._score_in_file_order(self.classify_sub_regions(gpd.read_file(self.sub_regions_file)))
+
+    def write_shard_inputs(self, ranges: List[Tuple[int, int]]) -> Optional[Tuple[List[int], List[str]]]:
+        """
+        Writes the sub-regions at every range `[start, end)` of the scoring order to a GeoJSON file of its own, so
+        a shard reads only its own sub-regions.
+
+        Returns:
+        - `order` (list): The file position of every sub-region in scoring order, for merging the shard scores.
+        - `paths` (list): The sub-regions file of every range.
+
+        None when the sub-regions file is not valid, in which case the job is not split.
+        """
+        if not self.sub_regions_file or not (self.validate_geojson or is_valid_geojson)(self.sub_regions_file):
+            return None
+        sub_regions_gdf = gpd.read_file(self.sub_regions_file)
+        order = self.order_sub_regions(self.classify_sub_regions(sub_regions_gdf.copy()))
+        split_ext = os.path.splitext(self.sub_regions_file)
+        paths = []
+        for index, (start, end) in enumerate(ranges):
+            path = f'{split_ext[0]}_shard_{index}{split_ext[1]}'
+            with open(path, 'w') as file:
+                file.write(sub_regions_gdf.iloc[order[start:end]].to_json(drop_id=True))
+            paths.append(path)
+        return [int(position) for position in order], paths
+
+    def _score_in_file_order(self, sub_regions_gdf: gpd.GeoDataFrame) -> List[Optional[float]]:
+        osm_data_handler = self.get_osm_data_handler()
+        area_analyzer = self.create_area_analyzer(osm_data_handler)
+        scores = [None] * len(sub_regions_gdf)
+        for index, sub_score in self.iter_sub_region_scores(osm_data_handler, area_analyzer, sub_regions_gdf,
+                                                            order=np.arange(len(sub_regions_gdf))):
+            scores[index] = sub_score
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+        return [_json_score(sub_score) for sub_score in scores]
+
+    def order_sub_regions(self, sub_regions_gdf: gpd.GeoDataFrame) -> np.ndarray:
+        """
+        Returns the positions of the sub-regions in the order they are scored: along the space-filling curve set by
+        `settings.sub_region_order`, or in file order. Along a curve, the sub-regions of a shard cover a compact
+        area, so the histories of the ways on their shared borders are fetched once into that replica's OSM cache
+        and reused by the neighbours. Within one replica the cache outlives every computation and serves all
+        sub-regions whatever their order.
+        """
+        return locality_order(sub_regions_gdf.geometry, method=self.settings.sub_region_order)
+
+    def iter_sub_region_scores(self, osm_data_handler, area_analyzer: AreaAnalyzer,
+                               sub_regions_gdf: gpd.GeoDataFrame,
+                               order: np.ndarray = None) -> Iterator[Tuple[int, Optional[float]]]:
+        """
+        Scores the classified sub-regions in `order`, by default `order_sub_regions`, yielding `(index, score)`
+        with the sub-region's position in the file as each one completes. The score is None for sub-regions that
+        cannot be scored. Checkpointed scores are reused and new ones recorded.
+        """
+        query_geometries = sub_regions_gdf.geometry.copy()
+        scorable = sub_regions_gdf['scorable'].to_numpy()
+        simplified, _ = simplify_geometries(query_geometries[scorable], float(self.settings.simplify_tolerance))
+        query_geometries[scorable] = simplified
+        indexed_scores = self.score_with_index(osm_data_handler, query_geometries, scorable)
+        split_ext = os.path.splitext(self.sub_regions_file)
+        if order is None:
+            order = self.order_sub_regions(sub_regions_gdf)
+        for index in order:
+            index = int(index)
+            geometry = query_geometries.iloc[index]
+            start_time = time.time()
+            if self.checkpoint is not None:
+                is_done, sub_score = self.checkpoint.get_sub_region_score(index)
+                if is_done:
+                    yield index, sub_score
+                    continue
+            with self._stage(f'sub-region {index}', self.settings.sub_region_timeout):
+                if indexed_scores is not None and index in indexed_scores:
+                    sub_score = indexed_scores[index]
+                elif scorable[index]:
+                    logger.info(" calculating confidence metric for sub_region: %d of job_id: %s", index,
+                                self.job_id)
+                    temp_geojson_file_name = split_ext[0]+"_"+str(index)+split_ext[1]
+                    with open(temp_geojson_file_name, 'w') as outfile:
+                        json.dump({'type': 'Feature', 'properties': {}, 'geometry': mapping(geometry)},
+                                  outfile)
+                    sub_score = area_analyzer.calculate_area_confidence_score(
+                        file_path=temp_geojson_file_name)
+                else:
+                    logger.info(" sub_region: %d of job_id: %s is not a valid polygon. skipping calcs..",
+                                index, self.job_id)
+                    sub_score = None
+
+            logger.info("--- %s seconds ---" % (time.time() - start_time))
+            if self.checkpoint is not None:
+                self.checkpoint.record_sub_region(index, sub_score)
+            yield index, sub_score
+
+    def score_features(self) -> Iterator[dict]:
+        """
+        Scores the sub-regions alone, without the dataset hull, yielding each one as a GeoJSON feature with its
+        `confidence_score` as soon as it is scored. Used for inline requests, whose sub-regions file is written
+        by the service and not validated against the remote GeoJSON schema.
+        """
+        osm_data_handler = self.get_osm_data_handler()
+        area_analyzer = self.create_area_analyzer(osm_data_handler)
+        sub_regions_gdf = self.classify_sub_regions(gpd.read_file(self.sub_regions_file))
+        features = json.loads(sub_regions_gdf.drop(columns='scorable').to_json())['features']
+        # Features are streamed back in request order
+        for index, sub_score in self.iter_sub_region_scores(osm_data_handler, area_analyzer, sub_regions_gdf,
+                                                            order=np.arange(len(sub_regions_gdf))):
+            feature = features[index]
+            feature['properties']['confidence_score'] = sub_score
+            yield feature
+
+    def score_with_index(self, osm_data_handler, query_geometries: gpd.GeoSeries, scorable) -> Optional[dict]:
+        """
+        With `settings.sub_region_scoring` set to `index`, fetches the OSM elements under all scorable
+        sub-regions once into a `ContributionIndex` and scores every sub-region from it.
+
+        Returns:
+        - `scores` (dict): Score per sub-region position, or None when sub-regions are scored one by one.
+        """
+        if str(self.settings.sub_region_scoring).lower() != 'index' or not scorable.any():
+            return None
+        start_time = time.time()
+        geometries = query_geometries[scorable]
+        index = ContributionIndex.from_osm(geometries.unary_union, osm_data_handler)
+        scores = index.score(geometries.to_numpy())
+        logger.info(" scored %d sub_regions of job_id: %s from the contribution index in %s seconds",
+                    len(scores), self.job_id, time.time() - start_time)
+        positions = np.flatnonzero(scorable)
+        return {int(position): float(score) for position, score in zip(positions, scores)}
+
+    def score_grid(self, osm_data_handler) -> gpd.GeoDataFrame:
+        """
+        Scores every `grid_cell_size` cell holding dataset nodes in one pass: the OSM elements under the cells
+        are fetched once into a `ContributionIndex` and all cells are aggregated from it.
+
+        Returns:
+        - `grid_gdf` (GeoDataFrame): The cells with `grid_col`, `grid_row`, `grid_cell_size` and `confidence_score`.
+        """
+        start_time = time.time()
+        nodes_gdf = gpd.read_file(self.nodes_file)
+        cells = occupied_grid_cells(nodes_gdf.geometry, float(self.grid_cell_size))
+        if cells.empty:
+            return None
+        index = ContributionIndex.from_osm(cells.unary_union, osm_data_handler)
+        grid_gdf = gpd.GeoDataFrame({
+            'grid_col': cells['col'],
+            'grid_row': cells['row'],
+            'grid_cell_size': float(self.grid_cell_size),
+            'confidence_score': index.score(cells.geometry.to_numpy())
+        }, geometry=cells.geometry, crs=cells.crs)
+        grid_gdf.attrs['grid_crs'] = cells.attrs.get('grid_crs')
+        logger.info(" scored %d grid cells of job_id: %s in %s seconds", len(grid_gdf), self.job_id,
+                    time.time() - start_time)
+        return grid_gdf
+
+    def classify_sub_regions(self, sub_regions_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+        """
+        Flags the sub-regions that can be scored, in one pass over the whole feature set.
+
+        Polygons and MultiPolygons are scorable when valid. With `settings.repair_sub_regions`, invalid
+        polygonal geometries are first repaired with `make_valid`; repairs that no longer yield a
+        (Multi)Polygon stay unscored.
+
+        Returns:
+        - `sub_regions_gdf` (GeoDataFrame): The sub-regions with a boolean `scorable` column.
+        """
+        polygonal = sub_regions_gdf.geom_type.isin(POLYGON_TYPES)
+        if self.settings.repair_sub_regions:
+            invalid = polygonal & ~sub_regions_gdf.is_valid
+            if invalid.any():
+                logger.info(" repairing %d invalid sub_regions of job_id: %s", int(invalid.sum()), self.job_id)
+                sub_regions_gdf = sub_regions_gdf.copy()
+                sub_regions_gdf.loc[invalid, 'geometry'] = sub_regions_gdf.geometry[invalid].make_valid()
+                polygonal = sub_regions_gdf.geom_type.isin(POLYGON_TYPES)
+        sub_regions_gdf['scorable'] = (polygonal & sub_regions_gdf.is_valid).to_numpy()
+        return sub_regions_gdf
+
+    def _build_results(self, score, sub_regions_gdf=None, grid_gdf=None, hull_error=None) -> dict:
+        """
+        Builds the result FeatureCollection: the convex hull with its score, and its `confidence_error` when the
+        score is an estimate, followed by the scored sub-regions and the scored grid cells.
+
+        With the `scores` response format only the hull is a feature; the sub-region scores are listed under
+        `scores` by feature index, and the grid cell scores under `grid_scores` by column and row.
+        """
         main_region_gdf = gpd.read_file(self.convex_file)
         assert(len(main_region_gdf) == 1)
         main_polygon = main_region_gdf.iloc[0].geometry
         main_result_gdf = gpd.GeoDataFrame([ {'geometry': main_polygon} ], crs=main_region_gdf.crs)
         main_result_gdf['confidence_score'] = [score]
-        
+        if hull_error is not None:
+            main_result_gdf['confidence_error'] = [hull_error]
+
+        if self.response_format == 'scores':
+            results = self._to_geojson(main_result_gdf)
+            if sub_regions_gdf is not None:
+                results['scores'] = self._sub_region_scores(sub_regions_gdf)
+            if grid_gdf is not None:
+                results['grid'] = {'cell_size': float(self.grid_cell_size), 'crs': grid_gdf.attrs.get('grid_crs')}
+                results['grid_scores'] = [
+                    {'grid_col': int(col), 'grid_row': int(row), 'confidence_score': _json_score(cell_score)}
+                    for col, row, cell_score in zip(grid_gdf['grid_col'], grid_gdf['grid_row'],
+                                                    grid_gdf['confidence_score'])]
+            return results
+
         if sub_regions_gdf is not None:
             # main_result_gdf = main_result_gdf.append(sub_regions_gdf, ignore_index=True)
             main_result_gdf = pd.concat([main_result_gdf, sub_regions_gdf], ignore_index=True)
-            
+        if grid_gdf is not None:
+            main_result_gdf = pd.concat([main_result_gdf, grid_gdf], ignore_index=True)
+
         # print(main_result_gdf)
-        results = main_result_gdf.to_json()
-        results = json.loads(results)
-        return results
+        return self._to_geojson(main_result_gdf)
+
+    def _to_geojson(self, result_gdf: gpd.GeoDataFrame) -> dict:
+        if self.coordinate_precision is not None:
+            result_gdf = result_gdf.copy()
+            # Rounds the coordinates only; unlike set_precision it never drops or snaps together vertices
+            result_gdf.geometry = shapely.transform(result_gdf.geometry.to_numpy(),
+                                                    lambda coords: np.round(coords, self.coordinate_precision))
+        return json.loads(result_gdf.to_json())
+
+    @staticmethod
+    def _sub_region_scores(sub_regions_gdf: gpd.GeoDataFrame) -> List[dict]:
+        ids = sub_regions_gdf['id'].tolist() if 'id' in sub_regions_gdf.columns else None
+        scores = []
+        # The index labels are the positions in the sub-regions file, also for the partial results
+        for position, (index, sub_score) in enumerate(zip(sub_regions_gdf.index, sub_regions_gdf['confidence_score'])):
+            entry = {'index': int(index)}
+            if ids is not None and not pd.isna(ids[position]):
+                entry['id'] = ids[position]
+            entry['confidence_score'] = _json_score(sub_score)
+            scores.append(entry)
+        return scores
+
+    def _stage(self, name: str, timeout: float = None):
+        if self.cancellation is None:
+            return nullcontext()
+        return self.cancellation.stage(name, timeout=float(timeout or 0))
+
+    def _report_progress(self, score, sub_regions_gdf, completed: dict) -> None:
+        if self.progress_reporter is None:
+            return
+
+        def snapshot() -> dict:
+            # Copied only when an interim message is due; the copy of a plain dict is atomic, so the timer
+            # thread can take it while this one adds scores
+            scores = dict(completed)
+            positions = sorted(scores)
+            completed_gdf = sub_regions_gdf.iloc[positions].drop(columns='scorable', errors='ignore')
+            completed_gdf['confidence_score'] = [scores[position] for position in positions]
+            return self._build_results(score, completed_gdf)
+
+        self.progress_reporter.update(len(completed), len(sub_regions_gdf), snapshot)
 
     def clean_up_files(self) -> None:
         clean_up(path=self.output)
\ No newline at end of file
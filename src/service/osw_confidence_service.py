@@ -1,24 +1,163 @@
 # Service that handles the confidence calculation
 import os
+import asyncio
 import json
 import logging
 import traceback
+import urllib.parse
 
 import osw_confidence_metric
-from dataclasses import asdict
+from dataclasses import asdict, dataclass
 from src.config import Settings
 from python_ms_core import Core
+from python_ms_core.core.storage.providers.azure.azure_storage_client import AzureStorageClient
 from src.models.confidence_request import ConfidenceRequest
 from src.service.osw_confidence_metric_calculator import OSWConfidenceMetricCalculator
+from src.service.job_scheduler import JobScheduler, JobCostEstimate
+from src.service.job_checkpoint import JobCheckpoint, get_checkpoint_store, CHECKPOINT_FILE_NAME
+from src.service.progress_reporter import ProgressReporter
+from src.service.job_cancellation import CancellationToken, JobCancelledError, JobRegistry
+from src.service.job_workspace import WorkspaceManager, JobWorkspace
+from src.service.dataset_cache import DatasetCache, CachedDataset
+from src.service.job_profiler import JobProfiler, profiled, prune_profiles
+from src.service.async_pipeline import AsyncJobPipeline
+from src.service.job_idempotency import IdempotencyGuard
+from src.service.job_sharding import JobSharder
+from src.service.worker_pool import WorkerPool
+from src.service.inline_scoring import InlineScoringService
 from python_ms_core.core.queue.models.queue_message import QueueMessage
 from src.models.confidence_response import ConfidenceResponse, ResponseData
 import threading
+from contextlib import ExitStack
+from typing import Any, Callable, List, Optional, Tuple
 
 logging.basicConfig()
 logger = logging.getLogger("OSWConfService")
 logger.setLevel(logging.INFO)
 
 
+@dataclass
+class RemoteFile:
+    """
+    A blob looked up once per job, with the size and version read from its properties.
+    """
+    url: str
+    file: Any = None
+    size: int = 0
+    version: Optional[str] = None
+
+
+@dataclass
+class ConfidenceJob:
+    """
+    State of one confidence calculation as it moves through its stages.
+    """
+    request: ConfidenceRequest
+    token: CancellationToken
+    profiler: Optional[JobProfiler] = None
+    zip_size: int = 0
+    data_file: Optional[RemoteFile] = None
+    workspace: Optional[JobWorkspace] = None
+    zip_path: Optional[str] = None
+    sub_regions_path: Optional[str] = None
+    cached_dataset: Optional[CachedDataset] = None
+    checkpoint: Optional[JobCheckpoint] = None
+    progress_reporter: Optional[ProgressReporter] = None
+    metric: Optional[OSWConfidenceMetricCalculator] = None
+    shard_ranges: Optional[List[Tuple[int, int]]] = None
+    shard_order: Optional[List[int]] = None
+    scores: Optional[dict] = None
+    is_success: bool = False
+    failed_message: str = ''
+    response: Optional[ConfidenceResponse] = None
+
+    @property
+    def job_id(self) -> str:
+        return self.request.data.jobId
+
+
+def calculate_scores(metric: OSWConfidenceMetricCalculator, shard: Optional[dict] = None,
+                     sub_region_scores: Callable[[], List] = None):
+    """
+    Runs the calculator for a job: the sub-regions of a shard, the hull with the given sub-region scores, or the
+    whole job.
+    """
+    if shard:
+        return metric.score_shard()
+    if sub_region_scores is not None:
+        return metric.calculate_score(sub_region_scores=sub_region_scores)
+    return metric.calculate_score()
+
+
+class _WorkerCacheStats:
+    """
+    Stands in for the dataset cache in a worker process, passing its accounting to the service's cache.
+    """
+
+    def __init__(self, call: Callable):
+        self.call = call
+
+    def record_artifact(self, hit: bool) -> None:
+        self.call('cache', 'record_artifact', hit)
+
+    def grow(self, key: str, size: int) -> None:
+        self.call('cache', 'grow', key, size)
+
+
+_worker_storage_client = None
+
+
+def score_in_worker(spec: dict, call: Callable):
+    """
+    Worker process side of a job: extracts the dataset, computes its hull and scores it, with the checkpoint,
+    progress reporter and cache entry rebuilt from `spec`. The scheduler slot, the publishing of the shards and
+    the progress messages are asked of the service through `call`.
+    """
+    global _worker_storage_client
+    settings = Settings()
+    token = CancellationToken(spec['job_id'], timeout=spec['timeout'])
+    checkpoint = None
+    if spec['checkpoint'] is not None:
+        if str(settings.checkpoint_store).lower() == 'blob' and _worker_storage_client is None:
+            _worker_storage_client = Core().get_storage_client()
+        checkpoint = JobCheckpoint(store=get_checkpoint_store(settings, _worker_storage_client), job_id=spec['job_id'],
+                                   **spec['checkpoint'])
+        checkpoint.load()
+    progress_reporter = None
+    if spec['progressive']:
+        progress_reporter = ProgressReporter(publish=lambda progress, partial: call('progress', progress, partial),
+                                             every=settings.progress_every, interval=settings.progress_interval)
+        progress_reporter.start()
+    cached_dataset = None
+    if spec['cached_dataset'] is not None:
+        cached_dataset = CachedDataset(cache=_WorkerCacheStats(call), **spec['cached_dataset'])
+
+    profiler = None
+    if spec.get('profile_top'):
+        profiler = JobProfiler(spec['job_id'], top=spec['profile_top'])
+        profiler.start()
+
+    def run():
+        metric = OSWConfidenceMetricCalculator(cancellation=token, checkpoint=checkpoint,
+                                               progress_reporter=progress_reporter, cached_dataset=cached_dataset,
+                                               **spec['calculator'])
+        ranges = call('plan', metric.get_hull_area_km2(), metric.count_sub_regions())
+        split = metric.write_shard_inputs(ranges) if ranges is not None else None
+        if split is None:
+            return calculate_scores(metric, spec['shard'])
+        call('split', ranges, *split)
+        # The shards fill in the sub-region scores once they report
+        return calculate_scores(metric, sub_region_scores=lambda: [None] * len(split[0]))
+    try:
+        return token.run(profiled(profiler, run))
+    finally:
+        if progress_reporter is not None:
+            progress_reporter.stop()
+        if profiler is not None:
+            profiler.stop()
+            call('profile', profiler.export())
+
+
 class OSWConfidenceService:
     """
     OSWConfidenceService class is responsible for handling confidence calculation requests.
@@ -28,15 +167,40 @@ class OSWConfidenceService:
     - `incoming_topic` (Topic): Topic for incoming confidence calculation requests.
     - `outgoing_topic` (Topic): Topic for outgoing confidence calculation responses.
     - `storage_client` (StorageClient): Client for interacting with the storage service.
+    - `scheduler` (JobScheduler): Admission control and fast/slow lanes for scoring, by estimated job cost.
+    - `checkpoint_store` (CheckpointStore): Where job checkpoints are kept, or None when disabled.
+    - `jobs` (JobRegistry): Cancellation tokens of the running jobs.
+    - `workspaces` (WorkspaceManager): Job working folders and the disk quota.
+    - `dataset_cache` (DatasetCache): Downloaded datasets shared by the jobs on this pod.
+    - `inline` (InlineScoringService): Synchronous scoring of inline GeoJSON for the HTTP API.
+    - `pipeline` (AsyncJobPipeline): Runs the jobs as coroutines when `SERVICE_MODE` is `async`, otherwise None.
+    - `idempotency` (IdempotencyGuard): Keeps redelivered and duplicate messages from computing a job again, or None.
+    - `sharding` (JobSharder): Splits jobs with many sub-regions into shards for other replicas, or None when disabled.
+    - `workers` (WorkerPool): Recycled worker processes that score the jobs, or None to score in this process.
     - `logger` (Logger): Logger instance for logging service-specific information.
 
     Methods:
-    - `__init__(self)`: Initializes an instance of the OSWConfidenceService class.
+    - `__init__(self, loop=None)`: Initializes an instance of the OSWConfidenceService class.
     - `subscribe(self) -> None`: Subscribes the service to the incoming confidence calculation topic.
     - `process(self, msg: QueueMessage)`: Processes incoming confidence calculation requests.
+    - `run_once(self, request: ConfidenceRequest)`: Runs a job unless it already ran or is running.
     - `calculate_confidence(self, request: ConfidenceRequest)`: Initiates the confidence calculation process.
-    - `download_single_file(self, remote_url: str, local_path: str)`: Downloads a single file from a remote URL.
+    - `start_job`, `admit_job`, `download_job_inputs`, `prepare_job`, `create_calculator`, `score_job`,
+      `close_job`, `publish_job_result`: The stages of a job, shared by the threaded and the asyncio paths.
+    - `score_job_in_worker(self, job: ConfidenceJob)`: Extracts and scores the dataset in a worker process.
+    - `plan_scoring(self, job, hull_area_km2, sub_region_count)`: Decides whether to split the job and estimates its cost.
+    - `split_job(self, job, ranges, order, input_paths)`: Publishes the shards of a split job.
+    - `report_shard(self, job: ConfidenceJob)`: Saves the outcome of a shard for the job that split it.
+    - `publish_shard_message(self, message: dict)`: Publishes a shard to the incoming topic.
+    - `publish_merged_result(self, job, success, scores, message)`: Publishes the response of a merged split job.
+    - `cancel_job(self, job_id: str) -> bool`: Cancels a running job.
+    - `save_profile(self, profiler: JobProfiler)`: Stores the profile of a profiled job.
+    - `download_single_file(self, remote_url: str, local_path: str, file=None)`: Downloads a single file from a remote URL.
+    - `fetch_dataset(self, remote_file: RemoteFile, local_path: str) -> CachedDataset`: Places a dataset zip, from the cache when unchanged.
+    - `find_remote_file(self, remote_url: str)`: Returns the file entity of a remote URL.
+    - `get_remote_file(self, remote_url: str) -> RemoteFile`: Looks up a remote file and reads its size and version.
     - `send_response_message(self, response: ConfidenceResponse)`: Sends the confidence calculation response message.
+    - `send_progress_message(self, request: ConfidenceRequest, progress: float, scores: dict)`: Sends an interim response.
 
     Usage:
     ```python
@@ -46,15 +210,41 @@ class OSWConfidenceService:
     ```
     """
 
-    def __init__(self):
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None, core: Core = None,
+                 settings: Settings = None, calculator_options: Optional[dict] = None):
         """
         Initializes an instance of the OSWConfidenceService class.
+
+        Parameters:
+        - `loop` (AbstractEventLoop): Optional event loop, such as FastAPI's, that runs the jobs when
+                `SERVICE_MODE` is `async`.
+        - `core` (Core): Optional core providing the topics and the storage client; defaults to `Core()`.
+        - `settings` (Settings): Optional settings; defaults to `Settings()`.
+        - `calculator_options` (dict): Optional keyword arguments for every `OSWConfidenceMetricCalculator` of
+                the queued jobs, e.g. its settings or a stand-in OSM backend. They are not sent to worker
+                processes, so they need `WORKER_PROCESSES=0`.
         """
-        self.core = Core()
-        self.settings = Settings()
+        self.core = core or Core()
+        self.settings = settings or Settings()
+        self.calculator_options = dict(calculator_options or {})
+        if self.calculator_options and int(self.settings.worker_processes or 0) > 0:
+            raise ValueError('calculator_options need WORKER_PROCESSES=0')
         self.incoming_topic = self.core.get_topic(self.settings.incoming_topic_name,
                                                   max_concurrent_messages=self.settings.max_concurrent_messages)
         self.storage_client = self.core.get_storage_client()
+        self.scheduler = JobScheduler.from_settings(self.settings)
+        self.checkpoint_store = get_checkpoint_store(self.settings, self.storage_client)
+        self.jobs = JobRegistry()
+        self.workspaces = WorkspaceManager.from_settings(self.settings)
+        self.dataset_cache = DatasetCache.from_settings(self.settings)
+        self.inline = InlineScoringService(self.settings, self.workspaces)
+        self.pipeline = None
+        if str(self.settings.service_mode).lower() == 'async':
+            self.pipeline = AsyncJobPipeline.from_settings(self, self.settings, loop=loop)
+        self.idempotency = IdempotencyGuard.from_settings(self.settings, self.storage_client)
+        self.sharding = JobSharder.from_settings(self.settings, self.storage_client, self.publish_shard_message,
+                                                 self.publish_merged_result)
+        self.workers = WorkerPool.from_settings(self.settings)
         self.listening_thread = threading.Thread(target=self.subscribe)
         self.listening_thread.start()
         logger.info('Confidence service initiated')
@@ -89,8 +279,7 @@ class OSWConfidenceService:
         # Have to start with the processing of the message
         try:
             confidence_request = ConfidenceRequest(messageType=msg.messageType, messageId=msg.messageId, data=msg.data)
-            # create a thread and complete the message
-            self.calculate_confidence(request=confidence_request)
+            self.run_once(confidence_request)
         except TypeError as e:
             logger.error(' Type error occurred')
             logger.error(e)
@@ -108,78 +297,413 @@ class OSWConfidenceService:
                 ).__dict__
             ))
 
-    def calculate_confidence(self, request: ConfidenceRequest):
+    def run_once(self, request: ConfidenceRequest):
         """
-        Initiates the confidence calculation process.
+        Runs the job of a message unless it already ran or is running. A duplicate waits for the running attempt
+        and gets its response replayed, as does a redelivery of a job already computed.
 
         Parameters:
         - `request` (ConfidenceRequest): The confidence calculation request.
         """
-        local_base_path = os.path.join(self.settings.get_download_folder(), request.data.jobId)
-        if not os.path.exists(local_base_path):
-            os.makedirs(local_base_path)
+        if self.idempotency is None:
+            self.run_job(request)
+            return
+        claim = self.idempotency.claim(request)
+        if not claim.owned:
+            # A split job is answered by the merge of its shards
+            if claim.response is not None:
+                self.send_response_message(ConfidenceResponse(messageId=request.messageId,
+                                                              messageType=request.messageType,
+                                                              data=claim.response))
+            return
+        job = None
+        try:
+            job = self.run_job(request)
+        finally:
+            succeeded = job is not None and job.is_success and job.response is not None
+            deferred = job is not None and job.is_success and job.response is None and job.shard_order is not None
+            self.idempotency.finish(claim, asdict(job.response.data) if succeeded else None, deferred=deferred)
+
+    def run_job(self, request: ConfidenceRequest) -> ConfidenceJob:
+        if self.pipeline is not None:
+            # The message is settled once this returns, so wait for the job's coroutine
+            return self.pipeline.submit(request).result()
+        return self.calculate_confidence(request=request)
+
+    def calculate_confidence(self, request: ConfidenceRequest) -> ConfidenceJob:
+        """
+        Initiates the confidence calculation process.
 
-        jobId = request.data.jobId
-        is_success = False
-        scores = None
+        Parameters:
+        - `request` (ConfidenceRequest): The confidence calculation request.
 
+        Returns:
+        - `job` (ConfidenceJob): The finished job with its response.
+        """
+        job = self.start_job(request)
         try:
             if not self.settings.is_simulated():
-                osw_file_local_path = os.path.join(local_base_path, f'{jobId}.zip')
-                self.download_single_file(request.data.data_file, osw_file_local_path)
+                self.admit_job(job)
+                with job.token.stage('download', timeout=float(self.settings.download_timeout)):
+                    job.token.run(profiled(job.profiler, lambda: self.download_job_inputs(job)))
+                self.prepare_job(job)
+                if self.workers is not None:
+                    self.score_job_in_worker(job)
+                else:
+                    job.metric = job.token.run(profiled(job.profiler, lambda: self.create_calculator(job)))
+                    self.score_job(job)
+            else:  # Simulated
+                self.simulate_job(job)
+        except Exception as e:
+            self.fail_job(job, e)
+        finally:
+            self.close_job(job)
+        self.publish_job_result(job)
+        return job
 
-                sub_regions_file_local_path = None
-                if request.data.sub_regions_file:
-                    sub_regions_file_local_path = os.path.join(local_base_path, f'{jobId}_subregions.geojson')
-                    self.download_single_file(request.data.sub_regions_file, sub_regions_file_local_path)
+    def start_job(self, request: ConfidenceRequest) -> ConfidenceJob:
+        """
+        Registers the job's cancellation token and starts its profiler when the job is profiled.
+        """
+        job = ConfidenceJob(request=request, token=self.jobs.register(
+            CancellationToken(request.data.jobId, timeout=float(self.settings.job_timeout))))
+        if request.data.profile or self.settings.profile_jobs:
+            job.profiler = JobProfiler(job.job_id, top=self.settings.profile_top)
+            job.profiler.start()
+        return job
 
-                metric = OSWConfidenceMetricCalculator(output_path=local_base_path, zip_file=osw_file_local_path,
-                                                       job_id=jobId, sub_regions_file=sub_regions_file_local_path)
+    def admit_job(self, job: ConfidenceJob) -> None:
+        """
+        Checks the job against the cost budget and reserves its workspace, waiting for disk space if needed. A
+        shard needs no dataset, only its sub-regions.
+        """
+        if JobSharder.is_shard(job.request):
+            job.workspace = self.workspaces.acquire(job.job_id)
+            return
+        # Reject on the blob size alone before spending time on the download
+        job.data_file = self.get_remote_file(job.request.data.data_file)
+        job.zip_size = job.data_file.size
+        self.scheduler.check_budget(JobCostEstimate(zip_size_bytes=job.zip_size), job_id=job.job_id)
+        # The workspace holds the zip, the extracted dataset and the per-polygon files
+        job.workspace = self.workspaces.acquire(
+            job.job_id, expected_bytes=job.zip_size * float(self.settings.workspace_expansion_factor))
+        job.zip_path = os.path.join(job.workspace.path, f'{job.job_id}.zip')
 
-                scores = metric.calculate_score()
-                logger.info('Score from OSWConfidenceMetricCalculator: %s', scores)
+    def download_job_inputs(self, job: ConfidenceJob) -> None:
+        """
+        Downloads the dataset zip, from the dataset cache when unchanged, and the sub-regions file. A shard reads its
+        sub-regions from the shard store instead.
+        """
+        if JobSharder.is_shard(job.request):
+            if self.sharding is None:
+                raise ValueError('Received a shard but sharding is disabled on this replica')
+            job.sub_regions_path = os.path.join(job.workspace.path, f'{job.job_id}_subregions.geojson')
+            self.sharding.fetch_input(job.request, job.sub_regions_path)
+            return
+        job.cached_dataset = self.fetch_dataset(job.data_file or self.get_remote_file(job.request.data.data_file),
+                                                job.zip_path)
+        if job.request.data.sub_regions_file:
+            job.sub_regions_path = os.path.join(job.workspace.path, f'{job.job_id}_subregions.geojson')
+            self.download_single_file(job.request.data.sub_regions_file, job.sub_regions_path)
 
-                metric.clean_up_files()
-                logger.info(' Cleaned up the temp directory')
+    def prepare_job(self, job: ConfidenceJob) -> None:
+        """
+        Loads the job's checkpoint and starts its progress reporter.
+        """
+        request = job.request
+        if self.checkpoint_store is not None:
+            job.checkpoint = JobCheckpoint(store=self.checkpoint_store, job_id=job.job_id,
+                                           fingerprint=f'{request.data.data_file}|{request.data.sub_regions_file}',
+                                           flush_every=self.settings.checkpoint_flush_every,
+                                           flush_interval=self.settings.checkpoint_flush_interval)
+            job.checkpoint.load()
 
-                if scores is not None:
-                    is_success = True
-            else:  # Simulated
-                scores = json.loads(
-                    '{"type": "FeatureCollection", "features": [{"id": "0", "type": "Feature", "properties": {"confidence_score": 0.75}, "geometry": {"type": "Polygon", "coordinates": [[[-122.1322201, 47.63528], [-122.1378655, 47.6353141], [-122.1395176, 47.6355614], [-122.1431969, 47.6365115], [-122.1443805, 47.6385402], [-122.1469453, 47.6460242], [-122.1429792, 47.6495373], [-122.1403351, 47.6497278], [-122.1325839, 47.6498422],  [-122.1321999, 47.6496722], [-122.1321845, 47.6496558], [-122.1285859, 47.6378078], [-122.1322201, 47.63528]]]}}]}')
-                is_success = True
-        except Exception as e:
-            logger.error(f"Failed to calculate confidence: {e}")
-            failed_message = f'Failed to calculate confidence : {e}'
+        # A worker process reports the progress of its job itself
+        if request.data.progressive and self.workers is None:
+            job.progress_reporter = ProgressReporter(
+                publish=lambda progress, partial: self.send_progress_message(request, progress, partial),
+                every=self.settings.progress_every,
+                interval=self.settings.progress_interval)
+            job.progress_reporter.start()
+
+    def create_calculator(self, job: ConfidenceJob) -> OSWConfidenceMetricCalculator:
+        """
+        Extracts the dataset and computes its hull. A shard has no zip, and its hull is that of its sub-regions.
+        """
+        data = job.request.data
+        return OSWConfidenceMetricCalculator(
+            output_path=job.workspace.path, zip_file=job.zip_path, job_id=job.job_id,
+            sub_regions_file=job.sub_regions_path, checkpoint=job.checkpoint,
+            progress_reporter=job.progress_reporter, grid_cell_size=data.grid_cell_size,
+            deadline_seconds=data.deadline_seconds, cancellation=job.token,
+            response_format=data.response_format,
+            coordinate_precision=data.coordinate_precision, cached_dataset=job.cached_dataset,
+            **self.calculator_options)
+
+    def score_job(self, job: ConfidenceJob) -> None:
+        """
+        Scores the dataset once a scheduler slot for its estimated cost is free. The slot is held until the
+        scoring has really stopped, after the job's response when the job was cancelled or timed out.
+
+        A job with more than `SHARD_SIZE` sub-regions is split: its sub-regions are published as shards for any
+        replica to score, while the hull and grid are scored here. The job then finishes without a response, which
+        is published by whichever replica merges the shard scores once they have all reported. A shard scores its
+        own sub-regions only.
+        """
+        estimate = self.start_scoring(job)
+        slot = ExitStack()
+        # Waits through the token, so a job cancelled or timed out while queued gives up its place
+        slot.enter_context(self.scheduler.slot(estimate, job_id=job.job_id, check=job.token.check))
+        try:
+            job.scores = job.token.run(profiled(job.profiler, lambda: self.calculate_job_scores(job)))
+        finally:
+            # A cancelled calculation runs on until its next check, and keeps its slot until it has stopped
+            job.token.when_stopped(slot.close)
+        self.finish_scoring(job)
+
+    def start_scoring(self, job: ConfidenceJob) -> JobCostEstimate:
+        """
+        Splits a job with more than `SHARD_SIZE` sub-regions into shards, and returns the cost estimate of the
+        scoring left on this replica, for its scheduler slot.
+        """
+        estimate, ranges = self.plan_scoring(job, job.metric.get_hull_area_km2(), job.metric.count_sub_regions())
+        split = job.metric.write_shard_inputs(ranges) if ranges is not None else None
+        if split is not None:
+            self.split_job(job, ranges, *split)
+        return estimate
+
+    def calculate_job_scores(self, job: ConfidenceJob):
+        sub_region_scores = None
+        if job.shard_order is not None:
+            # The shards fill in the sub-region scores once they report
+            sub_region_scores = lambda: [None] * len(job.shard_order)
+        return calculate_scores(job.metric, job.request.data.shard, sub_region_scores=sub_region_scores)
+
+    def score_job_in_worker(self, job: ConfidenceJob) -> None:
+        """
+        Extracts the dataset, computes its hull and scores it in a worker process, which asks back for its
+        scheduler slot once the hull is known. Stages as `score_job` otherwise.
+        """
+        request = job.request
+        checkpoint = None
+        if job.checkpoint is not None:
+            checkpoint = {'fingerprint': job.checkpoint.fingerprint, 'flush_every': job.checkpoint.flush_every,
+                          'flush_interval': job.checkpoint.flush_interval}
+        cached_dataset = None
+        if job.cached_dataset is not None:
+            cached_dataset = {'key': job.cached_dataset.key, 'url': job.cached_dataset.url,
+                              'folder': job.cached_dataset.folder, 'hit': job.cached_dataset.hit}
+        spec = {
+            'job_id': job.job_id,
+            'timeout': job.token.remaining() or 0,
+            'calculator': {'output_path': job.workspace.path, 'zip_file': job.zip_path, 'job_id': job.job_id,
+                           'sub_regions_file': job.sub_regions_path, 'grid_cell_size': request.data.grid_cell_size,
+                           'deadline_seconds': request.data.deadline_seconds,
+                           'response_format': request.data.response_format,
+                           'coordinate_precision': request.data.coordinate_precision},
+            'checkpoint': checkpoint,
+            'progressive': bool(request.data.progressive),
+            'cached_dataset': cached_dataset,
+            'shard': request.data.shard,
+            # The worker profiles its part of the job and sends the profile back
+            'profile_top': job.profiler.top if job.profiler is not None else 0
+        }
+        with ExitStack() as slot:
+            def on_call(name: str, *args):
+                if name == 'plan':
+                    estimate, ranges = self.plan_scoring(job, *args)
+                    slot.enter_context(self.scheduler.slot(estimate, job_id=job.job_id,
+                                                           check=job.token.check))
+                    return ranges
+                if name == 'split':
+                    self.split_job(job, *args)
+                elif name == 'profile':
+                    if job.profiler is not None:
+                        job.profiler.merge(*args)
+                elif name == 'progress':
+                    self.send_progress_message(request, *args)
+                elif name == 'cache' and job.cached_dataset is not None and args[0] in ('record_artifact', 'grow'):
+                    getattr(job.cached_dataset.cache, args[0])(*args[1:])
+                return None
+
+            job.scores = self.workers.run(score_in_worker, (spec,), on_call=on_call, token=job.token)
+        self.finish_scoring(job)
+
+    def plan_scoring(self, job: ConfidenceJob, hull_area_km2: float,
+                     sub_region_count: int) -> Tuple[JobCostEstimate, Optional[List[Tuple[int, int]]]]:
+        """
+        Decides whether a job with more than `SHARD_SIZE` sub-regions is split, and estimates the cost of the
+        scoring left on this replica.
 
+        Returns:
+        - `estimate` (JobCostEstimate): The cost of the job's scoring here.
+        - `ranges` (list): The range of the scoring order of every shard, or None when the job is not split.
+        """
+        shard = job.request.data.shard
+        if shard:
+            return JobCostEstimate(sub_region_count=int(shard['end']) - int(shard['start'])), None
+        ranges = None
+        if self.sharding is not None:
+            ranges = self.sharding.plan(job.request, sub_region_count)
+        if ranges is not None:
+            # Only the hull and the grid are scored on this replica
+            sub_region_count = 0
+        return JobCostEstimate(zip_size_bytes=job.zip_size, hull_area_km2=hull_area_km2,
+                               sub_region_count=sub_region_count), ranges
+
+    def split_job(self, job: ConfidenceJob, ranges: List[Tuple[int, int]], order: List[int],
+                  input_paths: List[str]) -> None:
+        """
+        Publishes the shards of a job, given the sub-regions file of every shard, and keeps the scoring order for
+        merging their scores.
+        """
+        self.sharding.fan_out(job.request, ranges, input_paths)
+        job.shard_ranges, job.shard_order = ranges, order
+
+    def finish_scoring(self, job: ConfidenceJob) -> None:
+        logger.info('Score from OSWConfidenceMetricCalculator: %s', job.scores)
+        if job.scores is not None:
+            if job.shard_order is not None:
+                # The replica that merges the shard scores publishes the response
+                self.sharding.defer(job.request, job.scores, job.shard_ranges, job.shard_order)
+            job.is_success = True
+
+    def simulate_job(self, job: ConfidenceJob) -> None:
+        """
+        Answers with a fixed score, for simulation.
+        """
+        job.scores = json.loads(
+            '{"type": "FeatureCollection", "features": [{"id": "0", "type": "Feature", "properties": {"confidence_score": 0.75}, "geometry": {"type": "Polygon", "coordinates": [[[-122.1322201, 47.63528], [-122.1378655, 47.6353141], [-122.1395176, 47.6355614], [-122.1431969, 47.6365115], [-122.1443805, 47.6385402], [-122.1469453, 47.6460242], [-122.1429792, 47.6495373], [-122.1403351, 47.6497278], [-122.1325839, 47.6498422],  [-122.1321999, 47.6496722], [-122.1321845, 47.6496558], [-122.1285859, 47.6378078], [-122.1322201, 47.63528]]]}}]}')
+        job.is_success = True
+
+    def fail_job(self, job: ConfidenceJob, error: Exception) -> None:
+        """
+        Records why the job failed, for its response.
+        """
+        if isinstance(error, JobCancelledError):
+            # The abandoned calculation stops at its next check; the workspace is freed below
+            logger.error(f'Stopped job: {error}')
+            job.failed_message = str(error)
+        else:
+            logger.error(f"Failed to calculate confidence: {error}")
+            job.failed_message = f'Failed to calculate confidence : {error}'
+
+    def close_job(self, job: ConfidenceJob) -> None:
+        """
+        Unregisters the job, stops its progress reporter and profiler, frees its workspace, and prunes the
+        checkpoints left by failed jobs.
+        """
+        self.jobs.unregister(job.token)
+        if job.progress_reporter is not None:
+            job.progress_reporter.stop()
+        if job.workspace is not None:
+            # Keep a failed job's local checkpoint for its retry
+            job.workspace.release(
+                keep=[CHECKPOINT_FILE_NAME] if job.checkpoint is not None and not job.is_success else [])
+            logger.info(' Cleaned up the temp directory')
+        if self.checkpoint_store is not None:
+            # Drops the kept checkpoints of failed jobs that were never retried
+            self.checkpoint_store.prune()
+        if job.profiler is not None:
+            job.profiler.stop()
+            self.save_profile(job.profiler)
+
+    def publish_job_result(self, job: ConfidenceJob) -> None:
+        """
+        Publishes the final response and discards the checkpoint of the finished job. A shard reports to the job
+        that split it instead, and a split job leaves its response to the merge of its shards.
+        """
+        if JobSharder.is_shard(job.request):
+            self.report_shard(job)
+            return
+        if job.is_success and job.shard_order is not None:
+            logger.info(f'Job {job.job_id} is answered once its shards are merged')
+            if job.checkpoint is not None:
+                job.checkpoint.discard()
+            return
         response = ConfidenceResponse(
-            messageId=request.messageId,
-            messageType=request.messageType,
+            messageId=job.request.messageId,
+            messageType=job.request.messageType,
             data=ResponseData(
-                jobId=jobId,
-                confidence_scores=scores,
+                jobId=job.job_id,
+                confidence_scores=job.scores,
                 confidence_library_version=osw_confidence_metric.__version__,
                 status='finished',
-                message='Processed successfully' if is_success else failed_message,
-                success=is_success
+                message='Processed successfully' if job.is_success else job.failed_message,
+                success=job.is_success,
+                progress=1.0 if job.request.data.progressive else None
             ).__dict__
         )
 
         logger.info('Sending response for lib confidence')
+        job.response = response
         self.send_response_message(response=response)
+        if job.checkpoint is not None:
+            job.checkpoint.discard()
+
+    def report_shard(self, job: ConfidenceJob) -> None:
+        """
+        Saves the outcome of a shard to the shard store, and merges the job that split it when this was its last
+        shard to report.
+        """
+        if self.sharding is None:
+            logger.error(f'Received shard {job.job_id} but sharding is disabled on this replica')
+            return
+        try:
+            self.sharding.report(job.request, job.is_success, scores=job.scores if job.is_success else None,
+                                 message=job.failed_message)
+            logger.info(f'Reported shard {job.job_id}')
+        except Exception as e:
+            logger.error(f'Failed to report shard {job.job_id}: {e}')
+            return
+        if job.checkpoint is not None and job.is_success:
+            job.checkpoint.discard()
+
+    def cancel_job(self, job_id: str) -> bool:
+        """
+        Cancels a running job. Its worker is released right away and a failure response is published.
+
+        Parameters:
+        - `job_id` (str): The job to cancel.
 
-    def download_single_file(self, remote_url: str, local_path: str):
+        Returns:
+        - `cancelled` (bool): False when no job with that id is running on this instance.
+        """
+        return self.jobs.cancel(job_id, reason='cancelled by request')
+
+    def save_profile(self, profiler: JobProfiler):
+        """
+        Saves a job's profile under `<downloads>/profiles/<jobId>`, removing the saved profiles older than
+        `PROFILE_RETENTION`, or uploads it to `profiles/<jobId>` in the storage container when `PROFILE_STORE` is
+        `blob`. Failures are logged, never raised.
+
+        Parameters:
+        - `profiler` (JobProfiler): The stopped profiler of the job.
+        """
+        try:
+            if str(self.settings.profile_store).lower() == 'blob':
+                profiler.upload(self.storage_client, self.settings.storage_container_name)
+            else:
+                folder = os.path.join(self.settings.get_download_folder(), 'profiles')
+                profiler.save(os.path.join(folder, profiler.job_id))
+                prune_profiles(folder, float(self.settings.profile_retention))
+        except Exception as e:
+            logger.error(f'Failed to save the profile of {profiler.job_id}: {e}')
+
+    def download_single_file(self, remote_url: str, local_path: str, file=None):
         """
         Downloads a single file from a remote URL.
 
         Parameters:
         - `remote_url` (str): The remote URL of the file.
         - `local_path` (str): The local path where the file should be saved.
+        - `file` (FileEntity): The file already looked up, to skip listing the container again.
         """
         logger.info(f'Downloading {remote_url}')
         logger.info(f' to  {local_path}')
         try:
-            file = self.storage_client.get_file_from_url(self.settings.storage_container_name, remote_url)
+            if file is None:
+                file = self.find_remote_file(remote_url)
             if file.file_path:
                 with open(local_path, 'wb') as blob:
                     blob.write(file.get_stream())
@@ -189,6 +713,82 @@ class OSWConfidenceService:
         except Exception as e:
             logger.error(e)
 
+    def fetch_dataset(self, remote_file: RemoteFile, local_path: str) -> Optional[CachedDataset]:
+        """
+        Places the dataset zip at `local_path`, from the dataset cache when the blob's ETag is unchanged since it
+        was cached, otherwise downloaded through the file entity already looked up.
+
+        Returns:
+        - `cached` (CachedDataset): The cache entry of the zip, or None when the cache was not used.
+        """
+        def download(path: str):
+            self.download_single_file(remote_file.url, path, file=remote_file.file)
+
+        cached = None
+        if self.dataset_cache.enabled:
+            cached = self.dataset_cache.fetch(remote_file.url, remote_file.version, download)
+        if cached is None:
+            download(local_path)
+            return None
+        cached.copy_to(local_path)
+        return cached
+
+    def find_remote_file(self, remote_url: str):
+        """
+        Returns the file entity of a remote URL. On Azure the blob is addressed by its path, as
+        `get_file_from_url` lists the whole container to find it.
+
+        Parameters:
+        - `remote_url` (str): The remote URL of the file.
+        """
+        if isinstance(self.storage_client, AzureStorageClient):
+            _, file_path = self.storage_client.get_container_info(urllib.parse.unquote(remote_url))
+            return self.storage_client.get_file(self.settings.storage_container_name, file_path)
+        return self.storage_client.get_file_from_url(self.settings.storage_container_name, remote_url)
+
+    def get_remote_file(self, remote_url: str) -> RemoteFile:
+        """
+        Looks up a remote file and reads its blob properties once, so its size, its version and its download all
+        reuse the same lookup. The size is 0 and the version None when they are not available.
+
+        Parameters:
+        - `remote_url` (str): The remote URL of the file.
+        """
+        remote_file = RemoteFile(url=remote_url)
+        try:
+            remote_file.file = self.find_remote_file(remote_url)
+            properties = remote_file.file.blob_client.get_blob_properties()
+            remote_file.size = int(properties.size or 0)
+            version = properties.etag or properties.last_modified
+            remote_file.version = str(version) if version else None
+        except Exception as e:
+            logger.info(f'Could not read the properties of {remote_url}: {e}')
+        return remote_file
+
+    def send_progress_message(self, request: ConfidenceRequest, progress: float, scores: dict):
+        """
+        Sends an interim response with the scores completed so far.
+
+        Parameters:
+        - `request` (ConfidenceRequest): The confidence calculation request.
+        - `progress` (float): Fraction of the sub-regions completed.
+        - `scores` (dict): Partial results, the hull followed by the completed sub-regions.
+        """
+        logger.info(f'Sending interim response for {request.data.jobId} at {progress:.0%}')
+        self.send_response_message(response=ConfidenceResponse(
+            messageId=request.messageId,
+            messageType=request.messageType,
+            data=ResponseData(
+                jobId=request.data.jobId,
+                confidence_scores=scores,
+                confidence_library_version=osw_confidence_metric.__version__,
+                status='in-progress',
+                message='Partial results',
+                success=True,
+                progress=progress
+            ).__dict__
+        ))
+
     def send_response_message(self, response: ConfidenceResponse):
         """
         Sends the confidence calculation response message.
@@ -212,9 +812,54 @@ class OSWConfidenceService:
         except Exception as e:
             logger.error(f'Failed to publish response: {e} for {response.data.jobId}')
 
+    def publish_merged_result(self, job: dict, success: bool, scores: Optional[dict], message: str):
+        """
+        Publishes the final response of a split job once its shard scores are merged, on whichever replica merged
+        them.
+
+        Parameters:
+        - `job` (dict): The job document saved by the replica that split the job.
+        - `success` (bool): False when a shard failed.
+        - `scores` (dict): The merged results.
+        - `message` (str): Why a shard failed.
+        """
+        response = ConfidenceResponse(
+            messageId=job['messageId'],
+            messageType=job['messageType'],
+            data=ResponseData(
+                jobId=job['jobId'],
+                confidence_scores=scores,
+                confidence_library_version=osw_confidence_metric.__version__,
+                status='finished',
+                message='Processed successfully' if success else f'Failed to calculate confidence : {message}',
+                success=success,
+                progress=1.0 if job['progressive'] else None
+            ).__dict__
+        )
+        self.send_response_message(response=response)
+        if self.idempotency is not None:
+            # Redeliveries of the job now get this response replayed, or compute a failed job again
+            self.idempotency.complete(job['jobId'], asdict(response.data) if success else None)
+
+    def publish_shard_message(self, message: dict):
+        """
+        Publishes a shard of a split job to the incoming topic, for any replica to pick up.
+
+        Parameters:
+        - `message` (dict): The shard message, with `messageId`, `messageType` and `data`.
+        """
+        self.core.get_topic(self.settings.incoming_topic_name).publish(data=QueueMessage.data_from(message))
+        logger.info(f'Published shard {message["data"]["jobId"]}')
+
     def stop_listening(self):
         """
         Stops the service from listening to incoming messages.
         """
         self.listening_thread.join(timeout=0)
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.idempotency is not None:
+            self.idempotency.stop()
+        if self.workers is not None:
+            self.workers.stop()
         logger.info('Stopped listening to incoming messages')
@@ -0,0 +1,88 @@
+# Publishes interim results of long sub-region jobs
+import time
+import logging
+import threading
+from typing import Callable, Optional
+
+logging.basicConfig()
+logger = logging.getLogger('ProgressReporter')
+logger.setLevel(logging.INFO)
+
+
+class ProgressReporter:
+    """
+    Calls `publish(progress, results)` every `every` completed sub-regions, and from a background thread
+    whenever `interval` seconds pass without a publish, so a stalled job keeps reporting the same progress.
+
+    Parameters:
+    - `publish` (Callable[[float, dict], None]): Sends an interim message with the progress fraction and results.
+    - `every` (int): Completed sub-regions between interim messages; 0 disables the count trigger.
+    - `interval` (float): Seconds between interim messages; 0 disables the timer.
+
+    Usage:
+    ```python
+    reporter = ProgressReporter(publish=send_interim, every=50, interval=60)
+    reporter.start()
+    reporter.update(completed, total, snapshot_fn)
+    reporter.stop()
+    ```
+    """
+
+    def __init__(self, publish: Callable[[float, dict], None], every: int = 50, interval: float = 60.0):
+        self.publish = publish
+        self.every = int(every)
+        self.interval = float(interval)
+        self.completed = 0
+        self.total = 0
+        self.published_at_count = 0
+        self.published_at = time.monotonic()
+        self.snapshot_fn: Optional[Callable[[], dict]] = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def progress(self) -> float:
+        return self.completed / self.total if self.total else 0.0
+
+    def start(self) -> None:
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def update(self, completed: int, total: int, snapshot_fn: Callable[[], dict]) -> None:
+        """
+        Records progress and publishes when `every` sub-regions finished since the last interim message.
+
+        Parameters:
+        - `completed` (int): Sub-regions finished so far.
+        - `total` (int): Total sub-regions.
+        - `snapshot_fn` (Callable[[], dict]): Builds the partial results; only called when publishing.
+        """
+        with self.lock:
+            self.completed, self.total, self.snapshot_fn = completed, total, snapshot_fn
+            due = self.every > 0 and completed < total and completed - self.published_at_count >= self.every
+        if due:
+            self._publish()
+
+    def _publish(self) -> None:
+        with self.lock:
+            if self.snapshot_fn is None:
+                return
+            progress, snapshot_fn = self.progress, self.snapshot_fn
+            self.published_at_count = self.completed
+            self.published_at = time.monotonic()
+        try:
+            self.publish(progress, snapshot_fn())
+        except Exception as e:
+            logger.error(f'Failed to publish interim results: {e}')
+
+    def _run(self) -> None:
+        while not self.stopped.wait(timeout=self.interval / 4):
+            if time.monotonic() - self.published_at >= self.interval:
+                self._publish()
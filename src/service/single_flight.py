@@ -0,0 +1,279 @@
+# Request coalescing and caching helpers, within a process and across processes
+import os
+import time
+import fcntl
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, Optional
+
+_MISSING = object()
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers that ask for a key while a call for it is in
+    flight wait for that call and receive its result (or exception) instead of starting their own.
+
+    Usage:
+    ```python
+    flight = SingleFlight()
+    history = flight.do(('way', 42), lambda: backend.get_way_history(42))
+    ```
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """
+        Returns `fn()` for `key`, sharing the result with concurrent callers of the same key.
+
+        Parameters:
+        - `key` (Hashable): Identifies the call, e.g. an element or a normalized tile.
+        - `fn` (Callable): Performs the call when no other caller is already running it.
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.in_flight[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded least-recently-used cache.
+
+    Parameters:
+    - `maxsize` (int): Number of entries kept; 0 disables caching.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = int(maxsize)
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self.lock:
+            value = self.data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.data.move_to_end(key)
+            return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.lock:
+            return key in self.data
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+class DiskCache:
+    """
+    Cache of picklable values kept as one file per key under `folder`, shared by every process using the folder,
+    such as the processes the confidence library starts for each computation, and kept across computations.
+    Entries older than `ttl` seconds are missing to `get` and removed by `prune`. With `max_bytes`, the least
+    recently used files are evicted once the folder grows past it: `get` marks an entry as used by setting its access
+    time, and the folder is measured after every tenth of `max_bytes` written through `set` and on every `prune`.
+
+    `get_or_fetch` is single-flight across processes: the fetch runs under a file lock for the key, and the
+    processes waiting on that lock then find the value in the cache.
+
+    Parameters:
+    - `folder` (str): Folder holding the entries.
+    - `ttl` (float): Seconds an entry stays valid; 0 keeps entries until they are removed.
+    - `stripes` (int): Number of lock files the keys are spread over.
+    - `max_bytes` (int): Size the folder is kept under; 0 keeps every entry until it expires.
+
+    Usage:
+    ```python
+    cache = DiskCache('/tmp/osm-cache', ttl=86400)
+    history = cache.get_or_fetch(('way', 42), lambda: backend.get_way_history(42))
+    ```
+    """
+
+    def __init__(self, folder: str, ttl: float = 86400, stripes: int = 256, max_bytes: int = 0):
+        self.folder = folder
+        self.ttl = float(ttl or 0)
+        self.stripes = max(1, int(stripes))
+        self.max_bytes = int(max_bytes or 0)
+        self.written = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _hash(key: Hashable) -> str:
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def path(self, key: Hashable) -> str:
+        digest = self._hash(key)
+        return os.path.join(self.folder, digest[:2], f'{digest}.pickle')
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        path = self.path(key)
+        try:
+            modified = os.path.getmtime(path)
+            if self.ttl and time.time() - modified > self.ttl:
+                self.misses += 1
+                return default
+            with open(path, 'rb') as file:
+                value = pickle.load(file)
+            if self.max_bytes:
+                # The access time orders the eviction; the modification time still dates the entry
+                os.utime(path, (time.time(), modified))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+            size = file.tell()
+        os.replace(temp_path, path)
+        if self.max_bytes:
+            self.written += size
+            if self.written * 10 >= self.max_bytes:
+                self.written = 0
+                self.evict()
+
+    @contextmanager
+    def lock(self, key: Hashable):
+        """
+        Holds the file lock of the stripe that `key` falls in.
+        """
+        folder = os.path.join(self.folder, 'locks')
+        os.makedirs(folder, exist_ok=True)
+        stripe = int(self._hash(key)[:8], 16) % self.stripes
+        with open(os.path.join(folder, f'{stripe}.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_or_fetch(self, key: Hashable, fetch: Callable[[], Any]) -> Any:
+        """
+        Returns the cached value of `key`, or runs `fetch()` once across processes and caches its result.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self.lock(key):
+            value = self.get(key, _MISSING)
+            if value is _MISSING:
+                value = fetch()
+                self.set(key, value)
+        return value
+
+    def _files(self):
+        """
+        Yields the path and `os.stat` of every entry under `folder`; the lock files, the prune marker and the files
+        being written are left out.
+        """
+        for root, folders, files in os.walk(self.folder):
+            folders[:] = [folder for folder in folders if folder != 'locks']
+            for name in files:
+                if name == '.pruned' or name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    pass
+
+    def prune(self, interval: float = 600) -> int:
+        """
+        Removes the files under `folder` older than `ttl`, then evicts down to `max_bytes`, at most once every
+        `interval` seconds across processes.
+
+        Returns:
+        - `removed` (int): Number of files removed.
+        """
+        if not self.ttl and not self.max_bytes:
+            return 0
+        marker = os.path.join(self.folder, '.pruned')
+        now = time.time()
+        try:
+            if now - os.path.getmtime(marker) < interval:
+                return 0
+        except OSError:
+            pass
+        os.makedirs(self.folder, exist_ok=True)
+        with open(marker, 'a'):
+            pass
+        os.utime(marker, None)
+        removed = 0
+        if self.ttl:
+            for path, stat in self._files():
+                try:
+                    if now - stat.st_mtime > self.ttl:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed + self.evict()
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used files until the folder holds at most `max_bytes`.
+
+        Returns:
+        - `removed` (int): Number of files removed.
+        """
+        if not self.max_bytes:
+            return 0
+        entries = [(stat.st_atime, stat.st_size, path) for path, stat in self._files()]
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
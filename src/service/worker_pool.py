@@ -0,0 +1,267 @@
+# Pool of recycled worker processes that run the memory-heavy part of the jobs
+import gc
+import queue
+import pickle
+import atexit
+import logging
+import threading
+import importlib
+import multiprocessing
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import psutil
+from src.service.job_cancellation import CancellationToken, JobCancelledError
+
+logging.basicConfig()
+logger = logging.getLogger('WorkerPool')
+logger.setLevel(logging.INFO)
+
+MB = 1024 * 1024
+# Imported once by the fork server, so a new worker starts with them loaded
+PRELOAD_MODULES = ('geopandas', 'shapely', 'osw_confidence_metric.area_analyzer',
+                   'src.service.osw_confidence_service')
+
+
+class WorkerCrashedError(Exception):
+    """
+    Raised when a worker process exits while running a job, e.g. when it is killed for running out of memory.
+    """
+
+
+def _send(conn, message: tuple) -> None:
+    try:
+        conn.send(message)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        # An unpicklable value is reported as an error instead
+        kind = 'raise' if message[0] in ('return', 'raise') else 'error'
+        conn.send((kind, RuntimeError(f'Could not send {type(message[1]).__name__}: {e}')) + message[2:])
+
+
+def _worker_main(conn, preload: Sequence[str]) -> None:
+    """
+    Worker loop: receives `(target, args)`, runs `target(*args, call=call)` and answers with its result or error
+    and the worker's RSS. `call(name, *args)` asks the parent to run `name` and returns its reply.
+    """
+    for module in preload:
+        importlib.import_module(module)
+
+    def call(name: str, *args):
+        with lock:
+            conn.send(('call', name, args))
+            kind, value = conn.recv()
+        if kind == 'raise':
+            raise value
+        return value
+
+    lock = threading.Lock()
+    process = psutil.Process()
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message is None:
+            return
+        target, args = message
+        try:
+            reply = ('result', target(*args, call=call))
+        except BaseException as e:
+            reply = ('error', e)
+        gc.collect()
+        with lock:
+            _send(conn, reply + (process.memory_info().rss,))
+
+
+class WorkerProcess:
+    """
+    One worker process and the parent's end of its pipe.
+    """
+
+    def __init__(self, context, preload: Sequence[str]):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, tuple(preload)),
+                                       name='confidence-worker')
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.rss = 0
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def stop(self, kill: bool = False) -> None:
+        try:
+            if kill:
+                self.process.kill()
+            else:
+                self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(timeout=5)
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Runs jobs in a pool of pre-started worker processes instead of the service process, so the memory that the
+    geometry libraries leave fragmented behind each job is returned to the system when a worker is recycled.
+
+    Workers are forked from a fork server that imported `preload` once, which keeps their start cheap. A worker is
+    replaced after `max_jobs` jobs, or as soon as its resident memory after a job exceeds `max_rss_mb`, and also
+    when a job was cancelled or timed out in it, since the abandoned work may still be running. A worker that dies
+    in a job, such as one killed for running out of memory, fails that job only.
+
+    A job is a picklable function `target(*args, call)` whose result is sent back pickled over the worker's pipe.
+    Through `call(name, *args)` it asks the parent to run `on_call(name, *args)` and gets its return value, for work
+    that needs the parent's state such as the scheduler, the storage clients or the response topic. The parent
+    checks the job's cancellation token while it waits, and kills the worker when the job is cancelled or expires.
+
+    Parameters:
+    - `size` (int): Number of worker processes.
+    - `max_jobs` (int): Jobs after which a worker is replaced; 0 never replaces it for that.
+    - `max_rss_mb` (float): Resident memory in MB above which a worker is replaced after its job; 0 disables.
+    - `preload` (list): Modules imported by the fork server.
+    - `poll_interval` (float): Seconds between checks of the cancellation token.
+
+    Usage:
+    ```python
+    pool = WorkerPool(size=2, max_jobs=20, max_rss_mb=2048)
+    result = pool.run(score, (spec,), on_call=handle, token=token)
+    pool.stop()
+    ```
+    """
+
+    def __init__(self, size: int, max_jobs: int = 20, max_rss_mb: float = 0,
+                 preload: Sequence[str] = PRELOAD_MODULES, poll_interval: float = 0.5):
+        self.size = max(1, int(size))
+        self.max_jobs = int(max_jobs)
+        self.max_rss_bytes = float(max_rss_mb) * MB
+        self.poll_interval = float(poll_interval)
+        self.preload = tuple(preload)
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            self.context = multiprocessing.get_context('forkserver')
+            self.context.set_forkserver_preload(list(self.preload))
+        else:
+            self.context = multiprocessing.get_context('spawn')
+        self.lock = threading.Lock()
+        self.idle: queue.Queue = queue.Queue()
+        self.workers: Dict[int, WorkerProcess] = {}
+        self.jobs = 0
+        self.recycled = 0
+        self.crashed = 0
+        self.stopped = False
+        for _ in range(self.size):
+            self.idle.put(self._start_worker())
+        # Workers are not daemons, as the scoring may start processes of its own; stop them before exit
+        atexit.register(self.stop)
+
+    @classmethod
+    def from_settings(cls, settings) -> Optional['WorkerPool']:
+        if int(settings.worker_processes or 0) <= 0:
+            return None
+        return cls(size=int(settings.worker_processes), max_jobs=int(settings.worker_max_jobs),
+                   max_rss_mb=float(settings.worker_max_rss_mb))
+
+    def run(self, target: Callable, args: tuple = (), on_call: Callable[..., Any] = None,
+            token: CancellationToken = None) -> Any:
+        """
+        Runs `target(*args, call=...)` in an idle worker, waiting for one if all are busy, and returns its result
+        or raises its exception.
+
+        Raises:
+        - `JobCancelledError`: When `token` is cancelled or expires; the worker is killed.
+        - `WorkerCrashedError`: When the worker exits during the job.
+        """
+        worker = self.idle.get()
+        healthy = False
+        try:
+            worker.conn.send((target, args))
+            while True:
+                if token is not None:
+                    token.check()
+                if not worker.conn.poll(self.poll_interval):
+                    if not worker.process.is_alive():
+                        raise WorkerCrashedError(f'Worker {worker.pid} exited with code {worker.process.exitcode}')
+                    continue
+                try:
+                    message = worker.conn.recv()
+                except (EOFError, OSError):
+                    raise WorkerCrashedError(f'Worker {worker.pid} exited with code {worker.process.exitcode}')
+                if message[0] == 'call':
+                    _, name, call_args = message
+                    try:
+                        reply = ('return', on_call(name, *call_args))
+                    except Exception as e:
+                        reply = ('raise', e)
+                    _send(worker.conn, reply)
+                    continue
+                kind, value, worker.rss = message
+                worker.jobs += 1
+                # Work abandoned on a cancellation may still be running in the worker
+                healthy = not isinstance(value, JobCancelledError)
+                if kind == 'error':
+                    raise value
+                return value
+        except WorkerCrashedError:
+            with self.lock:
+                self.crashed += 1
+            raise
+        finally:
+            with self.lock:
+                self.jobs += 1
+            self._release(worker, healthy)
+
+    def _release(self, worker: WorkerProcess, healthy: bool) -> None:
+        if self.stopped:
+            self._stop_worker(worker, kill=not healthy)
+            return
+        recycle = not healthy or (self.max_jobs and worker.jobs >= self.max_jobs) or \
+            (self.max_rss_bytes and worker.rss > self.max_rss_bytes)
+        if not recycle:
+            self.idle.put(worker)
+            return
+        logger.info('Recycling worker %s after %d jobs at %.0f MB', worker.pid, worker.jobs, worker.rss / MB)
+        self._stop_worker(worker, kill=not healthy)
+        with self.lock:
+            self.recycled += 1
+        self.idle.put(self._start_worker())
+
+    def _start_worker(self) -> WorkerProcess:
+        worker = WorkerProcess(self.context, self.preload)
+        with self.lock:
+            self.workers[worker.pid] = worker
+        return worker
+
+    def _stop_worker(self, worker: WorkerProcess, kill: bool = False) -> None:
+        with self.lock:
+            self.workers.pop(worker.pid, None)
+        worker.stop(kill=kill)
+
+    def stats(self) -> dict:
+        """
+        Returns the pool's counters and the jobs run and last resident memory of every worker.
+        """
+        with self.lock:
+            workers: List[WorkerProcess] = list(self.workers.values())
+            return {
+                'size': self.size,
+                'jobs': self.jobs,
+                'recycled': self.recycled,
+                'crashed': self.crashed,
+                'workers': [{'pid': worker.pid, 'jobs': worker.jobs, 'rss_mb': round(worker.rss / MB, 1)}
+                            for worker in workers]
+            }
+
+    def stop(self) -> None:
+        """
+        Stops the idle workers; busy ones are stopped when their job ends.
+        """
+        self.stopped = True
+        while True:
+            try:
+                self._stop_worker(self.idle.get_nowait())
+            except queue.Empty:
+                break
@@ -30,6 +30,18 @@ class TestConfidenceRequest(unittest.TestCase):
         self.assertEqual(request_instance.data.meta_file, req_body.meta_file)
         self.assertEqual(request_instance.data.trigger_type, req_body.trigger_type)
 
+    def test_confidence_request_optional_defaults(self):
+        request_instance = ConfidenceRequest(
+            messageId='123',
+            messageType='123',
+            data={'jobId': '123', 'data_file': 'data.csv', 'meta_file': 'meta.json', 'trigger_type': 'manual'}
+        )
+
+        self.assertIsNone(request_instance.data.sub_regions_file)
+        self.assertFalse(request_instance.data.progressive)
+        self.assertIsNone(request_instance.data.grid_cell_size)
+        self.assertIsNone(request_instance.data.deadline_seconds)
+
     def test_confidence_request_equality(self):
         # Test case for checking equality of ConfidenceRequest instances
 
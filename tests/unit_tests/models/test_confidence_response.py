@@ -32,6 +32,21 @@ class TestConfidenceResponse(unittest.TestCase):
         self.assertEqual(response_instance.data.status, res_body.status)
         self.assertEqual(response_instance.data.message, res_body.message)
 
+    def test_confidence_response_progress(self):
+        res_body = ResponseData(
+            jobId='123',
+            confidence_scores=None,
+            confidence_library_version='v1.0.0',
+            status='in-progress',
+            message='Partial results',
+            success=True,
+            progress=0.5
+        )
+
+        response_instance = ConfidenceResponse(messageId='id', messageType='type', data=res_body.__dict__)
+
+        self.assertEqual(response_instance.data.progress, 0.5)
+
     def test_confidence_response_equality(self):
         # Test case for checking equality of ConfidenceResponse instances
 
@@ -0,0 +1,73 @@
+# In-memory stand-in for the Azure storage client, with the provider's overwrite semantics
+from typing import Dict
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+
+class FakeBlobClient:
+
+    def __init__(self, blobs: Dict[str, bytes], name: str):
+        self.blobs = blobs
+        self.name = name
+
+    def upload_blob(self, data, overwrite: bool = False):
+        if self.name in self.blobs and not overwrite:
+            raise ResourceExistsError(f'The specified blob already exists: {self.name}')
+        self.blobs[self.name] = data
+
+
+class FakeContainerClient:
+
+    def __init__(self, blobs: Dict[str, bytes]):
+        self.blobs = blobs
+
+    def get_blob_client(self, name: str) -> FakeBlobClient:
+        return FakeBlobClient(self.blobs, name)
+
+    def upload_blob(self, name: str, data, overwrite: bool = False):
+        self.get_blob_client(name).upload_blob(data, overwrite=overwrite)
+
+
+class FakeFileEntity:
+
+    def __init__(self, blobs: Dict[str, bytes], name: str, client):
+        self.blobs = blobs
+        self.file_path = name
+        self.client = client
+
+    def upload(self, upload_stream):
+        # Like AzureFileEntity built by create_file: the container client uploads without overwriting
+        self.client.upload_blob(self.file_path, upload_stream)
+
+    def get_stream(self):
+        if self.file_path not in self.blobs:
+            raise ResourceNotFoundError(f'The specified blob does not exist: {self.file_path}')
+        return self.blobs[self.file_path]
+
+    def delete_file(self):
+        self.blobs.pop(self.file_path, None)
+
+
+class FakeContainer:
+
+    def __init__(self, blobs: Dict[str, bytes]):
+        self.blobs = blobs
+        self.container_client = FakeContainerClient(blobs)
+
+    def create_file(self, name: str) -> FakeFileEntity:
+        return FakeFileEntity(self.blobs, name, self.container_client)
+
+
+class FakeBlobStorage:
+    """
+    Storage client whose containers keep their blobs in `blobs`, keyed by container and file name.
+    """
+
+    def __init__(self):
+        self.blobs: Dict[str, Dict[str, bytes]] = {}
+
+    def get_container(self, container_name: str) -> FakeContainer:
+        return FakeContainer(self.blobs.setdefault(container_name, {}))
+
+    def get_file(self, container_name: str, file_name: str) -> FakeFileEntity:
+        container = self.get_container(container_name)
+        return FakeFileEntity(container.blobs, file_name, container.container_client)
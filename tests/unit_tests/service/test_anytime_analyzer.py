@@ -0,0 +1,89 @@
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+import geopandas as gpd
+from shapely.geometry import box
+from src.service.anytime_analyzer import AnytimeAreaAnalyzer, AreaScoreEstimate, estimate_from_tiles
+
+
+def scored_tiles(direct_scores):
+    indirect_values = {'poi_count': 1, 'bldg_count': 1, 'road_count': 1, 'poi_users': 1, 'road_users': 1,
+                       'bldg_users': 1, 'poi_time': 1, 'road_time': 1, 'bldg_time': 1}
+    return gpd.GeoDataFrame({
+        'direct_confirmations': [None] * len(direct_scores),
+        'direct_trust_score': direct_scores,
+        'time_trust_score': [0] * len(direct_scores),
+        'indirect_values': [indirect_values] * len(direct_scores)
+    }, geometry=[box(i, 0, i + 1, 1) for i in range(len(direct_scores))])
+
+
+class TestEstimateFromTiles(unittest.TestCase):
+
+    def test_complete_sample_has_no_error(self):
+        estimate = estimate_from_tiles(scored_tiles([0.2, 0.4, 0.6]), total=3)
+
+        # All tiles meet the indirect thresholds, so each scores 0.5 * direct + 0.25
+        self.assertAlmostEqual(estimate.score, 0.45)
+        self.assertEqual(estimate.error, 0.0)
+        self.assertTrue(estimate.complete)
+
+    def test_partial_sample_has_error(self):
+        estimate = estimate_from_tiles(scored_tiles([0.2, 0.4, 0.6, 0.8]), total=100)
+
+        self.assertGreater(estimate.error, 0)
+        self.assertFalse(estimate.complete)
+
+    def test_empty(self):
+        self.assertEqual(estimate_from_tiles(scored_tiles([]), total=10), AreaScoreEstimate(total=10))
+
+
+class TestAnytimeAreaAnalyzer(unittest.TestCase):
+
+    def setUp(self):
+        self.tiles = gpd.GeoDataFrame(geometry=[box(i, 0, i + 1, 1) for i in range(40)])
+        self.analyzer = AnytimeAreaAnalyzer(osm_data_handler=MagicMock(), initial_sample=4, seed=1)
+        self.analyzer._create_tiling_if_needed = MagicMock()
+        self.analyzer._score_tiles = MagicMock(side_effect=lambda batch: scored_tiles([0.4] * len(batch)))
+
+    @patch('src.service.anytime_analyzer.gpd.read_file')
+    def test_refines_until_complete(self, mock_read_file):
+        mock_read_file.return_value = self.tiles
+
+        estimate = self.analyzer.estimate_area_confidence_score('hull.geojson', deadline=time.monotonic() + 60)
+
+        self.assertEqual([len(call.args[0]) for call in self.analyzer._score_tiles.call_args_list], [4, 8, 16, 12])
+        self.assertTrue(estimate.complete)
+        self.assertAlmostEqual(estimate.score, 0.45)
+
+    @patch('src.service.anytime_analyzer.gpd.read_file')
+    def test_stops_at_deadline(self, mock_read_file):
+        mock_read_file.return_value = self.tiles
+
+        estimate = self.analyzer.estimate_area_confidence_score('hull.geojson', deadline=time.monotonic() - 1)
+
+        self.analyzer._score_tiles.assert_called_once()
+        self.assertEqual((estimate.sampled, estimate.total), (4, 40))
+
+    @patch('src.service.anytime_analyzer.gpd.read_file')
+    def test_stops_when_converged(self, mock_read_file):
+        mock_read_file.return_value = self.tiles
+        self.analyzer.target_error = 0.01
+
+        estimate = self.analyzer.estimate_area_confidence_score('hull.geojson', deadline=time.monotonic() + 60)
+
+        # Identical tile scores have no spread, so the first batch already converges
+        self.assertEqual(estimate.sampled, 4)
+
+    @patch('src.service.anytime_analyzer.gpd.read_file')
+    def test_no_tiles(self, mock_read_file):
+        mock_read_file.return_value = self.tiles
+        self.analyzer._create_tiling_if_needed.side_effect = lambda: setattr(self.analyzer, 'gdf', None)
+
+        estimate = self.analyzer.estimate_area_confidence_score('hull.geojson', deadline=time.monotonic() + 60)
+
+        self.assertEqual(estimate.score, 0)
+        self.analyzer._score_tiles.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import time
+import asyncio
+import unittest
+import threading
+from unittest.mock import MagicMock, patch
+from src.models.confidence_request import ConfidenceRequest
+from src.service.async_pipeline import AsyncJobPipeline
+from src.service.osw_confidence_service import OSWConfidenceService
+from src.service.job_cancellation import JobRegistry
+from src.service.job_scheduler import JobScheduler, JobCostEstimate
+
+
+def make_request(job_id: str) -> ConfidenceRequest:
+    return ConfidenceRequest(messageType='confidence', messageId=job_id,
+                             data={'jobId': job_id, 'data_file': 'https://storage/osw.zip', 'meta_file': '',
+                                   'trigger_type': 'manual'})
+
+
+class TestAsyncJobPipeline(unittest.TestCase):
+
+    def setUp(self):
+        with patch.object(OSWConfidenceService, '__init__', return_value=None):
+            self.service = OSWConfidenceService()
+        self.service.settings = MagicMock(job_timeout=0, download_timeout=0, profile_jobs=False)
+        self.service.settings.is_simulated.return_value = False
+        self.service.jobs = JobRegistry()
+        self.service.checkpoint_store = None
+        self.service.idempotency = None
+        self.service.workers = None
+        self.service.admit_job = MagicMock()
+        self.service.create_calculator = MagicMock()
+        self.service.start_scoring = MagicMock(return_value=JobCostEstimate())
+        self.service.scheduler = JobScheduler(small_job_cost=10, fast_lane_size=1, slow_lane_size=1)
+        self.service.close_job = MagicMock()
+        self.service.send_response_message = MagicMock()
+        self.lock = threading.Lock()
+        self.downloading = 0
+        self.most_downloading = 0
+
+    def slow_download(self, job, seconds=0.2):
+        with self.lock:
+            self.downloading += 1
+            self.most_downloading = max(self.most_downloading, self.downloading)
+        time.sleep(seconds)
+        with self.lock:
+            self.downloading -= 1
+
+    def score(self, job):
+        return {'type': 'FeatureCollection', 'features': []}
+
+    def test_overlaps_io_beyond_cpu_workers(self):
+        self.service.download_job_inputs = self.slow_download
+        self.service.calculate_job_scores = self.score
+        pipeline = AsyncJobPipeline(self.service, io_workers=64, cpu_workers=1)
+        self.addCleanup(pipeline.stop)
+
+        started = time.monotonic()
+        futures = [pipeline.submit(make_request(f'job-{index}')) for index in range(40)]
+        for future in futures:
+            future.result(timeout=10)
+
+        # 40 downloads of 0.2 s each overlap instead of running one at a time
+        self.assertLess(time.monotonic() - started, 4)
+        self.assertGreater(self.most_downloading, 10)
+        self.assertEqual(self.service.send_response_message.call_count, 40)
+        self.assertTrue(all(call.kwargs['response'].data.success
+                            for call in self.service.send_response_message.call_args_list))
+        self.assertEqual(pipeline.in_flight, 0)
+
+    def test_failed_stage_still_cleans_up_and_responds(self):
+        self.service.download_job_inputs = MagicMock(side_effect=Exception('no blob'))
+        self.service.calculate_job_scores = MagicMock()
+        pipeline = AsyncJobPipeline(self.service, io_workers=2, cpu_workers=1)
+        self.addCleanup(pipeline.stop)
+
+        pipeline.submit(make_request('job')).result(timeout=10)
+
+        self.service.calculate_job_scores.assert_not_called()
+        self.service.close_job.assert_called_once()
+        response = self.service.send_response_message.call_args.kwargs['response']
+        self.assertFalse(response.data.success)
+        self.assertIn('no blob', response.data.message)
+
+    def test_download_timeout(self):
+        self.service.settings.download_timeout = 0.1
+        release = threading.Event()
+        self.service.download_job_inputs = lambda job: release.wait(5)
+        self.service.calculate_job_scores = MagicMock()
+        pipeline = AsyncJobPipeline(self.service, io_workers=2, cpu_workers=1)
+        self.addCleanup(pipeline.stop)
+        self.addCleanup(release.set)
+
+        pipeline.submit(make_request('job')).result(timeout=3)
+
+        response = self.service.send_response_message.call_args.kwargs['response']
+        self.assertIn('timed out in stage download', response.data.message)
+
+    def test_waits_for_the_slot_without_a_cpu_thread(self):
+        self.service.download_job_inputs = MagicMock()
+        running = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def score(job):
+            running.set()
+            release.wait(5)
+            return {'type': 'FeatureCollection', 'features': []}
+
+        self.service.calculate_job_scores = score
+        pipeline = AsyncJobPipeline(self.service, io_workers=4, cpu_workers=2)
+        self.addCleanup(pipeline.stop)
+
+        first = pipeline.submit(make_request('first'))
+        running.wait(5)
+        queued = [pipeline.submit(make_request(f'queued-{index}')) for index in range(3)]
+        time.sleep(0.3)
+
+        # The one fast lane slot is taken, so the queued jobs wait on the loop and the second CPU thread is free
+        self.assertEqual(pipeline.cpu_executor.submit(lambda: 'free').result(timeout=1), 'free')
+        self.assertEqual(len(self.service.scheduler.fast_lane.waiting), 3)
+        release.set()
+        for future in [first] + queued:
+            self.assertTrue(future.result(timeout=10).is_success)
+
+    def test_cancelled_while_waiting_for_the_slot(self):
+        self.service.download_job_inputs = MagicMock()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.service.calculate_job_scores = lambda job: release.wait(5) and {'type': 'FeatureCollection',
+                                                                              'features': []}
+        pipeline = AsyncJobPipeline(self.service, io_workers=4, cpu_workers=2)
+        self.addCleanup(pipeline.stop)
+        first = pipeline.submit(make_request('first'))
+        queued = pipeline.submit(make_request('queued'))
+        deadline = time.monotonic() + 5
+        while not self.service.scheduler.fast_lane.waiting and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertTrue(self.service.jobs.cancel('queued'))
+
+        self.assertFalse(queued.result(timeout=3).is_success)
+        self.assertEqual(self.service.scheduler.fast_lane.waiting, [])
+        release.set()
+        self.assertTrue(first.result(timeout=10).is_success)
+
+    def test_runs_on_given_loop(self):
+        self.service.download_job_inputs = MagicMock()
+        self.service.calculate_job_scores = self.score
+
+        async def run():
+            pipeline = AsyncJobPipeline(self.service, loop=asyncio.get_running_loop(), io_workers=2, cpu_workers=1)
+            await pipeline.calculate_confidence(make_request('job'))
+            pipeline.stop()
+
+        asyncio.run(run())
+
+        self.assertTrue(self.service.send_response_message.call_args.kwargs['response'].data.success)
+
+    def test_process_waits_for_the_job(self):
+        self.service.download_job_inputs = self.slow_download
+        self.service.calculate_job_scores = self.score
+        self.service.pipeline = AsyncJobPipeline(self.service, io_workers=2, cpu_workers=1)
+        self.addCleanup(self.service.pipeline.stop)
+        message = MagicMock(messageType='confidence', messageId='job',
+                            data=make_request('job').data.__dict__)
+
+        self.service.process(message)
+
+        self.service.send_response_message.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+from src.service.batch_runner import BatchJob, BatchRunner, discover_jobs, result_path, input_fingerprint
+from src.service.job_checkpoint import LocalCheckpointStore
+from src.service.osm_data_backend import DEFAULT_CACHE_FOLDER
+
+SCORES = {'type': 'FeatureCollection', 'features': []}
+
+
+class TestDiscoverJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_directory(self):
+        for name in ['seattle.zip', 'seattle_subregions.geojson', 'tacoma.zip', 'notes.txt']:
+            Path(self.folder, name).write_text('')
+
+        jobs = discover_jobs(self.folder)
+
+        self.assertEqual([job.job_id for job in jobs], ['seattle', 'tacoma'])
+        self.assertEqual(jobs[0].sub_regions_file, os.path.join(self.folder, 'seattle_subregions.geojson'))
+        self.assertIsNone(jobs[1].sub_regions_file)
+
+    def test_manifest(self):
+        manifest = os.path.join(self.folder, 'manifest.json')
+        Path(manifest).write_text(json.dumps([
+            {'zip_file': 'a.zip', 'sub_regions_file': 'a.geojson', 'grid_cell_size': 250},
+            {'job_id': 'second', 'zip_file': '/data/b.zip'}
+        ]))
+
+        jobs = discover_jobs(manifest)
+
+        self.assertEqual(jobs[0], BatchJob(job_id='a', zip_file=os.path.join(self.folder, 'a.zip'),
+                                           sub_regions_file=os.path.join(self.folder, 'a.geojson'),
+                                           grid_cell_size=250))
+        self.assertEqual(jobs[1], BatchJob(job_id='second', zip_file='/data/b.zip'))
+
+
+class TestBatchRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.output = self.temp_dir.name
+        self.jobs = [BatchJob(job_id='first', zip_file='first.zip'), BatchJob(job_id='second', zip_file='second.zip')]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @patch('src.service.batch_runner.OSWConfidenceMetricCalculator')
+    def test_run(self, mock_calculator):
+        mock_calculator.return_value.calculate_score.return_value = SCORES
+        mock_calculator.return_value.count_sub_regions.return_value = 3
+
+        summary = BatchRunner(self.jobs, output_dir=self.output, workers=2, executor='thread').run()
+
+        self.assertEqual(summary['succeeded'], 2)
+        self.assertEqual(summary['failed'], 0)
+        self.assertGreater(summary['datasets_per_hour'], 0)
+        with open(result_path(self.output, 'first')) as file:
+            self.assertEqual(json.load(file), SCORES)
+        with open(os.path.join(self.output, 'summary.json')) as file:
+            self.assertEqual(json.load(file)['succeeded'], 2)
+        with open(os.path.join(self.output, 'jobs.jsonl')) as file:
+            self.assertEqual(len(file.readlines()), 2)
+        # Work folders are removed
+        self.assertEqual(os.listdir(os.path.join(self.output, 'work')), [])
+
+    @patch('src.service.batch_runner.OSWConfidenceMetricCalculator')
+    def test_resume_skips_finished_jobs(self, mock_calculator):
+        mock_calculator.return_value.calculate_score.return_value = SCORES
+        mock_calculator.return_value.count_sub_regions.return_value = 0
+        os.makedirs(os.path.join(self.output, 'results'))
+        Path(result_path(self.output, 'first')).write_text(json.dumps(SCORES))
+
+        summary = BatchRunner(self.jobs, output_dir=self.output, workers=1, executor='thread').run()
+
+        self.assertEqual(summary['skipped'], 1)
+        self.assertEqual(summary['succeeded'], 1)
+        self.assertEqual(mock_calculator.call_args.kwargs['job_id'], 'second')
+
+    @patch('src.service.batch_runner.OSWConfidenceMetricCalculator')
+    def test_failed_job_is_recorded(self, mock_calculator):
+        mock_calculator.return_value.calculate_score.side_effect = Exception('bad zip')
+        mock_calculator.return_value.count_sub_regions.return_value = 0
+
+        summary = BatchRunner(self.jobs[:1], output_dir=self.output, workers=1, executor='thread').run()
+
+        self.assertEqual(summary['failed'], 1)
+        self.assertEqual(summary['failed_jobs'], ['first'])
+        self.assertFalse(os.path.exists(result_path(self.output, 'first')))
+
+    @patch('src.service.batch_runner.OSWConfidenceMetricCalculator')
+    def test_run_removes_old_checkpoints(self, mock_calculator):
+        mock_calculator.return_value.calculate_score.return_value = SCORES
+        mock_calculator.return_value.count_sub_regions.return_value = 0
+        store = LocalCheckpointStore(os.path.join(self.output, 'checkpoints'))
+        store.save('removed', {'hull_score': 0.5})
+        old = time.time() - 120
+        os.utime(store.path('removed'), (old, old))
+        settings = MagicMock(checkpoint_retention=60, osm_api_limiter_file='', osm_cache_folder='')
+
+        BatchRunner(self.jobs[:1], output_dir=self.output, workers=1, executor='thread', settings=settings).run()
+
+        self.assertIsNone(store.load('removed'))
+
+    def test_fingerprint_changes_with_the_files(self):
+        zip_file = os.path.join(self.output, 'first.zip')
+        Path(zip_file).write_text('data')
+        job = BatchJob(job_id='first', zip_file=zip_file)
+        fingerprint = input_fingerprint(job)
+
+        Path(zip_file).write_text('other data')
+
+        self.assertNotEqual(input_fingerprint(job), fingerprint)
+        self.assertTrue(input_fingerprint(BatchJob(job_id='missing', zip_file='missing.zip')).startswith('missing.zip'))
+
+    def test_worker_environment_shares_limiter_and_cache(self):
+        settings = MagicMock(osm_api_limiter_file='/shared/limiter.json', osm_cache_folder='')
+
+        environment = BatchRunner(self.jobs, output_dir=self.output, workers=4, settings=settings)._worker_environment()
+
+        self.assertEqual(environment, {'OSM_API_LIMITER_FILE': '/shared/limiter.json',
+                                       'OSM_CACHE_FOLDER': DEFAULT_CACHE_FOLDER})
+
+    def test_unknown_executor(self):
+        with self.assertRaises(ValueError):
+            BatchRunner(self.jobs, output_dir=self.output, executor='cluster')
+
+
+if __name__ == '__main__':
+    unittest.main()
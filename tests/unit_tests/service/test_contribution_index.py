@@ -0,0 +1,118 @@
+import time
+import unittest
+from datetime import datetime
+from collections import namedtuple
+from unittest.mock import MagicMock, patch
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
+from shapely.geometry import box
+from src.service.contribution_index import ContributionIndex, EDGE_STATISTICS
+
+Row = namedtuple('Row', ['element_type', 'osmid'])
+
+
+def edge(x, y, versions=1, direct_confirmations=0, changes_to_tags=0, rollbacks=0, tags=1, user_count=1,
+         days_since_last_edit=10):
+    return {'x': x, 'y': y, 'versions': versions, 'direct_confirmations': direct_confirmations,
+            'changes_to_tags': changes_to_tags, 'rollbacks': rollbacks, 'tags': tags, 'user_count': user_count,
+            'days_since_last_edit': days_since_last_edit}
+
+
+def feature(x, y, category, user_count=1, days_since_last_edit=10):
+    return {'x': x, 'y': y, 'category': category, 'user_count': user_count,
+            'days_since_last_edit': days_since_last_edit}
+
+
+class TestContributionIndex(unittest.TestCase):
+
+    def setUp(self):
+        edges = pd.DataFrame([
+            edge(0.5, 0.5, versions=3, direct_confirmations=1, user_count=3, tags=4, days_since_last_edit=100),
+            edge(0.6, 0.6, versions=1, direct_confirmations=0, user_count=1, tags=2, days_since_last_edit=10),
+            edge(5.5, 5.5, changes_to_tags=2, rollbacks=1),
+        ])
+        features = pd.DataFrame([
+            feature(0.5, 0.4, 'poi', user_count=5, days_since_last_edit=30),
+            feature(0.4, 0.5, 'bldg', user_count=5, days_since_last_edit=30),
+            feature(0.3, 0.3, 'road', user_count=5, days_since_last_edit=30),
+            feature(5.4, 5.4, 'poi', user_count=1, days_since_last_edit=5),
+        ])
+        self.index = ContributionIndex(edges=edges, features=features)
+
+    def test_score_single_polygon(self):
+        scores = self.index.score([box(0, 0, 1, 1)])
+
+        # Direct: first edge meets every mean (0.8), the second none (0.0); time: only the first is older
+        # than the mean. Indirect thresholds are the polygon's own values, so all 8 items pass.
+        self.assertAlmostEqual(scores[0], 0.5 * 0.4 + 0.25 * 1 + 0.25 * 0.5)
+
+    def test_score_many_polygons(self):
+        scores = self.index.score([box(0, 0, 1, 1), box(5, 5, 6, 6), box(10, 10, 11, 11)])
+
+        self.assertEqual(len(scores), 3)
+        # The second polygon is below the first on every indirect item; its single edge meets its own means
+        self.assertAlmostEqual(scores[1], 0.5 * 1.0 + 0.25 * 0 + 0.25 * 0)
+        # No sidewalks gives 0, as for analyzer tiles without sidewalks
+        self.assertEqual(scores[2], 0.0)
+
+    def test_overlapping_polygons_share_elements(self):
+        scores = self.index.score([box(0, 0, 1, 1), box(0, 0, 1, 1)])
+
+        self.assertEqual(scores[0], scores[1])
+
+    def test_empty(self):
+        index = ContributionIndex(edges=pd.DataFrame(columns=['x', 'y'] + EDGE_STATISTICS),
+                                  features=pd.DataFrame(columns=['x', 'y', 'category', 'user_count',
+                                                                 'days_since_last_edit']))
+
+        self.assertEqual(index.score([]).tolist(), [])
+        self.assertEqual(index.score([box(0, 0, 1, 1)]).tolist(), [0.0])
+
+    def test_scores_ten_thousand_polygons_quickly(self):
+        rng = np.random.default_rng(0)
+        edges = pd.DataFrame([edge(x, y, versions=v) for x, y, v in zip(rng.random(50000) * 100,
+                                                                         rng.random(50000) * 100,
+                                                                         rng.integers(1, 5, 50000))])
+        features = pd.DataFrame([feature(x, y, 'poi') for x, y in zip(rng.random(20000) * 100,
+                                                                       rng.random(20000) * 100)])
+        index = ContributionIndex(edges=edges, features=features)
+        corners = rng.random((10000, 2)) * 98
+        polygons = shapely.box(corners[:, 0], corners[:, 1], corners[:, 0] + 2, corners[:, 1] + 2)
+
+        start = time.time()
+        scores = index.score(polygons)
+
+        self.assertEqual(len(scores), 10000)
+        self.assertLess(time.time() - start, 10)
+
+    @patch.object(ContributionIndex, '_fetch_features')
+    @patch('osmnx.graph.graph_from_polygon')
+    @patch('geonetworkx.graph_edges_to_gdf')
+    def test_from_osm(self, mock_edges_to_gdf, mock_graph_from_polygon, mock_fetch_features):
+        date = datetime(2024, 1, 1)
+        mock_edges_to_gdf.return_value = gpd.GeoDataFrame(
+            {'osmid': [301, 301]}, geometry=[box(0.4, 0.4, 0.6, 0.6).boundary, box(0.5, 0.5, 0.7, 0.7).boundary])
+        mock_fetch_features.return_value = {
+            'poi': gpd.GeoDataFrame({'element_type': ['node'], 'osmid': [101]}, geometry=[box(0.4, 0.4, 0.5, 0.5)])
+        }
+        handler = MagicMock()
+        handler.get_way_history.return_value = {
+            1: {'user': 'alice', 'timestamp': datetime(2023, 1, 1), 'tag': {'highway': 'footway'}, 'nd': [1, 2]},
+            2: {'user': 'bob', 'timestamp': datetime(2023, 6, 1), 'tag': {'highway': 'footway'}, 'nd': [1, 2]},
+        }
+        handler.get_item_history.return_value = {1: {'user': 'carol', 'timestamp': datetime(2023, 12, 1)}}
+
+        index = ContributionIndex.from_osm(box(0, 0, 1, 1), handler, date=date)
+
+        handler.get_way_history.assert_called_once_with(osmid=301)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.edges['versions'].tolist(), [2, 2])
+        self.assertEqual(index.edges['direct_confirmations'].tolist(), [1, 1])
+        self.assertEqual(index.features['days_since_last_edit'].tolist(), [31])
+        self.assertGreater(index.score([box(0, 0, 1, 1)])[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import tempfile
+import unittest
+import threading
+from pathlib import Path
+from unittest.mock import MagicMock
+from src.service.dataset_cache import DatasetCache
+
+URL = 'https://storage/osw/dataset.zip'
+
+
+def writer(content: str, calls: list = None):
+    def download(path):
+        if calls is not None:
+            calls.append(path)
+        Path(path).write_text(content)
+    return download
+
+
+class TestDatasetCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.temp_dir.name, 'cache')
+        self.target = os.path.join(self.temp_dir.name, 'job.zip')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_reuses_unchanged_blob(self):
+        cache = DatasetCache(root=self.root, max_bytes=1024)
+        calls = []
+
+        first = cache.fetch(URL, version='etag-1', download=writer('zip', calls))
+        second = cache.fetch(URL, version='etag-1', download=writer('zip', calls))
+        second.copy_to(self.target)
+
+        self.assertFalse(first.hit)
+        self.assertTrue(second.hit)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(Path(self.target).read_text(), 'zip')
+        self.assertEqual(cache.stats()['hit_rate'], 0.5)
+
+    def test_downloads_changed_blob(self):
+        cache = DatasetCache(root=self.root, max_bytes=1024)
+        cache.fetch(URL, version='etag-1', download=writer('old'))
+
+        cached = cache.fetch(URL, version='etag-2', download=writer('new'))
+
+        self.assertFalse(cached.hit)
+        self.assertEqual(Path(cached.path).read_text(), 'new')
+
+    def test_bypassed_without_version_or_size(self):
+        download = MagicMock()
+
+        self.assertIsNone(DatasetCache(root=self.root, max_bytes=1024).fetch(URL, None, download))
+        self.assertIsNone(DatasetCache(root=self.root, max_bytes=0).fetch(URL, 'etag-1', download))
+        download.assert_not_called()
+
+    def test_failed_download_is_not_cached(self):
+        cache = DatasetCache(root=self.root, max_bytes=1024)
+
+        self.assertIsNone(cache.fetch(URL, version='etag-1', download=lambda path: None))
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_evicts_least_recently_used(self):
+        cache = DatasetCache(root=self.root, max_bytes=10)
+        cache.fetch('a', version='1', download=writer('aaaa'))
+        cache.fetch('b', version='1', download=writer('bbbb'))
+        cache.fetch('a', version='1', download=writer('aaaa'))
+
+        cache.fetch('c', version='1', download=writer('cccc'))
+
+        self.assertTrue(cache.fetch('a', version='1', download=writer('aaaa')).hit)
+        self.assertFalse(cache.fetch('b', version='1', download=writer('bbbb')).hit)
+        self.assertGreaterEqual(cache.stats()['evictions'], 1)
+        self.assertLessEqual(cache.size_bytes(), 10)
+
+    def test_artifacts(self):
+        cache = DatasetCache(root=self.root, max_bytes=1024)
+        cached = cache.fetch(URL, version='etag-1', download=writer('zip'))
+        source = os.path.join(self.temp_dir.name, 'nodes.geojson')
+        Path(source).write_text('{}')
+
+        self.assertFalse(cached.restore_artifact('nodes.geojson', self.target))
+        cached.store_artifact('nodes.geojson', source)
+        self.assertTrue(cached.restore_artifact('nodes.geojson', self.target))
+
+        self.assertEqual(Path(self.target).read_text(), '{}')
+        self.assertEqual(cache.size_bytes(), len('zip') + len('{}'))
+        self.assertEqual(cache.stats()['artifact_hit_rate'], 0.5)
+
+    def test_entries_survive_restart(self):
+        DatasetCache(root=self.root, max_bytes=1024).fetch(URL, version='etag-1', download=writer('zip'))
+
+        cache = DatasetCache(root=self.root, max_bytes=1024)
+
+        self.assertTrue(cache.fetch(URL, version='etag-1', download=writer('zip')).hit)
+
+    def test_concurrent_fetches_download_once(self):
+        cache = DatasetCache(root=self.root, max_bytes=1024)
+        calls = []
+        started = threading.Event()
+
+        def slow_download(path):
+            calls.append(path)
+            started.set()
+            threading.Event().wait(0.1)
+            Path(path).write_text('zip')
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.fetch(URL, 'etag-1', slow_download)))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(result.hit for result in results), [False, True, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Point
+from src.service.footprint import compute_footprint, occupied_grid_cells
+
+
+def two_towns():
+    first = [Point(-122.3 + i * 1e-4, 47.6 + (i % 3) * 1e-4) for i in range(20)]
+    second = [Point(-121.3 + i * 1e-4, 48.1 + (i % 3) * 1e-4) for i in range(20)]
+    return gpd.GeoSeries(first + second, crs='EPSG:4326')
+
+
+class TestFootprint(unittest.TestCase):
+
+    def test_convex(self):
+        points = two_towns()
+
+        footprint = compute_footprint(points, mode='convex')
+
+        self.assertTrue(footprint.equals(points.unary_union.convex_hull))
+
+    def test_clustered_splits_disjoint_towns(self):
+        points = two_towns()
+
+        footprint = compute_footprint(points, mode='clustered', cell_size=500)
+
+        self.assertEqual(footprint.geom_type, 'MultiPolygon')
+        self.assertEqual(len(footprint.geoms), 2)
+        self.assertTrue(points.within(footprint).all())
+        self.assertLess(footprint.area, points.unary_union.convex_hull.area / 10)
+
+    def test_clustered_follows_a_bending_corridor(self):
+        angles = np.linspace(0, np.pi, 300)
+        points = gpd.GeoSeries([Point(-122.3 + 0.05 * np.cos(a), 47.6 + 0.05 * np.sin(a)) for a in angles])
+
+        footprint = compute_footprint(points, mode='clustered', cell_size=500)
+
+        self.assertTrue(points.within(footprint).all())
+        self.assertFalse(footprint.contains(Point(-122.3, 47.61)))
+
+    def test_single_point_cluster_is_a_polygon(self):
+        footprint = compute_footprint(gpd.GeoSeries([Point(-122.3, 47.6)], crs='EPSG:4326'), mode='clustered')
+
+        self.assertIn(footprint.geom_type, ('Polygon', 'MultiPolygon'))
+        self.assertGreater(footprint.area, 0)
+
+    def test_occupied_grid_cells(self):
+        points = two_towns()
+
+        cells = occupied_grid_cells(points, cell_size=500)
+
+        self.assertEqual(cells.crs, points.crs)
+        self.assertEqual(len(cells), len(cells[['col', 'row']].drop_duplicates()))
+        self.assertTrue(points.apply(lambda point: cells.intersects(point).any()).all())
+        self.assertLess(len(cells), 10)
+
+    def test_occupied_grid_cells_empty(self):
+        self.assertTrue(occupied_grid_cells(gpd.GeoSeries([], crs='EPSG:4326'), cell_size=500).empty)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            compute_footprint(two_towns(), mode='alpha')
+
+
+if __name__ == '__main__':
+    unittest.main()
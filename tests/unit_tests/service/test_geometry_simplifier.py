@@ -0,0 +1,56 @@
+import unittest
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Polygon
+from src.service.geometry_simplifier import simplify_geometries, SimplificationStats
+
+
+def dense_circle(vertices=5000):
+    angles = np.linspace(0, 2 * np.pi, vertices)
+    return Polygon(np.c_[-122.3 + 0.01 * np.cos(angles), 47.6 + 0.01 * np.sin(angles)])
+
+
+class TestGeometrySimplifier(unittest.TestCase):
+
+    def test_simplified_polygon_contains_original(self):
+        geometries = gpd.GeoSeries([dense_circle()], crs='EPSG:4326')
+
+        simplified, stats = simplify_geometries(geometries, tolerance=5)
+
+        self.assertTrue(simplified.contains(geometries).all())
+        self.assertEqual(stats.vertices_before, 5000)
+        self.assertLess(stats.vertices_after, 500)
+        self.assertGreater(stats.reduction, 0.9)
+        self.assertEqual(simplified.crs, geometries.crs)
+
+    def test_simple_polygon_is_kept(self):
+        square = Polygon([(-122.3, 47.6), (-122.29, 47.6), (-122.29, 47.61), (-122.3, 47.61)])
+        geometries = gpd.GeoSeries([square], crs='EPSG:4326')
+
+        simplified, stats = simplify_geometries(geometries, tolerance=5)
+
+        self.assertTrue(simplified.iloc[0].equals(square))
+        self.assertEqual(stats.reduction, 0.0)
+
+    def test_zero_tolerance_disables(self):
+        geometries = gpd.GeoSeries([dense_circle()], index=[7], crs='EPSG:4326')
+
+        simplified, stats = simplify_geometries(geometries, tolerance=0)
+
+        self.assertIs(simplified, geometries)
+        self.assertEqual(stats.vertices_before, stats.vertices_after)
+
+    def test_missing_crs_is_treated_as_wgs84(self):
+        geometries = gpd.GeoSeries([dense_circle()], index=[3])
+
+        simplified, _ = simplify_geometries(geometries, tolerance=5)
+
+        self.assertEqual(list(simplified.index), [3])
+        self.assertTrue(simplified.contains(geometries.set_crs(epsg=4326)).all())
+
+    def test_empty_stats(self):
+        self.assertEqual(SimplificationStats().reduction, 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
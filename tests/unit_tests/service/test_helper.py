@@ -1,9 +1,10 @@
 import os
 import unittest
 from tempfile import TemporaryDirectory
-from unittest.mock import patch, mock_open
-from src.service.helper import clean_up, is_valid_geojson
+from unittest.mock import patch, mock_open, MagicMock
+from src.service.helper import clean_up, is_valid_geojson, write_blob, create_blob
 from jsonschema import ValidationError
+from tests.unit_tests.service.fake_blob_storage import FakeBlobStorage
 
 
 class TestCleanUpFunction(unittest.TestCase):
@@ -127,5 +128,34 @@ class TestIsValidGeoJSON(unittest.TestCase):
         self.assertFalse(result)
 
 
+class TestWriteBlob(unittest.TestCase):
+
+    def test_overwrites_azure_blob(self):
+        storage = FakeBlobStorage()
+
+        write_blob(storage, 'osw', 'records/job.json', b'first')
+        write_blob(storage, 'osw', 'records/job.json', b'second')
+
+        self.assertEqual(storage.get_file('osw', 'records/job.json').get_stream(), b'second')
+
+    def test_other_providers_upload(self):
+        storage_client = MagicMock()
+        container = MagicMock(spec=['create_file'])
+        storage_client.get_container.return_value = container
+
+        write_blob(storage_client, 'osw', 'records/job.json', b'content')
+
+        container.create_file.assert_called_once_with('records/job.json')
+        container.create_file.return_value.upload.assert_called_once_with(b'content')
+
+    def test_create_blob_only_once(self):
+        storage = FakeBlobStorage()
+
+        self.assertTrue(create_blob(storage, 'osw', 'shards/job/merge.json', b'first'))
+        self.assertFalse(create_blob(storage, 'osw', 'shards/job/merge.json', b'second'))
+
+        self.assertEqual(storage.get_file('osw', 'shards/job/merge.json').get_stream(), b'first')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,147 @@
+import json
+import time
+import tempfile
+import unittest
+import threading
+from unittest.mock import MagicMock, patch
+from src.service.inline_scoring import InlineScoringService, InlineRequestError, ScoringBusyError, parse_features
+from src.service.job_cancellation import JobTimeoutError
+from src.service.job_workspace import WorkspaceManager
+
+POLYGON = {'type': 'Polygon', 'coordinates': [[[-122.32, 47.62], [-122.32, 47.61], [-122.31, 47.61],
+                                               [-122.32, 47.62]]]}
+
+
+def feature_collection(count):
+    return {'type': 'FeatureCollection',
+            'features': [{'type': 'Feature', 'properties': {'name': str(index)}, 'geometry': POLYGON}
+                         for index in range(count)]}
+
+
+def running_then_wait(running, release):
+    running.set()
+    release.wait(5)
+    yield from ()
+
+
+def scored(features):
+    return iter([{**feature, 'properties': {**feature['properties'], 'confidence_score': 0.5}}
+                 for feature in features])
+
+
+class TestParseFeatures(unittest.TestCase):
+
+    def test_geometry(self):
+        features = parse_features(POLYGON, max_features=10)
+
+        self.assertEqual(features, [{'type': 'Feature', 'properties': {}, 'geometry': POLYGON}])
+
+    def test_feature_without_properties(self):
+        features = parse_features({'type': 'Feature', 'geometry': POLYGON}, max_features=10)
+
+        self.assertEqual(features[0]['properties'], {})
+
+    def test_feature_collection(self):
+        self.assertEqual(len(parse_features(feature_collection(3), max_features=10)), 3)
+
+    def test_rejects_too_many_features(self):
+        with self.assertRaises(InlineRequestError):
+            parse_features(feature_collection(11), max_features=10)
+
+    def test_rejects_other_input(self):
+        for payload in [{'type': 'Point', 'coordinates': [0, 0]}, {'type': 'FeatureCollection', 'features': []},
+                        {'type': 'Feature', 'geometry': None}, []]:
+            with self.assertRaises(InlineRequestError):
+                parse_features(payload, max_features=10)
+
+
+class TestInlineScoringService(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.settings = MagicMock(http_max_features=100, http_stream_threshold=2, http_timeout=5,
+                                  http_max_concurrent=1, workspace_expansion_factor=4)
+        self.workspaces = WorkspaceManager(root=self.temp_dir.name)
+        self.inline = InlineScoringService(self.settings, self.workspaces)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @patch('src.service.inline_scoring.OSWConfidenceMetricCalculator')
+    def test_score(self, mock_calculator):
+        features = self.inline.parse(feature_collection(2))
+        written = []
+
+        def score_features():
+            with open(mock_calculator.call_args.kwargs['sub_regions_file']) as file:
+                written.extend(json.load(file)['features'])
+            return scored(features)
+
+        mock_calculator.return_value.score_features.side_effect = score_features
+
+        results = self.inline.score(features)
+
+        self.assertEqual(results['type'], 'FeatureCollection')
+        self.assertEqual([feature['properties']['confidence_score'] for feature in results['features']], [0.5, 0.5])
+        self.assertIsNone(mock_calculator.call_args.kwargs['zip_file'])
+        self.assertEqual(written, features)
+        # The workspace and the slot are released
+        self.assertEqual(self.workspaces.usage()['active_jobs'], 0)
+        self.assertTrue(self.inline.slots.acquire(blocking=False))
+
+    @patch('src.service.inline_scoring.OSWConfidenceMetricCalculator')
+    def test_stream(self, mock_calculator):
+        features = self.inline.parse(feature_collection(3))
+        mock_calculator.return_value.score_features.side_effect = lambda: scored(features)
+
+        self.assertTrue(self.inline.should_stream(features))
+        lines = list(self.inline.stream(features))
+
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[2])['properties']['name'], '2')
+        self.assertEqual(self.workspaces.usage()['active_jobs'], 0)
+
+    @patch('src.service.inline_scoring.OSWConfidenceMetricCalculator')
+    def test_stream_reports_late_failure(self, mock_calculator):
+        features = self.inline.parse(feature_collection(3))
+
+        def failing():
+            yield from scored(features[:1])
+            raise RuntimeError('backend down')
+
+        mock_calculator.return_value.score_features.side_effect = failing
+
+        lines = list(self.inline.stream(features))
+
+        self.assertEqual(json.loads(lines[-1]), {'error': 'backend down'})
+
+    @patch('src.service.inline_scoring.OSWConfidenceMetricCalculator')
+    def test_busy(self, mock_calculator):
+        running, release = threading.Event(), threading.Event()
+        mock_calculator.return_value.score_features.side_effect = lambda: running_then_wait(running, release)
+        worker = threading.Thread(target=self.inline.score, args=(self.inline.parse(POLYGON),))
+        worker.start()
+        running.wait(5)
+
+        with self.assertRaises(ScoringBusyError):
+            self.inline.score(self.inline.parse(POLYGON))
+        release.set()
+        worker.join()
+
+    @patch('src.service.inline_scoring.OSWConfidenceMetricCalculator')
+    def test_timeout(self, mock_calculator):
+        self.inline.timeout = 0.2
+        release = threading.Event()
+        mock_calculator.return_value.score_features.side_effect = lambda: running_then_wait(threading.Event(), release)
+
+        started = time.monotonic()
+        with self.assertRaises(JobTimeoutError):
+            self.inline.score(self.inline.parse(POLYGON))
+        release.set()
+
+        self.assertLess(time.monotonic() - started, 3)
+        self.assertTrue(self.inline.slots.acquire(blocking=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
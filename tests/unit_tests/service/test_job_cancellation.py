@@ -0,0 +1,139 @@
+import time
+import asyncio
+import unittest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from src.service.job_cancellation import CancellationToken, JobCancelledError, JobTimeoutError, JobRegistry
+
+
+class TestCancellationToken(unittest.TestCase):
+
+    def test_check_after_cancel(self):
+        token = CancellationToken('job')
+        token.check()
+
+        token.cancel('cancelled by request')
+
+        with self.assertRaises(JobCancelledError) as context:
+            token.check()
+        self.assertIn('cancelled by request', str(context.exception))
+
+    def test_job_timeout(self):
+        token = CancellationToken('job', timeout=0.01)
+        time.sleep(0.02)
+
+        with self.assertRaises(JobTimeoutError):
+            token.check()
+
+    def test_stage_timeout(self):
+        token = CancellationToken('job')
+
+        with self.assertRaises(JobTimeoutError) as context:
+            with token.stage('hull', timeout=0.01):
+                time.sleep(0.02)
+        self.assertIn('hull', str(context.exception))
+        # The stage deadline no longer applies once the stage is left
+        token.check()
+
+    def test_run_returns_result(self):
+        token = CancellationToken('job', timeout=5)
+
+        self.assertEqual(token.run(lambda: 42), 42)
+
+    def test_run_reraises(self):
+        token = CancellationToken('job')
+
+        with self.assertRaises(ValueError):
+            token.run(lambda: (_ for _ in ()).throw(ValueError('boom')))
+
+    def test_run_abandons_stuck_call(self):
+        token = CancellationToken('job')
+        release = threading.Event()
+
+        with self.assertRaises(JobTimeoutError):
+            with token.stage('download', timeout=0.1):
+                token.run(lambda: release.wait(5), poll_interval=0.05)
+        release.set()
+
+    def test_run_stops_on_cancel(self):
+        token = CancellationToken('job')
+        release = threading.Event()
+        threading.Timer(0.1, token.cancel).start()
+
+        started = time.monotonic()
+        with self.assertRaises(JobCancelledError):
+            token.run(lambda: release.wait(5), poll_interval=0.05)
+        release.set()
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_when_stopped_waits_for_abandoned_call(self):
+        token = CancellationToken('job')
+        release = threading.Event()
+        stopped = threading.Event()
+        threading.Timer(0.1, token.cancel).start()
+
+        with self.assertRaises(JobCancelledError):
+            token.run(lambda: release.wait(5), poll_interval=0.05)
+        token.when_stopped(stopped.set)
+
+        self.assertFalse(stopped.wait(0.2))
+        release.set()
+        self.assertTrue(stopped.wait(2))
+
+    def test_when_stopped_after_return(self):
+        token = CancellationToken('job')
+        stopped = threading.Event()
+
+        token.run(lambda: 42)
+        token.when_stopped(stopped.set)
+
+        self.assertTrue(stopped.is_set())
+
+    def test_run_async_returns_result(self):
+        token = CancellationToken('job', timeout=5)
+
+        self.assertEqual(asyncio.run(token.run_async(lambda: 42)), 42)
+
+    def test_run_async_abandons_stuck_call(self):
+        token = CancellationToken('job')
+        release = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        async def download():
+            with token.stage('download', timeout=0.1):
+                await token.run_async(lambda: release.wait(5), executor=executor, poll_interval=0.05)
+
+        started = time.monotonic()
+        with self.assertRaises(JobTimeoutError):
+            asyncio.run(download())
+        release.set()
+        executor.shutdown()
+        self.assertLess(time.monotonic() - started, 2)
+
+
+class TestJobRegistry(unittest.TestCase):
+
+    def test_cancel_registered_job(self):
+        registry = JobRegistry()
+        token = registry.register(CancellationToken('job'))
+
+        self.assertIn('job', registry)
+        self.assertTrue(registry.cancel('job'))
+        self.assertTrue(token.cancelled)
+
+        registry.unregister(token)
+        self.assertNotIn('job', registry)
+        self.assertFalse(registry.cancel('job'))
+
+    def test_unregister_keeps_newer_token(self):
+        registry = JobRegistry()
+        old = registry.register(CancellationToken('job'))
+        registry.register(CancellationToken('job'))
+
+        registry.unregister(old)
+
+        self.assertIn('job', registry)
+
+
+if __name__ == '__main__':
+    unittest.main()
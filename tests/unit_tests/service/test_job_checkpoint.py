@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import unittest
+from tempfile import TemporaryDirectory
+from unittest.mock import MagicMock
+from src.service.job_checkpoint import JobCheckpoint, LocalCheckpointStore, BlobCheckpointStore, \
+    get_checkpoint_store
+from tests.unit_tests.service.fake_blob_storage import FakeBlobStorage
+
+
+class TestLocalCheckpointStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.store = LocalCheckpointStore(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_save_load_delete(self):
+        self.store.save('1234', {'hull_score': 0.5})
+
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir.name, '1234', 'checkpoint.json')))
+        self.assertEqual(self.store.load('1234'), {'hull_score': 0.5})
+
+        self.store.delete('1234')
+        self.assertIsNone(self.store.load('1234'))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir.name, '1234')))
+
+    def test_delete_keeps_other_files(self):
+        self.store.save('1234', {'hull_score': 0.5})
+        with open(os.path.join(self.temp_dir.name, '1234', 'job.zip'), 'w') as file:
+            file.write('data')
+
+        self.store.delete('1234')
+
+        self.assertEqual(os.listdir(os.path.join(self.temp_dir.name, '1234')), ['job.zip'])
+
+    def test_prune_removes_old_checkpoints(self):
+        store = LocalCheckpointStore(self.temp_dir.name, retention=60)
+        store.save('old', {'hull_score': 0.5})
+        store.save('new', {'hull_score': 0.5})
+        os.makedirs(os.path.join(self.temp_dir.name, 'running'))
+        old = time.time() - 120
+        os.utime(store.path('old'), (old, old))
+
+        self.assertEqual(store.prune(), 1)
+
+        self.assertEqual(sorted(os.listdir(self.temp_dir.name)), ['new', 'running'])
+        # Pruned at most once per interval
+        os.utime(store.path('new'), (old, old))
+        self.assertEqual(store.prune(), 0)
+
+    def test_prune_without_retention(self):
+        self.store.save('old', {'hull_score': 0.5})
+        os.utime(self.store.path('old'), (0, 0))
+
+        self.assertEqual(self.store.prune(), 0)
+        self.assertIsNotNone(self.store.load('old'))
+
+
+class TestBlobCheckpointStore(unittest.TestCase):
+
+    def test_save(self):
+        storage_client = MagicMock()
+        store = BlobCheckpointStore(storage_client, 'osw')
+
+        store.save('1234', {'hull_score': 0.5})
+
+        container_client = storage_client.get_container.return_value.container_client
+        container_client.get_blob_client.assert_called_once_with('checkpoints/1234.json')
+        container_client.get_blob_client.return_value.upload_blob.assert_called_once_with(
+            b'{"hull_score": 0.5}', overwrite=True)
+
+    def test_save_overwrites(self):
+        store = BlobCheckpointStore(FakeBlobStorage(), 'osw')
+
+        store.save('1234', {'hull_score': 0.5, 'sub_region_scores': {}})
+        store.save('1234', {'hull_score': 0.5, 'sub_region_scores': {'0': 0.25}})
+
+        self.assertEqual(store.load('1234'), {'hull_score': 0.5, 'sub_region_scores': {'0': 0.25}})
+
+    def test_checkpoint_flushes_overwrite(self):
+        store = BlobCheckpointStore(FakeBlobStorage(), 'osw')
+        checkpoint = JobCheckpoint(store, '1234', fingerprint='osw.zip', flush_every=1)
+
+        checkpoint.set_hull_score(0.5)
+        checkpoint.record_sub_region(0, 0.25)
+        checkpoint.record_sub_region(1, 0.75)
+        checkpoint.close()
+
+        self.assertEqual(store.load('1234')['sub_region_scores'], {'0': 0.25, '1': 0.75})
+
+    def test_load(self):
+        storage_client = MagicMock()
+        storage_client.get_file.return_value.get_stream.return_value = b'{"hull_score": 0.5}'
+        store = BlobCheckpointStore(storage_client, 'osw')
+
+        self.assertEqual(store.load('1234'), {'hull_score': 0.5})
+        storage_client.get_file.assert_called_once_with('osw', 'checkpoints/1234.json')
+
+    def test_load_missing(self):
+        storage_client = MagicMock()
+        storage_client.get_file.side_effect = Exception('Not found')
+        store = BlobCheckpointStore(storage_client, 'osw')
+
+        self.assertIsNone(store.load('1234'))
+
+
+class TestJobCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.store = LocalCheckpointStore(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_batched_writes(self):
+        checkpoint = JobCheckpoint(self.store, '1234', fingerprint='a', flush_every=2, flush_interval=3600)
+
+        checkpoint.record_sub_region(0, 0.1)
+        self.assertIsNone(checkpoint.last_write)
+        self.assertIsNone(self.store.load('1234'))
+
+        checkpoint.record_sub_region(1, 0.2)
+        checkpoint.last_write.result()
+        self.assertEqual(self.store.load('1234')['sub_region_scores'], {'0': 0.1, '1': 0.2})
+
+        checkpoint.record_sub_region(2, None)
+        checkpoint.close()
+        self.assertEqual(len(self.store.load('1234')['sub_region_scores']), 3)
+
+    def test_resume(self):
+        first = JobCheckpoint(self.store, '1234', fingerprint='a')
+        first.set_hull_score(0.75)
+        first.record_sub_region(3, 0.5)
+        first.close()
+
+        second = JobCheckpoint(self.store, '1234', fingerprint='a')
+
+        self.assertTrue(second.load())
+        self.assertEqual(second.hull_score, 0.75)
+        self.assertEqual(second.get_sub_region_score(3), (True, 0.5))
+        self.assertEqual(second.get_sub_region_score(4), (False, None))
+
+    def test_ignores_other_inputs(self):
+        self.store.save('1234', {'fingerprint': 'a', 'hull_score': 0.75, 'sub_region_scores': {}})
+
+        checkpoint = JobCheckpoint(self.store, '1234', fingerprint='b')
+
+        self.assertFalse(checkpoint.load())
+        self.assertIsNone(checkpoint.hull_score)
+
+    def test_discard(self):
+        checkpoint = JobCheckpoint(self.store, '1234')
+        checkpoint.set_hull_score(0.75)
+
+        checkpoint.discard()
+
+        self.assertIsNone(self.store.load('1234'))
+
+
+class TestGetCheckpointStore(unittest.TestCase):
+
+    def test_stores(self):
+        settings = MagicMock(storage_container_name='osw')
+        settings.get_download_folder.return_value = '/tmp/downloads'
+
+        settings.checkpoint_store = 'local'
+        self.assertIsInstance(get_checkpoint_store(settings), LocalCheckpointStore)
+        settings.checkpoint_store = 'blob'
+        self.assertIsInstance(get_checkpoint_store(settings, MagicMock()), BlobCheckpointStore)
+        settings.checkpoint_store = 'none'
+        self.assertIsNone(get_checkpoint_store(settings))
+
+
+if __name__ == '__main__':
+    unittest.main()
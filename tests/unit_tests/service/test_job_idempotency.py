@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import tempfile
+import unittest
+import threading
+from unittest.mock import MagicMock
+from src.models.confidence_request import ConfidenceRequest
+from src.service.job_idempotency import IdempotencyGuard, LocalIdempotencyStore, BlobIdempotencyStore, \
+    get_idempotency_store, COMPLETED, DEFERRED, RUNNING
+from tests.unit_tests.service.fake_blob_storage import FakeBlobStorage
+
+RESPONSE = {'jobId': 'job', 'confidence_scores': {}, 'success': True}
+
+
+def make_request(job_id: str = 'job', data_file: str = 'https://storage/osw.zip', **data) -> ConfidenceRequest:
+    return ConfidenceRequest(messageType='confidence', messageId='message', data=dict(
+        {'jobId': job_id, 'data_file': data_file, 'meta_file': '', 'trigger_type': 'manual'}, **data))
+
+
+class SharedStore(LocalIdempotencyStore):
+    shared = True
+
+
+class TestIdempotencyGuard(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store = LocalIdempotencyStore(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def guard(self, store=None, **kwargs) -> IdempotencyGuard:
+        guard = IdempotencyGuard(store or self.store, **kwargs)
+        self.addCleanup(guard.stop)
+        return guard
+
+    def test_replays_completed_job(self):
+        guard = self.guard()
+        claim = guard.claim(make_request())
+        self.assertTrue(claim.owned)
+        self.assertEqual(self.store.load('job')['state'], RUNNING)
+
+        guard.finish(claim, RESPONSE)
+        duplicate = guard.claim(make_request(trigger_type='retry', progressive=True))
+
+        self.assertFalse(duplicate.owned)
+        self.assertEqual(duplicate.response, RESPONSE)
+
+    def test_recomputes_changed_inputs(self):
+        guard = self.guard()
+        guard.finish(guard.claim(make_request()), RESPONSE)
+
+        self.assertTrue(guard.claim(make_request(data_file='https://storage/other.zip')).owned)
+
+    def test_recomputes_failed_job(self):
+        guard = self.guard()
+        guard.finish(guard.claim(make_request()), None)
+
+        self.assertIsNone(self.store.load('job'))
+        self.assertTrue(guard.claim(make_request()).owned)
+
+    def test_drops_duplicates_of_deferred_job_until_answered(self):
+        guard = self.guard()
+        guard.finish(guard.claim(make_request()), None, deferred=True)
+
+        duplicate = guard.claim(make_request())
+        self.assertFalse(duplicate.owned)
+        self.assertIsNone(duplicate.response)
+        self.assertEqual(self.store.load('job')['state'], DEFERRED)
+
+        guard.complete('job', RESPONSE)
+        self.assertEqual(guard.claim(make_request()).response, RESPONSE)
+
+    def test_recomputes_deferred_job_that_failed(self):
+        guard = self.guard()
+        guard.finish(guard.claim(make_request()), None, deferred=True)
+
+        guard.complete('job', None)
+
+        self.assertTrue(guard.claim(make_request()).owned)
+
+    def test_recomputes_after_ttl(self):
+        guard = self.guard(ttl=0)
+        guard.finish(guard.claim(make_request()), RESPONSE)
+
+        self.assertTrue(guard.claim(make_request()).owned)
+
+    def test_duplicate_waits_for_running_job(self):
+        guard = self.guard()
+        claim = guard.claim(make_request())
+        duplicates = []
+        thread = threading.Thread(target=lambda: duplicates.append(guard.claim(make_request())))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(duplicates, [])
+
+        guard.finish(claim, RESPONSE)
+        thread.join(timeout=5)
+
+        self.assertEqual(duplicates[0].response, RESPONSE)
+
+    def test_waits_for_job_running_on_another_pod(self):
+        store = SharedStore(self.temp_dir.name)
+        record = {'state': RUNNING, 'fingerprint': IdempotencyGuard.fingerprint(make_request()),
+                  'owner': 'other-pod', 'heartbeat': time.time()}
+        store.save('job', record)
+
+        def complete():
+            store.save('job', dict(record, state=COMPLETED, completed=time.time(), response=RESPONSE))
+        threading.Timer(0.2, complete).start()
+
+        claim = self.guard(store, poll_interval=0.05).claim(make_request())
+
+        self.assertFalse(claim.owned)
+        self.assertEqual(claim.response, RESPONSE)
+
+    def test_takes_over_stale_job(self):
+        store = SharedStore(self.temp_dir.name)
+        store.save('job', {'state': RUNNING, 'fingerprint': IdempotencyGuard.fingerprint(make_request()),
+                           'owner': 'crashed-pod', 'heartbeat': time.time() - 600})
+
+        self.assertTrue(self.guard(store, stale_after=300).claim(make_request()).owned)
+
+    def test_takes_over_running_record_of_unshared_store(self):
+        # A running record in a local store was left by a process that died
+        self.store.save('job', {'state': RUNNING, 'fingerprint': IdempotencyGuard.fingerprint(make_request()),
+                                'owner': 'earlier-process', 'heartbeat': time.time()})
+
+        self.assertTrue(self.guard().claim(make_request()).owned)
+
+    def test_heartbeat_refreshes_running_record(self):
+        guard = self.guard(stale_after=0.15)
+        guard.claim(make_request())
+        first = self.store.load('job')['heartbeat']
+
+        time.sleep(0.2)
+
+        self.assertGreater(self.store.load('job')['heartbeat'], first)
+
+
+class TestIdempotencyStores(unittest.TestCase):
+
+    def test_blob_store(self):
+        storage_client = MagicMock()
+        store = BlobIdempotencyStore(storage_client, 'osw')
+
+        store.save('job', {'state': RUNNING})
+        storage_client.get_file.return_value.get_stream.return_value = json.dumps({'state': RUNNING}).encode()
+
+        storage_client.get_container.return_value.container_client.get_blob_client.assert_called_once_with(
+            'idempotency/job.json')
+        self.assertEqual(store.load('job'), {'state': RUNNING})
+        self.assertTrue(store.shared)
+
+    def test_blob_store_running_to_completed(self):
+        store = BlobIdempotencyStore(FakeBlobStorage(), 'osw')
+        guard = IdempotencyGuard(store, stale_after=0.15)
+        request = make_request()
+
+        claim = guard.claim(request)
+        self.assertEqual(store.load('job')['state'], RUNNING)
+        first = store.load('job')['heartbeat']
+        time.sleep(0.2)
+        self.assertGreater(store.load('job')['heartbeat'], first)
+
+        guard.finish(claim, RESPONSE)
+        guard.stop()
+
+        self.assertEqual(store.load('job')['state'], COMPLETED)
+        replay = guard.claim(request)
+        self.assertFalse(replay.owned)
+        self.assertEqual(replay.response, RESPONSE)
+
+    def test_pod_that_missed_the_new_record_waits_for_it(self):
+        store = BlobIdempotencyStore(FakeBlobStorage(), 'osw')
+        owner = IdempotencyGuard(store)
+        self.addCleanup(owner.stop)
+        other_store = BlobIdempotencyStore(store.storage_client, 'osw')
+        other = IdempotencyGuard(other_store, poll_interval=0.05)
+        self.addCleanup(other.stop)
+        claim = owner.claim(make_request())
+        # The other pod read the job before the owner created its record
+        load = other_store.load
+        stale_reads = [None]
+        other_store.load = lambda key: stale_reads.pop() if stale_reads else load(key)
+        threading.Timer(0.2, lambda: owner.finish(claim, RESPONSE)).start()
+
+        duplicate = other.claim(make_request())
+
+        self.assertFalse(duplicate.owned)
+        self.assertEqual(duplicate.response, RESPONSE)
+
+    def test_blob_store_replaces_an_attempt_once(self):
+        store = BlobIdempotencyStore(FakeBlobStorage(), 'osw')
+        expired = {'state': COMPLETED, 'attempt': 'first', 'completed': 0}
+        store.save('job', expired)
+
+        self.assertTrue(store.replace('job', expired, {'state': RUNNING, 'attempt': 'second'}))
+        self.assertFalse(store.replace('job', expired, {'state': RUNNING, 'attempt': 'third'}))
+        self.assertEqual(store.load('job')['attempt'], 'second')
+
+        store.release('job', store.load('job'))
+        self.assertNotIn('idempotency/job.first.claim', store.storage_client.blobs['osw'])
+
+    def test_local_store_prunes_old_records(self):
+        with tempfile.TemporaryDirectory() as folder:
+            store = LocalIdempotencyStore(folder, retention=60)
+            store.save('old', {'state': COMPLETED})
+            store.save('new', {'state': COMPLETED})
+            os.utime(store.path('old'), (time.time() - 120, time.time() - 120))
+
+            self.assertEqual(store.prune(), 1)
+            self.assertIsNone(store.load('old'))
+            self.assertIsNotNone(store.load('new'))
+            # Pruned at most once per interval
+            os.utime(store.path('new'), (time.time() - 120, time.time() - 120))
+            self.assertEqual(store.prune(), 0)
+
+    def test_local_store_keeps_records_without_retention(self):
+        with tempfile.TemporaryDirectory() as folder:
+            store = LocalIdempotencyStore(folder)
+            store.save('old', {'state': COMPLETED})
+            os.utime(store.path('old'), (0, 0))
+
+            self.assertEqual(store.prune(), 0)
+            self.assertIsNotNone(store.load('old'))
+
+    def test_blob_store_missing_record(self):
+        storage_client = MagicMock()
+        storage_client.get_file.side_effect = Exception('not found')
+
+        self.assertIsNone(BlobIdempotencyStore(storage_client, 'osw').load('job'))
+
+    def test_get_store(self):
+        settings = MagicMock(idempotency_store='none')
+        self.assertIsNone(get_idempotency_store(settings))
+        settings = MagicMock(idempotency_store='local', idempotency_retention=0, idempotency_ttl=3600)
+        settings.get_download_folder.return_value = '/tmp/downloads'
+        self.assertEqual(get_idempotency_store(settings).retention, 3600)
+        settings.idempotency_store = 'blob'
+        self.assertIsInstance(get_idempotency_store(settings, MagicMock()), BlobIdempotencyStore)
+
+
+if __name__ == '__main__':
+    unittest.main()
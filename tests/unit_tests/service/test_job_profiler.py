@@ -0,0 +1,133 @@
+import os
+import time
+import marshal
+import tempfile
+import unittest
+import threading
+import tracemalloc
+from unittest.mock import MagicMock
+from src.service.job_profiler import JobProfiler, prune_profiles
+from tests.unit_tests.service.fake_blob_storage import FakeBlobStorage
+
+
+def busy_work():
+    return sorted(str(value) for value in range(20000))
+
+
+class TestJobProfiler(unittest.TestCase):
+
+    def test_profiles_calls_on_other_threads(self):
+        profiler = JobProfiler('job', top=5)
+        profiler.start()
+        worker = threading.Thread(target=lambda: profiler.call(busy_work))
+        worker.start()
+        worker.join()
+        profiler.stop()
+
+        report = profiler.report()
+        self.assertIn('busy_work', report)
+        self.assertIn('allocation sites', report)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_call_returns_result(self):
+        profiler = JobProfiler('job')
+
+        self.assertEqual(profiler.call(lambda: 42), 42)
+
+    def test_save_writes_pstats_and_report(self):
+        profiler = JobProfiler('job')
+        profiler.start()
+        profiler.call(busy_work)
+        profiler.stop()
+
+        with tempfile.TemporaryDirectory() as folder:
+            paths = profiler.save(folder)
+
+            self.assertEqual(sorted(os.path.basename(path) for path in paths), ['job.pstats', 'job_profile.txt'])
+            with open(os.path.join(folder, 'job.pstats'), 'rb') as file:
+                stats = marshal.load(file)
+            self.assertTrue(any(function == 'busy_work' for _, _, function in stats))
+
+    def test_upload(self):
+        profiler = JobProfiler('job')
+        profiler.start()
+        profiler.stop()
+        storage_client = MagicMock()
+
+        names = profiler.upload(storage_client, 'container')
+
+        self.assertEqual(names, ['profiles/job/job_profile.txt'])
+        storage_client.get_container.assert_called_once_with(container_name='container')
+
+    def test_upload_overwrites(self):
+        storage = FakeBlobStorage()
+        profiler = JobProfiler('job')
+        profiler.start()
+        profiler.stop()
+
+        profiler.upload(storage, 'container')
+        profiler.upload(storage, 'container')
+
+        self.assertIn(b'Job job', storage.get_file('container', 'profiles/job/job_profile.txt').get_stream())
+
+    def test_merges_worker_profile(self):
+        worker_profiler = JobProfiler('job', top=5)
+        worker_profiler.start()
+        worker_profiler.call(busy_work)
+        worker_profiler.stop()
+        profiler = JobProfiler('job', top=5)
+        profiler.start()
+        profiler.stop()
+
+        profiler.merge(worker_profiler.export())
+
+        report = profiler.report()
+        self.assertIn('busy_work', report)
+        self.assertIn('allocation sites in the worker process', report)
+        self.assertIn('job.pstats', profiler.artifacts())
+
+    def test_peak_of_a_job_running_alone(self):
+        profiler = JobProfiler('job')
+        profiler.start()
+        profiler.call(busy_work)
+        profiler.stop()
+
+        self.assertFalse(profiler.peak_shared)
+        self.assertGreater(profiler.peak_bytes, 0)
+        self.assertNotIn('shared with other profiled jobs', profiler.report())
+
+    def test_peak_of_overlapping_jobs_is_marked_shared(self):
+        first, second, later = JobProfiler('first'), JobProfiler('second'), JobProfiler('later')
+        first.start()
+        second.start()
+        first.stop()
+        second.stop()
+        later.start()
+        later.stop()
+
+        self.assertTrue(first.peak_shared)
+        self.assertTrue(second.peak_shared)
+        self.assertFalse(later.peak_shared)
+        self.assertIn('shared with other profiled jobs', first.report())
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_prune_profiles(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for job_id in ('old', 'new'):
+                JobProfiler(job_id).save(os.path.join(folder, job_id))
+            old = time.time() - 120
+            os.utime(os.path.join(folder, 'old'), (old, old))
+
+            self.assertEqual(prune_profiles(folder, 0), 0)
+            self.assertEqual(prune_profiles(folder, 60), 1)
+            self.assertEqual(os.listdir(folder), ['new'])
+
+    def test_stop_without_start(self):
+        profiler = JobProfiler('job')
+        profiler.stop()
+
+        self.assertIn('Job job', profiler.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import time
+import asyncio
+import unittest
+import threading
+from unittest.mock import MagicMock
+from src.service.job_scheduler import JobScheduler, JobCostEstimate, JobRejectedError, PriorityLane
+
+
+class TestJobCostEstimate(unittest.TestCase):
+
+    def test_cost(self):
+        estimate = JobCostEstimate(zip_size_bytes=2 * 1024 * 1024, hull_area_km2=4, sub_region_count=3)
+
+        self.assertEqual(estimate.cost, 2 + 2 + 6)
+
+
+class TestPriorityLane(unittest.TestCase):
+
+    def test_cheapest_waiting_job_runs_first(self):
+        lane = PriorityLane('test', 1)
+        order = []
+        started = threading.Event()
+
+        def blocker():
+            with lane.slot(0):
+                started.set()
+                time.sleep(0.1)
+
+        def job(cost):
+            with lane.slot(cost):
+                order.append(cost)
+
+        threads = [threading.Thread(target=blocker)]
+        threads[0].start()
+        started.wait()
+        for cost in [30, 10, 20]:
+            thread = threading.Thread(target=job, args=(cost,))
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(order, [10, 20, 30])
+        self.assertEqual(lane.active, 0)
+
+    def test_gives_up_the_wait_when_checked_out(self):
+        lane = PriorityLane('test', 1)
+        cancelled = threading.Event()
+
+        def check():
+            if cancelled.is_set():
+                raise RuntimeError('cancelled')
+
+        with lane.slot(0):
+            threading.Timer(0.1, cancelled.set).start()
+            with self.assertRaises(RuntimeError):
+                with lane.slot(10, check=check, poll_interval=0.01):
+                    pass
+
+        self.assertEqual(lane.waiting, [])
+        self.assertEqual(lane.active, 0)
+
+    def test_waits_on_the_event_loop_cheapest_first(self):
+        lane = PriorityLane('test', 1)
+        order = []
+
+        async def job(cost):
+            await lane.acquire_async(cost, poll_interval=0.01)
+            order.append(cost)
+            await asyncio.sleep(0.02)
+            lane.release()
+
+        async def run():
+            with lane.slot(0):
+                tasks = [asyncio.create_task(job(cost)) for cost in [30, 10, 20]]
+                await asyncio.sleep(0.05)
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+
+        self.assertEqual(order, [10, 20, 30])
+        self.assertEqual(lane.active, 0)
+
+    def test_async_wait_gives_up_when_checked_out(self):
+        lane = PriorityLane('test', 1)
+
+        def check():
+            raise RuntimeError('cancelled')
+
+        with lane.slot(0):
+            with self.assertRaises(RuntimeError):
+                asyncio.run(lane.acquire_async(10, check=check))
+
+        self.assertEqual(lane.waiting, [])
+
+
+class TestJobScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = JobScheduler(small_job_cost=10, fast_lane_size=2, slow_lane_size=1, cost_budget=100)
+
+    def test_lane_for(self):
+        self.assertIs(self.scheduler.lane_for(JobCostEstimate(sub_region_count=1)), self.scheduler.fast_lane)
+        self.assertIs(self.scheduler.lane_for(JobCostEstimate(sub_region_count=20)), self.scheduler.slow_lane)
+
+    def test_rejects_over_budget(self):
+        with self.assertRaises(JobRejectedError) as context:
+            with self.scheduler.slot(JobCostEstimate(sub_region_count=60), job_id='42'):
+                pass
+
+        self.assertIn('Job 42 rejected', str(context.exception))
+
+    def test_no_budget(self):
+        scheduler = JobScheduler(small_job_cost=10, fast_lane_size=1, slow_lane_size=1, cost_budget=0)
+
+        with scheduler.slot(JobCostEstimate(sub_region_count=10000)) as lane:
+            self.assertIs(lane, scheduler.slow_lane)
+
+    def test_from_settings(self):
+        settings = MagicMock(small_job_cost=5, fast_lane_size=0, slow_lane_size=2, job_cost_budget=0,
+                             max_concurrent_messages=4)
+
+        scheduler = JobScheduler.from_settings(settings)
+
+        self.assertEqual(scheduler.fast_lane.size, 4)
+        self.assertEqual(scheduler.slow_lane.size, 2)
+
+    def test_from_settings_leaves_a_message_for_small_jobs(self):
+        settings = MagicMock(small_job_cost=5, fast_lane_size=0, slow_lane_size=4, job_cost_budget=0,
+                             max_concurrent_messages=4)
+
+        scheduler = JobScheduler.from_settings(settings)
+
+        self.assertEqual(scheduler.slow_lane.size, 3)
+
+    def test_from_settings_single_message(self):
+        settings = MagicMock(small_job_cost=5, fast_lane_size=0, slow_lane_size=1, job_cost_budget=0,
+                             max_concurrent_messages=1)
+
+        with self.assertLogs('JobScheduler', level='WARNING'):
+            scheduler = JobScheduler.from_settings(settings)
+
+        self.assertEqual((scheduler.fast_lane.size, scheduler.slow_lane.size), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from src.models.confidence_request import ConfidenceRequest
+from src.service.job_sharding import JobSharder, LocalShardResultStore, BlobShardResultStore, get_shard_store, \
+    plan_shards, merge_scores
+from tests.unit_tests.service.fake_blob_storage import FakeBlobStorage
+
+
+def make_request(job_id: str = 'job', **data) -> ConfidenceRequest:
+    return ConfidenceRequest(messageType='confidence', messageId='message', data=dict(
+        {'jobId': job_id, 'data_file': 'https://storage/osw.zip', 'meta_file': '', 'trigger_type': 'manual',
+         'sub_regions_file': 'https://storage/sub_regions.geojson'}, **data))
+
+
+def make_results(count: int) -> dict:
+    return {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'properties': {'confidence_score': 0.9}}] +
+            [{'type': 'Feature', 'properties': {'confidence_score': None}} for _ in range(count)]}
+
+
+class TestJobSharder(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store = LocalShardResultStore(os.path.join(self.temp_dir.name, 'shards'))
+        self.published = []
+        self.responses = []
+        self.sharder = JobSharder(self.store, self.published.append,
+                                  lambda *response: self.responses.append(response), shard_size=2)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def input_paths(self, count: int):
+        paths = []
+        for index in range(count):
+            paths.append(os.path.join(self.temp_dir.name, f'{index}.geojson'))
+            with open(paths[-1], 'w') as file:
+                file.write(f'{{"shard": {index}}}')
+        return paths
+
+    def report(self, index: int, scores=None, success: bool = True, message: str = ''):
+        shard_request = ConfidenceRequest(**JobSharder.shard_message(make_request(), index, 0, 0))
+        return self.sharder.report(shard_request, success, scores=scores, message=message)
+
+    def test_plan_shards(self):
+        self.assertEqual(plan_shards(5, 2), [(0, 2), (2, 4), (4, 5)])
+        self.assertEqual(plan_shards(0, 2), [])
+
+    def test_plan(self):
+        self.assertEqual(self.sharder.plan(make_request(), 3), [(0, 2), (2, 3)])
+        self.assertIsNone(self.sharder.plan(make_request(), 2))
+        self.assertIsNone(self.sharder.plan(make_request(shard={'parent': 'job', 'index': 0}), 3))
+
+    def test_shard_message(self):
+        message = JobSharder.shard_message(make_request(progressive=True, grid_cell_size=100), 1, 2, 4)
+
+        self.assertEqual(message['messageId'], 'message-shard-1')
+        self.assertEqual(message['data']['jobId'], 'job-shard-1')
+        self.assertEqual(message['data']['shard'], {'parent': 'job', 'index': 1, 'start': 2, 'end': 4})
+        self.assertFalse(message['data']['progressive'])
+        self.assertIsNone(message['data']['grid_cell_size'])
+        self.assertTrue(JobSharder.is_shard(ConfidenceRequest(**message)))
+
+    def test_shard_reads_its_own_sub_regions(self):
+        self.sharder.fan_out(make_request(), [(0, 2), (2, 4)], self.input_paths(2))
+        local_path = os.path.join(self.temp_dir.name, 'shard.geojson')
+
+        self.sharder.fetch_input(ConfidenceRequest(**self.published[1]), local_path)
+
+        with open(local_path) as file:
+            self.assertEqual(json.load(file), {'shard': 1})
+
+    def test_fetch_missing_input(self):
+        with self.assertRaises(FileNotFoundError):
+            self.sharder.fetch_input(ConfidenceRequest(**JobSharder.shard_message(make_request(), 0, 0, 2)),
+                                     os.path.join(self.temp_dir.name, 'shard.geojson'))
+
+    def test_last_shard_to_report_merges(self):
+        ranges = [(0, 2), (2, 4), (4, 5)]
+        self.sharder.fan_out(make_request(), ranges, self.input_paths(3))
+
+        self.assertFalse(self.sharder.defer(make_request(), make_results(5), ranges, [4, 3, 2, 1, 0]))
+        self.assertFalse(self.report(0, scores=[0.0, 0.1]))
+        self.assertFalse(self.report(2, scores=[0.4]))
+        self.assertTrue(self.report(1, scores=[0.2, 0.3]))
+
+        self.assertEqual(len(self.published), 3)
+        job, success, results, message = self.responses[0]
+        self.assertTrue(success)
+        self.assertEqual(job['messageId'], 'message')
+        self.assertEqual([feature['properties']['confidence_score'] for feature in results['features']],
+                         [0.9, 0.4, 0.3, 0.2, 0.1, 0.0])
+        self.assertFalse(os.path.exists(os.path.join(self.store.folder, 'job')))
+
+    def test_coordinator_merges_when_shards_finished_first(self):
+        self.sharder.fan_out(make_request(), [(0, 2), (2, 3)], self.input_paths(2))
+        self.report(0, scores=[0.1, 0.2])
+        self.report(1, scores=[0.3])
+
+        self.assertTrue(self.sharder.defer(make_request(), make_results(3), [(0, 2), (2, 3)], [0, 1, 2]))
+
+        self.assertEqual(len(self.responses), 1)
+
+    def test_merges_once(self):
+        self.sharder.defer(make_request(), make_results(2), [(0, 2)], [0, 1])
+        self.report(0, scores=[0.1, 0.2])
+
+        self.assertFalse(self.sharder.try_merge('job'))
+        self.assertEqual(len(self.responses), 1)
+
+    def test_replica_that_saw_the_job_before_the_merge_does_not_merge_again(self):
+        self.sharder.defer(make_request(), make_results(2), [(0, 2)], [0, 1])
+        stale_job = self.store.load('job', 'job')
+        self.report(0, scores=[0.1, 0.2])
+        # The job document and the result this replica read before the other one discarded them
+        stale_reads = [stale_job, {'success': True, 'scores': [0.1, 0.2], 'message': ''}]
+        load = self.store.load
+        self.store.load = lambda parent, name: stale_reads.pop(0) if stale_reads else load(parent, name)
+
+        self.assertFalse(self.sharder.try_merge('job'))
+
+        self.assertEqual(len(self.responses), 1)
+        self.assertIsNone(load('job', 'merge'))
+
+    def test_failed_shard_fails_the_job(self):
+        self.sharder.defer(make_request(), make_results(4), [(0, 2), (2, 4)], [0, 1, 2, 3])
+        self.report(0, scores=[0.1, 0.2])
+        self.report(1, success=False, message='osm timeout')
+
+        _, success, results, message = self.responses[0]
+        self.assertFalse(success)
+        self.assertIsNone(results)
+        self.assertIn('osm timeout', message)
+        # The shard that succeeded is kept for the retry
+        self.assertIsNotNone(self.store.load('job', '0'))
+        self.assertIsNone(self.store.load('job', 'job'))
+
+    def test_retry_publishes_only_unreported_shards(self):
+        self.report(0, scores=[0.5, 0.5])
+        self.report(1, success=False, message='failed')
+
+        self.sharder.fan_out(make_request(), [(0, 2), (2, 4), (4, 5)], self.input_paths(3))
+
+        self.assertEqual([message['data']['shard']['index'] for message in self.published], [1, 2])
+        self.assertIsNone(self.store.load('job', '1'))
+
+    def test_merge_scores_format(self):
+        results = {'type': 'FeatureCollection', 'features': [{'properties': {'confidence_score': 0.9}}],
+                   'scores': [{'index': 0, 'confidence_score': None}, {'index': 1, 'confidence_score': None}]}
+
+        merge_scores(results, [1, 0], [0.2, 0.1])
+
+        self.assertEqual(results['scores'], [{'index': 0, 'confidence_score': 0.1},
+                                             {'index': 1, 'confidence_score': 0.2}])
+
+
+class TestShardResultStores(unittest.TestCase):
+
+    def test_blob_store_replaces_results(self):
+        storage = FakeBlobStorage()
+        store = BlobShardResultStore(storage, 'osw')
+
+        store.save('job', '1', {'success': False})
+        store.save('job', '1', {'success': True})
+
+        self.assertEqual(store.load('job', '1'), {'success': True})
+        self.assertIn('shards/job/1.json', storage.blobs['osw'])
+
+    def test_blob_store_creates_once(self):
+        store = BlobShardResultStore(FakeBlobStorage(), 'osw')
+
+        self.assertTrue(store.create('job', 'merge', {'claimed': 1}))
+        self.assertFalse(store.create('job', 'merge', {'claimed': 2}))
+        self.assertEqual(store.load('job', 'merge'), {'claimed': 1})
+
+    def test_blob_store_inputs(self):
+        store = BlobShardResultStore(FakeBlobStorage(), 'osw')
+
+        store.save_input('job', 0, b'{}')
+        self.assertEqual(store.load_input('job', 0), b'{}')
+        store.delete_input('job', 0)
+        self.assertIsNone(store.load_input('job', 0))
+
+    def test_blob_store_missing_result(self):
+        storage_client = MagicMock()
+        storage_client.get_file.side_effect = Exception('not found')
+
+        self.assertIsNone(BlobShardResultStore(storage_client, 'osw').load('job', '0'))
+
+    def test_local_store_creates_once(self):
+        with tempfile.TemporaryDirectory() as folder:
+            store = LocalShardResultStore(folder)
+
+            self.assertTrue(store.create('job', 'merge', {'claimed': 1}))
+            self.assertFalse(store.create('job', 'merge', {'claimed': 2}))
+            self.assertEqual(store.load('job', 'merge'), {'claimed': 1})
+
+    def test_get_store(self):
+        settings = MagicMock(shard_store='local')
+        settings.get_download_folder.return_value = '/tmp/downloads'
+        self.assertIsInstance(get_shard_store(settings), LocalShardResultStore)
+        settings.shard_store = 'blob'
+        self.assertIsInstance(get_shard_store(settings, MagicMock()), BlobShardResultStore)
+
+    def test_disabled_without_shard_size(self):
+        self.assertIsNone(JobSharder.from_settings(MagicMock(shard_size=0), MagicMock(), MagicMock(), MagicMock()))
+
+
+if __name__ == '__main__':
+    unittest.main()
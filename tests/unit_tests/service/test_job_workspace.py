@@ -0,0 +1,136 @@
+import os
+import time
+import tempfile
+import unittest
+import threading
+from pathlib import Path
+from unittest.mock import patch
+from src.service.job_workspace import WorkspaceManager, DiskQuotaExceededError, folder_size
+
+MB = 1024 * 1024
+
+
+class TestWorkspaceManager(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.temp_dir.name, 'downloads')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_release_removes_folder(self):
+        manager = WorkspaceManager(root=self.root, quota_bytes=10 * MB)
+        workspace = manager.acquire('job', expected_bytes=MB)
+        Path(workspace.path, 'job.zip').write_text('data')
+        self.assertEqual(manager.usage()['reserved_bytes'], MB)
+
+        workspace.release()
+        workspace.release()
+
+        self.assertFalse(os.path.exists(workspace.path))
+        self.assertEqual(manager.usage()['reserved_bytes'], 0)
+        self.assertEqual(manager.usage()['active_jobs'], 0)
+
+    def test_release_keeps_named_files(self):
+        manager = WorkspaceManager(root=self.root)
+        workspace = manager.acquire('job')
+        Path(workspace.path, 'job.zip').write_text('data')
+        Path(workspace.path, 'checkpoint.json').write_text('{}')
+
+        workspace.release(keep=['checkpoint.json'])
+
+        self.assertEqual(os.listdir(workspace.path), ['checkpoint.json'])
+
+    def test_rejects_job_larger_than_quota(self):
+        manager = WorkspaceManager(root=self.root, quota_bytes=MB)
+
+        with self.assertRaises(DiskQuotaExceededError):
+            manager.acquire('job', expected_bytes=2 * MB)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'job')))
+
+    def test_rejects_when_quota_is_taken(self):
+        manager = WorkspaceManager(root=self.root, quota_bytes=3 * MB, wait_timeout=0)
+        manager.acquire('first', expected_bytes=2 * MB)
+
+        with self.assertRaises(DiskQuotaExceededError):
+            manager.acquire('second', expected_bytes=2 * MB)
+
+    def test_waits_for_release(self):
+        manager = WorkspaceManager(root=self.root, quota_bytes=3 * MB, wait_timeout=5)
+        first = manager.acquire('first', expected_bytes=2 * MB)
+        threading.Timer(0.1, first.release).start()
+
+        started = time.monotonic()
+        second = manager.acquire('second', expected_bytes=2 * MB)
+
+        self.assertLess(time.monotonic() - started, 3)
+        self.assertEqual(manager.usage()['reserved_bytes'], 2 * MB)
+        second.release()
+
+    def test_keeps_minimum_free_space(self):
+        manager = WorkspaceManager(root=self.root, min_free_bytes=manager_free_bytes(self.root) + MB)
+
+        with self.assertRaises(DiskQuotaExceededError):
+            manager.acquire('job')
+
+    def test_small_job_in_memory_folder(self):
+        memory_root = os.path.join(self.temp_dir.name, 'memory')
+        manager = WorkspaceManager(root=self.root, quota_bytes=MB, memory_root=memory_root,
+                                   memory_max_job_bytes=MB // 2)
+
+        small = manager.acquire('small', expected_bytes=MB // 4)
+        large = manager.acquire('large', expected_bytes=MB)
+
+        self.assertTrue(small.in_memory)
+        self.assertTrue(small.path.startswith(memory_root))
+        self.assertFalse(large.in_memory)
+        self.assertEqual(manager.usage()['in_memory_jobs'], 1)
+        # Jobs in memory do not count against the disk quota
+        self.assertEqual(manager.usage()['reserved_bytes'], MB)
+
+    def test_unknown_size_not_in_memory(self):
+        memory_root = os.path.join(self.temp_dir.name, 'memory')
+        manager = WorkspaceManager(root=self.root, memory_root=memory_root, memory_max_job_bytes=MB)
+
+        workspace = manager.acquire('job', expected_bytes=0)
+
+        self.assertFalse(workspace.in_memory)
+        self.assertTrue(workspace.path.startswith(self.root))
+
+    def test_admission_measures_workspaces_only(self):
+        manager = WorkspaceManager(root=self.root, quota_bytes=10 * MB, measure_interval=60)
+        Path(self.root, 'cache').mkdir(parents=True)
+        Path(self.root, 'cache', 'dataset.zip').write_bytes(b'x' * 100)
+        first = manager.acquire('first', expected_bytes=MB)
+        Path(first.path, 'job.zip').write_bytes(b'x' * 100)
+
+        with patch('src.service.job_workspace.folder_size', wraps=folder_size) as measure:
+            manager.acquire('second', expected_bytes=MB)
+            manager.acquire('third', expected_bytes=MB)
+
+        # Each workspace is measured once within the interval, and the rest of the downloads folder never
+        measured = [call.args[0] for call in measure.call_args_list]
+        self.assertEqual(sorted(measured), sorted([first.path, os.path.join(self.root, 'second')]))
+        self.assertEqual(first.written_bytes, 100)
+        self.assertEqual(first.unwritten_bytes(max_age=60), MB - 100)
+
+    def test_usage_reports_used_bytes(self):
+        manager = WorkspaceManager(root=self.root)
+        workspace = manager.acquire('job')
+        Path(workspace.path, 'job.zip').write_bytes(b'x' * 100)
+
+        usage = manager.usage()
+
+        self.assertEqual(usage['used_bytes'], 100)
+        self.assertEqual(folder_size(workspace.path), 100)
+        self.assertEqual(usage['active_jobs'], 1)
+        self.assertGreater(usage['free_bytes'], 0)
+
+
+def manager_free_bytes(root: str) -> int:
+    return WorkspaceManager(root=root).free_bytes()
+
+
+if __name__ == '__main__':
+    unittest.main()
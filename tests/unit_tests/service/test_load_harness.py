@@ -0,0 +1,94 @@
+import io
+import json
+import zipfile
+import tempfile
+import unittest
+import geopandas as gpd
+from src.service.load_harness import LoadHarness, InMemoryStorageClient, InMemoryTopic, SimulatedOSMDataBackend, \
+    DEFAULT_PROFILES, make_dataset, parse_mix, percentiles
+
+
+class TestLoadHarnessParts(unittest.TestCase):
+
+    def test_parse_mix(self):
+        self.assertEqual(parse_mix('small=3,large=1'), {'small': 0.75, 'large': 0.25})
+        with self.assertRaises(ValueError):
+            parse_mix('huge=1')
+
+    def test_make_dataset(self):
+        zip_bytes, sub_regions = make_dataset(DEFAULT_PROFILES['medium'], seed=1)
+
+        with zipfile.ZipFile(io.BytesIO(zip_bytes)) as archive:
+            nodes = gpd.read_file(io.BytesIO(archive.read('nodes.geojson')))
+        self.assertEqual(len(nodes), DEFAULT_PROFILES['medium'].nodes)
+        self.assertEqual(len(json.loads(sub_regions)['features']), DEFAULT_PROFILES['medium'].sub_regions)
+        self.assertIsNone(make_dataset(DEFAULT_PROFILES['small'], seed=1)[1])
+
+    def test_storage_client(self):
+        storage_client = InMemoryStorageClient()
+        storage_client.put('memory://a.zip', b'abc')
+
+        file = storage_client.get_file_from_url('container', 'memory://a.zip')
+        self.assertEqual(file.get_stream(), b'abc')
+        self.assertEqual(file.blob_client.get_blob_properties().size, 3)
+        self.assertTrue(file.blob_client.get_blob_properties().etag)
+        self.assertIsNone(storage_client.get_file_from_url('container', 'memory://missing.zip').file_path)
+
+        storage_client.get_container(container_name='container').create_file('out.json').upload('{}')
+        self.assertEqual(storage_client.get_file('container', 'out.json').get_stream(), b'{}')
+
+    def test_topic_publish_notifies_listeners(self):
+        topic = InMemoryTopic('responses')
+        received = []
+        topic.listeners.append(lambda published_at, message: received.append(message))
+
+        topic.publish(data='message')
+
+        self.assertEqual(received, ['message'])
+        self.assertEqual(len(topic.published), 1)
+
+    def test_simulated_backend_counts_calls(self):
+        backend = SimulatedOSMDataBackend(latency=0)
+
+        backend.get_way_history(osmid=1)
+        backend.get_map_data((0, 0, 1, 1))
+
+        self.assertEqual(backend.calls, 2)
+
+    def test_percentiles(self):
+        self.assertEqual(percentiles([]), {})
+        self.assertEqual(percentiles([1.0, 2.0, 3.0])['p50'], 2.0)
+
+
+class TestLoadHarness(unittest.TestCase):
+
+    def test_run(self):
+        harness = LoadHarness(messages=3, rate=0, mix={'small': 1.0}, osm_latency=0, concurrency=2)
+
+        report = harness.run(timeout=60)
+
+        self.assertEqual(report.sent, 3)
+        self.assertEqual(report.completed, 3)
+        self.assertEqual(report.failed, 0)
+        self.assertGreater(report.throughput_per_minute, 0)
+        self.assertIn('p99', report.latency)
+        self.assertIn('p50', report.queueing_delay)
+        self.assertGreater(report.osm_calls, 0)
+        self.assertEqual(report.dataset_cache, {})
+
+    def test_run_uses_dataset_cache_and_settings(self):
+        cache_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_folder.cleanup)
+        harness = LoadHarness(messages=3, rate=0, mix={'medium': 1.0}, osm_latency=0, concurrency=1,
+                              settings={'dataset_cache_mb': 64, 'dataset_cache_folder': cache_folder.name,
+                                        'sub_region_order': 'file'})
+
+        report = harness.run(timeout=60)
+
+        self.assertEqual(report.completed, 3)
+        self.assertEqual(report.dataset_cache['misses'], 1)
+        self.assertEqual(report.dataset_cache['hits'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
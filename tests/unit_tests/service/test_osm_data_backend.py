@@ -0,0 +1,265 @@
+import os
+import time
+import pickle
+import tempfile
+import unittest
+import multiprocessing
+import threading
+from datetime import datetime
+from pathlib import Path
+from collections import namedtuple
+from unittest.mock import MagicMock, patch
+from osmapi.errors import ElementNotFoundApiError
+from src.service.osm_data_backend import OSMApiDataBackend, OSMHistoryExtractBackend, CoalescingOSMDataBackend, \
+    get_osm_data_backend, load_history_extract, configure_overpass_cache, tile_for, tiles_for_bbox
+from src.service.single_flight import DiskCache
+
+HISTORY_FILE = f'{Path.cwd()}/tests/files/osm_history.osh'
+CHANGE_FILE = f'{Path.cwd()}/tests/files/osm_history.osc'
+
+Item = namedtuple('Item', ['element_type', 'osmid'])
+
+
+def fetch_way_in_process(backend, osmid):
+    backend.get_way_history(osmid)
+
+
+class TestTiles(unittest.TestCase):
+
+    def test_tile_for(self):
+        self.assertEqual(tile_for(0, 0, 1), (1, 1))
+        self.assertEqual(tile_for(-180, 85, 2), (0, 0))
+
+    def test_tiles_for_bbox(self):
+        tiles = list(tiles_for_bbox((-1, -1, 1, 1), 1))
+        self.assertCountEqual(tiles, [(0, 0), (0, 1), (1, 0), (1, 1)])
+
+
+class TestOSMHistoryExtractBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = OSMHistoryExtractBackend(paths=[HISTORY_FILE, CHANGE_FILE], tile_zoom=14)
+
+    def test_way_history(self):
+        history = self.backend.get_way_history(osmid=301)
+
+        self.assertEqual(sorted(history), [1, 2, 3])
+        self.assertEqual(history[2]['user'], 'carol')
+        self.assertEqual(history[2]['timestamp'], datetime(2022, 2, 2, 12, 0, 0))
+        self.assertEqual(history[3]['tag']['surface'], 'asphalt')
+        self.assertEqual(history[1]['nd'], [101, 102])
+        self.assertTrue(history[3]['visible'])
+
+    def test_item_history(self):
+        node_history = self.backend.get_item_history(item=Item('node', 101))
+        relation_history = self.backend.get_item_history(item=Item('relation', 401))
+
+        self.assertEqual(len(node_history), 2)
+        self.assertEqual(relation_history[1]['member'][0]['ref'], 301)
+        self.assertIsNone(self.backend.get_item_history(item={'osmid': 101}))
+
+    def test_deleted_in_change_file(self):
+        history = self.backend.get_node_history(osmid=201)
+
+        self.assertFalse(history[2]['visible'])
+
+    def test_missing_element(self):
+        with self.assertRaises(ElementNotFoundApiError):
+            self.backend.get_way_history(osmid=999)
+
+    def test_get_map_data(self):
+        data = self.backend.get_map_data(bounding_params=(-122.15, 47.63, -122.13, 47.65))
+
+        keys = [(element['type'], element['data']['id']) for element in data]
+        self.assertEqual(keys, [('node', 101), ('node', 102), ('node', 103), ('way', 301), ('relation', 401)])
+        self.assertEqual(data[3]['data']['version'], 3)
+
+    def test_get_map_data_skips_deleted(self):
+        data = self.backend.get_map_data(bounding_params=(-122.66, 48.28, -122.64, 48.30))
+
+        self.assertEqual(data, [])
+
+    def test_pickle_uses_process_cache(self):
+        backend = load_history_extract((HISTORY_FILE,), 14)
+
+        restored = pickle.loads(pickle.dumps(backend))
+
+        self.assertIs(restored, backend)
+
+
+class TestCoalescingOSMDataBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.cache = DiskCache(self.folder.name, ttl=60)
+        self.extract = OSMHistoryExtractBackend(paths=[HISTORY_FILE, CHANGE_FILE], tile_zoom=14)
+        self.inner = MagicMock(wraps=self.extract)
+        self.backend = CoalescingOSMDataBackend(backend=self.inner, cache=self.cache)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_concurrent_history_requests_share_one_fetch(self):
+        def slow_history(osmid):
+            time.sleep(0.05)
+            return self.extract.get_way_history(osmid)
+
+        self.inner.get_way_history.side_effect = slow_history
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.backend.get_way_history(301)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.inner.get_way_history.assert_called_once_with(301)
+        self.assertEqual(len(results), 5)
+        # Threads joining the flight get its result, later ones a copy from the cache
+        self.assertTrue(all(result == results[0] for result in results))
+
+    def test_item_history_is_cached(self):
+        self.backend.get_item_history(item=Item('node', 101))
+        self.backend.get_item_history(item=Item('node', 101))
+
+        self.inner.get_node_history.assert_called_once_with(101)
+
+    def test_history_fetched_by_other_process_is_reused(self):
+        backend = CoalescingOSMDataBackend(backend=self.extract, cache=self.cache)
+        process = multiprocessing.get_context('spawn').Process(target=fetch_way_in_process, args=(backend, 301))
+        process.start()
+        process.join(timeout=60)
+
+        history = self.backend.get_way_history(301)
+
+        self.inner.get_way_history.assert_not_called()
+        self.assertEqual(sorted(history), [1, 2, 3])
+
+    def test_expired_history_is_fetched_again(self):
+        self.backend.get_way_history(301)
+        old = time.time() - 120
+        os.utime(self.cache.path(('way', 301)), (old, old))
+        self.backend.get_way_history(301)
+
+        self.assertEqual(self.inner.get_way_history.call_count, 2)
+
+    def test_without_cache_only_coalesces(self):
+        backend = CoalescingOSMDataBackend(backend=self.inner)
+        backend.get_way_history(301)
+        backend.get_way_history(301)
+
+        self.assertEqual(self.inner.get_way_history.call_count, 2)
+
+    def test_map_data_is_passed_to_the_backend(self):
+        bounding_params = (-122.1440, 47.6350, -122.1320, 47.6370)
+
+        data = self.backend.get_map_data(bounding_params)
+
+        self.inner.get_map_data.assert_called_once_with(bounding_params)
+        self.assertEqual(data, self.extract.get_map_data(bounding_params))
+
+    def test_pickle_keeps_backend(self):
+        backend = CoalescingOSMDataBackend(backend=self.extract, cache=self.cache)
+
+        restored = pickle.loads(pickle.dumps(backend))
+
+        self.assertEqual(restored.backend.paths, self.extract.paths)
+        self.assertEqual(restored.cache.folder, self.folder.name)
+        self.assertIs(restored.flight, CoalescingOSMDataBackend.flight)
+
+    @patch('src.service.osm_data_backend.configure_overpass_cache')
+    def test_unpickling_configures_overpass_cache(self, mock_configure):
+        overpass_cache = DiskCache(os.path.join(self.folder.name, 'overpass'))
+        backend = CoalescingOSMDataBackend(backend=self.extract, overpass_cache=overpass_cache)
+
+        pickle.loads(pickle.dumps(backend))
+
+        self.assertEqual(mock_configure.call_count, 2)
+        self.assertEqual(mock_configure.call_args.args[0].folder, overpass_cache.folder)
+
+
+class TestConfigureOverpassCache(unittest.TestCase):
+
+    def test_points_osmnx_at_folder_and_prunes(self):
+        import osmnx as ox
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        previous = ox.settings.use_cache, ox.settings.cache_folder
+        self.addCleanup(lambda: setattr(ox.settings, 'cache_folder', previous[1]))
+        self.addCleanup(lambda: setattr(ox.settings, 'use_cache', previous[0]))
+        response = os.path.join(folder.name, 'response.json')
+        with open(response, 'w') as file:
+            file.write('{}')
+        old = time.time() - 120
+        os.utime(response, (old, old))
+
+        configure_overpass_cache(DiskCache(folder.name, ttl=60))
+
+        self.assertTrue(ox.settings.use_cache)
+        self.assertEqual(ox.settings.cache_folder, folder.name)
+        self.assertFalse(os.path.exists(response))
+
+
+class TestGetOSMDataBackend(unittest.TestCase):
+
+    @patch('src.service.osm_data_backend.get_shared_session')
+    @patch('src.service.osm_data_backend.OsmApi')
+    def test_api_backend(self, mock_osm_api, mock_get_shared_session):
+        settings = MagicMock(osm_backend='api', username='user', password='pass', osm_cache_ttl=0)
+
+        backend = get_osm_data_backend(settings)
+
+        self.assertIsInstance(backend, CoalescingOSMDataBackend)
+        self.assertIsInstance(backend.backend, OSMApiDataBackend)
+        self.assertIsNone(backend.cache)
+        mock_get_shared_session.assert_called_once_with(settings)
+        mock_osm_api.assert_called_once_with(username='user', password='pass',
+                                             session=mock_get_shared_session.return_value)
+
+    @patch('src.service.osm_data_backend.configure_overpass_cache')
+    @patch('src.service.osm_data_backend.get_shared_session')
+    @patch('src.service.osm_data_backend.OsmApi')
+    def test_api_backend_caches(self, mock_osm_api, mock_get_shared_session, mock_configure):
+        settings = MagicMock(osm_backend='api', username='user', password='pass',
+                             osm_cache_ttl=60, osm_cache_folder='/cache', osm_cache_max_mb=64)
+
+        backend = get_osm_data_backend(settings)
+
+        self.assertEqual(backend.cache.folder, os.path.join('/cache', 'osm-api'))
+        self.assertEqual(backend.cache.ttl, 60)
+        self.assertEqual(backend.cache.max_bytes, 64 * 1024 * 1024)
+        self.assertEqual(mock_configure.call_args.args[0].folder, os.path.join('/cache', 'overpass'))
+
+    @patch('src.service.osm_data_backend.OSMDataHandler')
+    def test_api_backend_without_session(self, mock_handler):
+        backend = OSMApiDataBackend(username='user', password='pass')
+
+        backend.get_way_history(osmid=1)
+
+        mock_handler.assert_called_once_with(username='user', password='pass')
+        mock_handler.return_value.get_way_history.assert_called_once_with(osmid=1)
+
+    def test_extract_backend(self):
+        settings = MagicMock(osm_backend='extract', osm_history_extract=f'{HISTORY_FILE}, {CHANGE_FILE}',
+                             osm_extract_tile_zoom=14, osm_cache_ttl=0)
+
+        backend = get_osm_data_backend(settings)
+
+        self.assertIsInstance(backend, OSMHistoryExtractBackend)
+        self.assertEqual(len(backend.get_way_history(osmid=301)), 3)
+
+    def test_extract_backend_without_files(self):
+        settings = MagicMock(osm_backend='extract', osm_history_extract='', osm_cache_ttl=0)
+
+        with self.assertRaises(ValueError):
+            get_osm_data_backend(settings)
+
+    def test_unknown_backend(self):
+        settings = MagicMock(osm_backend='overpass')
+
+        with self.assertRaises(ValueError):
+            get_osm_data_backend(settings)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+import os
+import pickle
+import tempfile
+import unittest
+import multiprocessing
+from unittest.mock import MagicMock, patch
+import requests
+from src.service import osm_session
+from src.service.osm_session import TokenBucket, AdaptiveConcurrencyLimiter, RateLimitedSession, \
+    SharedLimiterState, SharedTokenBucket, SharedConcurrencyLimiter, get_shared_session
+
+
+def make_response(status_code, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    return response
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_wait(self):
+        bucket = TokenBucket(rate=1, capacity=2)
+
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertGreater(bucket.try_acquire(), 0)
+
+    def test_set_rate(self):
+        bucket = TokenBucket(rate=1, capacity=1)
+        bucket.set_rate(4)
+
+        self.assertEqual(bucket.rate, 4)
+
+
+class TestAdaptiveConcurrencyLimiter(unittest.TestCase):
+
+    def test_additive_increase(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=2, minimum=1, maximum=3, latency_target=1)
+
+        for _ in range(2):
+            limiter.acquire()
+            limiter.release(latency=0.1)
+
+        self.assertEqual(limiter.limit, 3)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_multiplicative_decrease(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=4, minimum=1, maximum=8, latency_target=1)
+
+        limiter.acquire()
+        limiter.release(latency=0.1, throttled=True)
+        self.assertEqual(limiter.limit, 2)
+
+        limiter.acquire()
+        limiter.release(latency=5)
+        self.assertEqual(limiter.limit, 1)
+
+
+def take_token(path, results):
+    results.put(SharedTokenBucket(SharedLimiterState(path), rate=0.001, capacity=2).try_acquire())
+
+
+class TestSharedLimiters(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.state = SharedLimiterState(os.path.join(self.folder.name, 'limiter.json'))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_buckets_share_tokens(self):
+        first = SharedTokenBucket(self.state, rate=0.001, capacity=2)
+        second = SharedTokenBucket(SharedLimiterState(self.state.path), rate=0.001, capacity=2)
+
+        self.assertEqual(first.try_acquire(), 0)
+        self.assertEqual(second.try_acquire(), 0)
+        self.assertGreater(first.try_acquire(), 0)
+        self.assertGreater(second.try_acquire(), 0)
+
+    def test_bucket_shared_with_other_process(self):
+        bucket = SharedTokenBucket(self.state, rate=0.001, capacity=2)
+        bucket.try_acquire()
+        results = multiprocessing.get_context('spawn').Queue()
+        process = multiprocessing.get_context('spawn').Process(target=take_token, args=(self.state.path, results))
+        process.start()
+        process.join(timeout=60)
+
+        self.assertEqual(results.get(timeout=5), 0)
+        self.assertGreater(bucket.try_acquire(), 0)
+
+    def test_update_rate(self):
+        first = SharedTokenBucket(self.state, rate=2, capacity=2)
+        second = SharedTokenBucket(self.state, rate=2, capacity=2)
+        first.update_rate(lambda rate: rate / 2)
+        second.update_rate(lambda rate: rate / 2)
+
+        self.assertEqual(first.rate, 0.5)
+
+    def test_limiters_share_in_flight(self):
+        first = SharedConcurrencyLimiter(self.state, initial=2, minimum=1, maximum=4, latency_target=1)
+        second = SharedConcurrencyLimiter(self.state, initial=2, minimum=1, maximum=4, latency_target=1)
+        first.acquire()
+        second.acquire()
+
+        self.assertEqual(first.in_flight, 2)
+        second.release(latency=5)
+        self.assertEqual(first.limit, 1)
+        self.assertEqual(first.in_flight, 1)
+
+    def test_limiter_drops_exited_processes(self):
+        with self.state.update() as state:
+            state['limiter'] = {'limit': 1, 'successes': 0, 'in_flight': {'999999999': 1}}
+        limiter = SharedConcurrencyLimiter(self.state, initial=1, minimum=1, maximum=1, latency_target=1)
+        limiter.acquire()
+
+        self.assertEqual(limiter.in_flight, 1)
+
+    def test_session_with_limiter_file(self):
+        session = RateLimitedSession(rate=1, max_rate=4, max_concurrency=2, limiter_file=self.state.path)
+
+        self.assertIsInstance(session.bucket, SharedTokenBucket)
+        session._adjust_rate(throttled=True)
+        self.assertEqual(RateLimitedSession(limiter_file=self.state.path).bucket.rate, 0.5)
+
+
+class TestRateLimitedSession(unittest.TestCase):
+
+    def setUp(self):
+        self.session = RateLimitedSession(rate=100, max_rate=200, max_concurrency=4, max_retries=2)
+
+    @patch('src.service.osm_session.time.sleep')
+    @patch('requests.Session.request')
+    def test_retries_throttled_requests(self, mock_request, mock_sleep):
+        mock_request.side_effect = [make_response(429, {'Retry-After': '3'}), make_response(200)]
+
+        response = self.session.request('GET', 'https://api.openstreetmap.org/api/0.6/way/1/history')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_request.call_count, 2)
+        mock_sleep.assert_called_once_with(3.0)
+        self.assertEqual(self.session.bucket.rate, 50.1)
+
+    @patch('src.service.osm_session.time.sleep')
+    @patch('requests.Session.request')
+    def test_returns_last_response_after_retries(self, mock_request, mock_sleep):
+        mock_request.return_value = make_response(503)
+
+        response = self.session.request('GET', 'https://api.openstreetmap.org/api/0.6/way/1/history')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(mock_request.call_count, 3)
+
+    @patch('src.service.osm_session.time.sleep')
+    @patch('requests.Session.request')
+    def test_raises_connection_error_after_retries(self, mock_request, mock_sleep):
+        mock_request.side_effect = requests.ConnectionError('reset')
+
+        with self.assertRaises(requests.ConnectionError):
+            self.session.request('GET', 'https://api.openstreetmap.org/api/0.6/way/1/history')
+
+    @patch('requests.Session.request')
+    def test_unexpected_error_releases_the_slot(self, mock_request):
+        mock_request.side_effect = requests.exceptions.InvalidURL('bad url')
+
+        for _ in range(self.session.limiter.limit + 1):
+            with self.assertRaises(requests.exceptions.InvalidURL):
+                self.session.request('GET', 'https://api.openstreetmap.org/api/0.6/way/1/history')
+
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(self.session.limiter.in_flight, 0)
+
+    def test_backoff_is_capped(self):
+        for attempt in range(20):
+            self.assertLessEqual(self.session.backoff(attempt), self.session.backoff_cap)
+
+
+class TestGetSharedSession(unittest.TestCase):
+
+    def tearDown(self):
+        osm_session._shared_session = None
+
+    def test_shared_session(self):
+        osm_session._shared_session = None
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        settings = MagicMock(osm_api_rate_limit=1, osm_api_max_rate_limit=5, osm_api_max_concurrency=2,
+                             osm_api_latency_target=1, osm_api_max_retries=1, osm_api_pool_size=2,
+                             osm_api_limiter_file=os.path.join(folder.name, 'limiter.json'))
+
+        session = get_shared_session(settings)
+
+        self.assertIs(get_shared_session(), session)
+        self.assertIs(pickle.loads(pickle.dumps(session)), session)
+        self.assertEqual(session.limiter.maximum, 2)
+        self.assertIsInstance(session.limiter, SharedConcurrencyLimiter)
+        osm_session._shared_session = None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,20 @@
 import os
 import zipfile
+import shutil
 import unittest
 from tempfile import TemporaryDirectory
 from unittest.mock import patch, MagicMock, mock_open
+import shapely
+import geopandas as gpd
+from shapely.geometry import Point, Polygon, MultiPolygon
+from src.config import Settings
 from src.service.osw_confidence_metric_calculator import OSWConfidenceMetricCalculator
+from src.service.anytime_analyzer import AreaScoreEstimate
+from src.service.job_cancellation import CancellationToken, JobCancelledError
+from src.service.dataset_cache import DatasetCache
+from src.service.job_sharding import plan_shards
+from src.service.osm_data_backend import CoalescingOSMDataBackend
+from src.service.single_flight import DiskCache
 
 
 def create_sample_inputs(zip_file_path, sub_regions_file_path):
@@ -75,6 +86,465 @@ class TestOSWConfidenceMetric(unittest.TestCase):
         # Assertions
         self.assertEqual(one_conf_score, 0.75)
 
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=True)
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_resumes_from_checkpoint(self, mock_score_calculation, mock_is_valid_geojson):
+        checkpoint = MagicMock()
+        checkpoint.hull_score = 0.5
+        checkpoint.get_sub_region_score.return_value = (True, 0.25)
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path,
+                                                          checkpoint=checkpoint)
+
+        confidence_scores = confidence_metric.calculate_score()
+
+        mock_score_calculation.assert_not_called()
+        self.assertEqual([feature['properties']['confidence_score'] for feature in confidence_scores['features']],
+                         [0.5, 0.25])
+        checkpoint.close.assert_called_once()
+
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=True)
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_records_checkpoint(self, mock_score_calculation, mock_is_valid_geojson):
+        mock_score_calculation.return_value = 0.75
+        checkpoint = MagicMock()
+        checkpoint.hull_score = None
+        checkpoint.get_sub_region_score.return_value = (False, None)
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path,
+                                                          checkpoint=checkpoint)
+
+        confidence_metric.calculate_score()
+
+        checkpoint.set_hull_score.assert_called_once_with(0.75)
+        checkpoint.record_sub_region.assert_called_once_with(0, 0.75)
+
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=True)
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_reports_progress(self, mock_score_calculation, mock_is_valid_geojson):
+        mock_score_calculation.return_value = 0.75
+        progress_reporter = MagicMock()
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path,
+                                                          progress_reporter=progress_reporter)
+
+        confidence_metric.calculate_score()
+
+        completed, total, snapshot_fn = progress_reporter.update.call_args.args
+        self.assertEqual((completed, total), (1, 1))
+        snapshot = snapshot_fn()
+        self.assertEqual([feature['properties']['confidence_score'] for feature in snapshot['features']],
+                         [0.75, 0.75])
+
+    def test_progress_snapshot_is_taken_when_published(self):
+        progress_reporter = MagicMock()
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id, progress_reporter=progress_reporter)
+        sub_regions = self._sample_sub_regions()
+        completed = {0: 0.5}
+
+        confidence_metric._report_progress(0.75, sub_regions, completed)
+        completed[2] = 0.25
+
+        snapshot_fn = progress_reporter.update.call_args.args[2]
+        self.assertEqual(progress_reporter.update.call_args.args[:2], (1, 4))
+        self.assertEqual([feature['properties']['confidence_score'] for feature in snapshot_fn()['features']],
+                         [0.75, 0.5, 0.25])
+
+    def _sample_sub_regions(self):
+        square = Polygon([(0, 0), (1, 0), (1, 1), (0, 1)])
+        bowtie = Polygon([(0, 0), (1, 1), (1, 0), (0, 1)])
+        return gpd.GeoDataFrame(geometry=[square, MultiPolygon([square, Polygon([(2, 2), (3, 2), (3, 3)])]),
+                                          bowtie, Point(0, 0)], crs='EPSG:4326')
+
+    def test_classify_sub_regions(self):
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id)
+        confidence_metric.settings.repair_sub_regions = False
+
+        sub_regions_gdf = confidence_metric.classify_sub_regions(self._sample_sub_regions())
+
+        self.assertEqual(sub_regions_gdf['scorable'].tolist(), [True, True, False, False])
+
+    def test_classify_sub_regions_repairs_invalid(self):
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id)
+        confidence_metric.settings.repair_sub_regions = True
+
+        sub_regions_gdf = confidence_metric.classify_sub_regions(self._sample_sub_regions())
+
+        self.assertEqual(sub_regions_gdf['scorable'].tolist(), [True, True, True, False])
+        self.assertEqual(sub_regions_gdf.geom_type.iloc[2], 'MultiPolygon')
+
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=True)
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_multipolygon_sub_regions(self, mock_score_calculation, mock_is_valid_geojson):
+        mock_score_calculation.return_value = 0.5
+        self._sample_sub_regions().to_file(self.sub_region_file_path, driver='GeoJSON')
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path)
+        confidence_metric.settings.repair_sub_regions = False
+
+        results = confidence_metric.calculate_score()
+
+        self.assertEqual([feature['properties']['confidence_score'] for feature in results['features']],
+                         [0.5, 0.5, 0.5, None, None])
+        self.assertNotIn('scorable', results['features'][1]['properties'])
+        self.assertEqual(mock_score_calculation.call_count, 3)
+
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=True)
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_with_shard_scores(self, mock_score_calculation, mock_is_valid_geojson):
+        mock_score_calculation.return_value = 0.5
+        self._sample_sub_regions().to_file(self.sub_region_file_path, driver='GeoJSON')
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path)
+        confidence_metric.settings.sub_region_order = 'file'
+
+        results = confidence_metric.calculate_score(sub_region_scores=lambda: [0.1, 0.2, 0.3, None])
+
+        # Only the hull is scored here, the sub-region scores come from the shards
+        self.assertEqual([feature['properties']['confidence_score'] for feature in results['features']],
+                         [0.5, 0.1, 0.2, 0.3, None])
+        mock_score_calculation.assert_called_once()
+
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_score_sub_region_range(self, mock_score_calculation):
+        mock_score_calculation.return_value = 0.5
+        self._sample_sub_regions().to_file(self.sub_region_file_path, driver='GeoJSON')
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path)
+        confidence_metric.settings.repair_sub_regions = False
+        confidence_metric.settings.sub_region_order = 'file'
+
+        self.assertEqual(confidence_metric.score_sub_region_range(1, 3), [0.5, None])
+        mock_score_calculation.assert_called_once()
+
+    def _scattered_sub_regions(self):
+        # File order alternates between two places far apart
+        return gpd.GeoDataFrame(geometry=[Polygon([(x, 0), (x + 1, 0), (x + 1, 1), (x, 1)])
+                                          for x in (0, 100, 2, 102, 4, 104)], crs='EPSG:4326')
+
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=True)
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_in_locality_order(self, mock_score_calculation, mock_is_valid_geojson):
+        scored_x = []
+
+        def score_by_position(file_path):
+            geometry = shapely.from_geojson(open(file_path).read())
+            if geometry.bounds[0] < 0:  # The dataset hull
+                return 1.0
+            scored_x.append(geometry.bounds[0])
+            return geometry.bounds[0] / 1000
+        mock_score_calculation.side_effect = score_by_position
+        self._scattered_sub_regions().to_file(self.sub_region_file_path, driver='GeoJSON')
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path)
+        confidence_metric.settings.sub_region_order = 'hilbert'
+
+        results = confidence_metric.calculate_score()
+
+        # Neighbours are scored one after another, the results keep the file order
+        self.assertEqual(sorted(scored_x[:3]), [0, 2, 4] if scored_x[0] < 50 else [100, 102, 104])
+        self.assertEqual([feature['properties']['confidence_score'] for feature in results['features'][1:]],
+                         [0, 0.1, 0.002, 0.102, 0.004, 0.104])
+
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=True)
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_shards_take_neighbouring_sub_regions(self, mock_score_calculation, mock_is_valid_geojson):
+        mock_score_calculation.side_effect = lambda file_path: shapely.from_geojson(open(file_path).read()).bounds[0]
+        self._scattered_sub_regions().to_file(self.sub_region_file_path, driver='GeoJSON')
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path)
+        confidence_metric.settings.sub_region_order = 'zorder'
+
+        shards = [confidence_metric.score_sub_region_range(0, 3), confidence_metric.score_sub_region_range(3, 6)]
+        results = confidence_metric.calculate_score(sub_region_scores=lambda: shards[0] + shards[1])
+
+        self.assertEqual(sorted(map(sorted, shards)), [[0, 2, 4], [100, 102, 104]])
+        self.assertEqual([feature['properties']['confidence_score'] for feature in results['features'][1:]],
+                         [0, 100, 2, 102, 4, 104])
+
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=True)
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_shards_score_their_own_sub_regions(self, mock_score_calculation, mock_is_valid_geojson):
+        mock_score_calculation.side_effect = lambda file_path: shapely.from_geojson(open(file_path).read()).bounds[0]
+        self._scattered_sub_regions().to_file(self.sub_region_file_path, driver='GeoJSON')
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path)
+        confidence_metric.settings.sub_region_order = 'zorder'
+
+        order, paths = confidence_metric.write_shard_inputs(plan_shards(6, 3))
+        shards = []
+        for index, path in enumerate(paths):
+            # A shard has neither the dataset nor the other sub-regions
+            shard_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=None,
+                                                         job_id=f'{self.job_id}-shard-{index}', sub_regions_file=path)
+            shards.append(shard_metric.score_shard())
+        results = confidence_metric.calculate_score(sub_region_scores=lambda: shards[0] + shards[1])
+
+        self.assertEqual(len(gpd.read_file(paths[0])), 3)
+        self.assertEqual(sorted(map(sorted, shards)), [[0, 2, 4], [100, 102, 104]])
+        self.assertEqual(sorted(order), list(range(6)))
+        self.assertEqual([feature['properties']['confidence_score'] for feature in results['features'][1:]],
+                         [0, 100, 2, 102, 4, 104])
+
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=False)
+    def test_invalid_sub_regions_are_not_split(self, mock_is_valid_geojson):
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path)
+
+        self.assertIsNone(confidence_metric.write_shard_inputs([(0, 1)]))
+
+    def test_locality_order_reuses_cached_histories(self):
+        # Squares sharing their borders, alternating in the file between two places far apart
+        sub_regions = gpd.GeoDataFrame(geometry=[Polygon([(x, 0), (x + 1, 0), (x + 1, 1), (x, 1)])
+                                                 for x in (0, 100, 1, 101, 2, 102)], crs='EPSG:4326')
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id)
+        fetches = {}
+        for order in ('file', 'hilbert'):
+            confidence_metric.settings.sub_region_order = order
+            positions = confidence_metric.order_sub_regions(sub_regions)
+            inner = MagicMock()
+            inner.get_way_history.side_effect = lambda osmid: {1: {'id': osmid}}
+            for start, end in plan_shards(len(positions), 3):
+                # Every shard runs on its own replica, with its own cache, and fetches the ways on the borders
+                cache_folder = TemporaryDirectory()
+                self.addCleanup(cache_folder.cleanup)
+                backend = CoalescingOSMDataBackend(backend=inner, cache=DiskCache(cache_folder.name))
+                for index in positions[start:end]:
+                    min_x, _, max_x, _ = sub_regions.geometry.iloc[index].bounds
+                    for border in range(int(min_x), int(max_x) + 1):
+                        backend.get_way_history(border)
+            fetches[order] = inner.get_way_history.call_count
+
+        self.assertEqual(fetches, {'file': 10, 'hilbert': 8})
+
+    def test_given_settings_backend_and_analyzer(self):
+        settings = Settings(simplify_tolerance=0, sub_region_scoring='analyzer')
+        backend = MagicMock()
+        analyzer_class = MagicMock()
+        analyzer_class.return_value.calculate_area_confidence_score.return_value = 0.5
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path,
+                                                          settings=settings, osm_data_handler=backend,
+                                                          area_analyzer_class=analyzer_class,
+                                                          validate_geojson=lambda file_path: True)
+
+        results = confidence_metric.calculate_score()
+
+        self.assertIs(confidence_metric.settings, settings)
+        analyzer_class.assert_called_with(osm_data_handler=backend)
+        self.assertEqual([feature['properties']['confidence_score'] for feature in results['features']], [0.5, 0.5])
+
+    def test_get_query_hull(self):
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id)
+        confidence_metric.settings.simplify_tolerance = 0
+        self.assertEqual(confidence_metric.get_query_hull(), confidence_metric.convex_file)
+
+        confidence_metric.settings.simplify_tolerance = 2
+        query_hull = gpd.read_file(confidence_metric.get_query_hull())
+        hull = gpd.read_file(confidence_metric.convex_file)
+
+        self.assertTrue(query_hull.geometry.iloc[0].buffer(1e-9).contains(hull.geometry.iloc[0]))
+
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=True)
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_keeps_original_sub_region_geometry(self, mock_score_calculation, mock_is_valid_geojson):
+        mock_score_calculation.return_value = 0.5
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path)
+        confidence_metric.settings.simplify_tolerance = 10
+        original = gpd.read_file(self.sub_region_file_path).geometry.iloc[0]
+
+        results = confidence_metric.calculate_score()
+
+        self.assertTrue(gpd.GeoDataFrame.from_features(results['features']).geometry.iloc[1].equals_exact(original, 1e-9))
+
+    @patch('src.service.osw_confidence_metric_calculator.ContributionIndex')
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=True)
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_with_contribution_index(self, mock_score_calculation, mock_is_valid_geojson,
+                                                     mock_index):
+        mock_score_calculation.return_value = 0.5
+        mock_index.from_osm.return_value.score.return_value = [0.25, 0.75, 0.125]
+        self._sample_sub_regions().to_file(self.sub_region_file_path, driver='GeoJSON')
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path)
+        confidence_metric.settings.repair_sub_regions = True
+        confidence_metric.settings.sub_region_scoring = 'index'
+
+        results = confidence_metric.calculate_score()
+
+        # Only the hull goes through the analyzer; the three polygonal sub-regions come from one index
+        mock_score_calculation.assert_called_once()
+        mock_index.from_osm.assert_called_once()
+        self.assertEqual(len(mock_index.from_osm.return_value.score.call_args.args[0]), 3)
+        self.assertEqual([feature['properties']['confidence_score'] for feature in results['features']],
+                         [0.5, 0.25, 0.75, 0.125, None])
+
+    @patch('src.service.osw_confidence_metric_calculator.ContributionIndex')
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_with_grid(self, mock_score_calculation, mock_index):
+        mock_score_calculation.return_value = 0.5
+        mock_index.from_osm.return_value.score.side_effect = lambda cells: [0.25] * len(cells)
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id, grid_cell_size=100)
+
+        results = confidence_metric.calculate_score()
+
+        cells = results['features'][1:]
+        mock_index.from_osm.assert_called_once()
+        self.assertGreater(len(cells), 1)
+        self.assertTrue(all(cell['properties']['confidence_score'] == 0.25 for cell in cells))
+        self.assertEqual(cells[0]['properties']['grid_cell_size'], 100)
+        self.assertEqual(len({(cell['properties']['grid_col'], cell['properties']['grid_row']) for cell in cells}),
+                         len(cells))
+
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=True)
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_scores_format(self, mock_score_calculation, mock_is_valid_geojson):
+        mock_score_calculation.side_effect = [0.5, 0.25]
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path,
+                                                          response_format='scores')
+
+        results = confidence_metric.calculate_score()
+
+        # Only the hull geometry is returned, the sub-region is referenced by its index
+        self.assertEqual(len(results['features']), 1)
+        self.assertEqual(results['features'][0]['properties'], {'confidence_score': 0.5})
+        self.assertEqual(results['scores'], [{'index': 0, 'confidence_score': 0.25}])
+
+    @patch('src.service.osw_confidence_metric_calculator.ContributionIndex')
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_scores_format_with_grid(self, mock_score_calculation, mock_index):
+        mock_score_calculation.return_value = 0.5
+        mock_index.from_osm.return_value.score.side_effect = lambda cells: [0.25] * len(cells)
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id, grid_cell_size=100,
+                                                          response_format='scores')
+
+        results = confidence_metric.calculate_score()
+
+        self.assertEqual(len(results['features']), 1)
+        self.assertEqual(results['grid']['cell_size'], 100)
+        self.assertTrue(results['grid']['crs'].startswith('EPSG:326'))
+        self.assertGreater(len(results['grid_scores']), 1)
+        self.assertEqual(set(results['grid_scores'][0]), {'grid_col', 'grid_row', 'confidence_score'})
+
+    def test_sub_region_scores_keep_feature_ids(self):
+        sub_regions_gdf = gpd.GeoDataFrame({'id': ['a', None], 'confidence_score': [0.25, None]},
+                                           geometry=[Point(0, 0), Point(1, 1)])
+
+        scores = OSWConfidenceMetricCalculator._sub_region_scores(sub_regions_gdf)
+
+        self.assertEqual(scores, [{'index': 0, 'id': 'a', 'confidence_score': 0.25},
+                                  {'index': 1, 'confidence_score': None}])
+
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_rounds_coordinates(self, mock_score_calculation):
+        mock_score_calculation.return_value = 0.5
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id, coordinate_precision=3)
+
+        results = confidence_metric.calculate_score()
+
+        coordinates = shapely.get_coordinates(shapely.geometry.shape(results['features'][0]['geometry']))
+        self.assertTrue((coordinates.round(3) == coordinates).all())
+
+    def test_reuses_cached_nodes_and_hull(self):
+        cache = DatasetCache(root=os.path.join(self.temp_dir.name, 'cache'), max_bytes=1024 * 1024)
+        download = lambda path: shutil.copyfile(self.zip_file_path, path)
+        first = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                              job_id=self.job_id,
+                                              cached_dataset=cache.fetch('url', 'etag-1', download))
+        second_path = os.path.join(self.temp_dir.name, 'second')
+        os.makedirs(second_path)
+
+        with patch.object(OSWConfidenceMetricCalculator, 'unzip_nodes_file') as mock_unzip, \
+                patch('src.service.osw_confidence_metric_calculator.compute_footprint') as mock_footprint:
+            second = OSWConfidenceMetricCalculator(output_path=second_path, zip_file=self.zip_file_path,
+                                                   job_id='5678',
+                                                   cached_dataset=cache.fetch('url', 'etag-1', download))
+
+        mock_unzip.assert_not_called()
+        mock_footprint.assert_not_called()
+        self.assertEqual(gpd.read_file(second.convex_file).geometry[0], gpd.read_file(first.convex_file).geometry[0])
+        self.assertEqual(cache.stats()['artifact_hits'], 2)
+
+    def test_rejects_unknown_response_format(self):
+        with self.assertRaises(ValueError):
+            OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                          job_id=self.job_id, response_format='compact')
+
+    @patch('src.service.osw_confidence_metric_calculator.AnytimeAreaAnalyzer')
+    def test_calculate_score_with_deadline(self, mock_analyzer):
+        mock_analyzer.return_value.estimate_area_confidence_score.return_value = \
+            AreaScoreEstimate(score=0.6, error=0.05, sampled=16, total=100)
+        checkpoint = MagicMock(hull_score=None)
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id, checkpoint=checkpoint,
+                                                          deadline_seconds=30)
+
+        results = confidence_metric.calculate_score()
+
+        self.assertEqual(results['features'][0]['properties'], {'confidence_score': 0.6, 'confidence_error': 0.05})
+        # An incomplete estimate is not checkpointed as the hull score
+        checkpoint.set_hull_score.assert_not_called()
+
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson', return_value=True)
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_calculate_score_stops_when_cancelled(self, mock_score_calculation, mock_is_valid_geojson):
+        token = CancellationToken(self.job_id)
+        mock_score_calculation.side_effect = lambda file_path: token.cancel() or 0.5
+        checkpoint = MagicMock(hull_score=None)
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path,
+                                                          checkpoint=checkpoint, cancellation=token)
+
+        with self.assertRaises(JobCancelledError):
+            confidence_metric.calculate_score()
+
+        # Cancelled while scoring the hull, so no sub-region is started
+        mock_score_calculation.assert_called_once()
+        checkpoint.record_sub_region.assert_not_called()
+
+    @patch('src.service.osw_confidence_metric_calculator.is_valid_geojson')
+    @patch('osw_confidence_metric.area_analyzer.AreaAnalyzer.calculate_area_confidence_score')
+    def test_score_features_without_zip(self, mock_score_calculation, mock_is_valid_geojson):
+        mock_score_calculation.return_value = 0.6
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=None,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path)
+
+        features = list(confidence_metric.score_features())
+
+        self.assertEqual(confidence_metric.nodes_file, self.sub_region_file_path)
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]['properties']['confidence_score'], 0.6)
+        self.assertEqual(features[0]['geometry']['type'], 'Polygon')
+        # Only the feature is scored, not the hull, and the schema is not fetched
+        mock_score_calculation.assert_called_once()
+        mock_is_valid_geojson.assert_not_called()
+
     def test_unzip_nodes_file(self):
         confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
                                                           job_id=self.job_id)
@@ -97,6 +567,38 @@ class TestOSWConfidenceMetric(unittest.TestCase):
         # Assertions
         self.assertEqual(convex_file, os.path.join(confidence_metric.output, f'{self.job_id}.geojson'))
 
+    def test_get_convex_hull_clustered(self):
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id)
+        confidence_metric.settings.footprint_mode = 'clustered'
+        confidence_metric.settings.footprint_cell_size = 100
+
+        hull = gpd.read_file(confidence_metric.get_convex_hull())
+        nodes = gpd.read_file(confidence_metric.nodes_file)
+        vertices = gpd.GeoSeries(shapely.points(shapely.get_coordinates(nodes.geometry.to_numpy())))
+
+        self.assertEqual(len(hull), 1)
+        self.assertTrue(vertices.within(hull.geometry.iloc[0]).all())
+
+    def test_get_hull_area_km2(self):
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id)
+
+        area = confidence_metric.get_hull_area_km2()
+
+        # The sample polygon is roughly 150m x 190m
+        self.assertAlmostEqual(area, 0.028, delta=0.005)
+
+    def test_count_sub_regions(self):
+        confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                          job_id=self.job_id,
+                                                          sub_regions_file=self.sub_region_file_path)
+        no_sub_regions = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
+                                                       job_id=self.job_id)
+
+        self.assertEqual(confidence_metric.count_sub_regions(), 1)
+        self.assertEqual(no_sub_regions.count_sub_regions(), 0)
+
     @patch('src.service.osw_confidence_metric_calculator.clean_up')
     def test_clean_up_files(self, mock_clean_up):
         confidence_metric = OSWConfidenceMetricCalculator(output_path=self.temp_path, zip_file=self.zip_file_path,
@@ -1,12 +1,22 @@
 import os
 import json
 import shutil
+import time
 import unittest
+import threading
 import python_ms_core
 from pathlib import Path
 import osw_confidence_metric
 from unittest.mock import Mock, MagicMock, patch
-from src.service.osw_confidence_service import OSWConfidenceService
+from python_ms_core.core.storage.providers.azure.azure_storage_client import AzureStorageClient
+from src.service.osw_confidence_service import RemoteFile, OSWConfidenceService, score_in_worker
+from src.service.job_cancellation import JobRegistry
+from src.service.job_workspace import WorkspaceManager
+from src.service.dataset_cache import DatasetCache
+from src.service.job_idempotency import IdempotencyGuard, LocalIdempotencyStore
+from src.service.job_sharding import JobSharder, LocalShardResultStore
+from src.service.job_scheduler import JobScheduler
+from src.service.job_profiler import JobProfiler
 from python_ms_core.core.queue.models.queue_message import QueueMessage
 from src.models.confidence_request import ConfidenceRequest
 from src.models.confidence_response import ConfidenceResponse, ResponseData
@@ -22,6 +32,10 @@ def create_sample_zip_file(test_zip_file_path):
     shutil.copy(ZIP_FILE_PATH, test_zip_file_path)
 
 
+def busy_score():
+    return sorted(range(1000))
+
+
 class TestOSWConfidenceService(unittest.TestCase):
 
     def setUp(self) -> None:
@@ -35,8 +49,32 @@ class TestOSWConfidenceService(unittest.TestCase):
             self.service.settings = MagicMock()
             self.service.settings.get_download_folder = MagicMock()
             self.service.settings.get_download_folder.return_value = DOWNLOAD_PATH
+            self.service.settings.job_timeout = 0
+            self.service.settings.profile_jobs = False
+            self.service.jobs = JobRegistry()
+            self.service.workspaces = WorkspaceManager(root=DOWNLOAD_PATH)
+            self.service.dataset_cache = DatasetCache(root=os.path.join(DOWNLOAD_PATH, 'cache'), max_bytes=0)
+            self.service.pipeline = None
+            self.service.checkpoint_store = None
+            self.service.idempotency = None
+            self.service.sharding = None
+            self.service.workers = None
             os.makedirs(DOWNLOAD_PATH, exist_ok=True)
 
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_create_calculator_passes_calculator_options(self, mock_calculator):
+        backend = MagicMock()
+        self.service.calculator_options = {'osm_data_handler': backend}
+
+        self.service.create_calculator(MagicMock())
+
+        self.assertIs(mock_calculator.call_args.kwargs['osm_data_handler'], backend)
+
+    def test_calculator_options_need_the_service_process(self):
+        with self.assertRaises(ValueError):
+            OSWConfidenceService(core=MagicMock(), settings=MagicMock(worker_processes=2),
+                                 calculator_options={'osm_data_handler': MagicMock()})
+
     @patch.object(OSWConfidenceService, 'subscribe')
     def test_start_listening(self, mock_subscribe):
         # Act
@@ -191,6 +229,31 @@ class TestOSWConfidenceServiceOther(unittest.TestCase):
         mock_settings.return_value.max_concurrent_messages = 10
         mock_settings.return_value.storage_container_name = 'test_container'
         mock_settings.return_value.simulate = 'YES'
+        mock_settings.return_value.small_job_cost = 50
+        mock_settings.return_value.fast_lane_size = 0
+        mock_settings.return_value.slow_lane_size = 1
+        mock_settings.return_value.job_cost_budget = 0
+        mock_settings.return_value.checkpoint_store = 'none'
+        mock_settings.return_value.job_timeout = 0
+        mock_settings.return_value.download_timeout = 0
+        mock_settings.return_value.get_download_folder.return_value = DOWNLOAD_PATH
+        mock_settings.return_value.disk_quota_mb = 0
+        mock_settings.return_value.disk_min_free_mb = 0
+        mock_settings.return_value.disk_wait_timeout = 0
+        mock_settings.return_value.workspace_expansion_factor = 4
+        mock_settings.return_value.memory_workspace_folder = ''
+        mock_settings.return_value.memory_workspace_max_job_mb = 0
+        mock_settings.return_value.profile_jobs = False
+        mock_settings.return_value.profile_store = 'local'
+        mock_settings.return_value.profile_top = 10
+        mock_settings.return_value.http_max_concurrent = 2
+        mock_settings.return_value.http_timeout = 60
+        mock_settings.return_value.http_max_features = 100
+        mock_settings.return_value.http_stream_threshold = 10
+        mock_settings.return_value.dataset_cache_mb = 0
+        mock_settings.return_value.dataset_cache_folder = ''
+        mock_settings.return_value.shard_size = 0
+        mock_settings.return_value.worker_processes = 0
 
         # Mock Core
         mock_core.return_value.get_topic.return_value = MagicMock()
@@ -264,12 +327,532 @@ class TestOSWConfidenceServiceOther(unittest.TestCase):
 
         mock_calculator.return_value.calculate_score.return_value = '{"type": "FeatureCollection", "features": [{"id": "0", "type": "Feature", "properties": {"confidence_score": 0.75}, "geometry": {"type": "Polygon", "coordinates": [[[-122.1322201, 47.63528], [-122.1378655, 47.6353141], [-122.1395176, 47.6355614], [-122.1431969, 47.6365115], [-122.1443805, 47.6385402], [-122.1469453, 47.6460242], [-122.1429792, 47.6495373], [-122.1403351, 47.6497278], [-122.1325839, 47.6498422],  [-122.1321999, 47.6496722], [-122.1321845, 47.6496558], [-122.1285859, 47.6378078], [-122.1322201, 47.63528]]]}}]}'
         mock_calculator.return_value.clean_up_files = MagicMock()
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.5
+        mock_calculator.return_value.count_sub_regions.return_value = 1
 
         # Act
         self.service.calculate_confidence(request_msg)
 
         # Assert
         self.service.send_response_message.assert_called_once()
+        self.assertTrue(self.service.send_response_message.call_args.kwargs['response'].data.success)
+
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_calculate_confidence_rejects_job_over_budget(self, mock_calculator):
+        # Arrange
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.download_single_file = MagicMock()
+        self.service.get_remote_file = MagicMock(return_value=RemoteFile('', size=10 * 1024 * 1024))
+        self.service.scheduler.cost_budget = 5
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=self.sample_message['data'])
+
+        # Act
+        self.service.calculate_confidence(request_msg)
+
+        # Assert
+        response = self.service.send_response_message.call_args.kwargs['response']
+        self.assertFalse(response.data.success)
+        self.assertIn('exceeds the budget', response.data.message)
+        self.service.download_single_file.assert_not_called()
+        mock_calculator.assert_not_called()
+
+    def test_process_replays_redelivered_message(self):
+        # Arrange
+        folder = os.path.join(DOWNLOAD_PATH, 'idempotency')
+        self.addCleanup(shutil.rmtree, folder, True)
+        self.service.idempotency = IdempotencyGuard(LocalIdempotencyStore(folder))
+        self.addCleanup(self.service.idempotency.stop)
+        self.service.send_response_message = MagicMock()
+        response = ConfidenceResponse(messageId='1234', messageType='confidence', data=ResponseData(
+            jobId='1234', confidence_scores={'type': 'FeatureCollection', 'features': []},
+            confidence_library_version='1', status='finished', message='Processed successfully',
+            success=True).__dict__)
+        self.service.calculate_confidence = MagicMock(return_value=MagicMock(is_success=True, response=response))
+        msg = QueueMessage.data_from(TEST_DATA)
+
+        # Act
+        self.service.process(msg)
+        self.service.process(msg)
+
+        # Assert
+        self.service.calculate_confidence.assert_called_once()
+        replayed = self.service.send_response_message.call_args.args[0]
+        self.assertEqual(replayed.data.confidence_scores, response.data.confidence_scores)
+        self.assertEqual(replayed.messageId, msg.messageId)
+
+    def test_process_drops_redelivered_split_job_until_merged(self):
+        # Arrange
+        folder = os.path.join(DOWNLOAD_PATH, 'idempotency')
+        self.addCleanup(shutil.rmtree, folder, True)
+        self.service.idempotency = IdempotencyGuard(LocalIdempotencyStore(folder))
+        self.addCleanup(self.service.idempotency.stop)
+        self.service.send_response_message = MagicMock()
+        self.service.calculate_confidence = MagicMock(
+            return_value=MagicMock(is_success=True, response=None, shard_order=[0, 1, 2]))
+        msg = QueueMessage.data_from(TEST_DATA)
+
+        # Act
+        self.service.process(msg)
+        self.service.process(msg)
+        self.service.send_response_message.assert_not_called()
+        self.service.publish_merged_result({'messageId': msg.messageId, 'messageType': msg.messageType,
+                                            'jobId': msg.data['jobId'], 'progressive': False},
+                                           True, {'type': 'FeatureCollection', 'features': []}, '')
+        self.service.process(msg)
+
+        # Assert
+        self.service.calculate_confidence.assert_called_once()
+        self.assertEqual(self.service.send_response_message.call_count, 2)
+        replayed = self.service.send_response_message.call_args.args[0]
+        self.assertEqual(replayed.data.confidence_scores, {'type': 'FeatureCollection', 'features': []})
+
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_calculate_confidence_splits_large_job(self, mock_calculator):
+        # Arrange
+        folder = os.path.join(DOWNLOAD_PATH, 'shards')
+        self.addCleanup(shutil.rmtree, folder, True)
+        store = LocalShardResultStore(folder)
+        publish = MagicMock()
+        self.service.sharding = JobSharder(store, publish, self.service.publish_merged_result, shard_size=2)
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.download_single_file = MagicMock()
+        self.service.scheduler.slot = MagicMock()
+        input_paths = []
+        for index in range(3):
+            input_paths.append(os.path.join(DOWNLOAD_PATH, f'1234_shard_{index}.geojson'))
+            Path(input_paths[-1]).write_text('{}')
+            self.addCleanup(os.remove, input_paths[-1])
+        mock_calculator.return_value.count_sub_regions.return_value = 5
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.5
+        mock_calculator.return_value.write_shard_inputs.return_value = ([4, 3, 2, 1, 0], input_paths)
+        mock_calculator.return_value.calculate_score.side_effect = lambda sub_region_scores=None: {
+            'type': 'FeatureCollection',
+            'features': [{'properties': {'confidence_score': 0.9}}] +
+                        [{'properties': {'confidence_score': score}} for score in sub_region_scores()]}
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=self.sample_message['data'])
+
+        # Act
+        job = self.service.calculate_confidence(request_msg)
+
+        # Assert
+        self.assertTrue(job.is_success)
+        self.assertEqual([call.args[0]['data']['jobId'] for call in publish.call_args_list],
+                         ['1234-shard-0', '1234-shard-1', '1234-shard-2'])
+        mock_calculator.return_value.write_shard_inputs.assert_called_once_with([(0, 2), (2, 4), (4, 5)])
+        # The job is answered by the merge, not while its message is held
+        self.service.send_response_message.assert_not_called()
+        self.assertEqual(self.service.scheduler.slot.call_args.args[0].sub_region_count, 0)
+        for index, scores in enumerate([[0.0, 0.1], [0.2, 0.3], [0.4]]):
+            self.service.sharding.report(ConfidenceRequest(**publish.call_args_list[index].args[0]), True, scores)
+        response = self.service.send_response_message.call_args.kwargs['response']
+        self.assertTrue(response.data.success)
+        self.assertEqual(response.messageId, self.sample_message['messageId'])
+        self.assertEqual([feature['properties']['confidence_score']
+                          for feature in response.data.confidence_scores['features']], [0.9, 0.4, 0.3, 0.2, 0.1, 0.0])
+        self.assertFalse(os.path.exists(os.path.join(folder, '1234')))
+
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_calculate_confidence_of_shard_reports_scores(self, mock_calculator):
+        # Arrange
+        folder = os.path.join(DOWNLOAD_PATH, 'shards')
+        self.addCleanup(shutil.rmtree, folder, True)
+        store = LocalShardResultStore(folder)
+        store.save_input('1234', 1, b'{"type": "FeatureCollection", "features": []}')
+        self.service.sharding = JobSharder(store, MagicMock(), MagicMock(), shard_size=2)
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.get_remote_file = MagicMock()
+        self.service.download_single_file = MagicMock()
+        mock_calculator.return_value.score_shard.return_value = [0.5, None]
+        message = JobSharder.shard_message(ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                                             messageId=self.sample_message['messageId'],
+                                                             data=self.sample_message['data']), 1, 2, 4)
+
+        # Act
+        self.service.calculate_confidence(ConfidenceRequest(**message))
+
+        # Assert
+        # A shard downloads neither the dataset nor the whole sub-regions file
+        self.service.get_remote_file.assert_not_called()
+        self.service.download_single_file.assert_not_called()
+        kwargs = mock_calculator.call_args.kwargs
+        self.assertIsNone(kwargs['zip_file'])
+        self.assertTrue(kwargs['sub_regions_file'].endswith('1234-shard-1_subregions.geojson'))
+        mock_calculator.return_value.score_shard.assert_called_once_with()
+        mock_calculator.return_value.calculate_score.assert_not_called()
+        self.service.send_response_message.assert_not_called()
+        self.assertEqual(store.load('1234', '1'), {'success': True, 'scores': [0.5, None], 'message': ''})
+
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_calculate_confidence_in_worker_process(self, mock_calculator):
+        # Arrange
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.download_single_file = MagicMock()
+        self.service.scheduler.slot = MagicMock()
+        calls = []
+
+        def run(target, args, on_call, token):
+            calls.append(on_call('plan', 1.5, 3))
+            on_call('progress', 0.5, {'features': []})
+            return {'type': 'FeatureCollection', 'features': []}
+        self.service.workers = MagicMock()
+        self.service.workers.run.side_effect = run
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=dict(self.sample_message['data'], grid_cell_size=100))
+
+        # Act
+        self.service.calculate_confidence(request_msg)
+
+        # Assert
+        mock_calculator.assert_not_called()
+        target, (spec,) = self.service.workers.run.call_args.args
+        self.assertIs(target, score_in_worker)
+        self.assertEqual(spec['calculator']['grid_cell_size'], 100)
+        self.assertEqual(calls, [None])
+        estimate = self.service.scheduler.slot.call_args.args[0]
+        self.assertEqual((estimate.hull_area_km2, estimate.sub_region_count), (1.5, 3))
+        responses = [call.kwargs['response'] for call in self.service.send_response_message.call_args_list]
+        self.assertEqual([response.data.status for response in responses], ['in-progress', 'finished'])
+        self.assertTrue(responses[-1].data.success)
+
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_score_in_worker(self, mock_calculator):
+        # Arrange
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.5
+        mock_calculator.return_value.count_sub_regions.return_value = 3
+        mock_calculator.return_value.calculate_score.return_value = {'features': []}
+        call = MagicMock(return_value=None)
+        spec = {'job_id': '1234', 'timeout': 0, 'calculator': {'output_path': DOWNLOAD_PATH, 'zip_file': 'osw.zip',
+                                                               'job_id': '1234'},
+                'checkpoint': None, 'progressive': False, 'cached_dataset': None, 'shard': None}
+
+        # Act
+        scores = score_in_worker(spec, call=call)
+
+        # Assert
+        self.assertEqual(scores, {'features': []})
+        call.assert_called_once_with('plan', 1.5, 3)
+        mock_calculator.return_value.calculate_score.assert_called_once_with()
+
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_score_in_worker_splits_job(self, mock_calculator):
+        # Arrange
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.5
+        mock_calculator.return_value.count_sub_regions.return_value = 3
+        mock_calculator.return_value.write_shard_inputs.return_value = ([2, 0, 1], ['0.geojson', '1.geojson'])
+        mock_calculator.return_value.calculate_score.side_effect = \
+            lambda sub_region_scores=None: {'sub_region_scores': sub_region_scores()}
+        call = MagicMock(side_effect=lambda name, *args: [(0, 2), (2, 3)] if name == 'plan' else None)
+        spec = {'job_id': '1234', 'timeout': 0, 'calculator': {'output_path': DOWNLOAD_PATH, 'zip_file': 'osw.zip',
+                                                               'job_id': '1234'},
+                'checkpoint': None, 'progressive': False, 'cached_dataset': None, 'shard': None}
+
+        # Act
+        scores = score_in_worker(spec, call=call)
+
+        # Assert
+        call.assert_any_call('split', [(0, 2), (2, 3)], [2, 0, 1], ['0.geojson', '1.geojson'])
+        self.assertEqual(scores, {'sub_region_scores': [None, None, None]})
+
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_score_in_worker_sends_profile(self, mock_calculator):
+        # Arrange
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.5
+        mock_calculator.return_value.count_sub_regions.return_value = 3
+        mock_calculator.return_value.calculate_score.return_value = {'features': []}
+        call = MagicMock(return_value=None)
+        spec = {'job_id': '1234', 'timeout': 0, 'calculator': {'output_path': DOWNLOAD_PATH, 'zip_file': 'osw.zip',
+                                                               'job_id': '1234'},
+                'checkpoint': None, 'progressive': False, 'cached_dataset': None, 'shard': None, 'profile_top': 5}
+
+        # Act
+        score_in_worker(spec, call=call)
+
+        # Assert
+        name, exported = call.call_args.args
+        self.assertEqual(name, 'profile')
+        self.assertIn('stats', exported)
+        self.assertIn('peak_bytes', exported)
+
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_calculate_confidence_reuses_cached_dataset(self, mock_calculator):
+        # Arrange
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.get_remote_file = MagicMock(return_value=RemoteFile('', size=0, version='etag-1'))
+        self.service.download_single_file = MagicMock(
+            side_effect=lambda remote_url, local_path, file=None: Path(local_path).write_text('data'))
+        self.service.dataset_cache = DatasetCache(root=os.path.join(DOWNLOAD_PATH, 'cache'), max_bytes=1024)
+        self.addCleanup(shutil.rmtree, os.path.join(DOWNLOAD_PATH, 'cache'), True)
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.0
+        mock_calculator.return_value.count_sub_regions.return_value = 0
+        mock_calculator.return_value.calculate_score.return_value = {'type': 'FeatureCollection', 'features': []}
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=dict(self.sample_message['data'], sub_regions_file=None))
+
+        # Act
+        self.service.calculate_confidence(request_msg)
+        self.service.calculate_confidence(request_msg)
+
+        # Assert
+        self.service.download_single_file.assert_called_once()
+        self.assertTrue(mock_calculator.call_args.kwargs['cached_dataset'].hit)
+        self.assertEqual(self.service.dataset_cache.stats()['hits'], 1)
+
+    @patch('src.service.osw_confidence_service.JobCheckpoint')
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_calculate_confidence_with_checkpoint(self, mock_calculator, mock_checkpoint):
+        # Arrange
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.download_single_file = MagicMock()
+        self.service.get_remote_file = MagicMock(return_value=RemoteFile('', size=0))
+        self.service.checkpoint_store = MagicMock()
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.0
+        mock_calculator.return_value.count_sub_regions.return_value = 1
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=self.sample_message['data'])
+
+        # Act
+        self.service.calculate_confidence(request_msg)
+
+        # Assert
+        mock_checkpoint.return_value.load.assert_called_once()
+        self.assertIs(mock_calculator.call_args.kwargs['checkpoint'], mock_checkpoint.return_value)
+        mock_checkpoint.return_value.discard.assert_called_once()
+
+    @patch('src.service.osw_confidence_service.ProgressReporter')
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_calculate_confidence_progressive(self, mock_calculator, mock_reporter):
+        # Arrange
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.download_single_file = MagicMock()
+        self.service.get_remote_file = MagicMock(return_value=RemoteFile('', size=0))
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.0
+        mock_calculator.return_value.count_sub_regions.return_value = 1
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data={**self.sample_message['data'], 'progressive': True})
+
+        # Act
+        self.service.calculate_confidence(request_msg)
+
+        # Assert
+        mock_reporter.return_value.start.assert_called_once()
+        mock_reporter.return_value.stop.assert_called_once()
+        self.assertIs(mock_calculator.call_args.kwargs['progress_reporter'], mock_reporter.return_value)
+        self.assertEqual(self.service.send_response_message.call_args.kwargs['response'].data.progress, 1.0)
+
+    def test_send_progress_message(self):
+        self.service.send_response_message = MagicMock()
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=self.sample_message['data'])
+
+        self.service.send_progress_message(request_msg, 0.25, {'type': 'FeatureCollection', 'features': []})
+
+        response = self.service.send_response_message.call_args.kwargs['response']
+        self.assertEqual(response.data.status, 'in-progress')
+        self.assertEqual(response.data.progress, 0.25)
+        self.assertTrue(response.data.success)
+
+    @patch('src.service.job_workspace.clean_up')
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_calculate_confidence_times_out(self, mock_calculator, mock_clean_up):
+        # Arrange
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.settings.job_timeout = 0.2
+        self.service.download_single_file = MagicMock()
+        self.service.get_remote_file = MagicMock(return_value=RemoteFile('', size=0))
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.0
+        mock_calculator.return_value.count_sub_regions.return_value = 1
+        release = threading.Event()
+        mock_calculator.return_value.calculate_score.side_effect = lambda: release.wait(5)
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=self.sample_message['data'])
+
+        # Act
+        started = time.monotonic()
+        self.service.calculate_confidence(request_msg)
+        release.set()
+
+        # Assert
+        self.assertLess(time.monotonic() - started, 3)
+        response = self.service.send_response_message.call_args.kwargs['response']
+        self.assertFalse(response.data.success)
+        self.assertIn('timed out', response.data.message)
+        self.assertTrue(mock_clean_up.call_args.kwargs['path'].endswith('1234'))
+        self.assertNotIn('1234', self.service.jobs)
+
+    @patch('src.service.job_workspace.clean_up')
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_cancel_job(self, mock_calculator, mock_clean_up):
+        # Arrange
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.download_single_file = MagicMock()
+        self.service.get_remote_file = MagicMock(return_value=RemoteFile('', size=0))
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.0
+        mock_calculator.return_value.count_sub_regions.return_value = 1
+        running, release = threading.Event(), threading.Event()
+        mock_calculator.return_value.calculate_score.side_effect = lambda: running.set() or release.wait(5)
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=self.sample_message['data'])
+        worker = threading.Thread(target=self.service.calculate_confidence, args=(request_msg,))
+
+        # Act
+        worker.start()
+        running.wait(5)
+        cancelled = self.service.cancel_job('1234')
+        worker.join(5)
+        release.set()
+
+        # Assert
+        self.assertTrue(cancelled)
+        self.assertFalse(worker.is_alive())
+        response = self.service.send_response_message.call_args.kwargs['response']
+        self.assertFalse(response.data.success)
+        self.assertIn('cancelled', response.data.message)
+        self.assertFalse(self.service.cancel_job('1234'))
+
+    @patch('src.service.job_workspace.clean_up')
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_cancel_job_waiting_for_its_slot(self, mock_calculator, mock_clean_up):
+        # Arrange
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.download_single_file = MagicMock()
+        self.service.get_remote_file = MagicMock(return_value=RemoteFile('', size=0))
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.0
+        mock_calculator.return_value.count_sub_regions.return_value = 1
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=self.sample_message['data'])
+        self.service.scheduler = JobScheduler(small_job_cost=50, fast_lane_size=1, slow_lane_size=1)
+        lanes = (self.service.scheduler.fast_lane, self.service.scheduler.slow_lane)
+        worker = threading.Thread(target=self.service.calculate_confidence, args=(request_msg,))
+
+        # Act
+        with lanes[0].slot(0), lanes[1].slot(0):
+            worker.start()
+            for _ in range(100):
+                if any(lane.waiting for lane in lanes):
+                    break
+                time.sleep(0.01)
+            self.service.cancel_job('1234')
+            worker.join(5)
+
+            # Assert
+            self.assertFalse(worker.is_alive())
+            self.assertEqual([lane.waiting for lane in lanes], [[], []])
+        mock_calculator.return_value.calculate_score.assert_not_called()
+        response = self.service.send_response_message.call_args.kwargs['response']
+        self.assertFalse(response.data.success)
+        self.assertIn('cancelled', response.data.message)
+
+    @patch('src.service.job_workspace.clean_up')
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_cancelled_job_keeps_slot_until_stopped(self, mock_calculator, mock_clean_up):
+        # Arrange
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.download_single_file = MagicMock()
+        self.service.get_remote_file = MagicMock(return_value=RemoteFile('', size=0))
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.0
+        mock_calculator.return_value.count_sub_regions.return_value = 1
+        running, release, stopped = threading.Event(), threading.Event(), threading.Event()
+        mock_calculator.return_value.calculate_score.side_effect = lambda: running.set() or release.wait(5)
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=self.sample_message['data'])
+        worker = threading.Thread(target=self.service.calculate_confidence, args=(request_msg,))
+        lanes = (self.service.scheduler.fast_lane, self.service.scheduler.slow_lane)
+
+        # Act
+        worker.start()
+        running.wait(5)
+        self.service.cancel_job('1234')
+        worker.join(5)
+        active_after_cancel = sum(lane.active for lane in lanes)
+        release.set()
+        for _ in range(50):
+            if sum(lane.active for lane in lanes) == 0:
+                stopped.set()
+                break
+            time.sleep(0.05)
+
+        # Assert
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(active_after_cancel, 1)
+        self.assertTrue(stopped.is_set())
+
+    def test_get_remote_file(self):
+        file = MagicMock()
+        file.blob_client.get_blob_properties.return_value.size = 2048
+        file.blob_client.get_blob_properties.return_value.etag = '"etag-1"'
+        self.service.storage_client.get_file_from_url.return_value = file
+
+        remote_file = self.service.get_remote_file('https://example.com/osw/file.zip')
+
+        self.assertEqual((remote_file.file, remote_file.size, remote_file.version), (file, 2048, '"etag-1"'))
+        file.blob_client.get_blob_properties.assert_called_once_with()
+
+    def test_find_remote_file_on_azure_skips_the_listing(self):
+        storage_client = MagicMock(spec=AzureStorageClient)
+        storage_client.get_container_info.side_effect = lambda url: (url.split('/')[3], '/'.join(url.split('/')[4:]))
+        self.service.storage_client = storage_client
+
+        file = self.service.find_remote_file('https://account.blob.core.windows.net/osw/jobs/my%20file.zip')
+
+        storage_client.get_file.assert_called_once_with(self.service.settings.storage_container_name,
+                                                        'jobs/my file.zip')
+        storage_client.get_file_from_url.assert_not_called()
+        self.assertIs(file, storage_client.get_file.return_value)
+
+    def test_get_remote_file_unavailable(self):
+        self.service.storage_client.get_file_from_url.side_effect = Exception('Mock Error')
+
+        remote_file = self.service.get_remote_file('https://example.com/osw/file.zip')
+
+        self.assertEqual((remote_file.file, remote_file.size, remote_file.version), (None, 0, None))
+
+    def test_job_lists_the_container_once(self):
+        # Arrange
+        file = MagicMock()
+        file.file_path = 'osw/file.zip'
+        file.get_stream.return_value = b'data'
+        file.blob_client.get_blob_properties.return_value.size = 4
+        self.service.storage_client.get_file_from_url = MagicMock(return_value=file)
+        self.service.dataset_cache = DatasetCache(root=os.path.join(DOWNLOAD_PATH, 'cache'), max_bytes=1024)
+        self.addCleanup(shutil.rmtree, os.path.join(DOWNLOAD_PATH, 'cache'), True)
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=dict(self.sample_message['data'], sub_regions_file=None))
+        job = self.service.start_job(request_msg)
+
+        # Act
+        self.service.admit_job(job)
+        self.service.download_job_inputs(job)
+        self.service.workspaces.release(job.workspace)
+
+        # Assert
+        self.service.storage_client.get_file_from_url.assert_called_once()
+        file.blob_client.get_blob_properties.assert_called_once_with()
+        self.assertEqual(job.zip_size, 4)
 
     @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
     def test_calculate_confidence_without_simulation_exception(self, mock_calculator):
@@ -301,6 +884,107 @@ class TestOSWConfidenceServiceOther(unittest.TestCase):
         # Assert
         self.service.send_response_message.assert_called_once()
 
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_calculate_confidence_removes_workspace_on_failure(self, mock_calculator):
+        # Arrange
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.get_remote_file = MagicMock(return_value=RemoteFile('', size=0))
+        self.service.download_single_file = MagicMock(
+            side_effect=lambda remote_url, local_path, file=None: Path(local_path).write_text('data'))
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.0
+        mock_calculator.return_value.count_sub_regions.return_value = 1
+        mock_calculator.return_value.calculate_score.side_effect = Exception('Mocked exception')
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=self.sample_message['data'])
+
+        # Act
+        self.service.calculate_confidence(request_msg)
+
+        # Assert
+        self.assertFalse(self.service.send_response_message.call_args.kwargs['response'].data.success)
+        self.assertFalse(os.path.exists(os.path.join(DOWNLOAD_PATH, '1234')))
+        self.assertEqual(self.service.workspaces.usage()['active_jobs'], 0)
+
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_calculate_confidence_rejects_job_over_disk_quota(self, mock_calculator):
+        # Arrange
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.download_single_file = MagicMock()
+        self.service.get_remote_file = MagicMock(return_value=RemoteFile('', size=10 * 1024 * 1024))
+        self.service.workspaces = WorkspaceManager(root=DOWNLOAD_PATH, quota_bytes=20 * 1024 * 1024)
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=self.sample_message['data'])
+
+        # Act
+        self.service.calculate_confidence(request_msg)
+
+        # Assert
+        response = self.service.send_response_message.call_args.kwargs['response']
+        self.assertFalse(response.data.success)
+        self.assertIn('disk quota', response.data.message)
+        self.service.download_single_file.assert_not_called()
+        mock_calculator.assert_not_called()
+
+    @patch('src.service.osw_confidence_service.OSWConfidenceMetricCalculator')
+    def test_calculate_confidence_profiled(self, mock_calculator):
+        # Arrange
+        self.service.send_response_message = MagicMock()
+        self.service.settings.is_simulated = MagicMock(return_value=False)
+        self.service.download_single_file = MagicMock()
+        self.service.get_remote_file = MagicMock(return_value=RemoteFile('', size=0))
+        self.service.save_profile = MagicMock()
+        mock_calculator.return_value.get_hull_area_km2.return_value = 1.0
+        mock_calculator.return_value.count_sub_regions.return_value = 1
+        mock_calculator.return_value.calculate_score.side_effect = busy_score
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data={**self.sample_message['data'], 'profile': True})
+
+        # Act
+        self.service.calculate_confidence(request_msg)
+
+        # Assert
+        profiler = self.service.save_profile.call_args.args[0]
+        self.assertEqual(profiler.job_id, '1234')
+        self.assertTrue(any(function == 'busy_score' for _, _, function in profiler.stats().stats))
+
+    @patch('src.service.osw_confidence_service.JobProfiler')
+    def test_calculate_confidence_not_profiled_by_default(self, mock_profiler):
+        self.service.send_response_message = MagicMock()
+        request_msg = ConfidenceRequest(messageType=self.sample_message['messageType'],
+                                        messageId=self.sample_message['messageId'],
+                                        data=self.sample_message['data'])
+
+        self.service.calculate_confidence(request_msg)
+
+        mock_profiler.assert_not_called()
+
+    def test_save_profile_removes_old_local_profiles(self):
+        self.service.settings.profile_store = 'local'
+        self.service.settings.profile_retention = 60
+        profiles = os.path.join(DOWNLOAD_PATH, 'profiles')
+        os.makedirs(os.path.join(profiles, 'old'), exist_ok=True)
+        self.addCleanup(shutil.rmtree, profiles, True)
+        old = time.time() - 120
+        os.utime(os.path.join(profiles, 'old'), (old, old))
+
+        self.service.save_profile(JobProfiler('job'))
+
+        self.assertEqual(os.listdir(profiles), ['job'])
+
+    def test_save_profile_to_blob(self):
+        self.service.settings.profile_store = 'blob'
+        profiler = MagicMock()
+
+        self.service.save_profile(profiler)
+
+        profiler.upload.assert_called_once_with(self.service.storage_client, 'test_container')
+        profiler.save.assert_not_called()
+
     @patch('src.service.osw_confidence_service.threading.Thread')
     def test_stop_listening(self, mock_thread):
         # Arrange
@@ -0,0 +1,49 @@
+import time
+import unittest
+from unittest.mock import MagicMock
+from src.service.progress_reporter import ProgressReporter
+
+
+class TestProgressReporter(unittest.TestCase):
+
+    def test_publishes_every_n(self):
+        publish = MagicMock()
+        reporter = ProgressReporter(publish=publish, every=2, interval=0)
+
+        for completed in range(1, 6):
+            reporter.update(completed, 5, lambda: {'completed': True})
+
+        # The last sub-region is left to the final response
+        self.assertEqual([call.args[0] for call in publish.call_args_list], [0.4, 0.8])
+
+    def test_snapshot_only_built_when_publishing(self):
+        snapshot_fn = MagicMock(return_value={})
+        reporter = ProgressReporter(publish=MagicMock(), every=10, interval=0)
+
+        reporter.update(1, 20, snapshot_fn)
+
+        snapshot_fn.assert_not_called()
+
+    def test_publishes_on_interval(self):
+        publish = MagicMock()
+        reporter = ProgressReporter(publish=publish, every=0, interval=0.05)
+        reporter.update(1, 10, lambda: {'features': []})
+
+        reporter.start()
+        time.sleep(0.2)
+        reporter.stop()
+
+        self.assertGreaterEqual(publish.call_count, 1)
+        publish.assert_called_with(0.1, {'features': []})
+
+    def test_publish_errors_are_logged(self):
+        publish = MagicMock(side_effect=Exception('Mock Error'))
+        reporter = ProgressReporter(publish=publish, every=1, interval=0)
+
+        reporter.update(1, 2, lambda: {})
+
+        publish.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import os
+import time
+import tempfile
+import unittest
+import threading
+import multiprocessing
+from src.service.single_flight import SingleFlight, LRUCache, DiskCache
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_calls_share_result(self):
+        flight = SingleFlight()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.05)
+            return {'value': 1}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', fetch))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(flight.in_flight, {})
+
+    def test_exception_is_shared_and_not_cached(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            flight.do('key', fail)
+        self.assertEqual(flight.do('key', lambda: 2), 2)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_disabled(self):
+        cache = LRUCache(maxsize=0)
+        cache.set('a', 1)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.misses, 1)
+
+
+def fetch_in_process(folder, key, value):
+    DiskCache(folder).get_or_fetch(key, lambda: value)
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.cache = DiskCache(self.folder.name, ttl=60)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_get_or_fetch_caches(self):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return {'version': 1}
+
+        self.assertEqual(self.cache.get_or_fetch(('way', 1), fetch), {'version': 1})
+        self.assertEqual(DiskCache(self.folder.name).get_or_fetch(('way', 1), fetch), {'version': 1})
+        self.assertEqual(len(calls), 1)
+
+    def test_value_fetched_in_other_process(self):
+        process = multiprocessing.get_context('spawn').Process(
+            target=fetch_in_process, args=(self.folder.name, ('way', 2), {'version': 2}))
+        process.start()
+        process.join(timeout=60)
+
+        self.assertEqual(self.cache.get(('way', 2)), {'version': 2})
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_expired_entry_is_fetched_again(self):
+        self.cache.set('key', 1)
+        old = time.time() - 120
+        os.utime(self.cache.path('key'), (old, old))
+
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.get_or_fetch('key', lambda: 2), 2)
+
+    def test_concurrent_fetches_share_lock(self):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'value'
+
+        caches = [DiskCache(self.folder.name, ttl=60) for _ in range(4)]
+        threads = [threading.Thread(target=cache.get_or_fetch, args=('key', fetch)) for cache in caches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+
+    def test_prune(self):
+        self.cache.set('old', 1)
+        self.cache.set('new', 2)
+        old = time.time() - 120
+        os.utime(self.cache.path('old'), (old, old))
+
+        self.assertEqual(self.cache.prune(), 1)
+        self.assertEqual(self.cache.prune(), 0)
+        self.assertFalse(os.path.exists(self.cache.path('old')))
+        self.assertEqual(self.cache.get('new'), 2)
+
+    def test_evicts_least_recently_used_past_max_bytes(self):
+        cache = DiskCache(self.folder.name, ttl=60, max_bytes=2500)
+        now = time.time()
+        for index, key in enumerate(['a', 'b', 'c']):
+            self.cache.set(key, b'x' * 1000)
+            os.utime(cache.path(key), (now - 30 + index, now - 30 + index))
+        # Reading 'a' makes 'b' the least recently used
+        self.assertEqual(cache.get('a'), b'x' * 1000)
+
+        self.assertEqual(cache.evict(), 1)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_set_keeps_folder_under_max_bytes(self):
+        cache = DiskCache(self.folder.name, ttl=60, max_bytes=5000)
+        for index in range(20):
+            cache.set(index, b'x' * 1000)
+
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(self.folder.name) for name in names)
+        self.assertLessEqual(size, 5000 + 1100)
+        self.assertIsNotNone(cache.get(19))
+
+
+if __name__ == '__main__':
+    unittest.main()
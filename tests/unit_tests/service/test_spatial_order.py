@@ -0,0 +1,52 @@
+import unittest
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Point, Polygon
+from src.service.spatial_order import hilbert_keys, z_order_keys, locality_order
+
+
+def grid(bits: int):
+    side = 1 << bits
+    x, y = np.meshgrid(np.arange(side), np.arange(side))
+    return x.ravel(), y.ravel()
+
+
+class TestSpatialOrder(unittest.TestCase):
+
+    def test_hilbert_curve_visits_neighbouring_cells(self):
+        x, y = grid(3)
+        keys = hilbert_keys(x, y, 3)
+
+        self.assertEqual(sorted(keys.tolist()), list(range(64)))
+        path = np.argsort(keys)
+        steps = np.abs(np.diff(x[path])) + np.abs(np.diff(y[path]))
+        self.assertTrue((steps == 1).all())
+
+    def test_z_order_interleaves_bits(self):
+        self.assertEqual(z_order_keys(np.array([0, 1, 0, 1, 2]), np.array([0, 0, 1, 1, 0]), 2).tolist(),
+                         [0, 1, 2, 3, 4])
+
+    def test_groups_nearby_geometries(self):
+        geometries = gpd.GeoSeries([Point(x, x % 3) for x in (0, 100, 1, 101, 2, 102)])
+
+        for method in ('hilbert', 'zorder'):
+            order = locality_order(geometries, method=method)
+            self.assertEqual(sorted(order[:3].tolist()) in ([0, 2, 4], [1, 3, 5]), True, method)
+
+    def test_file_order(self):
+        geometries = gpd.GeoSeries([Point(100, 0), Point(0, 0), Point(50, 0)])
+
+        self.assertEqual(locality_order(geometries, method='file').tolist(), [0, 1, 2])
+
+    def test_empty_geometries_go_last(self):
+        geometries = gpd.GeoSeries([Polygon(), Point(0, 0), None, Point(1, 1)])
+
+        self.assertEqual(sorted(locality_order(geometries).tolist()[:2]), [1, 3])
+
+    def test_rejects_unknown_order(self):
+        with self.assertRaises(ValueError):
+            locality_order(gpd.GeoSeries([Point(0, 0)] * 3), method='random')
+
+
+if __name__ == '__main__':
+    unittest.main()
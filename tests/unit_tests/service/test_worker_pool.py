@@ -0,0 +1,118 @@
+import os
+import time
+import unittest
+import threading
+from src.service.job_cancellation import CancellationToken, JobCancelledError
+from src.service.worker_pool import WorkerPool, WorkerCrashedError
+
+
+def add(a, b, call):
+    return a + b
+
+
+def ask_parent(value, call):
+    return call('double', value) + 1
+
+
+def fail(call):
+    raise ValueError('bad input')
+
+
+def sleep(seconds, call):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def crash(call):
+    os._exit(3)
+
+
+def grow_memory(mb, call):
+    return len(bytearray(mb * 1024 * 1024))
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def pool(self, **kwargs) -> WorkerPool:
+        pool = WorkerPool(size=kwargs.pop('size', 1), preload=('json',), poll_interval=0.05, **kwargs)
+        self.addCleanup(pool.stop)
+        return pool
+
+    def pids(self, pool: WorkerPool):
+        return [worker['pid'] for worker in pool.stats()['workers']]
+
+    def test_runs_job_in_worker(self):
+        pool = self.pool()
+
+        self.assertEqual(pool.run(add, (2, 3)), 5)
+        self.assertNotEqual(pool.run(sleep, (0,)), os.getpid())
+
+    def test_job_calls_parent(self):
+        pool = self.pool()
+
+        self.assertEqual(pool.run(ask_parent, (4,), on_call=lambda name, value: value * 2), 9)
+
+    def test_job_error_keeps_worker(self):
+        pool = self.pool()
+        pids = self.pids(pool)
+
+        with self.assertRaisesRegex(ValueError, 'bad input'):
+            pool.run(fail)
+
+        self.assertEqual(self.pids(pool), pids)
+        self.assertEqual(pool.run(add, (1, 1)), 2)
+
+    def test_recycles_after_max_jobs(self):
+        pool = self.pool(max_jobs=2)
+
+        first = pool.run(sleep, (0,))
+        self.assertEqual(pool.run(sleep, (0,)), first)
+        third = pool.run(sleep, (0,))
+
+        self.assertNotEqual(third, first)
+        self.assertEqual(pool.stats()['recycled'], 1)
+
+    def test_recycles_above_memory_limit(self):
+        pool = self.pool(max_rss_mb=1)
+
+        first = pool.run(sleep, (0,))
+
+        self.assertNotEqual(pool.run(sleep, (0,)), first)
+        self.assertGreater(pool.stats()['recycled'], 0)
+
+    def test_cancellation_kills_worker(self):
+        pool = self.pool()
+        token = CancellationToken('job')
+        threading.Timer(0.2, token.cancel, args=('cancelled by request',)).start()
+        started = time.monotonic()
+
+        with self.assertRaises(JobCancelledError):
+            pool.run(sleep, (30,), token=token)
+
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(pool.run(add, (1, 2)), 3)
+        self.assertEqual(pool.stats()['recycled'], 1)
+
+    def test_crashed_worker_fails_its_job_only(self):
+        pool = self.pool()
+
+        with self.assertRaises(WorkerCrashedError):
+            pool.run(crash)
+
+        self.assertEqual(pool.run(grow_memory, (1,)), 1024 * 1024)
+        self.assertEqual(pool.stats()['crashed'], 1)
+
+    def test_concurrent_jobs_use_all_workers(self):
+        pool = self.pool(size=2)
+        pids = []
+        threads = [threading.Thread(target=lambda: pids.append(pool.run(sleep, (0.3,)))) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(pids)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,10 @@
 import unittest
+from unittest.mock import MagicMock, patch
 from fastapi import status
 from fastapi.testclient import TestClient
 from src.main import app, get_settings
+from src.service.inline_scoring import InlineRequestError, ScoringBusyError
+from src.service.job_cancellation import JobTimeoutError
 
 
 class TestApp(unittest.TestCase):
@@ -13,6 +16,99 @@ class TestApp(unittest.TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.text.strip('\"'), "I'm healthy !!")
 
+    def test_cancel_job(self):
+        service = MagicMock()
+        service.cancel_job.return_value = True
+        with patch.object(app, 'confidence_service', service):
+            response = self.client.post('/admin/jobs/1234/cancel')
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.json(), {'jobId': '1234', 'status': 'cancelling'})
+        service.cancel_job.assert_called_once_with('1234')
+
+    def test_cancel_unknown_job(self):
+        service = MagicMock()
+        service.cancel_job.return_value = False
+        with patch.object(app, 'confidence_service', service):
+            response = self.client.post('/admin/jobs/1234/cancel')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_disk_usage(self):
+        service = MagicMock()
+        service.workspaces.usage.return_value = {'used_bytes': 10, 'reserved_bytes': 40, 'free_bytes': 100,
+                                                 'quota_bytes': 0, 'active_jobs': 1, 'in_memory_jobs': 0}
+        with patch.object(app, 'confidence_service', service):
+            response = self.client.get('/health/disk')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['reserved_bytes'], 40)
+
+    def test_disk_usage_without_service(self):
+        with patch.object(app, 'confidence_service', None):
+            response = self.client.get('/health/disk')
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_dataset_cache_stats(self):
+        service = MagicMock()
+        service.dataset_cache.stats.return_value = {'enabled': True, 'hits': 3, 'misses': 1, 'hit_rate': 0.75}
+        with patch.object(app, 'confidence_service', service):
+            response = self.client.get('/health/cache')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['hit_rate'], 0.75)
+
+    def test_worker_pool_stats(self):
+        service = MagicMock()
+        service.workers.stats.return_value = {'size': 2, 'jobs': 5, 'recycled': 1, 'crashed': 0, 'workers': []}
+        with patch.object(app, 'confidence_service', service):
+            response = self.client.get('/health/workers')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['recycled'], 1)
+
+    def test_worker_pool_stats_without_pool(self):
+        service = MagicMock(workers=None)
+        with patch.object(app, 'confidence_service', service):
+            response = self.client.get('/health/workers')
+
+        self.assertEqual(response.json(), {'size': 0})
+
+    def test_score_confidence(self):
+        service = MagicMock()
+        service.inline.should_stream.return_value = False
+        service.inline.score.return_value = {'type': 'FeatureCollection', 'features': []}
+        with patch.object(app, 'confidence_service', service):
+            response = self.client.post('/confidence', json={'type': 'Polygon', 'coordinates': []})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'type': 'FeatureCollection', 'features': []})
+        service.inline.parse.assert_called_once_with({'type': 'Polygon', 'coordinates': []})
+
+    def test_score_confidence_streams(self):
+        service = MagicMock()
+        service.inline.should_stream.return_value = True
+        service.inline.stream.return_value = iter(['{"id": "0"}\n', '{"id": "1"}\n'])
+        with patch.object(app, 'confidence_service', service):
+            response = self.client.post('/confidence', json={'type': 'FeatureCollection', 'features': []})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.headers['content-type'].startswith('application/x-ndjson'))
+        self.assertEqual(response.text.splitlines(), ['{"id": "0"}', '{"id": "1"}'])
+
+    def test_score_confidence_errors(self):
+        for error, code in [(InlineRequestError('bad'), status.HTTP_400_BAD_REQUEST),
+                            (ScoringBusyError('busy'), status.HTTP_429_TOO_MANY_REQUESTS),
+                            (JobTimeoutError('slow'), status.HTTP_504_GATEWAY_TIMEOUT)]:
+            service = MagicMock()
+            service.inline.should_stream.return_value = False
+            service.inline.score.side_effect = error
+            with patch.object(app, 'confidence_service', service):
+                response = self.client.post('/confidence', json={'type': 'Polygon', 'coordinates': []})
+
+            self.assertEqual(response.status_code, code)
+
     def test_get_settings(self):
         settings = get_settings()
         self.assertIsNotNone(settings)